@@ -0,0 +1,11 @@
+"""
+Micro-benchmarks for the Cython kernels of raypier.core.
+
+The benchmarks are written in the style of airspeed velocity (asv): each class
+has a setup() method and time_* methods, parameterised by its params and
+param_names. They can be run with asv (see asv.conf.json), or without it using
+the runner in this package, which keeps baselines and reports regressions::
+
+    python -m benchmarks.run_benchmarks --save baseline
+    python -m benchmarks.run_benchmarks --compare baseline --threshold 1.2
+"""
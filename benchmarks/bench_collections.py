@@ -0,0 +1,46 @@
+"""
+Benchmarks of the RayCollection accessors.
+"""
+
+from raypier.core.ctracer import RayCollection
+
+from .common import make_rays
+
+
+class RayCollectionAccessors(object):
+    params = [1000, 100000]
+    param_names = ("n_rays",)
+
+    def setup(self, n_rays):
+        self.rays = make_rays(n_rays)
+        self.data = self.rays.copy_as_array()
+
+    def time_as_array(self, n_rays):
+        self.rays.as_array()
+
+    def time_copy_as_array(self, n_rays):
+        self.rays.copy_as_array()
+
+    def time_from_array(self, n_rays):
+        RayCollection.from_array(self.data)
+
+    def time_origin(self, n_rays):
+        self.rays.origin
+
+    def time_direction(self, n_rays):
+        self.rays.direction
+
+    def time_E1_amp(self, n_rays):
+        self.rays.E1_amp
+
+    def time_power(self, n_rays):
+        self.rays.power
+
+    def time_getitem(self, n_rays):
+        rays = self.rays
+        for i in range(0, n_rays, max(n_rays//1000, 1)):
+            rays[i]
+
+    def time_iterate(self, n_rays):
+        for ray in self.rays:
+            pass
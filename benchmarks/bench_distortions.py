@@ -0,0 +1,26 @@
+"""
+Benchmarks of ZernikeDistortion.z_offset_and_gradient_c(), called for an
+array of points with Distortion.z_offset_and_gradient().
+"""
+
+import numpy
+
+from raypier.core.cdistortions import ZernikeDistortion
+
+
+class ZernikeOffsetAndGradient(object):
+    #j_max is the highest Zernike term (ANSI index) with a coefficient
+    params = ([10, 45], [1000, 100000])
+    param_names = ("j_max", "n_points")
+
+    def setup(self, j_max, n_points):
+        rng = numpy.random.default_rng(3)
+        coefs = {"j%d"%j: c for j, c in enumerate(rng.normal(0, 1e-3, j_max+1))}
+        self.distortion = ZernikeDistortion(unit_radius=5.0, **coefs)
+        r = 5.0*numpy.sqrt(rng.uniform(0, 1, n_points))
+        theta = rng.uniform(0, 2*numpy.pi, n_points)
+        self.x = r*numpy.cos(theta)
+        self.y = r*numpy.sin(theta)
+
+    def time_z_offset_and_gradient(self, j_max, n_points):
+        self.distortion.z_offset_and_gradient(self.x, self.y)
@@ -0,0 +1,130 @@
+"""
+Benchmarks of Face.intersect_c(), for each face type of raypier.core.cfaces.
+The rays are intersected as a batch with Face.intersect_batch(), which loops
+over intersect_c() (or the face's own batch loop) in C.
+"""
+
+import numpy
+
+from raypier.core import cfaces
+from raypier.core.ctracer import Transform
+from raypier.core.cshapes import CircleShape, RectangleShape
+from raypier.core.cdistortions import ZernikeDistortion
+
+from .common import make_segments
+
+
+def circular():
+    face = cfaces.CircularFace()
+    face.diameter = 8.0
+    return face
+
+
+def shaped_planar():
+    return cfaces.ShapedPlanarFace(shape=CircleShape(radius=4.0))
+
+
+def eliptical_plane():
+    face = cfaces.ElipticalPlaneFace(g_x=0.5, g_y=0.2)
+    face.diameter = 8.0
+    return face
+
+
+def rectangular():
+    return cfaces.RectangularFace(width=6.0, length=6.0)
+
+
+def spherical():
+    face = cfaces.SphericalFace(curvature=15.0)
+    face.diameter = 8.0
+    return face
+
+
+def shaped_spherical():
+    return cfaces.ShapedSphericalFace(curvature=15.0, shape=CircleShape(radius=4.0))
+
+
+def extruded_planar():
+    return cfaces.ExtrudedPlanarFace(x1=-4.0, y1=-4.0, x2=4.0, y2=4.0, z1=-5.0, z2=5.0)
+
+
+def extruded_bezier():
+    curves = numpy.array([[[-4.0,-1.0], [-1.0,-3.0], [1.0,3.0], [4.0,1.0]]])
+    return cfaces.ExtrudedBezierFace(beziercurves=curves, z_height_1=-5.0, z_height_2=5.0)
+
+
+def polygon():
+    return cfaces.PolygonFace(xy_points=[[-4.0,-4.0], [4.0,-3.0], [3.0,4.0], [-3.0,3.0]])
+
+
+def off_axis_parabolic():
+    face = cfaces.OffAxisParabolicFace()
+    #The aperture is centred at x=EFL
+    face.EFL = 2.0
+    face.diameter = 12.0
+    face.height = 10.0
+    return face
+
+
+def ellipsoidal():
+    face = cfaces.EllipsoidalFace()
+    face.major, face.minor = 30.0, 20.0
+    face.x1, face.x2, face.y1, face.y2, face.z1, face.z2 = -5, 5, -5, 5, -25, 0
+    face.transform = Transform()
+    face.inverse_transform = Transform()
+    return face
+
+
+def saddle():
+    return cfaces.SaddleFace(curvature=0.01, shape=RectangleShape(width=8.0, height=8.0))
+
+
+def cylinderical():
+    return cfaces.CylindericalFace(radius=15.0, shape=RectangleShape(width=8.0, height=8.0))
+
+
+def axicon():
+    return cfaces.AxiconFace(gradient=0.2, shape=CircleShape(radius=4.0))
+
+
+def conic_revolution():
+    return cfaces.ConicRevolutionFace(curvature=15.0, conic_const=-0.5,
+                                      shape=CircleShape(radius=4.0))
+
+
+def aspheric():
+    return cfaces.AsphericFace(curvature=-30.0, conic_const=-0.5, A4=1e-5,
+                               shape=CircleShape(radius=4.0))
+
+
+def distortion():
+    base = cfaces.ShapedSphericalFace(curvature=15.0, shape=CircleShape(radius=4.0))
+    return cfaces.DistortionFace(base_face=base,
+                                 distortion=ZernikeDistortion(unit_radius=4.0, j5=0.01, j7=-0.002))
+
+
+#The extruded faces are parallel to z, so are intersected by rays along x
+SIDEWAYS = {'extruded_planar', 'extruded_bezier'}
+
+FACES = {f.__name__: f for f in (circular, shaped_planar, eliptical_plane, rectangular,
+                                 spherical, shaped_spherical, extruded_planar,
+                                 extruded_bezier, polygon, off_axis_parabolic, ellipsoidal,
+                                 saddle, cylinderical, axicon, conic_revolution, aspheric,
+                                 distortion)}
+
+
+class FaceIntersect(object):
+    params = (list(FACES), [1000, 100000])
+    param_names = ("face", "n_rays")
+
+    def setup(self, face, n_rays):
+        self.face = FACES[face]()
+        self.p1, self.p2 = make_segments(n_rays)
+        if face in SIDEWAYS:
+            self.p1, self.p2 = self.p1[:,[2,0,1]], self.p2[:,[2,0,1]]
+
+    def time_intersect(self, face, n_rays):
+        self.face.intersect_batch(self.p1, self.p2, 1)
+
+    def time_intersect_parabasal(self, face, n_rays):
+        self.face.intersect_batch(self.p1, self.p2, 0)
@@ -0,0 +1,92 @@
+"""
+Benchmarks of the Gaussian-mode field kernels of raypier.core.cfields.
+"""
+
+import numpy
+
+from raypier.core.cfields import sum_gaussian_modes, build_interaction_matrix, \
+        evaluate_modes, calc_mode_curvature, sum_gaussian_modes_times
+from raypier.core.gausslets import make_hexagonal_grid
+
+from .common import make_rays
+
+
+class SumGaussianModes(object):
+    params = ([100, 1000], [1000, 10000])
+    param_names = ("n_rays", "n_points")
+
+    def setup(self, n_rays, n_points):
+        self.rays = make_rays(n_rays)
+        self.wavelengths = numpy.asarray(self.rays.wavelengths)
+        #Modes with a 1/e^2 width of about 1mm
+        self.modes = numpy.zeros((n_rays, 3), dtype=numpy.complex128)
+        self.modes[:,0] = self.modes[:,2] = 1j*4000.0
+        rng = numpy.random.default_rng(1)
+        self.points = numpy.column_stack([rng.uniform(-4,4,n_points), rng.uniform(-4,4,n_points),
+                                          numpy.full(n_points, 5.0)])
+
+    def time_sum_gaussian_modes(self, n_rays, n_points):
+        sum_gaussian_modes(self.rays, self.modes, self.wavelengths, self.points, 0.0)
+
+    def time_sum_gaussian_modes_truncated(self, n_rays, n_points):
+        sum_gaussian_modes(self.rays, self.modes, self.wavelengths, self.points, 0.0, 1e-6)
+
+    def time_sum_gaussian_modes_rays(self, n_rays, n_points):
+        sum_gaussian_modes(self.rays, self.modes, self.wavelengths, self.points, 0.0, 0.0, "rays")
+
+
+class SumGaussianModesFewPoints(SumGaussianModes):
+    """Many rays summed at a probe line of few points"""
+    params = ([10000], [16, 256])
+
+    def time_sum_gaussian_modes_tiled(self, n_rays, n_points):
+        sum_gaussian_modes(self.rays, self.modes, self.wavelengths, self.points, 0.0, 0.0, "tiled")
+
+
+class SumGaussianModesTimes(object):
+    """A scan of time delays, as for a temporal-focusing field"""
+    params = ([100], [1000], [20, 200])
+    param_names = ("n_rays", "n_points", "n_times")
+
+    def setup(self, n_rays, n_points, n_times):
+        SumGaussianModes.setup(self, n_rays, n_points)
+        self.times = numpy.linspace(-1.0, 1.0, n_times)
+
+    def time_sum_gaussian_modes_times(self, n_rays, n_points, n_times):
+        sum_gaussian_modes_times(self.rays, self.modes, self.wavelengths, self.points, self.times)
+
+
+class EvaluateModes(object):
+    params = [1000, 100000]
+    param_names = ("n_rays",)
+
+    def setup(self, n_rays):
+        #The six neighbours of each ray, in a slightly distorted hexagonal ring
+        rng = numpy.random.default_rng(2)
+        angle = numpy.arange(6)*numpy.pi/3
+        r = 1.0 + rng.uniform(-0.05, 0.05, (n_rays, 6))
+        self.x = r*numpy.cos(angle)
+        self.y = r*numpy.sin(angle)
+        self.dx = 0.01*self.x + rng.normal(0, 1e-4, (n_rays, 6))
+        self.dy = 0.02*self.y + rng.normal(0, 1e-4, (n_rays, 6))
+
+    def time_evaluate_modes(self, n_rays):
+        evaluate_modes(self.x, self.y, self.dx, self.dy, 1.0)
+
+
+class BuildInteractionMatrix(object):
+    #The decomposition radius, in mm. The modes and test points have a 0.5mm spacing.
+    params = [5.0, 15.0]
+    param_names = ("radius",)
+
+    def setup(self, radius):
+        self.spacing = 0.5
+        self.rx, self.ry = make_hexagonal_grid(radius, spacing=self.spacing)
+        zero = numpy.zeros_like(self.rx)
+        self.A, self.B, self.C, self.x, self.y, self.z = calc_mode_curvature(
+                        self.rx, self.ry, zero, zero, zero, zero, zero)
+
+    def time_build_interaction_matrix(self, radius):
+        build_interaction_matrix(self.rx, self.ry, self.rx, self.ry, self.A, self.B, self.C,
+                                 self.x, self.y, self.z, 1.0, self.spacing, 3*self.spacing,
+                                 1.5, self.spacing)
@@ -0,0 +1,62 @@
+"""
+Benchmarks of InterfaceMaterial.eval_child_ray_c(), for each material of
+raypier.core.cmaterials. The rays are evaluated as a batch with
+InterfaceMaterial.eval_child_rays(), which loops over eval_child_ray_c() in C.
+
+The ResampleGaussletMaterial is not included, as it only captures gausslets.
+"""
+
+import numpy
+
+from raypier.core import cmaterials
+from raypier.core.ctracer import RayCollection
+from raypier.dispersion import NondispersiveCurve
+
+from .common import make_rays
+
+
+MATERIALS = {
+    "opaque": lambda: cmaterials.OpaqueMaterial(),
+    "transparent": lambda: cmaterials.TransparentMaterial(),
+    "pec": lambda: cmaterials.PECMaterial(),
+    "partially_reflective": lambda: cmaterials.PartiallyReflectiveMaterial(reflectivity=0.3),
+    "linear_polarising": lambda: cmaterials.LinearPolarisingMaterial(),
+    "waveplate": lambda: cmaterials.WaveplateMaterial(retardance=0.25, fast_axis=(1,1,0)),
+    "dielectric": lambda: cmaterials.DielectricMaterial(n_inside=1.5),
+    "full_dielectric": lambda: cmaterials.FullDielectricMaterial(n_inside=1.5, n_coating=1.38,
+                                                                 thickness=0.2),
+    "single_layer_coated": lambda: cmaterials.SingleLayerCoatedMaterial(n_inside=1.5,
+                                                                        n_coating=1.38,
+                                                                        thickness=0.2),
+    "coated_dispersive": lambda: cmaterials.CoatedDispersiveMaterial(
+                                    dispersion_inside=NondispersiveCurve(1.5),
+                                    dispersion_coating=NondispersiveCurve(1.38),
+                                    coating_thickness=0.2),
+    "diffraction_grating": lambda: cmaterials.DiffractionGratingMaterial(lines_per_mm=600,
+                                                                         order=1),
+    "circular_aperture": lambda: cmaterials.CircularApertureMaterial(radius=2.0,
+                                                                     outer_radius=5.0),
+    "rectangular_aperture": lambda: cmaterials.RectangularApertureMaterial(width=2.0,
+                                                                           height=3.0),
+    }
+
+
+class MaterialEvalChildRays(object):
+    params = (list(MATERIALS), [1000, 100000])
+    param_names = ("material", "n_rays")
+
+    def setup(self, material, n_rays):
+        self.rays = make_rays(n_rays)
+        self.material = MATERIALS[material]()
+        self.material.wavelengths = numpy.asarray(self.rays.wavelengths)
+        #The rays intersect the plane z=0
+        data = self.rays.as_array()
+        t = -data['origin'][:,2]/data['direction'][:,2]
+        self.points = data['origin'] + t[:,None]*data['direction']
+        self.normals = numpy.tile([0.0,0.0,-1.0], (n_rays,1))
+        self.tangents = numpy.tile([1.0,0.0,0.0], (n_rays,1))
+
+    def time_eval_child_rays(self, material, n_rays):
+        new_rays = RayCollection(2*len(self.rays))
+        self.material.eval_child_rays(self.rays, self.points, self.normals, self.tangents,
+                                      new_rays)
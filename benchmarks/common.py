@@ -0,0 +1,43 @@
+"""
+Inputs shared by the benchmarks.
+"""
+
+import numpy
+
+from raypier.core.ctracer import RayCollection, ray_dtype
+
+
+def make_segments(n_rays, seed=0):
+    """
+    Returns (p1, p2), the (n_rays,3) start- and end-points of rays travelling
+    along +z through the region about the origin, in local face coordinates.
+    """
+    rng = numpy.random.default_rng(seed)
+    p1 = numpy.column_stack([rng.uniform(-4,4,n_rays), rng.uniform(-4,4,n_rays),
+                             numpy.full(n_rays, -20.0)])
+    p2 = p1 + numpy.column_stack([rng.uniform(-0.1,0.1,(n_rays,2)),
+                                  numpy.ones(n_rays)])*40.0
+    return p1, p2
+
+
+def make_rays(n_rays, seed=0):
+    """
+    Returns a RayCollection of n_rays linearly polarised rays, with the
+    directions of make_segments() and a single wavelength.
+    """
+    p1, p2 = make_segments(n_rays, seed)
+    direction = p2 - p1
+    direction /= numpy.sqrt((direction**2).sum(axis=1))[:,None]
+    data = numpy.zeros(n_rays, dtype=ray_dtype)
+    data['origin'] = p1
+    data['direction'] = direction
+    data['normal'] = (0,1,0)
+    data['E_vector'] = numpy.cross(direction, (0,1,0))
+    data['E1_amp'] = 1.0
+    data['E2_amp'] = 0.5j
+    data['refractive_index'] = 1.0
+    data['length'] = 100.0
+    data['parent_idx'] = numpy.arange(n_rays)
+    rays = RayCollection.from_array(data)
+    rays.wavelengths = numpy.array([0.78])
+    return rays
@@ -0,0 +1,212 @@
+"""
+Runs the benchmarks without asv. The results can be saved as a named baseline
+(in benchmarks/baselines), and compared with a saved baseline, reporting each
+benchmark which is slower than the baseline by more than a threshold factor.
+
+Usage::
+
+    python -m benchmarks.run_benchmarks [-k PATTERN] [--save NAME] [--compare NAME]
+                                        [--threshold 1.2] [--repeat 5] [--quick]
+
+The exit status is 1 if any benchmark has regressed.
+"""
+
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import os
+import pkgutil
+import platform
+import sys
+import timeit
+
+import numpy
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+
+class Benchmark(object):
+    """
+    One time_* method of a benchmark class, with one combination of its params.
+    """
+    def __init__(self, cls, method, args, param_names):
+        self.cls = cls
+        self.method = method
+        self.args = args
+        self.name = "%s.%s.%s(%s)"%(cls.__module__.split(".")[-1], cls.__name__, method,
+                                    ", ".join("%s=%s"%(n, a) for n, a in zip(param_names, args)))
+
+    def make_timer(self):
+        """Returns a timeit.Timer for the benchmark, after calling its setup()."""
+        obj = self.cls()
+        if hasattr(obj, "setup"):
+            obj.setup(*self.args)
+        method = getattr(obj, self.method)
+        args = self.args
+        return timeit.Timer(lambda: method(*args))
+
+    def run(self, repeat=5, quick=False):
+        """Returns the best time (in seconds) of a single call of the benchmark."""
+        timer = self.make_timer()
+        if quick:
+            return timer.timeit(1)
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat, number))/number
+
+
+def benchmark_params(cls):
+    """Returns the list of parameter combinations of a benchmark class, and their names."""
+    params = getattr(cls, "params", [])
+    names = list(getattr(cls, "param_names", []))
+    if not names:
+        return [()], []
+    #As for asv, a single parameter may be given as a flat list
+    if len(names) == 1 and not (params and isinstance(params[0], (list, tuple))):
+        params = [params]
+    return list(itertools.product(*params)), names
+
+
+def discover(pattern=None):
+    """
+    Returns the list of Benchmarks of the bench_* modules of this package, with
+    names containing the pattern (if given).
+    """
+    out = []
+    package = os.path.dirname(os.path.abspath(__file__))
+    for info in sorted(pkgutil.iter_modules([package]), key=lambda i: i.name):
+        if not info.name.startswith("bench_"):
+            continue
+        module = importlib.import_module("%s.%s"%(__package__ or "benchmarks", info.name))
+        for name, cls in sorted(vars(module).items()):
+            if not isinstance(cls, type) or cls.__module__ != module.__name__:
+                continue
+            methods = sorted(m for m in dir(cls) if m.startswith("time_"))
+            combinations, names = benchmark_params(cls)
+            for method in methods:
+                for args in combinations:
+                    bench = Benchmark(cls, method, args, names)
+                    if pattern is None or pattern in bench.name:
+                        out.append(bench)
+    return out
+
+
+def run(benchmarks, repeat=5, quick=False, out=None):
+    """
+    Runs the benchmarks, writing each result to out (if given).
+
+    returns - a dict of the time of each benchmark, by name.
+    """
+    results = {}
+    for bench in benchmarks:
+        results[bench.name] = t = bench.run(repeat=repeat, quick=quick)
+        if out is not None:
+            out.write("%-90s %s\n"%(bench.name, format_time(t)))
+            out.flush()
+    return results
+
+
+def format_time(t):
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if t >= scale:
+            return "%7.3f%s"%(t/scale, unit)
+    return "%7.3fns"%(t*1e9)
+
+
+def baseline_path(name):
+    """Returns the file of a named baseline, unless name is already a .json path."""
+    if name.endswith(".json"):
+        return name
+    return os.path.join(BASELINE_DIR, name + ".json")
+
+
+def save_baseline(results, name):
+    data = {"machine": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "results": results}
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    return path
+
+
+def load_baseline(name):
+    with open(baseline_path(name)) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Compares the results with the baseline times. A benchmark has regressed if
+    its time is more than threshold times the baseline, and improved if it is
+    less than the baseline divided by threshold.
+
+    returns - a list of (name, baseline time, time, ratio, status) tuples, where
+            status is 'regressed', 'improved', 'same' or 'new'.
+    """
+    rows = []
+    for name, t in results.items():
+        base = baseline.get(name)
+        if base is None:
+            rows.append((name, None, t, None, "new"))
+            continue
+        ratio = t/base if base > 0 else float("inf")
+        if ratio > threshold:
+            status = "regressed"
+        elif ratio < 1.0/threshold:
+            status = "improved"
+        else:
+            status = "same"
+        rows.append((name, base, t, ratio, status))
+    return rows
+
+
+def format_report(rows, threshold):
+    lines = ["%-90s %10s %10s %7s  %s"%("benchmark", "baseline", "time", "ratio", "")]
+    for name, base, t, ratio, status in rows:
+        lines.append("%-90s %10s %10s %7s  %s"%(name,
+                                               "-" if base is None else format_time(base),
+                                               format_time(t),
+                                               "-" if ratio is None else "%.2f"%ratio,
+                                               "" if status == "same" else status))
+    n = {s: sum(1 for r in rows if r[-1] == s) for s in ("regressed", "improved", "new")}
+    lines.append("%d regressed, %d improved (threshold %.2f), %d new"%(n["regressed"],
+                                                        n["improved"], threshold, n["new"]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the raypier benchmarks")
+    parser.add_argument("-k", dest="pattern", default=None,
+                        help="only run the benchmarks with names containing this")
+    parser.add_argument("--save", default=None, help="save the results as this baseline")
+    parser.add_argument("--compare", default=None, help="compare the results with this baseline")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="the slow-down factor reported as a regression")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="the number of timings to take the best of")
+    parser.add_argument("--quick", action="store_true",
+                        help="time a single call of each benchmark")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.compare) if args.compare else None
+    results = run(discover(args.pattern), repeat=args.repeat, quick=args.quick,
+                  out=sys.stdout)
+    if args.save:
+        print("Saved baseline to %s"%save_baseline(results, args.save))
+    if baseline is not None:
+        rows = compare(results, baseline, args.threshold)
+        print(format_report(rows, args.threshold))
+        if any(r[-1] == "regressed" for r in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
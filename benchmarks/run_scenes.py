@@ -0,0 +1,214 @@
+"""
+End-to-end benchmarks of the example scenes (see scenes.py), run without the GUI.
+
+For each scene, ray density and number of tracing threads, the harness records
+the time to trace all sources, the time spent in decomposition planes, the time
+of each EFieldPlane.evaluate(), the number of rays traced and the peak memory.
+The results are written as a JSON report, which can be compared with the report
+of another build (or thread count) with --compare.
+
+Usage::
+
+    python -m benchmarks.run_scenes [--scenes achromat,cpc] [--densities 1,2,4]
+                                    [--threads 1,2] [--repeat 3] [--output report.json]
+                                    [--compare other.json] [--threshold 1.2]
+
+The peak memory is given as the peak of the memory allocated through Python and
+numpy during the run (traced with tracemalloc, in a separate untimed run), plus
+the memory allocated for the traced ray collections. The process maximum
+resident set size is also recorded, where the platform gives it.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import os
+
+import numpy
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from raypier.fields import EFieldPlane
+
+from .scenes import SCENES
+from . import run_benchmarks
+
+
+#The measurements which are times, as compared between reports
+TIMES = ("trace_time", "decomp_time", "field_time", "probe_time", "total_time")
+
+
+def trace_model(model, num_threads=1):
+    """
+    Traces a RayTraceModel, as for RayTraceModel.do_update() without rendering,
+    and evaluates its probes (the EFieldPlanes last).
+
+    returns - a dict of the times taken, the rays traced and their memory.
+    """
+    model.num_threads = num_threads
+    start = time.perf_counter()
+    model.prepare_to_trace()
+    model.trace_timelines = {}
+    for o in model.optics:
+        o.intersections = []
+    for ray_source in model.sources:
+        model.trace_ray_source(ray_source, model.optics)
+    trace_end = time.perf_counter()
+
+    fields = [p for p in model.probes if isinstance(p, EFieldPlane)]
+    for probe in model.probes:
+        if probe not in fields:
+            probe.evaluate(model.sources)
+    probe_end = time.perf_counter()
+    field_times = []
+    for probe in fields:
+        t = time.perf_counter()
+        probe.evaluate(model.sources)
+        field_times.append(time.perf_counter() - t)
+    end = time.perf_counter()
+
+    timelines = list(model.trace_timelines.values())
+    return {"trace_time": trace_end - start,
+            "decomp_time": sum(t.decomp_time for t in timelines),
+            "field_time": sum(field_times),
+            "field_times": field_times,
+            "probe_time": probe_end - trace_end,
+            "total_time": end - start,
+            "n_rays": sum(t.n_rays for t in timelines),
+            "n_generations": max([len(t.generations) for t in timelines] or [0]),
+            "ray_bytes": sum(t.allocated_bytes for t in timelines)}
+
+
+def measure(scene, density, num_threads=1, repeat=1):
+    """
+    Runs a scene (a name in scenes.SCENES) at the given density. The times are
+    the best of repeat runs, each with a new model. The memory is measured in
+    one more run.
+    """
+    make_model = SCENES[scene]
+    runs = [trace_model(make_model(density), num_threads) for i in range(repeat)]
+    result = {"scene": scene, "density": density, "num_threads": num_threads}
+    result.update(runs[0])
+    for name in TIMES:
+        result[name] = min(r[name] for r in runs)
+
+    model = make_model(density)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        trace_model(model, num_threads)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result["peak_python_bytes"] = peak
+    result["peak_bytes"] = peak + result["ray_bytes"]
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Linux gives the maximum RSS in kB, macOS in bytes
+        result["max_rss_bytes"] = rss if sys.platform == "darwin" else rss*1024
+    return result
+
+
+def build_info():
+    """Returns a dict describing the build and machine the benchmarks ran on."""
+    info = {"machine": platform.node(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "date": datetime.datetime.now().isoformat(timespec="seconds")}
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        info["git_revision"] = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                                       cwd=root, stderr=subprocess.DEVNULL,
+                                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def result_key(result):
+    return "%s(density=%s, num_threads=%d)"%(result["scene"], result["density"],
+                                            result["num_threads"])
+
+
+def flatten_times(report):
+    """Returns a dict of the times of a report, by scene and measurement name."""
+    return {"%s.%s"%(result_key(r), name): r[name] for r in report["results"]
+            for name in TIMES}
+
+
+def run(scenes, densities, threads, repeat=1, label=None, out=None):
+    """
+    Runs each scene at each density and number of threads.
+
+    returns - the report, as a dict of the build info and the list of results.
+    """
+    report = {"label": label, "build": build_info(), "results": []}
+    for scene in scenes:
+        for density in densities:
+            for num_threads in threads:
+                result = measure(scene, density, num_threads, repeat)
+                report["results"].append(result)
+                if out is not None:
+                    out.write("%-55s rays %8d  trace %9s  decomp %9s  field %9s  peak %6.1fMB\n"%(
+                              result_key(result), result["n_rays"],
+                              run_benchmarks.format_time(result["trace_time"]),
+                              run_benchmarks.format_time(result["decomp_time"]),
+                              run_benchmarks.format_time(result["field_time"]),
+                              result["peak_bytes"]/2**20))
+                    out.flush()
+    return report
+
+
+def parse_list(text, type=str):
+    return [type(v) for v in text.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the end-to-end scene benchmarks")
+    parser.add_argument("--scenes", default=",".join(SCENES),
+                        help="comma-separated scene names (default, all)")
+    parser.add_argument("--densities", default="1,2,4", help="comma-separated ray densities")
+    parser.add_argument("--threads", default="1", help="comma-separated thread counts")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="the number of runs to take the best times of")
+    parser.add_argument("--label", default=None, help="a label for the report")
+    parser.add_argument("--output", default=None, help="write the JSON report to this file")
+    parser.add_argument("--compare", default=None,
+                        help="compare the times with those of this JSON report")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="the slow-down factor reported as a regression")
+    args = parser.parse_args(argv)
+
+    scenes = parse_list(args.scenes)
+    unknown = set(scenes) - set(SCENES)
+    if unknown:
+        parser.error("Unknown scenes: %s"%", ".join(sorted(unknown)))
+    report = run(scenes, parse_list(args.densities, float), parse_list(args.threads, int),
+                 repeat=args.repeat, label=args.label, out=sys.stdout)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            other = json.load(f)
+        rows = run_benchmarks.compare(flatten_times(report), flatten_times(other),
+                                      args.threshold)
+        print(run_benchmarks.format_report(rows, args.threshold))
+        if any(r[-1] == "regressed" for r in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
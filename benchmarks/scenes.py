@@ -0,0 +1,278 @@
+"""
+Headless versions of the example scenes, for the end-to-end benchmarks (see
+run_scenes.py). Each scene function takes a ray density (a multiplier of the
+example's sampling along each sampled axis of its sources) and returns a
+RayTraceModel with the optics, sources and probes of the example. The GUI-only
+results and constraints of the examples are left out.
+"""
+
+import numpy
+
+from raypier.tracer import RayTraceModel
+
+
+def achromat(density):
+    """examples/ctracer_demo_achromat.py: a collimated beam focused by an achromat."""
+    from raypier.sources import ParallelRaySource
+    from raypier.achromats import EdmundOptic45805
+
+    source = ParallelRaySource(direction=(0,1,0),
+                               origin=(0,-50,0),
+                               number=int(25*density),
+                               radius=10,
+                               wavelength=0.8,
+                               rings=int(5*density))
+    l1 = EdmundOptic45805(centre=(0,-20,0),
+                          direction=(0,1,0))
+    return RayTraceModel(optics=[l1], sources=[source])
+
+
+def cpc_control_points(lea, theta_p, theta_n, sign):
+    """
+    Returns the Bezier control points of one arm of the compound parabolic
+    concentrator of examples/CPC3.py, for an exit aperture lea. The right arm has
+    sign=1, the left arm sign=-1.
+    """
+    theta_D = numpy.pi/2. - (theta_p if sign > 0 else theta_n)
+    a = (lea*(1+numpy.cos(theta_D)))/2.
+    theta_E = numpy.pi - theta_p - theta_n
+    rE = (2.*a)/(1+numpy.cos(theta_E))
+    E = numpy.array([sign*rE*numpy.sin(theta_E), -rE*numpy.cos(theta_E)])
+    D = numpy.array([sign*lea*numpy.sin(theta_D), -lea*numpy.cos(theta_D)])
+
+    #The control point of the equivalent quadratic Bezier
+    H = numpy.array([D[0], -2*a])/2.
+    J = numpy.array([E[0], -2*a])/2.
+    m1 = (D[1]-H[1])/(D[0]-H[0])
+    m2 = (E[1]-J[1])/(E[0]-J[0])
+    b1 = D[1] - m1*D[0]
+    b2 = E[1] - m2*E[0]
+    Kx = (b2-b1)/(m1-m2)
+    K = numpy.array([Kx, m1*Kx+b1])
+    c1 = 2./3.*K + 1./3.*D
+    c2 = 2./3.*K + 1./3.*E
+
+    theta = sign*(theta_p if sign > 0 else theta_n)
+    rot = numpy.array([[numpy.cos(theta), -numpy.sin(theta)],
+                       [numpy.sin(theta), numpy.cos(theta)]])
+    shift = numpy.array([sign*lea/2., 0])
+    return numpy.array([[numpy.dot(rot, p) - shift for p in (D, c1, c2, E)]])
+
+
+def cpc(density):
+    """examples/CPC3.py: a compound parabolic trough made of two Bezier mirrors."""
+    from raypier.splines import Extruded_bezier
+    from raypier.beamstop import RectTarget
+    from raypier.sources import RectRaySource
+    from raypier.core.cmaterials import PECMaterial
+
+    system_length = 100
+    theta_p = theta_n = numpy.radians(10)
+    lea = 4.
+    right_arm = Extruded_bezier(name="right arm",
+                                control_points=cpc_control_points(lea, theta_p, theta_n, 1),
+                                z_height_1=0, z_height_2=system_length, material=PECMaterial())
+    left_arm = Extruded_bezier(name="left arm",
+                               control_points=cpc_control_points(lea, theta_p, theta_n, -1),
+                               z_height_1=0, z_height_2=system_length, material=PECMaterial())
+    target = RectTarget(width=lea, length=system_length, elevation=90., rotation=90.,
+                        centre=(0,0,system_length/2.))
+    source = RectRaySource(origin=(0,100,system_length/4.),
+                           direction=(0,-1,0),
+                           working_dist=200.,
+                           number=int(10*density),
+                           length=system_length/4.,
+                           width=10,
+                           randomness=True,
+                           theta=10.00000001)
+    return RayTraceModel(sources=[source], optics=[target, right_arm, left_arm],
+                         recursion_limit=10)
+
+
+def grating_compensator(density):
+    """examples/grating_dispersion_compensator_example.py: a grating pulse stretcher."""
+    from raypier.achromats import EdmundOptic45805
+    from raypier.diffraction_gratings import RectangularGrating
+    from raypier.mirrors import PECMirror, RectMirror
+    from raypier.sources import BroadbandRaySource
+    from raypier.beamstop import BeamStop
+
+    origin = numpy.array([-29.685957, 124.73850, 1.5])
+    source = BroadbandRaySource(origin=tuple(origin),
+                                direction=tuple(numpy.array([0.0,0.0,2.5]) - origin),
+                                wavelength_start=0.76,
+                                wavelength_end=0.80,
+                                number=int(260*density),
+                                uniform_deltaf=True,
+                                max_ray_len=300.0)
+    grating = RectangularGrating(centre=(0,0,0),
+                                 direction=(0,1,0),
+                                 lines_per_mm=1400,
+                                 order=-1)
+    grating.orientation = 41.0
+    lens = EdmundOptic45805(centre=(0,75,0),
+                            direction=(0,-1,0))
+    mir = PECMirror(centre=(0,150,0),
+                    direction=(0,1,0),
+                    thickness=5)
+    mir2 = RectMirror(centre=(-10.413843, 52.149718, -3.0),
+                      direction=(0.23150872699334185, -0.9727849212359605, -0.009654343160915735),
+                      width=6.0,
+                      length=10.0)
+    bs = BeamStop(centre=(-35,150,15),
+                  direction=(-0.2314983, 0.97131408, 0.05438228))
+    return RayTraceModel(optics=[grating, lens, mir, mir2, bs], sources=[source])
+
+
+def temporal_focusing(density):
+    """examples/temporal_focusing_microscopy_example.py: a broadband gausslet beam
+    dispersed by a grating and focused by an aspheric objective, with the field
+    evaluated at the focus.
+    """
+    from raypier.beamsplitters import UnpolarisingBeamsplitterCube
+    from raypier.lenses import PlanoConvexLens
+    from raypier.diffraction_gratings import RectangularGrating
+    from raypier.gausslet_sources import BroadbandGaussletSource
+    from raypier.fields import EFieldPlane
+    from raypier.probes import GaussletCapturePlane
+    from raypier.shapes import CircleShape
+    from raypier.general_optic import GeneralLens
+    from raypier.faces import AsphericFace, SphericalFace
+    from raypier.materials import OpticalMaterial
+
+    src = BroadbandGaussletSource(origin=(0,0,0),
+                                  direction=(1.0,0.0,0.0),
+                                  E_vector=(0,0,1),
+                                  working_dist=0.0,
+                                  number=int(200*density),
+                                  wavelength=1.0,
+                                  wavelength_extent=0.03,
+                                  bandwidth_nm=13.0,
+                                  beam_waist=1000.0)
+    grating = RectangularGrating(centre=(220.0,0.,0.),
+                                 direction=(-1,1,0.),
+                                 length=15.,
+                                 width=20.0,
+                                 thickness=3.0,
+                                 lines_per_mm=1400.0)
+    grating.orientation = 45.5
+    lens1 = PlanoConvexLens(centre=(40.0,0.0,0.0),
+                            direction=(-1,0,0),
+                            diameter=25.0,
+                            CT=6.0,
+                            n_inside=1.6,
+                            curvature=100.0)
+    s1 = AsphericFace(z_height=0.0,
+                      curvature=1./8.107287E-02,
+                      conic_const=-6.196140E-01,
+                      A6=-1.292772E-08,
+                      A8=-1.932447E-10)
+    s2 = SphericalFace(curvature=-200.0,
+                       z_height=-8.0)
+    asphere = GeneralLens(name="Sample Objective",
+                          centre=(10.0,-30.0,0.0),
+                          direction=(0,1,0),
+                          shape=CircleShape(radius=10.0),
+                          surfaces=[s2,s1],
+                          materials=[OpticalMaterial(glass_name="L-BAL35")])
+    bs = UnpolarisingBeamsplitterCube(centre=(10.0, 0., 0.),
+                                      size=15.0)
+    capture = GaussletCapturePlane(centre=(10,-53.3,0),
+                                   direction=(0,1,0),
+                                   width=15.0,
+                                   height=15.0)
+    field = EFieldPlane(centre=(10,-53.3,0),
+                        direction=(0,0,1),
+                        detector=capture,
+                        align_detector=True,
+                        size=100,
+                        width=0.1,
+                        height=0.5,
+                        time_ps=-7.0)
+    return RayTraceModel(optics=[bs, grating, lens1, asphere],
+                         sources=[src], probes=[field, capture])
+
+
+def zernike_interferometer(density):
+    """examples/zernike_demo_interferometer_example.py: a Michelson interferometer
+    with a Zernike-distorted mirror, with the fringe field evaluated at the output.
+    """
+    from raypier.api import UnpolarisingBeamsplitterCube, CollimatedGaussletSource, \
+            CircleShape, GeneralLens, PlanarFace, GaussletCapturePlane, EFieldPlane
+    from raypier.distortions import ZernikeSeries
+    from raypier.faces import DistortionFace
+
+    src = CollimatedGaussletSource(origin=(-30,0,0),
+                                   direction=(1,0,0),
+                                   radius=5.0,
+                                   beam_waist=10.0,
+                                   resolution=10.0*density,
+                                   E_vector=(0,1,0),
+                                   wavelength=1.0,
+                                   max_ray_len=50.0)
+    bs = UnpolarisingBeamsplitterCube(centre=(0,0,0),
+                                      size=10.0)
+    shape = CircleShape(radius=10.0)
+    f1 = PlanarFace(mirror=True)
+    dist = ZernikeSeries(unit_radius=5.0, coefficients=[(3,0.0005),(7,0.0001)])
+    f2 = DistortionFace(base_face=PlanarFace(mirror=True), mirror=True, distortion=dist)
+    m1 = GeneralLens(name="Flat Mirror",
+                     shape=shape,
+                     surfaces=[f1],
+                     centre=(0,20,0),
+                     direction=(0,-1,0))
+    m2 = GeneralLens(name="Distorted Mirror",
+                     shape=shape,
+                     surfaces=[f2],
+                     centre=(20,0,0),
+                     direction=(-1,0,0))
+    cap = GaussletCapturePlane(centre=(0,-20,0),
+                               direction=(0,1,0))
+    field = EFieldPlane(centre=(0,-20,0),
+                        direction=(0,1,0),
+                        detector=cap,
+                        align_detector=True,
+                        width=10.0,
+                        height=10.0,
+                        size=100)
+    return RayTraceModel(optics=[bs, m1, m2], sources=[src], probes=[field, cap])
+
+
+def decompose_position(density):
+    """examples/test_decompose_position.py: a gausslet beam re-sampled by a position
+    decomposition plane before a lens, with the field evaluated after the lens.
+    None of the scenes above include a decomposition.
+    """
+    from raypier.api import CollimatedGaussletSource, PositionDecompositionPlane, \
+            PlanoConvexLens, GaussletCapturePlane, EFieldPlane
+
+    src = CollimatedGaussletSource(origin=(0,0,0),
+                                   direction=(0,0,1),
+                                   E_vector=(1,0,0),
+                                   E1_amp=1.0,
+                                   E2_amp=0.0,
+                                   radius=10.0,
+                                   resolution=6.0*density,
+                                   beam_waist=8.0,
+                                   wavelength=1.0)
+    lens = PlanoConvexLens(centre=(0,0,100),
+                           direction=(0,0,1),
+                           n_inside=1.5,
+                           curvature=25.0,
+                           diameter=25.0,
+                           CT=5.0)
+    decomp = PositionDecompositionPlane(centre=(0,0,95), direction=(0,0,1),
+                                        radius=10.0, resolution=16.*density, curvature=0.0,
+                                        blending=1.2)
+    cap = GaussletCapturePlane(width=30.0, height=30.0)
+    probe = EFieldPlane(detector=cap,
+                        centre=(0,0,110),
+                        direction=(0,0,1),
+                        width=20.0,
+                        height=20.0,
+                        size=100)
+    return RayTraceModel(optics=[lens, decomp], sources=[src], probes=[cap, probe])
+
+
+SCENES = {f.__name__: f for f in (achromat, cpc, grating_compensator, temporal_focusing,
+                                  zernike_interferometer, decompose_position)}
@@ -15,13 +15,70 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import warnings
+"""
+Raypier: a non-sequential optical ray-tracer.
 
-try:
-    from traits.etsconfig.api import ETSConfig
-    target = 'qt4' #was 'wx'
-    ETSConfig.toolkit = target
-except ImportError: 
-    ### If ETS is not present, we don't want to fail immediately, in case the user only want's to use raypier.core.
-    warnings.warn(f"Couldn't set ETS toolkit backend to {target}.")
+Importing raypier itself is cheap. The traits-based optics, sources and model
+(as listed in raypier.api) are imported when first accessed as attributes of
+this package, e.g. raypier.RayTraceModel. For tracing without traits, VTK or Qt,
+use raypier.core.model.
+"""
 
+import os
+import importlib
+
+### The GUI toolkit for ETS (traits/traitsui), read when traitsui is first imported.
+### An ETS_TOOLKIT set in the environment (e.g. "null" for headless batch processes)
+### takes precedence. Setting it here avoids importing traits with raypier.
+target = 'qt4' #was 'wx'
+os.environ.setdefault("ETS_TOOLKIT", target)
+
+
+### The names of raypier.api, by the module they are defined in
+_lazy_modules = {
+    "shapes": ("CircleShape", "RectangleShape", "PolygonShape", "HexagonShape"),
+    "general_optic": ("GeneralLens",),
+    "faces": ("PlanarFace", "SphericalFace", "CylindericalFace", "AsphericFace", "ConicFace",
+              "AxiconFace", "DistortionFace"),
+    "lenses": ("PlanoConvexLens", "PlanoConicLens", "AsphericLens", "BiConicLens"),
+    "materials": ("OpticalMaterial", "air"),
+    "sources": ("ConfocalRaySource", "ConfocalRayFieldSource", "ParallelRaySource",
+                "GaussianBeamRaySource", "SingleRaySource", "HexagonalRayFieldSource",
+                "AdHocSource", "BroadbandRaySource"),
+    "gausslet_sources": ("CollimatedGaussletSource",),
+    "tracer": ("RayTraceModel",),
+    "fields": ("EFieldPlane",),
+    "decompositions": ("AngleDecompositionPlane", "PositionDecompositionPlane"),
+    "probes": ("RayCapturePlane", "GaussletCapturePlane"),
+    "apertures": ("CircularAperture", "RectangularAperture"),
+    "intensity_surface": ("IntensitySurface",),
+    "beamsplitters": ("UnpolarisingBeamsplitterCube", "PolarisingBeamsplitterCube"),
+    "constraints": ("Constraint",),
+    "core.ctracer": ("ray_dtype", "gausslet_dtype", "RayCollection", "GaussletCollection"),
+    "core.fields": ("eval_Efield_from_gausslets", "eval_Efield_from_rays"),
+    }
+
+_lazy_names = {name: module for module, names in _lazy_modules.items() for name in names}
+
+__all__ = sorted(_lazy_names)
+
+
+def __getattr__(name):
+    """Imports the names of raypier.api, and the subpackages, on first access."""
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = _lazy_names.get(name)
+    if module is not None:
+        value = getattr(importlib.import_module("." + module, __name__), name)
+        globals()[name] = value
+        return value
+    try:
+        return importlib.import_module("." + name, __name__)
+    except ModuleNotFoundError as e:
+        if e.name != f"{__name__}.{name}":
+            raise
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
@@ -30,6 +30,7 @@ from cython.parallel cimport threadid
 cimport numpy as np_
 import numpy as np
 cimport openmp
+from math import factorial
 
 
 num_threads = openmp.omp_get_num_procs()
@@ -58,6 +59,11 @@ cdef class SimpleTestZernikeJ7(Distortion):
         Z = sqrt(8.0)*(3*(x*x + y*y) - 2)*y
         return Z * self.amplitude
     
+    def max_amplitude(self, double radius):
+        cdef double rho = radius/fabs(self.unit_radius)
+        ### |(3*rho**2 - 2)*y| is at most 1 inside the unit circle and rises monotonically outside
+        return sqrt(8.0)*fabs(self.amplitude)*max(1.0, (3*rho*rho - 2)*rho)
+    
     cdef vector_t z_offset_and_gradient_c(self, double x, double y) nogil:
         """The z-axis surface sag is returned as the z-component 
         of the output vector. The x- and y-components of the surface
@@ -142,6 +148,21 @@ def eval_nmk(int j):
     return (out.n, out.m, out.k)
 
 
+def zernike_R_bound(int n, int m, double rho):
+    """An upper bound on the magnitude of the radial polynomial R_n^m(r) for
+    0 <= r <= rho. This is 1 inside the unit circle. Beyond it, the sum of the
+    magnitudes of the polynomial terms is used.
+    """
+    cdef int s, half_sum, half_diff
+    if rho <= 1.0:
+        return 1.0
+    m = abs(m)
+    half_sum = (n + m)//2
+    half_diff = (n - m)//2
+    return sum(factorial(n-s)/(factorial(s)*factorial(half_sum-s)*factorial(half_diff-s)) 
+               * rho**(n-2*s) for s in range(half_diff+1))
+
+
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.
 @cython.nonecheck(False)
@@ -358,6 +379,12 @@ cdef class ZernikeDistortion(Distortion):
     def __len__(self):
         return self.n_coefs
     
+    ### The coefficient tables are re-created from the coefficients
+    pickle_exclude = ('n_coefs', 'j_max', 'k_max', 'coef_map', 'workspace')
+    
+    def pickle_args(self):
+        return ([(self.coefs[i].j, self.coefs[i].value) for i in range(self.n_coefs)],), {}
+    
     property workspace:
         def __get__(self):
             return np.asarray(self.workspace)
@@ -408,6 +435,17 @@ cdef class ZernikeDistortion(Distortion):
     
     def append_coef(self, int k, double value):
         raise NotImplementedError()
+    
+    def max_amplitude(self, double radius):
+        cdef:
+            int i
+            double N, out=0.0, rho = radius/fabs(self.unit_radius)
+            zernike_coef_t coef
+        for i in range(self.n_coefs):
+            coef = self.coefs[i]
+            N = sqrt(coef.n+1) if coef.m==0 else sqrt(2*(coef.n+1))
+            out += fabs(coef.value) * N * zernike_R_bound(coef.n, coef.m, rho)
+        return out
         
     @cython.boundscheck(False)  # Deactivate bounds checking
     @cython.wraparound(False)   # Deactivate negative indexing.
@@ -14,12 +14,12 @@ Cython module for Face definitions
 cdef extern from "math.h":
     double M_PI
     double sqrt(double) nogil
-    double atan2 (double y, double x )
-    double pow(double x, double y)
-    double fabs(double)
-    double cos(double)
-    double sin(double)
-    double acos(double)
+    double atan2 (double y, double x ) nogil
+    double pow(double x, double y) nogil
+    double fabs(double) nogil
+    double cos(double) nogil
+    double sin(double) nogil
+    double acos(double) nogil
 
 cdef extern from "float.h":
     double DBL_MAX
@@ -29,7 +29,9 @@ cdef double INF=(DBL_MAX+DBL_MAX)
 from .ctracer cimport Face, sep_, \
         vector_t, ray_t, FaceList, subvv_, dotprod_, mag_sq_, norm_,\
             addvv_, multvs_, mag_, transform_t, Transform, transform_c,\
-                rotate_c, Shape, Distortion
+                rotate_c, Shape, Distortion, record_iterations_c
+from cpython.ref cimport PyObject
+from libc.stdlib cimport malloc, free
 
 import numpy as np
 cimport numpy as np_
@@ -39,6 +41,14 @@ from cython.parallel import prange
 cdef struct flatvector_t:
     double x,y
     
+###Number of samples along each axis used to estimate the bounds of a ShapedFace
+BOUNDS_SAMPLES = 33
+
+
+cdef double max_r2(b):
+    """The largest squared radius of the rectangle b=(xmin, xmax, ymin, ymax)"""
+    return max(b[0]*b[0], b[1]*b[1]) + max(b[2]*b[2], b[3]*b[3])
+    
     
 cdef class ShapedFace(Face):
     cdef:
@@ -55,6 +65,41 @@ cdef class ShapedFace(Face):
     cdef double eval_implicit_c(self, double x, double y, double z) nogil:
         return z - self.eval_z_c(x,y)
     
+    def get_bounds(self):
+        """Returns the bounding box of the face, the bounding rectangle of the shape
+        together with the range of z over it (see get_z_range()).
+        """
+        b = self.shape.get_bounds()
+        if b is None:
+            return None
+        z = self.get_z_range(b)
+        if z is None:
+            return None
+        return (b[0], b[1], b[2], b[3], z[0], z[1])
+    
+    def get_z_range(self, b):
+        """Returns (zmin, zmax), the range of the surface z over the rectangle 
+        b=(xmin, xmax, ymin, ymax), or None if it can't be found. Subclasses give
+        the exact range where they can. Here, it is estimated by sampling (see
+        sample_z_range()).
+        """
+        return self.sample_z_range(b)
+    
+    def sample_z_range(self, b):
+        """Estimates the range of z over the rectangle b by sampling the surface. 
+        The range is padded by the largest step between adjacent samples, to allow 
+        for features between the samples.
+        """
+        x = np.linspace(b[0], b[1], BOUNDS_SAMPLES)
+        y = np.linspace(b[2], b[3], BOUNDS_SAMPLES)
+        pts = np.ascontiguousarray(np.stack(np.meshgrid(x, y), axis=-1).reshape(-1,2))
+        z = self.eval_z_points(pts).reshape(BOUNDS_SAMPLES, BOUNDS_SAMPLES)
+        if np.isnan(z).all():
+            return None
+        pad = max(np.nanmax(np.abs(np.diff(z, axis=0)), initial=0.0),
+                  np.nanmax(np.abs(np.diff(z, axis=1)), initial=0.0))
+        return (np.nanmin(z)-pad, np.nanmax(z)+pad)
+    
     @cython.boundscheck(False)  # Deactivate bounds checking
     @cython.wraparound(False)   # Deactivate negative indexing.
     def eval_z_extent(self, double[:] x, double[:] y):
@@ -130,6 +175,22 @@ cdef class ShapedFace(Face):
         return aout
     
 
+cdef inline double intersect_circular(vector_t p1, vector_t p2, double z_plane, double offset,
+                                      double d, double tolerance, int is_base_ray) nogil:
+    cdef:
+        double max_length = sep_(p1, p2)
+        double h = (z_plane-p1.z)/(p2.z-p1.z)
+        double X, Y
+        
+    if (h<tolerance) or (h>1.0):
+        return 0
+    X = p1.x + h*(p2.x-p1.x) - offset
+    Y = p1.y + h*(p2.y-p1.y)
+    if is_base_ray and (X*X + Y*Y) > (d*d/4):
+        return 0
+    return h * max_length
+
+
 cdef class CircularFace(Face):
     cdef public double diameter, offset, z_plane
     
@@ -137,8 +198,12 @@ cdef class CircularFace(Face):
     
     def __cinit__(self, **kwds):
         self.z_plane = kwds.get('z_plane', 0.0)
+        
+    def get_bounds(self):
+        cdef double r = fabs(self.diameter)/2
+        return (self.offset-r, self.offset+r, -r, r, self.z_plane, self.z_plane)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -149,24 +214,20 @@ cdef class CircularFace(Face):
           the distance along the ray to the first valid intersection. No
           intersection can be indicated by a negative value.
         """
+        return intersect_circular(p1, p2, self.z_plane, self.offset, self.diameter, 
+                                  self.tolerance, is_base_ray)
+    
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil:
         cdef:
-            double max_length = sep_(p1, p2)
-            double h = (self.z_plane-p1.z)/(p2.z-p1.z)
-            double X, Y, d=self.diameter
-            
-        #print "CFACE", p1, p2
-        
-        if (h<self.tolerance) or (h>1.0):
-            #print "H", h
-            return 0
-        X = p1.x + h*(p2.x-p1.x) - self.offset
-        Y = p1.y + h*(p2.y-p1.y)
-        if is_base_ray and (X*X + Y*Y) > (d*d/4):
-            #print "X", X, "Y", Y
-            return 0
-        return h * max_length
+            size_t i
+            double z_plane=self.z_plane, offset=self.offset, d=self.diameter
+            double tolerance=self.tolerance
+        for i in range(n):
+            dist[i] = intersect_circular(p1[i], p2[i], z_plane, offset, d, tolerance, 
+                                         is_base_ray)
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -184,7 +245,7 @@ cdef class ShapedPlanarFace(ShapedFace):
     def __cinit__(self, **kwds):
         self.z_height = kwds.get('z_height', 0.0)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -209,7 +270,7 @@ cdef class ShapedPlanarFace(ShapedFace):
             return -1
         return h*max_length
         
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -234,8 +295,12 @@ cdef class ElipticalPlaneFace(Face):
     def __cinit__(self, **kwds):
         self.g_x = kwds.get('g_x', 0.0)
         self.g_y = kwds.get('g_y', 0.0)
+        
+    def get_bounds(self):
+        cdef double r = fabs(self.diameter)/2, dz = (fabs(self.g_x)+fabs(self.g_y))*r
+        return (-r, r, -r, r, -dz, dz)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double max_length = sep_(p1, p2)
             double h = (self.g_x*p1.x + self.g_y*p1.y - p1.z) / \
@@ -253,7 +318,7 @@ cdef class ElipticalPlaneFace(Face):
             return 0
         return h * max_length
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -274,8 +339,12 @@ cdef class RectangularFace(Face):
         self.width = kwds.get("width", 2.0)
         self.length = kwds.get("length", 5.0)
         self.offset = kwds.get("offset", 0.0)
+        
+    def get_bounds(self):
+        cdef double l = fabs(self.length)/2, w = fabs(self.width)/2
+        return (self.offset-l, self.offset+l, -w, w, self.z_plane, self.z_plane)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -307,7 +376,7 @@ cdef class RectangularFace(Face):
                 return 0 
         return h * max_length
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -318,6 +387,62 @@ cdef class RectangularFace(Face):
         return normal
     
     
+cdef inline double intersect_spherical(vector_t r, vector_t p2, double z_height, 
+                                       double curvature, double diameter, double tolerance,
+                                       int is_base_ray) nogil:
+    cdef:
+        double A,B,C,D, cz, a1, a2
+        vector_t s, d, pt1, pt2
+        
+    s = subvv_(p2, r)
+    cz = z_height - curvature
+    d = r
+    d.z -= cz
+    
+    A = mag_sq_(s)
+    B = 2*dotprod_(s,d)
+    C = mag_sq_(d) - curvature**2
+    D = B*B - 4*A*C
+    
+    if D < 0: #no intersection with sphere
+        return 0
+    
+    D = sqrt(D)
+    
+    #1st root
+    a1 = (-B+D)/(2*A) 
+    pt1 = addvv_(r, multvs_(s, a1))
+    #2nd root
+    a2 = (-B-D)/(2*A)
+    pt2 = addvv_(r, multvs_(s, a2))
+    
+    if curvature >= 0:
+        if pt1.z < cz:
+            a1 = INF
+        if pt2.z < cz:
+            a2 = INF
+    else:
+        if pt1.z > cz:
+            a1 = INF
+        if pt2.z > cz:
+            a2 = INF
+        
+    D = diameter*diameter/4.
+    
+    if is_base_ray:
+        if (pt1.x*pt1.x + pt1.y*pt1.y) > D:
+            a1 = INF
+        if (pt2.x*pt2.x + pt2.y*pt2.y) > D:
+            a2 = INF
+    
+    if a2 < a1:
+        a1 = a2
+    
+    if a1>1.0 or a1<tolerance:
+        return 0
+    return a1 * sep_(r, p2)
+
+
 cdef class SphericalFace(Face):
     cdef public double diameter, curvature, z_height
     
@@ -328,8 +453,14 @@ cdef class SphericalFace(Face):
     def __cinit__(self, **kwds):
         self.z_height = kwds.get('z_height', 0.0)
         self.curvature = kwds.get('curvature', 25.0)
+        
+    def get_bounds(self):
+        cdef: 
+            double R = self.curvature, r = min(fabs(self.diameter)/2, fabs(R))
+            double z_edge = self.z_height - R + (1 if R>=0 else -1)*sqrt(R*R - r*r)
+        return (-r, r, -r, r, min(self.z_height, z_edge), max(self.z_height, z_edge))
     
-    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -342,59 +473,20 @@ cdef class SphericalFace(Face):
                 intersection is larger than the existing ray.length. OTherwise,
                 this is set to the intersecting face idx
         """
-        cdef:
-            double A,B,C,D, cz, a1, a2
-            vector_t s, d, pt1, pt2
-            
-        s = subvv_(p2, r)
-        cz = self.z_height - self.curvature
-        d = r
-        d.z -= cz
-        
-        A = mag_sq_(s)
-        B = 2*dotprod_(s,d)
-        C = mag_sq_(d) - self.curvature**2
-        D = B*B - 4*A*C
-        
-        if D < 0: #no intersection with sphere
-            return 0
-        
-        D = sqrt(D)
-        
-        #1st root
-        a1 = (-B+D)/(2*A) 
-        pt1 = addvv_(r, multvs_(s, a1))
-        #2nd root
-        a2 = (-B-D)/(2*A)
-        pt2 = addvv_(r, multvs_(s, a2))
-        
-        if self.curvature >= 0:
-            if pt1.z < cz:
-                a1 = INF
-            if pt2.z < cz:
-                a2 = INF
-        else:
-            if pt1.z > cz:
-                a1 = INF
-            if pt2.z > cz:
-                a2 = INF
-            
-        D = self.diameter*self.diameter/4.
-        
-        if is_base_ray:
-            if (pt1.x*pt1.x + pt1.y*pt1.y) > D:
-                a1 = INF
-            if (pt2.x*pt2.x + pt2.y*pt2.y) > D:
-                a2 = INF
-        
-        if a2 < a1:
-            a1 = a2
-        
-        if a1>1.0 or a1<self.tolerance:
-            return 0
-        return a1 * sep_(r, p2)
+        return intersect_spherical(r, p2, self.z_height, self.curvature, self.diameter,
+                                   self.tolerance, is_base_ray)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil:
+        cdef:
+            size_t i
+            double z_height=self.z_height, curvature=self.curvature
+            double diameter=self.diameter, tolerance=self.tolerance
+        for i in range(n):
+            dist[i] = intersect_spherical(p1[i], p2[i], z_height, curvature, diameter, 
+                                          tolerance, is_base_ray)
+    
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -419,7 +511,7 @@ cdef class ShapedSphericalFace(ShapedFace):
         self.z_height = kwds.get('z_height', 0.0)
         self.curvature = kwds.get("curvature", 100.0)
     
-    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -482,7 +574,7 @@ cdef class ShapedSphericalFace(ShapedFace):
             return 0
         return a1 * sep_(r, p2)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -494,6 +586,12 @@ cdef class ShapedSphericalFace(ShapedFace):
             p.x = -p.x
         return norm_(p)
     
+    def get_z_range(self, b):
+        cdef: 
+            double c = self.curvature, r2 = min(max_r2(b), c*c)
+            double z_edge = self.z_height - c + (1 if c>=0 else -1)*sqrt(c*c - r2)
+        return (min(self.z_height, z_edge), max(self.z_height, z_edge))
+    
     cdef double eval_z_c(self, double x, double y) nogil:
         cdef:
             double r2 = x*x + y*y
@@ -561,6 +659,11 @@ cdef class ExtrudedPlanarFace(Face):
             self.y2_ = v
             self.calc_normal()
             
+    def get_bounds(self):
+        return (min(self.x1_, self.x2_), max(self.x1_, self.x2_), 
+                min(self.y1_, self.y2_), max(self.y1_, self.y2_),
+                min(self.z1, self.z2), max(self.z1, self.z2))
+        
     cdef calc_normal(self):
         cdef vector_t n
             
@@ -569,7 +672,7 @@ cdef class ExtrudedPlanarFace(Face):
         n.z = 0
         self.normal = norm_(n)
         
-    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t r, vector_t p2, int is_base_ray) nogil:
         cdef: 
             vector_t s, u, v
             double a, dz
@@ -603,7 +706,7 @@ cdef class ExtrudedPlanarFace(Face):
         else:
             return a * mag_(s)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         return self.normal
 
 #
@@ -612,11 +715,11 @@ cdef class ExtrudedPlanarFace(Face):
 
 
     
-cdef double eval_bezier(double t, double cp0, double cp1, double cp2, double cp3):
+cdef double eval_bezier(double t, double cp0, double cp1, double cp2, double cp3) nogil:
     #just evaluate a cubic bezier spline
     return cp0*((1-t)**3) + 3*cp1*t*((1-t)**2) + 3*cp2*(1-t)*(t**2) + cp3*(t**3)
 
-cdef double dif_bezier(double t, double cp0, double cp1, double cp2, double cp3):
+cdef double dif_bezier(double t, double cp0, double cp1, double cp2, double cp3) nogil:
     #calc the derivative of a cubic bezier when parameter = t
     cdef long double A, B, C     #just doin this old school polynomial style
     A = cp3-3*cp2+3*cp1-cp0
@@ -630,7 +733,7 @@ cdef struct poly_roots:
     double roots[3] 
     int n
     
-cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
+cdef poly_roots roots_of_cubic(double a, double b, double c, double d) nogil:
     #this code is known not to work in the case of (x-c)^3 (triple zero)
     # **TODO ** fix this
     # TODO: cubic solution explodes with small a, co quadratic is used.
@@ -641,7 +744,9 @@ cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
         long double R = (2.0*a1*a1*a1 - 9.0*a1*a2 + 27.0*a3)/54.0
         long double R2_Q3 = R*R - Q*Q*Q
         long double theta
-        poly_roots x= ((0.0,0.0,0.0),0)
+        poly_roots x
+    x.roots[0] = x.roots[1] = x.roots[2] = 0.0
+    x.n = 0
     if fabs(a) <= 0.0000000001:
         #^this, precision is less than ideal here
         if fabs(b) <= 0.0000000001:
@@ -684,7 +789,7 @@ cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
             #print "single: ",x.roots[0]
     return x
 
-cdef flatvector_t rotate2D(double phi, flatvector_t p):
+cdef flatvector_t rotate2D(double phi, flatvector_t p) nogil:
     cdef flatvector_t result
     result.x = p.x*cos(phi) - p.y*sin(phi)
     result.y = p.x*sin(phi) + p.y*cos(phi)     
@@ -761,9 +866,21 @@ cdef class ExtrudedBezierFace(Face):
 
         self.mincorner = temp1
         self.maxcorner = temp2
+        
+    def pickle_args(self):
+        return (self.curves_array, self.z_height_1, self.z_height_2), {}
+        
+    def get_bounds(self):
+        ### The curves lie within the convex hull of their control points
+        return (self.mincorner.x, self.maxcorner.x, self.mincorner.y, self.maxcorner.y,
+                min(self.z_height_1, self.z_height_2), max(self.z_height_1, self.z_height_2))
 
-    cdef double intersect_c(self, vector_t ar, vector_t pee2, int is_base_ray):
+    cdef double intersect_c(self, vector_t ar, vector_t pee2, int is_base_ray) nogil:
+        ### The control-points are held in a numpy array, so we need the GIL here
+        with gil:
+            return self.intersect_bezier(ar, pee2, is_base_ray)
 
+    cdef double intersect_bezier(self, vector_t ar, vector_t pee2, int is_base_ray):
         cdef: 
             flatvector_t tempvector
             flatvector_t r, p2, s, origin
@@ -867,7 +984,11 @@ cdef class ExtrudedBezierFace(Face):
 
 
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
+        with gil:
+            return self.compute_bezier_normal(p)
+
+    cdef vector_t compute_bezier_normal(self, vector_t p):
         cdef:
             flatvector_t ray,cp0,cp1,cp2,cp3,rotated
             double theta, tmp, t
@@ -986,7 +1107,14 @@ cdef class PolygonFace(Face):
             data = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1,2)
             self._xy_points=data
             
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    def get_bounds(self):
+        pts = self._xy_points
+        if len(pts)==0:
+            return None
+        return (pts[:,0].min(), pts[:,0].max(), pts[:,1].min(), pts[:,1].max(),
+                self.z_plane, self.z_plane)
+            
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double max_length = sep_(p1, p2)
             double h = (self.z_plane-p1.z)/(p2.z-p1.z)
@@ -998,12 +1126,14 @@ cdef class PolygonFace(Face):
         X = p1.x + h*(p2.x-p1.x)
         Y = p1.y + h*(p2.y-p1.y)
         #test for (X,Y) in polygon
-        if is_base_ray and point_in_polygon_c(X,Y, self._xy_points)==1:
-            return h * max_length
-        else:
+        if not is_base_ray:
             return 0.0
+        with gil:
+            if point_in_polygon_c(X,Y, self._xy_points)==1:
+                return h * max_length
+        return 0.0
         
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1018,7 +1148,7 @@ cdef class OffAxisParabolicFace(Face):
     cdef:
         public double EFL, diameter, height
                 
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -1088,7 +1218,7 @@ cdef class OffAxisParabolicFace(Face):
                 return 0
             return a1 * sep_(p1, p2)
 #
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1131,8 +1261,11 @@ cdef class EllipsoidalFace(Face):
             cdef Transform t=Transform()
             t.trans = self.inv_trans
             return t
+        
+    def get_bounds(self):
+        return (self.x1, self.x2, self.y1, self.y2, self.z1, self.z2)
             
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double B,A, a, b, c, d
             
@@ -1181,7 +1314,7 @@ cdef class EllipsoidalFace(Face):
             return 0
         return root1*mag_(S)
         
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         cdef vector_t n
         
         p = transform_c(self.trans, p)
@@ -1225,7 +1358,7 @@ cdef class SaddleFace(ShapedFace):
         self.z_height = kwds.get("z_height", 0.0)
         self.curvature = kwds.get("curvature", 0.0)
         
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double A=sqrt(6.0), root, denom, a1, a2
             vector_t d,p, pt1, pt2
@@ -1280,7 +1413,7 @@ cdef class SaddleFace(ShapedFace):
             return -1
         return a1 * sep_(p1, p2)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1309,7 +1442,7 @@ cdef class CylindericalFace(ShapedFace):
         self.z_height = kwds.get('z_height', 0.0)
         self.radius = kwds.get("radius", 100.0)
         
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double a1, a2, cz, ox2, oz2, dx2, dz2, denom, R=self.radius
             double R2 = R*R
@@ -1367,7 +1500,7 @@ cdef class CylindericalFace(ShapedFace):
             return -1
         return a1 * sep_(p1, p2)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1402,7 +1535,7 @@ cdef class AxiconFace(ShapedFace):
         self.z_height = kwds.get('z_height', 0.0)
         self.gradient = kwds.get('gradient', 0.0)
         
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
             double a1, a2, root, ox2, oy2, oz2, dx2, dy2, dz2, beta2, denom
             double beta = self.gradient
@@ -1456,7 +1589,7 @@ cdef class AxiconFace(ShapedFace):
             return -1
         return a1 * sep_(p1, p2)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1474,7 +1607,7 @@ cdef class AxiconFace(ShapedFace):
         return self.z_height - (self.gradient * sqrt(x*x + y*y))
     
     
-cdef double intersect_conic(vector_t a, vector_t d, double curvature, double conic_const):
+cdef double intersect_conic(vector_t a, vector_t d, double curvature, double conic_const) nogil:
     cdef:
         double beta = 1 + conic_const
         double R = -curvature
@@ -1530,6 +1663,30 @@ cdef double intersect_conic(vector_t a, vector_t d, double curvature, double con
     
          
     
+cdef inline double intersect_conic_face(vector_t p1, vector_t p2, double z_height, 
+                                        double curvature, double conic_const, PyObject *shape,
+                                        double tolerance, int is_base_ray) nogil:
+    cdef:
+        double a1
+        vector_t d, a, pt1
+        
+    d = subvv_(p2, p1) #the input ray direction, in local coords.
+    a = p1
+    a.z -= z_height
+    
+    a1 = intersect_conic(a, d, curvature, conic_const)
+    
+    pt1 = addvv_(a, multvs_(d, a1))
+        
+    if is_base_ray and not (<Shape>shape).point_inside_c(pt1.x, pt1.y):
+        return INF
+        
+    if a1>1.0 or a1<tolerance:
+        return -1
+    
+    return a1 * sep_(p1, p2)
+    
+    
 cdef class ConicRevolutionFace(ShapedFace):
     """This is surface of revolution formed from a conic section. Spherical and ellipsoidal faces
     are a special case of this.
@@ -1546,7 +1703,7 @@ cdef class ConicRevolutionFace(ShapedFace):
         self.conic_const = kwds.get('conic_const', 0.0)
         self.curvature = kwds.get('curvature', 10.0)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -1557,27 +1714,21 @@ cdef class ConicRevolutionFace(ShapedFace):
           the distance along the ray to the first valid intersection. No
           intersection can be indicated by a negative value.
         """
-        cdef:
-            double a1
-            vector_t d, a, pt1
-            
-        d = subvv_(p2, p1) #the input ray direction, in local coords.
-        a = p1
-        a.z -= self.z_height
-        
-        a1 = intersect_conic(a, d, self.curvature, self.conic_const)
-        
-        pt1 = addvv_(a, multvs_(d, a1))
-            
-        if is_base_ray and not (<Shape>(self.shape)).point_inside_c(pt1.x, pt1.y):
-            return INF
-            
-        if a1>1.0 or a1<self.tolerance:
-            return -1
-        
-        return a1 * sep_(p1, p2)
+        return intersect_conic_face(p1, p2, self.z_height, self.curvature, self.conic_const,
+                                    <PyObject*>self.shape, self.tolerance, is_base_ray)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil:
+        cdef:
+            size_t i
+            double z_height=self.z_height, curvature=self.curvature
+            double conic_const=self.conic_const, tolerance=self.tolerance
+            PyObject *shape = <PyObject*>self.shape
+        for i in range(n):
+            dist[i] = intersect_conic_face(p1[i], p2[i], z_height, curvature, conic_const,
+                                           shape, tolerance, is_base_ray)
+    
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1602,13 +1753,39 @@ cdef class ConicRevolutionFace(ShapedFace):
         
         return norm_(g)
     
+    def get_z_range(self, b):
+        """intersect_conic() finds hits on both sheets of the conic (i.e. past the 
+        equator of an ellipsoid, or on the second sheet of a hyperboloid), so the 
+        range spans both. The sag of each sheet is monotonic in the radius, so 
+        the range is given by the sags on-axis and at the furthest corner of b, 
+        or at the equator if that is nearer (for an ellipsoid).
+        """
+        cdef:
+            double R = self.curvature, beta = 1 + self.conic_const
+            double r2 = max_r2(b), root
+        if beta == 0:
+            ### A paraboloid has only the one sheet
+            z = (0.0, -r2/(2*R))
+        else:
+            if beta > 0:
+                r2 = min(r2, R*R/beta)
+            root = (1 if R>=0 else -1)*sqrt(max(R*R - beta*r2, 0.0))
+            z = (0.0, -(R - root)/beta, -(R + root)/beta, -2*R/beta)
+        if not np.isfinite(z).all():
+            return self.sample_z_range(b)
+        return (self.z_height + min(z), self.z_height + max(z))
+    
     cdef double eval_z_c(self, double x, double y) nogil:
         cdef:
             double r2 = (x*x) + (y*y)
             double R = self.curvature
             double R2 = R*R
         
-        return self.z_height  - (r2/(R + sqrt(R2 - (1+self.conic_const)*r2)))
+        ### Take the sheet of the conic through the vertex, as intersect_conic() does
+        if R >= 0:
+            return self.z_height  - (r2/(R + sqrt(R2 - (1+self.conic_const)*r2)))
+        else:
+            return self.z_height  - (r2/(R - sqrt(R2 - (1+self.conic_const)*r2)))
     
     cdef double eval_implicit_c(self, double x, double y, double z) nogil:
         return z - self.eval_z_c(x,y)
@@ -1628,7 +1805,7 @@ cdef struct aspheric_t:
     vector_t d
     
     
-cdef double eval_aspheric_impf(aspheric_t A, double alpha):
+cdef double eval_aspheric_impf(aspheric_t A, double alpha) nogil:
     cdef: 
         double out
         double r2 = ((A.a.x + alpha*A.d.x)**2 + (A.a.y + alpha*A.d.y)**2)
@@ -1640,7 +1817,7 @@ cdef double eval_aspheric_impf(aspheric_t A, double alpha):
     return out
 
 
-cdef double eval_aspheric_grad(aspheric_t A, double alpha):
+cdef double eval_aspheric_grad(aspheric_t A, double alpha) nogil:
     cdef:
         double out
         double r2 = ((A.a.x + alpha*A.d.x)**2 + (A.a.y + alpha*A.d.y)**2)
@@ -1683,7 +1860,43 @@ cdef class AsphericFace(ShapedFace):
         self.A16 = kwds.get('A16',0.0)
         self.atol = kwds.get("atol", 1.0e-8)
         
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef aspheric_t start_c(self, vector_t p1, vector_t p2, double *a1) nogil:
+        """The coefficients of the implicit function along the ray from p1 to p2 (in 
+        local coords), and the starting point a1 of the root-finding, at the 
+        intersection with the conic surface.
+        """
+        cdef aspheric_t A
+        A.d = subvv_(p2, p1) #the input ray direction, in local coords.
+        A.a = p1
+        A.a.z -= self.z_height
+        
+        a1[0] = intersect_conic(A.a, A.d, self.curvature, self.conic_const)
+        
+        A.R = -self.curvature
+        A.beta = 1 + self.conic_const
+        A.A4 = self.A4
+        A.A6 = self.A6
+        A.A8 = self.A8
+        A.A10 = self.A10
+        A.A12 = self.A12
+        A.A14 = self.A14
+        A.A16 = self.A16
+        return A
+    
+    cdef double root_distance_c(self, aspheric_t *A, double a1, vector_t p1, vector_t p2,
+                                int is_base_ray) nogil:
+        """The distance to the intersection at the root a1 (as for intersect_c())."""
+        cdef vector_t pt1 = addvv_(A.a, multvs_(A.d, a1))
+
+        if is_base_ray and not (<Shape>(self.shape)).point_inside_c(pt1.x, pt1.y):
+            return INF
+            
+        if a1>1.0 or a1<self.tolerance:
+            return -1
+        
+        return a1 * sep_(p1, p2)
+        
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -1697,32 +1910,13 @@ cdef class AsphericFace(ShapedFace):
         cdef:
             double a1, dz, f, f_last
             double tol = self.atol**2
-            vector_t d, a, pt1
-            aspheric_t A
-            
-        d = subvv_(p2, p1) #the input ray direction, in local coords.
-        a = p1
-        a.z -= self.z_height
-        
-        a1 = intersect_conic(a, d, self.curvature, self.conic_const)
-        
-        A.R = -self.curvature
-        A.beta = 1 + self.conic_const
-        A.A4 = self.A4
-        A.A6 = self.A6
-        A.A8 = self.A8
-        A.A10 = self.A10
-        A.A12 = self.A12
-        A.A14 = self.A14
-        A.A16 = self.A16
-        A.a = a
-        A.d = d
+            aspheric_t A = self.start_c(p1, p2, &a1)
+            int i
 
         ### Find root using Newton's method. Typically only a 3-4 iterations are required.
          
         f = f_last = eval_aspheric_impf(A, a1)
         dz = - f / eval_aspheric_grad(A, a1)
-        #print("Start:", dz, a1)
 
         #### If we've not converged after 100 iterations, then it ain't going converge ever.
         for i in range(100):
@@ -1731,26 +1925,77 @@ cdef class AsphericFace(ShapedFace):
                 break
             f = eval_aspheric_impf(A, a1)
             if fabs(f) > fabs(f_last): #We're not converging
+                record_iterations_c(self, i+1)
                 return -1
             f_last = f
             dz = - f / eval_aspheric_grad(A, a1)
         else:
+            record_iterations_c(self, 100)
             return -1     
+        record_iterations_c(self, i+1)
         
-        #print("Converged:", dz, a1, i)
-        
-        pt1 = addvv_(a, multvs_(d, a1))
-
-        if is_base_ray and not (<Shape>(self.shape)).point_inside_c(pt1.x, pt1.y):
-            return INF
-            
-        if a1>1.0 or a1<self.tolerance:
-            return -1
-        
-        #print("Ret:", a1 * sep_(p1, p2))
-        return a1 * sep_(p1, p2)
+        return self.root_distance_c(&A, a1, p1, p2, is_base_ray)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil:
+        """As intersect_c(), for a batch of n rays. The Newton iterations step through 
+        the batch together, each pass updating only the rays which have not yet 
+        converged (kept in a compacted list), so that each pass is a short loop 
+        over the rays with the face's coefficients already loaded.
+        """
+        cdef:
+            double tol = self.atol**2
+            double f
+            aspheric_t *A = <aspheric_t*>malloc((n+1)*sizeof(aspheric_t))
+            double *a1 = <double*>malloc((n+1)*sizeof(double))
+            double *dz = <double*>malloc((n+1)*sizeof(double))
+            double *f_last = <double*>malloc((n+1)*sizeof(double))
+            size_t *active = <size_t*>malloc((n+1)*sizeof(size_t))
+            size_t i, k, m, n_active = n
+            unsigned long iterations = 0
+            int it
+            
+        if A is NULL or a1 is NULL or dz is NULL or f_last is NULL or active is NULL:
+            for i in range(n):
+                dist[i] = self.intersect_c(p1[i], p2[i], is_base_ray)
+        else:
+            for i in range(n):
+                A[i] = self.start_c(p1[i], p2[i], a1 + i)
+                f_last[i] = eval_aspheric_impf(A[i], a1[i])
+                dz[i] = - f_last[i] / eval_aspheric_grad(A[i], a1[i])
+                dist[i] = -1
+                active[i] = i
+                
+            for it in range(100):
+                m = 0
+                for k in range(n_active):
+                    i = active[k]
+                    a1[i] += dz[i]
+                    if dz[i]*dz[i] < tol:
+                        iterations += it+1
+                        dist[i] = self.root_distance_c(A + i, a1[i], p1[i], p2[i], is_base_ray)
+                        continue
+                    f = eval_aspheric_impf(A[i], a1[i])
+                    if fabs(f) > fabs(f_last[i]): #We're not converging
+                        iterations += it+1
+                        continue
+                    f_last[i] = f
+                    dz[i] = - f / eval_aspheric_grad(A[i], a1[i])
+                    active[m] = i
+                    m += 1
+                n_active = m
+                if n_active == 0:
+                    break
+            #Any rays still active have not converged after 100 iterations
+            iterations += 100*n_active
+            record_iterations_c(self, iterations)
+        free(A)
+        free(a1)
+        free(dz)
+        free(f_last)
+        free(active)
+    
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -1781,6 +2026,30 @@ cdef class AsphericFace(ShapedFace):
         
         return norm_(g)
 
+    def get_z_range(self, b):
+        """The conic sag and each of the polynomial terms is monotonic in the 
+        radius, so each lies between its value on-axis (zero) and its value at the 
+        furthest corner of b (or at the edge of the surface, for an ellipsoidal 
+        base). The range is the sum of these.
+        """
+        cdef:
+            double R = self.curvature, beta = 1 + self.conic_const
+            double r2 = max_r2(b), t, zmin=0.0, zmax=0.0
+            int i
+        if beta > 0:
+            r2 = min(r2, R*R/beta)
+        t = -r2/(R + (1 if R>=0 else -1)*sqrt(max(R*R - beta*r2, 0.0)))
+        if not np.isfinite(t):
+            return self.sample_z_range(b)
+        zmin = min(t, 0.0)
+        zmax = max(t, 0.0)
+        coefs = (self.A4, self.A6, self.A8, self.A10, self.A12, self.A14, self.A16)
+        for i in range(len(coefs)):
+            t = coefs[i] * r2**(i+2)
+            zmin += min(t, 0.0)
+            zmax += max(t, 0.0)
+        return (self.z_height + zmin, self.z_height + zmax)
+    
     cdef double eval_z_c(self, double x, double y) nogil:
         cdef: 
             double out
@@ -1816,18 +2085,18 @@ cdef class DistortionFace(ShapedFace):
         self.shape = kwds.get('shape', face.shape)
         self.accuracy = kwds.get("accuracy", 1e-6)
         
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    def pickle_args(self):
+        return (), {'base_face': self.base_face, 'distortion': self.distortion}
+        
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         cdef:
-            ShapedFace face=self.base_face
             double z_shift=0.0, tolerance, a1, a2, h=sep_(p2,p1)
             vector_t dxdyz, pt1, d, n, o, q1, q2
             int i
-            Distortion dist=self.distortion
-            Shape shape = self.shape
             
         tolerance = self.accuracy
         
-        a2 = face.intersect_c(p1,p2,0) #Don't check the shape yet
+        a2 = self.base_face.intersect_c(p1,p2,0) #Don't check the shape yet
         if a2>h or a2<self.tolerance: #If no intersection, then, no intersection
             #print("NO intersection", a2, p1.z, p2.z)
             return -1.0
@@ -1836,9 +2105,9 @@ cdef class DistortionFace(ShapedFace):
         #starting estimate of intersection
         d = subvv_(p2,p1)
         pt1 = addvv_(p1, multvs_(d,a2/h))
-        dxdyz = dist.z_offset_and_gradient_c(pt1.x, pt1.y)
+        dxdyz = self.distortion.z_offset_and_gradient_c(pt1.x, pt1.y)
         
-        n = face.compute_normal_c(pt1)
+        n = self.base_face.compute_normal_c(pt1)
         #print("base normal:", n.x, n.y, n.z)
         #print("pt1:", pt1.x, pt1.y, pt1.z)
         #print("dx:", dxdyz.x, "dy:", dxdyz.y, "z:", dxdyz.z)
@@ -1863,17 +2132,17 @@ cdef class DistortionFace(ShapedFace):
             #print("a_error:", a1-a2, i)
             if fabs(a1 - a2) < tolerance:
                 break
-            z_shift = dist.z_offset_c(pt1.x, pt1.y)
+            z_shift = self.distortion.z_offset_c(pt1.x, pt1.y)
             
             q1 = p1
             q2 = p2
             q1.z -= z_shift
             q2.z -= z_shift
-            a2 = face.intersect_c(q1, q2, 0)
+            a2 = self.base_face.intersect_c(q1, q2, 0)
             
             pt1 = addvv_(q1, multvs_(d,a2/h)) #this point on base
-            n = face.compute_normal_c(pt1)
-            dxdyz = dist.z_offset_and_gradient_c(pt1.x, pt1.y)
+            n = self.base_face.compute_normal_c(pt1)
+            dxdyz = self.distortion.z_offset_and_gradient_c(pt1.x, pt1.y)
             pt1.z += dxdyz.z #move to distorted face
             
             n.x /= n.z
@@ -1885,13 +2154,14 @@ cdef class DistortionFace(ShapedFace):
             ### Better estimate for a
             a2 = a1
             a1 = -h*dotprod_(o,n)/dotprod_(d,n)
+        record_iterations_c(self, i+1)
             
-        if not shape.point_inside_c(pt1.x, pt1.y):
+        if not self.shape.point_inside_c(pt1.x, pt1.y):
             return -1.0
         #print("Final a1:", a1)
         return a1
             
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         cdef:
             vector_t n, p1, dxdyz
 
@@ -1906,6 +2176,19 @@ cdef class DistortionFace(ShapedFace):
         n.y -= dxdyz.y
         return norm_(n)
             
+    def get_z_range(self, b):
+        """The range of the base face, widened by the bound on the amplitude of 
+        the distortion over b. If the distortion gives no such bound, the range 
+        is estimated by sampling.
+        """
+        amp = self.distortion.max_amplitude(sqrt(max_r2(b)))
+        if amp is None:
+            return self.sample_z_range(b)
+        z = self.base_face.get_z_range(b)
+        if z is None:
+            return None
+        return (z[0] - amp, z[1] + amp)
+    
     cdef double eval_z_c(self, double x, double y) nogil:
         cdef:
             double z
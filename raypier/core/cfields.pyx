@@ -8,6 +8,9 @@ cdef extern from "math.h":
     double cos(double)
     double sin(double)
     double acos(double)
+    double log(double) nogil
+    double floor(double) nogil
+    double INFINITY
     
 
 IF UNAME_SYSNAME == "Windows":
@@ -25,6 +28,8 @@ ELSE:
         double complex I    
         
 from cython.parallel import prange
+from libc.stdlib cimport malloc, free
+cimport openmp
 
 
 from .ctracer cimport Face, sep_, \
@@ -46,6 +51,100 @@ cdef:
     double complex rootI=csqrt(I)
 
 
+#The number of points in a tile of the tiled field summation. The field of a tile 
+#(16 bytes x 3 components per point) stays in the L1 cache while the modes are summed.
+DEF TILE_SIZE = 64
+
+
+ctypedef struct mode_t:
+    vector_t origin, direction, E, H
+    double complex A, B, C, detG0, kz, E1_amp, E2_amp
+    double phase, inv_root_area, phase_per_ps
+    unsigned int wavelength_idx
+
+
+cdef int field_thread_count(int num_threads):
+    """The thread count for a num_threads argument. Zero or negative values select
+    one thread per processor.
+    """
+    cdef int max_threads = openmp.omp_get_num_procs()
+    if num_threads <= 0 or num_threads > max_threads:
+        return max_threads
+    return num_threads
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void prepare_modes(RayCollection rays, double complex[:,:] modes, 
+                        np_.npy_float64[:] wavelengths, double time_ps, mode_t *out) nogil:
+    """Fills out the per-ray parameters of the mode of each ray, for calc_mode_U()."""
+    cdef:
+        size_t iray
+        ray_t ray
+        mode_t *m
+        double k, invk
+        double c = 0.299792458 #speed of light (in mm/ps)
+        
+    for iray in range(rays.n_rays):
+        ray = rays.rays[iray]
+        m = out + iray
+        m.origin = ray.origin
+        m.direction = ray.direction
+        m.E = norm_(ray.E_vector)
+        m.H = norm_(cross_(ray.direction, m.E))
+        k = 2000.0*M_PI/wavelengths[ray.wavelength_idx]
+        ### The accumulated path length already includes the refractive index of up-stream rays
+        ### Hence, need to calculate it before applying the refractive index of the last leg.
+        m.phase_per_ps = c*k/ray.refractive_index.real
+        m.phase = ray.phase + (ray.accumulated_path*k) - (time_ps*m.phase_per_ps)
+        m.wavelength_idx = ray.wavelength_idx
+        
+        m.kz = ray.refractive_index
+        m.kz *= k
+        invk = 2./m.kz.real
+        m.A = modes[iray, 0]
+        m.B = modes[iray, 1]
+        m.C = modes[iray, 2]
+        
+        ###normalisation factor 1/root(area). Yes, there really is a double square root.
+        m.inv_root_area = sqrt(sqrt(m.A.imag*m.C.imag -(m.B.imag*m.B.imag))*(2.0/M_PI))
+        
+        m.A.imag *= invk
+        m.B.imag *= invk
+        m.C.imag *= invk
+        m.detG0 = (m.A*m.C) - (m.B*m.B)
+        m.E1_amp = ray.E1_amp
+        m.E2_amp = ray.E2_amp
+        
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double complex mode_U(mode_t *m, np_.npy_float64[:,:] points, Py_ssize_t ipt) nogil:
+    """The (scalar) amplitude of the mode m at the point ipt."""
+    cdef vector_t pt
+    
+    pt.x = points[ipt,0]
+    pt.y = points[ipt,1]
+    pt.z = points[ipt,2]
+    pt = subvv_(pt, m.origin)
+    return calc_mode_U(m.A, m.B, m.C, m.detG0, pt, m.E, m.H, m.direction, m.kz, m.phase, 
+                       m.inv_root_area)
+
+
+cdef inline void add_mode_field(mode_t *m, np_.npy_float64[:,:] points, Py_ssize_t ipt, 
+                                double complex *out) nogil:
+    """Adds the field of the mode m at the point ipt, to out[0:3]."""
+    cdef double complex E1, E2, U = mode_U(m, points, ipt)
+    
+    E1 = m.E1_amp * U
+    E2 = m.E2_amp * U
+    
+    out[0] += (E1*m.E.x + E2*m.H.x)
+    out[1] += (E1*m.E.y + E2*m.H.y)
+    out[2] += (E1*m.E.z + E2*m.H.z)
+
+
 @cython.boundscheck(False)  # Deactivate bounds checking
 @cython.wraparound(False)   # Deactivate negative indexing.
 @cython.cdivision(True)
@@ -53,66 +152,455 @@ cpdef  sum_gaussian_modes(RayCollection rays,
                           double complex[:,:] modes, 
                           np_.npy_float64[:] wavelengths,
                           np_.npy_float64[:,:] points,
-                          double time_ps):
+                          double time_ps,
+                          double tolerance=0.0,
+                          str method="auto",
+                          int num_threads=0):
     """
     Compute the E-field at the given points by propagation of the
     given rays, with phase and mode-coefficients.
+    
+    If a tolerance is given, the modes are truncated: each mode is only evaluated 
+    at the points where its amplitude is at least tolerance times its on-axis 
+    amplitude (at the same distance along the ray). The points are binned into a
+    grid (see build_point_grid()), so each mode only visits the cells within its
+    footprint. The error in the field is then at most tolerance times the sum of 
+    the on-axis amplitudes of the modes at each point.
+    
+    Otherwise, the method gives the loop order of the (exact) summation: "tiled" 
+    (see sum_gaussian_modes_tiled()), "rays" (see sum_gaussian_modes_rays()) or 
+    "auto", which takes the ray-parallel summation where there are too few points
+    to give each thread a few tiles. num_threads is the number of threads to sum 
+    with; zero selects one thread per processor.
+    """
+    if tolerance > 0.0:
+        return sum_gaussian_modes_truncated(rays, modes, wavelengths, points, time_ps, 
+                                            tolerance, num_threads)
+    cdef int n_threads = field_thread_count(num_threads)
+    if method == "auto":
+        if points.shape[0] < 4*TILE_SIZE*n_threads and rays.n_rays >= <size_t>(4*n_threads) \
+                and n_threads > 1:
+            method = "rays"
+        else:
+            method = "tiled"
+    if method == "tiled":
+        return sum_gaussian_modes_tiled(rays, modes, wavelengths, points, time_ps, n_threads)
+    elif method == "rays":
+        return sum_gaussian_modes_rays(rays, modes, wavelengths, points, time_ps, n_threads)
+    raise ValueError("Unknown summation method '%s' (expected 'auto', 'tiled' or 'rays')"%method)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sum_gaussian_modes_tiled(RayCollection rays,
+                             double complex[:,:] modes, 
+                             np_.npy_float64[:] wavelengths,
+                             np_.npy_float64[:,:] points,
+                             double time_ps,
+                             int num_threads=0):
+    """
+    As sum_gaussian_modes(), parallelised over tiles of TILE_SIZE points. Each thread
+    sums all the modes over its own tiles, so the field of a tile stays in cache
+    and no two threads write to the same points.
     """
     cdef:
-        size_t iray, ipt 
-        size_t Nray=rays.n_rays
-        size_t Npt=points.shape[0]
-        
-        ray_t ray
+        Py_ssize_t Npt=points.shape[0], ntiles, itile, ipt, pt_end
+        size_t iray, Nray=rays.n_rays
+        int n_threads = field_thread_count(num_threads)
         complex_t[:,:] out = np.zeros((Npt,3), dtype=np.complex128)
-        vector_t pt, H, E
-        double complex U, A, B, C, E1, E2, detG0, kz
-        double x,y,z, phase, k, inv_root_area, invk
-        double c = 0.299792458 #speed of light (in mm/ps)
+        mode_t *params
+        
+    if Npt == 0 or Nray == 0:
+        return np.asarray(out)
+    params = <mode_t*>malloc(Nray*sizeof(mode_t))
+    if params is NULL:
+        raise MemoryError()
+    ntiles = (Npt + TILE_SIZE - 1)//TILE_SIZE
+    try:
+        with nogil:
+            prepare_modes(rays, modes, wavelengths, time_ps, params)
+            for itile in prange(ntiles, num_threads=n_threads, schedule="dynamic"):
+                pt_end = (itile+1)*TILE_SIZE
+                if pt_end > Npt:
+                    pt_end = Npt
+                for iray in range(Nray):
+                    for ipt in range(itile*TILE_SIZE, pt_end):
+                        add_mode_field(params + iray, points, ipt, &out[ipt,0])
+    finally:
+        free(params)
+    return np.asarray(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sum_gaussian_modes_rays(RayCollection rays,
+                            double complex[:,:] modes, 
+                            np_.npy_float64[:] wavelengths,
+                            np_.npy_float64[:,:] points,
+                            double time_ps,
+                            int num_threads=0):
+    """
+    As sum_gaussian_modes(), parallelised over the rays, for small sets of points 
+    (where there are few tiles of points to share between threads). The rays are 
+    split into one contiguous block per thread, each summed into its own copy of 
+    the field, and the copies are added at the end.
+    """
+    cdef:
+        Py_ssize_t Npt=points.shape[0], ipt
+        size_t iray, Nray=rays.n_rays, ray_end
+        int ichunk, n_chunks = field_thread_count(num_threads)
+        size_t chunk_size
+        complex_t[:,:,:] partial
+        mode_t *params
+        
+    if Npt == 0 or Nray == 0:
+        return np.zeros((Npt,3), dtype=np.complex128)
+    if <size_t>n_chunks > Nray:
+        n_chunks = Nray
+    chunk_size = (Nray + n_chunks - 1)//n_chunks
+    partial = np.zeros((n_chunks,Npt,3), dtype=np.complex128)
+    params = <mode_t*>malloc(Nray*sizeof(mode_t))
+    if params is NULL:
+        raise MemoryError()
+    try:
+        with nogil:
+            prepare_modes(rays, modes, wavelengths, time_ps, params)
+            for ichunk in prange(n_chunks, num_threads=n_chunks, schedule="static", chunksize=1):
+                ray_end = (ichunk+1)*chunk_size
+                if ray_end > Nray:
+                    ray_end = Nray
+                for iray in range(ichunk*chunk_size, ray_end):
+                    for ipt in range(Npt):
+                        add_mode_field(params + iray, points, ipt, &partial[ichunk,ipt,0])
+    finally:
+        free(params)
+    return np.asarray(partial).sum(axis=0)
+
         
-    c *= time_ps  #x time (in picoseconds)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sum_gaussian_modes_times(RayCollection rays,
+                             double complex[:,:] modes, 
+                             np_.npy_float64[:] wavelengths,
+                             np_.npy_float64[:,:] points,
+                             times_ps,
+                             int num_threads=0):
+    """
+    As sum_gaussian_modes() (with the tiled summation), for each of the given times 
+    (in picoseconds) in one pass. The time only enters the phase of each mode, so 
+    each mode is evaluated once per point and multiplied by a phase factor for each
+    time.
     
-    with nogil:
-        for iray in range(Nray):
-            ray = rays.rays[iray]
-            E = norm_(ray.E_vector)
-            H = norm_(cross_(ray.direction, E))
-            k = 2000.0*M_PI/wavelengths[ray.wavelength_idx]
-            ### The accumulated path length already includes the refractive index of up-stream rays
-            ### Hence, need to calculate it before applying the refractive index of the last leg.
-            phase = ray.phase + (ray.accumulated_path*k) - (c*k/ray.refractive_index.real)
-            
-            #kz = ray.refractive_index.real + I*ray.refractive_index.imag
-            kz = ray.refractive_index
-            kz *= k
-            invk = 2./kz.real
-            A = modes[iray, 0]
-            B = modes[iray, 1]
-            C = modes[iray, 2]
-            
-            ###normalisation factor 1/root(area). Yes, there really is a double square root.
-            inv_root_area = sqrt(sqrt(A.imag*C.imag -(B.imag*B.imag))*(2.0/M_PI))
+    returns - a complex array of shape (T,N,3) for T times and N points.
+    """
+    cdef:
+        double[:] times = np.ascontiguousarray(times_ps, dtype=np.float64).reshape(-1)
+        Py_ssize_t Npt=points.shape[0], Nt=times.shape[0], ntiles, itile, ipt, pt_end, it
+        size_t iray, Nray=rays.n_rays
+        int thread, n_threads = field_thread_count(num_threads)
+        complex_t[:,:,:] out = np.zeros((Nt,Npt,3), dtype=np.complex128)
+        complex_t[:,:,:] field = np.empty((n_threads,TILE_SIZE,3), dtype=np.complex128)
+        double complex U, E1, E2, shift
+        mode_t *params
+        mode_t *m
+        
+    if Npt == 0 or Nray == 0 or Nt == 0:
+        return np.asarray(out)
+    params = <mode_t*>malloc(Nray*sizeof(mode_t))
+    if params is NULL:
+        raise MemoryError()
+    ntiles = (Npt + TILE_SIZE - 1)//TILE_SIZE
+    try:
+        with nogil:
+            prepare_modes(rays, modes, wavelengths, 0.0, params)
+            for itile in prange(ntiles, num_threads=n_threads, schedule="dynamic"):
+                thread = openmp.omp_get_thread_num()
+                pt_end = (itile+1)*TILE_SIZE
+                if pt_end > Npt:
+                    pt_end = Npt
+                for iray in range(Nray):
+                    m = params + iray
+                    ### The field of this mode over the tile, at time zero
+                    for ipt in range(itile*TILE_SIZE, pt_end):
+                        U = mode_U(m, points, ipt)
+                        E1 = m.E1_amp * U
+                        E2 = m.E2_amp * U
+                        field[thread, ipt - itile*TILE_SIZE, 0] = (E1*m.E.x + E2*m.H.x)
+                        field[thread, ipt - itile*TILE_SIZE, 1] = (E1*m.E.y + E2*m.H.y)
+                        field[thread, ipt - itile*TILE_SIZE, 2] = (E1*m.E.z + E2*m.H.z)
+                    for it in range(Nt):
+                        shift = cexp(-I*(m.phase_per_ps*times[it]))
+                        for ipt in range(itile*TILE_SIZE, pt_end):
+                            out[it,ipt,0] += shift*field[thread, ipt - itile*TILE_SIZE, 0]
+                            out[it,ipt,1] += shift*field[thread, ipt - itile*TILE_SIZE, 1]
+                            out[it,ipt,2] += shift*field[thread, ipt - itile*TILE_SIZE, 2]
+    finally:
+        free(params)
+    return np.asarray(out)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sum_gaussian_modes_spectral(RayCollection rays,
+                                double complex[:,:] modes, 
+                                np_.npy_float64[:] wavelengths,
+                                np_.npy_float64[:,:] points,
+                                double time_ps,
+                                int num_threads=0):
+    """
+    As sum_gaussian_modes() (with the tiled summation), with the field of the rays of
+    each wavelength (by their wavelength_idx) summed separately.
+    
+    returns - a complex array of shape (W,N,3) for W wavelengths and N points.
+    """
+    cdef:
+        Py_ssize_t Npt=points.shape[0], Nw=wavelengths.shape[0], ntiles, itile, ipt, pt_end
+        size_t iray, Nray=rays.n_rays
+        int n_threads = field_thread_count(num_threads)
+        complex_t[:,:,:] out = np.zeros((Nw,Npt,3), dtype=np.complex128)
+        mode_t *params
+        
+    if Npt == 0 or Nray == 0:
+        return np.asarray(out)
+    if np.asarray(rays.wavelength_idx).max() >= Nw:
+        raise ValueError("The rays' wavelength_idx exceeds the number of wavelengths")
+    params = <mode_t*>malloc(Nray*sizeof(mode_t))
+    if params is NULL:
+        raise MemoryError()
+    ntiles = (Npt + TILE_SIZE - 1)//TILE_SIZE
+    try:
+        with nogil:
+            prepare_modes(rays, modes, wavelengths, time_ps, params)
+            for itile in prange(ntiles, num_threads=n_threads, schedule="dynamic"):
+                pt_end = (itile+1)*TILE_SIZE
+                if pt_end > Npt:
+                    pt_end = Npt
+                for iray in range(Nray):
+                    for ipt in range(itile*TILE_SIZE, pt_end):
+                        add_mode_field(params + iray, points, ipt, 
+                                       &out[params[iray].wavelength_idx,ipt,0])
+    finally:
+        free(params)
+    return np.asarray(out)
+
+        
+def build_point_grid(points, double points_per_cell=4.0):
+    """
+    Bins the points into a uniform grid of cells over their bounding box, with about
+    points_per_cell points per cell. Axes along which the points do not extend have
+    a single cell.
+    
+    returns - (lo, cell_size, shape, order, cell_start), where lo is the lower 
+            corner of the grid, order lists the point indices sorted by cell, and 
+            the points in cell i (the flat index into a grid of the given shape) 
+            are order[cell_start[i]:cell_start[i+1]].
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1,3)
+    n = points.shape[0]
+    shape = np.ones(3, dtype=np.intp)
+    if n == 0:
+        return np.zeros(3), np.ones(3), shape, np.zeros(0, np.intp), np.zeros(2, np.intp)
+    lo = points.min(axis=0)
+    extent = points.max(axis=0) - lo
+    active = extent > 1e-9*extent.max()
+    n_active = active.sum()
+    if n_active:
+        n_cells = max(n/points_per_cell, 1.0)
+        h = (np.prod(extent[active])/n_cells)**(1.0/n_active)
+        shape[active] = np.clip(np.ceil(extent[active]/h), 1, n)
+    cell_size = np.where(active, extent/shape, 1.0)
+    idx = np.minimum(((points - lo)/cell_size).astype(np.intp), shape-1)
+    flat = (idx[:,0]*shape[1] + idx[:,1])*shape[2] + idx[:,2]
+    order = np.argsort(flat, kind='stable')
+    cell_start = np.searchsorted(flat[order], np.arange(shape.prod()+1))
+    return lo, cell_size, shape, order.astype(np.intp), cell_start.astype(np.intp)
+
+
+@cython.cdivision(True)
+cdef double mode_radius_sq(double complex A, double complex B, double complex C,
+                           double complex detG0, double complex kz, double z, 
+                           double log_tol) nogil:
+    """
+    The squared transverse radius of the footprint of a mode (with the coefficients
+    as used in calc_mode_U()) at a distance z along the ray, beyond which its 
+    amplitude is below exp(-log_tol) of the on-axis amplitude. This is given by the
+    smallest eigenvalue of the imaginary part of the mode's quadratic form.
+    Returns INFINITY if the mode does not decay transversely.
+    """
+    cdef:
+        double complex denom = (1 + (z*(A+C)) + (z*z)*detG0) *2
+        double m11, m12, m22, lmin
+    m11 = (kz*(A + z*detG0)/denom).imag
+    m22 = (kz*(C + z*detG0)/denom).imag
+    m12 = (kz*B/denom).imag
+    lmin = 0.5*(m11 + m22) - sqrt(0.25*(m11 - m22)*(m11 - m22) + m12*m12)
+    if lmin <= 0:
+        return INFINITY
+    return log_tol/lmin
+
+
+cdef inline Py_ssize_t cell_index(double v, double lo, double size, Py_ssize_t n) nogil:
+    cdef double i = floor((v - lo)/size)
+    if i < 0:
+        return 0
+    if i > n-1:
+        return n-1
+    return <Py_ssize_t>i
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void add_truncated_mode(mode_t *m, np_.npy_float64[:,:] points, double *lo, double *hi,
+                             double *size, Py_ssize_t[:] shape, Py_ssize_t[:] order, 
+                             Py_ssize_t[:] cell_start, double log_tol, 
+                             double complex *out) nogil:
+    """
+    Adds the field of the mode m to out[3*ipt:3*ipt+3], at the points ipt within its 
+    footprint (see sum_gaussian_modes_truncated()), visiting only the cells of the 
+    point grid which overlap the footprint.
+    """
+    cdef:
+        Py_ssize_t icell, ncells, cell, j, ipt, i0, j0, k0, ni, nj, nk, axis
+        Py_ssize_t lo_idx[3]
+        Py_ssize_t hi_idx[3]
+        double origin[3]
+        double direction[3]
+        vector_t pt
+        double x, y, zmin, zmax, r2, r2_end, a, b, ext, cmin, cmax
+        double complex U, E1, E2
+        
+    origin[0] = m.origin.x
+    origin[1] = m.origin.y
+    origin[2] = m.origin.z
+    direction[0] = m.direction.x
+    direction[1] = m.direction.y
+    direction[2] = m.direction.z
+    
+    ### The range of distances along the ray, of the grid's bounding box
+    zmin = 0.0
+    zmax = 0.0
+    for axis in range(3):
+        a = (lo[axis] - origin[axis])*direction[axis]
+        b = (hi[axis] - origin[axis])*direction[axis]
+        zmin += a if a < b else b
+        zmax += b if a < b else a
+    
+    ### The mode footprint is widest at one end of the range
+    r2 = mode_radius_sq(m.A, m.B, m.C, m.detG0, m.kz, zmin, log_tol)
+    r2_end = mode_radius_sq(m.A, m.B, m.C, m.detG0, m.kz, zmax, log_tol)
+    if r2_end > r2:
+        r2 = r2_end
+    
+    ### The cells overlapping the bounding box of the footprint
+    for axis in range(3):
+        if r2 == INFINITY:
+            lo_idx[axis] = 0
+            hi_idx[axis] = shape[axis]-1
+            continue
+        a = origin[axis] + zmin*direction[axis]
+        b = origin[axis] + zmax*direction[axis]
+        ext = sqrt(r2*(1.0 - direction[axis]*direction[axis]))
+        cmin = (a if a < b else b) - ext
+        cmax = (b if a < b else a) + ext
+        if cmax < lo[axis] or cmin > hi[axis]:
+            return
+        lo_idx[axis] = cell_index(cmin, lo[axis], size[axis], shape[axis])
+        hi_idx[axis] = cell_index(cmax, lo[axis], size[axis], shape[axis])
+    
+    i0 = lo_idx[0]
+    j0 = lo_idx[1]
+    k0 = lo_idx[2]
+    ni = hi_idx[0] - i0 + 1
+    nj = hi_idx[1] - j0 + 1
+    nk = hi_idx[2] - k0 + 1
+    ncells = ni*nj*nk
+    
+    for icell in range(ncells):
+        cell = ((i0 + icell//(nj*nk))*shape[1] + (j0 + (icell//nk)%nj))*shape[2] \
+                    + (k0 + icell%nk)
+        for j in range(cell_start[cell], cell_start[cell+1]):
+            ipt = order[j]
+            pt.x = points[ipt,0]
+            pt.y = points[ipt,1]
+            pt.z = points[ipt,2]
+            pt = subvv_(pt, m.origin)
+            x = dotprod_(pt, m.E)
+            y = dotprod_(pt, m.H)
+            if (x*x + y*y) > r2:
+                continue
             
-            A.imag *= invk
-            B.imag *= invk
-            C.imag *= invk
-            detG0 = (A*C) - (B*B)
+            U = calc_mode_U(m.A, m.B, m.C, m.detG0, pt, m.E, m.H, m.direction, m.kz, 
+                            m.phase, m.inv_root_area)
+            E1 = m.E1_amp * U
+            E2 = m.E2_amp * U
             
-            for ipt in prange(Npt):
-                pt.x = points[ipt,0]
-                pt.y = points[ipt,1]
-                pt.z = points[ipt,2]
-                pt = subvv_(pt, ray.origin)
-                
-                U = calc_mode_U(A,B,C, detG0, pt, E, H, ray.direction, kz, phase, inv_root_area)
-                
-                E1 = ray.E1_amp * U
-                E2 = ray.E2_amp * U
-                
-                out[ipt,0] += (E1*E.x + E2*H.x)
-                out[ipt,1] += (E1*E.y + E2*H.y)
-                out[ipt,2] += (E1*E.z + E2*H.z)
-    return np.asarray(out)
+            out[3*ipt] += (E1*m.E.x + E2*m.H.x)
+            out[3*ipt+1] += (E1*m.E.y + E2*m.H.y)
+            out[3*ipt+2] += (E1*m.E.z + E2*m.H.z)
+
+
+@cython.boundscheck(False)  # Deactivate bounds checking
+@cython.wraparound(False)   # Deactivate negative indexing.
+@cython.cdivision(True)
+def sum_gaussian_modes_truncated(RayCollection rays,
+                                 double complex[:,:] modes, 
+                                 np_.npy_float64[:] wavelengths,
+                                 np_.npy_float64[:,:] points,
+                                 double time_ps,
+                                 double tolerance,
+                                 int num_threads=0):
+    """
+    As sum_gaussian_modes(), with the modes truncated at the given (relative) 
+    amplitude tolerance. As in sum_gaussian_modes_rays(), the rays are split into
+    one contiguous block per thread, each summed into its own copy of the field.
+    """
+    if not 0.0 < tolerance < 1.0:
+        raise ValueError("The tolerance must be between 0 and 1")
+    grid_lo, grid_size, grid_shape, grid_order, grid_start = build_point_grid(points)
+    cdef:
+        size_t iray, Nray=rays.n_rays, ray_end, chunk_size
+        Py_ssize_t Npt=points.shape[0], axis
+        int ichunk, n_chunks = field_thread_count(num_threads)
+        double[:] lo_view = grid_lo, size_view = grid_size
+        Py_ssize_t[:] shape = grid_shape, order = grid_order, cell_start = grid_start
+        double lo[3]
+        double hi[3]
+        double size[3]
+        double log_tol = log(1.0/tolerance)
+        complex_t[:,:,::1] partial
+        mode_t *params
+        
+    if Npt == 0 or Nray == 0:
+        return np.zeros((Npt,3), dtype=np.complex128)
+    for axis in range(3):
+        lo[axis] = lo_view[axis]
+        size[axis] = size_view[axis]
+        hi[axis] = lo[axis] + size[axis]*shape[axis]
+    if <size_t>n_chunks > Nray:
+        n_chunks = Nray
+    chunk_size = (Nray + n_chunks - 1)//n_chunks
+    partial = np.zeros((n_chunks,Npt,3), dtype=np.complex128)
+    params = <mode_t*>malloc(Nray*sizeof(mode_t))
+    if params is NULL:
+        raise MemoryError()
+    try:
+        with nogil:
+            prepare_modes(rays, modes, wavelengths, time_ps, params)
+            for ichunk in prange(n_chunks, num_threads=n_chunks, schedule="static", chunksize=1):
+                ray_end = (ichunk+1)*chunk_size
+                if ray_end > Nray:
+                    ray_end = Nray
+                for iray in range(ichunk*chunk_size, ray_end):
+                    add_truncated_mode(params + iray, points, lo, hi, size, shape, order,
+                                       cell_start, log_tol, &partial[ichunk,0,0])
+    finally:
+        free(params)
+    return np.asarray(partial).sum(axis=0)
 
         
 cdef double complex calc_mode_U(double complex A,
@@ -423,4 +911,5 @@ def apply_mode_curvature(GaussletCollection gc, double[:] A, double[:] B, double
             shift = addvv_(shift, multvs_(y, (-C[i]*py - B[i]*px)) )
             para.direction = norm_(addvv_(shift, para.direction))
             ###Not finished
+    gc.version += 1
     return 
@@ -2,12 +2,12 @@
 cimport cython
 
 cdef extern from "math.h":
-    double sqrt(double arg)
-    double fabs(double arg)
-    double sin(double arg)
-    double cos(double arg)
-    double atan2(double y, double x)
-    double erf(double arg)
+    double sqrt(double arg) nogil
+    double fabs(double arg) nogil
+    double sin(double arg) nogil
+    double cos(double arg) nogil
+    double atan2(double y, double x) nogil
+    double erf(double arg) nogil
     double M_PI
     
 cdef extern from "float.h":
@@ -15,16 +15,16 @@ cdef extern from "float.h":
 
 IF UNAME_SYSNAME == "Windows":
     cdef extern from "complex.h":
-        double complex csqrt "sqrt" (double complex)
-        double cabs "abs" (double complex)
-        double complex cexp "exp" (double complex)
+        double complex csqrt "sqrt" (double complex) nogil
+        double cabs "abs" (double complex) nogil
+        double complex cexp "exp" (double complex) nogil
 	
     cdef double complex I = 1j
 ELSE:
     cdef extern from "complex.h":
-        double complex csqrt (double complex)
-        double cabs (double complex)
-        double complex cexp (double complex)
+        double complex csqrt (double complex) nogil
+        double cabs (double complex) nogil
+        double complex cexp (double complex) nogil
         double complex I
     
 cdef:
@@ -41,7 +41,7 @@ import numpy as np
 cimport numpy as np_
 
 
-cdef ray_t convert_to_sp(ray_t ray, vector_t normal):
+cdef ray_t convert_to_sp(ray_t ray, vector_t normal) nogil:
     """Project the E-field components of a given ray
     onto the S- and P-polarisations defined by the 
     surface normal
@@ -144,6 +144,19 @@ cdef double sellmeier_5(double wavelen, double[:] coefs):
         n += coefs[2*i + 1] * (wavelen**coefs[2*i+2])
         
         
+def rebuild_dispersion_curve(cls, formula_id, coefs, absorption, wavelength_min, 
+                             wavelength_max, state):
+    """Unpickles a BaseDispersionCurve, or python subclass, without calling
+    the subclass constructor.
+    """
+    obj = cls.__new__(cls)
+    BaseDispersionCurve.__init__(obj, formula_id, coefs, absorption, 
+                                 wavelength_min, wavelength_max)
+    if state:
+        obj.__dict__.update(state)
+    return obj
+
+
 cdef class BaseDispersionCurve(object):
     """
     Base class for DispersionCurve objects. This extension class provides 
@@ -222,6 +235,11 @@ cdef class BaseDispersionCurve(object):
             
         return n_out
     
+    def __reduce__(self):
+        return rebuild_dispersion_curve, (type(self), self.formula_id, np.asarray(self.coefs),
+                                          self.absorption, self.wavelength_min,
+                                          self.wavelength_max, getattr(self, '__dict__', None))
+    
     def evaluate_n(self, wavelen):
         """
         Calculates the complex refractive index for the given wavelengths.
@@ -242,7 +260,7 @@ cdef class OpaqueMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         pass
     
     
@@ -257,7 +275,7 @@ cdef class TransparentMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         cdef:
             vector_t normal
             ray_t sp_ray
@@ -282,7 +300,7 @@ cdef class PECMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -342,7 +360,7 @@ cdef class PartiallyReflectiveMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -401,7 +419,7 @@ cdef class LinearPolarisingMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -490,7 +508,7 @@ cdef class WaveplateMaterial(InterfaceMaterial):
         self.fast_axis = kwds.get("fast_axis", (1.0,0,0))
             
             
-    cdef ray_t apply_retardance_c(self, ray_t r):
+    cdef ray_t apply_retardance_c(self, ray_t r) nogil:
         cdef:
             complex_t E1=r.E1_amp, retard=self.retardance_
         r.E1_amp.real = E1.real*retard.real - E1.imag*retard.imag
@@ -517,7 +535,7 @@ cdef class WaveplateMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -584,7 +602,7 @@ cdef class DielectricMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -681,7 +699,7 @@ cdef class DielectricMaterial(InterfaceMaterial):
                                    vector_t point, #position of intercept
                                    orientation_t orient,
                                    unsigned int ray_type_id, #bool, if True, it's a reflected ray
-                                   ):
+                                   ) nogil:
         cdef:
             vector_t cosThetaNormal, normal, out_dir
             para_t para_out
@@ -752,7 +770,7 @@ cdef class FullDielectricMaterial(DielectricMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -887,7 +905,7 @@ cdef class SingleLayerCoatedMaterial(FullDielectricMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -1089,7 +1107,7 @@ cdef class CoatedDispersiveMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -1255,7 +1273,7 @@ cdef class CoatedDispersiveMaterial(InterfaceMaterial):
                                    vector_t point, #position of intercept
                                    orientation_t orient,
                                    unsigned int ray_type_id, #bool, if True, it's a reflected ray
-                                   ):
+                                   ) nogil:
         cdef:
             vector_t cosThetaNormal, normal, out_dir
             para_t para_out
@@ -1333,7 +1351,7 @@ cdef class DiffractionGratingMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -1406,7 +1424,7 @@ cdef class DiffractionGratingMaterial(InterfaceMaterial):
                                    vector_t point, #position of intercept
                                    orientation_t orient,
                                    unsigned int ray_type_id, #bool, if True, it's a reflected ray
-                                   ):        
+                                   ) nogil:        
         cdef:
             para_t para_out
             vector_t reflected, normal, tangent, tangent2
@@ -1441,7 +1459,8 @@ cdef class DiffractionGratingMaterial(InterfaceMaterial):
         
         k_z = 1 - (k_x*k_x) - (k_y*k_y) #Apply Pythagoras to get z-component
         if k_z < 0: #diffracted ray is evanescent
-            print("Error. Parabasal reflection is imaginary!")
+            with gil:
+                print("Error. Parabasal reflection is imaginary!")
             #return #Then we're in trouble!
         k_z = sign * sqrt(k_z) 
         
@@ -1502,7 +1521,7 @@ cdef class CircularApertureMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         cdef:
             vector_t normal
             ray_t sp_ray
@@ -1579,7 +1598,7 @@ cdef class RectangularApertureMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         cdef:
             vector_t normal, p
             ray_t sp_ray
@@ -1646,6 +1665,11 @@ cdef class ResampleGaussletMaterial(InterfaceMaterial):
         self.captured_rays = GaussletCollection(size)
         if func is not None:
             self.eval_func = func
+            
+    pickle_exclude = ('eval_func',)
+    
+    def pickle_args(self):
+        return (), {'eval_func': self._evaluation_func}
         
     property eval_func:
         def __get__(self):
@@ -1664,7 +1688,7 @@ cdef class ResampleGaussletMaterial(InterfaceMaterial):
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
         Capture each incident ray in an internal GaussletCollection.
         """
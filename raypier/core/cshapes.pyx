@@ -2,12 +2,12 @@
 cdef extern from "math.h":
     double M_PI
     double sqrt(double) nogil
-    double atan2 (double y, double x )
-    double pow(double x, double y)
-    double fabs(double)
-    double cos(double)
-    double sin(double)
-    double acos(double)
+    double atan2 (double y, double x ) nogil
+    double pow(double x, double y) nogil
+    double fabs(double) nogil
+    double cos(double) nogil
+    double sin(double) nogil
+    double acos(double) nogil
 
 
 from .ctracer cimport Shape, sep_, \
@@ -15,6 +15,15 @@ from .ctracer cimport Shape, sep_, \
             addvv_, multvs_, mag_, cross_
             
 import numpy as np
+
+
+def union_bounds(b1, b2):
+    """The bounding rectangle of two rectangles (xmin, xmax, ymin, ymax), 
+    either of which may be None (unbounded).
+    """
+    if b1 is None or b2 is None:
+        return None
+    return (min(b1[0],b2[0]), max(b1[1],b2[1]), min(b1[2],b2[2]), max(b1[3],b2[3]))
             
 
 cdef class LogicalOpShape(Shape):
@@ -38,8 +47,14 @@ cdef class InvertShape(LogicalOpShape):
     def __cinit__(self, Shape shape):
         self.shape = shape
         
-    cdef bint point_inside_c(self, double x, double y):
+    def pickle_args(self):
+        return (self.shape,), {}
+        
+    cdef bint point_inside_c(self, double x, double y) nogil:
         return 1 & (~self.shape.point_inside_c(x,y))
+    
+    def get_bounds(self):
+        return None
             
             
 cdef class BooleanShape(LogicalOpShape):
@@ -51,21 +66,39 @@ cdef class BooleanShape(LogicalOpShape):
         self.shape1 = shape1
         self.shape2 = shape2
         
+    def pickle_args(self):
+        return (self.shape1, self.shape2), {}
+        
         
 cdef class BooleanAND(BooleanShape):
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         return (<Shape>self.shape1).point_inside_c(x,y) & (<Shape>self.shape2).point_inside_c(x,y)
     
+    def get_bounds(self):
+        b1 = self.shape1.get_bounds()
+        b2 = self.shape2.get_bounds()
+        if b1 is None:
+            return b2
+        if b2 is None:
+            return b1
+        return (max(b1[0],b2[0]), min(b1[1],b2[1]), max(b1[2],b2[2]), min(b1[3],b2[3]))
+    
     
 cdef class BooleanOR(BooleanShape):
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         return (<Shape>self.shape1).point_inside_c(x,y) | (<Shape>self.shape2).point_inside_c(x,y)
     
+    def get_bounds(self):
+        return union_bounds(self.shape1.get_bounds(), self.shape2.get_bounds())
+    
     
 cdef class BooleanXOR(BooleanShape):
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         return (<Shape>self.shape1).point_inside_c(x,y) ^ (<Shape>self.shape2).point_inside_c(x,y)
     
+    def get_bounds(self):
+        return union_bounds(self.shape1.get_bounds(), self.shape2.get_bounds())
+    
     
 cdef class BasicShape(LogicalOpShape):
     cdef:
@@ -106,7 +139,7 @@ cdef class CircleShape(BasicShape):
     def __cinit__(self, **kwds):
         self.radius = kwds.get("radius", 1.0)
         
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         cdef:
             double dx = x-self.centre_x
             double dy = y-self.centre_y
@@ -115,6 +148,10 @@ cdef class CircleShape(BasicShape):
         else:
             return 0
         
+    def get_bounds(self):
+        r = fabs(self.radius)
+        return (self.centre_x-r, self.centre_x+r, self.centre_y-r, self.centre_y+r)
+        
         
 cdef class RectangleShape(BasicShape):
     cdef:
@@ -125,7 +162,7 @@ cdef class RectangleShape(BasicShape):
         self.width = kwds.get("width", 5.0)
         self.height = kwds.get("height", 7.0)
         
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         cdef:
             double dx = x-self.centre_x
             double dy = y-self.centre_y
@@ -134,6 +171,11 @@ cdef class RectangleShape(BasicShape):
             return 1
         else:
             return 0
+        
+    def get_bounds(self):
+        w = fabs(self.width)/2
+        h = fabs(self.height)/2
+        return (self.centre_x-w, self.centre_x+w, self.centre_y-h, self.centre_y+h)
 
 
 cdef class PolygonShape(BasicShape):
@@ -147,7 +189,15 @@ cdef class PolygonShape(BasicShape):
         def __set__(self, val):
             self._coordinates = val
             
-    cdef bint point_inside_c(self, double X, double Y):
+    def get_bounds(self):
+        if self._coordinates is None:
+            return None
+        pts = self.coordinates
+        if len(pts)==0:
+            return None
+        return (pts[:,0].min(), pts[:,0].max(), pts[:,1].min(), pts[:,1].max())
+            
+    cdef bint point_inside_c(self, double X, double Y) nogil:
         cdef:
             int i, size, ct=0
             double y1, y2, x1, x2
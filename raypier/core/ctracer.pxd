@@ -2,7 +2,7 @@
 from _operator import invert
 
 cdef extern from "math.h":
-    double sqrt(double arg)
+    double sqrt(double arg) nogil
 
 cdef extern from "float.h":
     #double INFINITY
@@ -14,6 +14,7 @@ cdef:
 
 
 from libc.stdlib cimport malloc, free
+from cpython.ref cimport PyObject
 
 ############################################
 ### C type declarations for internal use ###
@@ -25,6 +26,32 @@ cdef struct vector_t:
 cdef struct orientation_t:
     vector_t normal, tangent
 
+### Blocks of ray data which are awaiting release, once no buffer views of them remain
+cdef struct retired_t:
+    void **blocks
+    size_t n_blocks
+
+### An axis-aligned bounding box
+cdef struct aabb_t:
+    vector_t lo, hi
+
+### Settings and tallies for the pruning of low-power rays after each generation
+cdef struct prune_t:
+    double min_power, roulette_power
+    unsigned long long seed, generation
+    size_t n_pruned, n_killed, n_survived
+    double pruned_power, killed_power, added_power
+
+### Performance counters for one face (and its material), recorded when profiling
+cdef struct face_profile_t:
+    unsigned long long tests, hits, intersect_ns, iterations, children, eval_ns
+
+### The counters of each face, for each thread, of a profiled trace
+cdef struct profile_t:
+    face_profile_t *data
+    size_t n_faces
+    int n_threads
+
 
 IF UNAME_SYSNAME == "Windows":
     ctypedef double complex complex_t
@@ -53,6 +80,14 @@ cdef packed struct ray_t:
     ##objects
     #object face, end_face, child_refl, child_trans
     
+### A compact ray record for geometric (illumination / stray-light) tracing. The
+### polarisation and phase are dropped; only the (unpolarised) power is carried.
+cdef packed struct geo_ray_t:
+    vector_t origin, direction
+    complex_t refractive_index
+    double length, power
+    unsigned int wavelength_idx, parent_idx, end_face_idx, ray_type_id
+    
 ### Structure for parabasal rays. These only carry geometric information.
 cdef packed struct para_t:
     #vectors
@@ -134,9 +169,18 @@ cdef class RayCollection(RayArrayView):
         double[:] _wavelengths
         
         int[:,:] _neighbours
-        double _mtime        
+        double _mtime
+        
+        readonly unsigned long version #incremented when the rays are modified
+        public object mode_cache #see core.fields.cached_modes()
+        
+        object _base #an adopted numpy array, owning the ray data
+        bint _adopted
+        unsigned int _n_exports
+        retired_t _retired
+        size_t _block_bytes #allocated size of the ray data
 
-    cdef add_ray_c(self, ray_t r)
+    cdef void add_ray_c(self, ray_t r) nogil
     cdef void reset_length_c(self, double max_length)
     
     cdef double get_mtime(self, unsigned long guard)
@@ -150,8 +194,17 @@ cdef class GaussletCollection:
         readonly unsigned long n_rays, max_size
         GaussletCollection _parent
         double[:] _wavelengths
+        
+        readonly unsigned long version #incremented when the gausslets are modified
+        public object mode_cache #see core.fields.cached_modes()
+        
+        object _base
+        bint _adopted
+        unsigned int _n_exports
+        retired_t _retired
+        size_t _block_bytes #allocated size of the ray data
 
-    cdef add_gausslet_c(self, gausslet_t r)
+    cdef void add_gausslet_c(self, gausslet_t r) nogil
     cdef void extend_c(self, GaussletCollection gc)
     cdef void reset_length_c(self, double max_length)
     
@@ -159,6 +212,25 @@ cdef class GaussletCollection:
 cdef class GaussletBaseRayView(RayArrayView):
     cdef:
         GaussletCollection owner
+        
+        
+cdef class GeometricRayCollection:
+    cdef: 
+        geo_ray_t *rays
+        readonly unsigned long n_rays, max_size
+        GeometricRayCollection _parent
+        double[:] _wavelengths
+        
+        readonly unsigned long version #incremented when the rays are modified
+        
+        object _base
+        bint _adopted
+        unsigned int _n_exports
+        retired_t _retired
+        size_t _block_bytes #allocated size of the ray data
+
+    cdef void add_ray_c(self, geo_ray_t r) nogil
+    cdef void reset_length_c(self, double max_length)
     
 
 cdef class RayCollectionIterator:
@@ -183,14 +255,14 @@ cdef class InterfaceMaterial(object):
                             unsigned int ray_idx,
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays)
+                            RayCollection new_rays) nogil
     
     cdef para_t eval_parabasal_ray_c(self, ray_t *base_ray,  
                                      vector_t direction, #incoming ray direction
                                    vector_t point, #position of intercept
                                    orientation_t orient,
                                    unsigned int ray_type_id, #indicates if it's a transmitted or reflected ray 
-                                   )
+                                   ) nogil
     
     cdef void eval_decomposed_rays_c(self, GaussletCollection child_rays)
 
@@ -203,7 +275,7 @@ cdef class Distortion:
     
     
 cdef class Shape:
-    cdef bint point_inside_c(self, double x, double y)
+    cdef bint point_inside_c(self, double x, double y) nogil
 
 
 cdef class Face(object):
@@ -217,23 +289,79 @@ cdef class Face(object):
         public short int invert_normal
         public unsigned int count    
 
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray)
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil
 
-    cdef vector_t compute_normal_c(self, vector_t p)
-    cdef vector_t compute_tangent_c(self, vector_t p)
+    cdef vector_t compute_normal_c(self, vector_t p) nogil
+    cdef vector_t compute_tangent_c(self, vector_t p) nogil
 
 
 cdef class FaceList(object):
     """A group of faces which share a transform"""
     cdef transform_t trans
     cdef transform_t inv_trans
-    cdef public list faces
+    cdef list _faces
+    cdef PyObject **_face_ptrs #borrowed references to the members of _faces
+    cdef size_t n_faces
+    cdef aabb_t *_face_bounds #local bounds of each face, or NULL if not computed
+    cdef aabb_t bounds_ #global bounds of the whole FaceList
+    cdef bint bounded
     cdef public object owner
 
     cpdef void sync_transforms(self)
-    cdef int intersect_c(self, ray_t *ray, vector_t end_point)
-    cdef int intersect_para_c(self, para_t *ray, vector_t ray_end, Face face)
-    cdef orientation_t compute_orientation_c(self, Face face, vector_t point)
+    cdef void sync_faces_c(self)
+    cdef int intersect_c(self, ray_t *ray, vector_t end_point, bint use_bounds=*) nogil
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, size_t n, double *length, 
+                                int *face_idx, double *work) nogil
+    cdef int intersect_para_c(self, para_t *ray, vector_t ray_end, Face face) nogil
+    cdef orientation_t compute_orientation_c(self, Face face, vector_t point) nogil
+
+
+cdef struct bvh_node_t:
+    aabb_t box
+    int child #index of the first of two child nodes, or -1 for a leaf
+    int start, count #range of FaceLists in a leaf
+
+
+cdef class FaceListBVH(object):
+    """A bounding-volume hierarchy over a list of FaceLists"""
+    cdef:
+        bvh_node_t *nodes
+        int n_nodes
+        readonly int depth #number of levels of nodes
+        int *items #FaceList indices, ordered by leaf
+        int *unbounded #FaceLists without finite bounds
+        int n_unbounded
+        PyObject **set_ptrs
+        list _face_sets
+        object _boxes
+        readonly unsigned int build_count
+
+    cdef build(self, list bounds)
+    cdef build_node(self, int node_idx, object boxes, object centres, object members, 
+                    int start, object set_idx, int level)
+    cdef int intersect_c(self, ray_t *ray, vector_t ray_end, PyObject **face_set) nogil
+
+
+cdef class CompiledScene(object):
+    """The FaceLists and Faces of a static scene, prepared for tracing"""
+    cdef:
+        readonly list face_sets, all_faces, decomp_faces
+        readonly FaceListBVH bvh
+        readonly double max_length
+        public bint face_major
+        PyObject **set_ptrs
+        PyObject **face_ptrs
+        size_t n_sets, n_faces
+        object _wavelengths
+        prune_t prune
+        list _branching
+        size_t _generation
+        unsigned long long decomp_ns
+        
+    cdef size_t child_capacity(self, size_t n_rays)
+    cdef void record_branching(self, size_t n_rays, size_t n_children)
 
 
 ##################################
@@ -244,12 +372,18 @@ cdef RayCollection trace_segment_c(RayCollection rays,
                                     list face_sets,
                                     list all_faces,
                                     list decomp_faces,
-                                    float max_length)
+                                    float max_length,
+                                    int num_threads=*,
+                                    FaceListBVH bvh=*)
 
 cdef GaussletCollection trace_gausslet_c(GaussletCollection gausslets, 
                                     list face_sets, 
                                     list all_faces,
                                     list decomp_faces,
-                                    double max_length)
+                                    double max_length,
+                                    int num_threads=*,
+                                    FaceListBVH bvh=*)
+
+cdef double ray_power_(ray_t ray) nogil
 
-cdef double ray_power_(ray_t ray)
+cdef void record_iterations_c(Face face, unsigned long n) nogil
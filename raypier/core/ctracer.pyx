@@ -24,7 +24,12 @@ cdef:
     public unsigned int GAUSSLET=1<<1
     public unsigned int PARABASAL=1<<2
     
-from libc.stdlib cimport malloc, free, realloc
+from libc.stdlib cimport malloc, calloc, free, realloc
+from libc.string cimport memset
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+from cpython.ref cimport PyObject
+from cython.parallel cimport prange
+cimport openmp
 
 cdef extern from "stdlib.h" nogil:
     void *memcpy(void *str1, void *str2, size_t n)
@@ -35,6 +40,10 @@ cimport numpy as np_
 
 cdef:
     int NPARA = 6
+    size_t MIN_CHUNK_SIZE = 64 #smallest block of rays handed to a tracing thread
+    int BVH_LEAF_SIZE = 2 #maximum number of FaceLists in a leaf of a FaceListBVH
+    int POOL_MIN_CLASS = 10 #smallest pooled block of ray data is 2**10 bytes
+    int POOL_N_CLASSES = 48
     
 
 ray_dtype = np.dtype([('origin', np.double, (3,)),
@@ -69,6 +78,24 @@ gausslet_dtype = np.dtype([
                     ('para_rays', para_dtype, (NPARA,))
                     ])
 
+geo_ray_dtype = np.dtype([('origin', np.double, (3,)),
+                        ('direction', np.double, (3,)),
+                        ('refractive_index', np.complex128),
+                        ('length', np.double),
+                        ('power', np.double),
+                        ('wavelength_idx', np.uint32),
+                        ('parent_idx', np.uint32),
+                        ('end_face_idx', np.uint32),
+                        ('ray_type_id', np.uint32)
+                        ])
+
+### PEP-3118 format strings for ray_t, gausslet_t and geo_ray_t, used to export the 
+### RayCollection, GaussletCollection and GeometricRayCollection data through the 
+### buffer protocol
+cdef bytes RAY_FORMAT = memoryview(np.empty(0, dtype=ray_dtype)).format.encode('ascii')
+cdef bytes GAUSSLET_FORMAT = memoryview(np.empty(0, dtype=gausslet_dtype)).format.encode('ascii')
+cdef bytes GEO_RAY_FORMAT = memoryview(np.empty(0, dtype=geo_ray_dtype)).format.encode('ascii')
+
 
 ##############################
 ### Vector maths functions ###
@@ -255,17 +282,224 @@ def norm(a):
     a_ = norm_(a_)
     return (a_.x, a_.y, a_.z)
 
+##################################
+### Bounding box functions
+##################################
+
+cdef inline aabb_t empty_aabb_c() nogil:
+    cdef aabb_t out
+    out.lo.x = out.lo.y = out.lo.z = INF
+    out.hi.x = out.hi.y = out.hi.z = -INF
+    return out
+
+cdef inline aabb_t union_aabb_c(aabb_t a, aabb_t b) nogil:
+    cdef aabb_t out
+    out.lo.x = min(a.lo.x, b.lo.x)
+    out.lo.y = min(a.lo.y, b.lo.y)
+    out.lo.z = min(a.lo.z, b.lo.z)
+    out.hi.x = max(a.hi.x, b.hi.x)
+    out.hi.y = max(a.hi.y, b.hi.y)
+    out.hi.z = max(a.hi.z, b.hi.z)
+    return out
+
+cdef aabb_t transform_aabb_c(transform_t t, aabb_t box) nogil:
+    """Returns the axis-aligned bounds of the transformed box"""
+    cdef:
+        aabb_t out = empty_aabb_c(), corner
+        vector_t p
+        int i
+    for i in range(8):
+        p.x = box.hi.x if (i & 1) else box.lo.x
+        p.y = box.hi.y if (i & 2) else box.lo.y
+        p.z = box.hi.z if (i & 4) else box.lo.z
+        corner.lo = corner.hi = transform_c(t, p)
+        out = union_aabb_c(out, corner)
+    return out
+
+cdef double intersect_aabb_c(aabb_t *box, vector_t p1, vector_t p2) nogil:
+    """Returns the fractional distance (from 0.0 to 1.0) along the line-segment
+    from p1 to p2 at which it enters the box, or -1 if the segment misses the box.
+    """
+    cdef:
+        double tmin=0.0, tmax=1.0, t1, t2, o, d, lo, hi
+        int i
+    for i in range(3):
+        if i==0:
+            o = p1.x; d = p2.x - p1.x; lo = box.lo.x; hi = box.hi.x
+        elif i==1:
+            o = p1.y; d = p2.y - p1.y; lo = box.lo.y; hi = box.hi.y
+        else:
+            o = p1.z; d = p2.z - p1.z; lo = box.lo.z; hi = box.hi.z
+        if d == 0.0:
+            if o < lo or o > hi:
+                return -1
+        else:
+            t1 = (lo - o)/d
+            t2 = (hi - o)/d
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > tmin:
+                tmin = t1
+            if t2 < tmax:
+                tmax = t2
+            if tmin > tmax:
+                return -1
+    return tmin
+
+##################################
+### Pickling support
+##################################
+
+def object_state(obj, exclude=()):
+    """Collects the state of an extension-type object for pickling, from the
+    attributes (descriptors) of each class in its MRO. Private names (with a
+    leading underscore) and the excluded names are skipped, as are attributes
+    which cannot be read. Typed memoryviews are converted to numpy arrays. The
+    __dict__ of a python subclass is included.
+
+    returns - a dict of the attribute values, in base-class-first order
+    """
+    state = {}
+    for klass in reversed(type(obj).__mro__):
+        for name, attr in vars(klass).items():
+            if name.startswith('_') or name in exclude or name in state:
+                continue
+            if not hasattr(attr, '__set__') or isinstance(attr, property):
+                continue
+            try:
+                value = getattr(obj, name)
+            except Exception:
+                continue
+            if type(value).__name__ == '_memoryviewslice': #each module has its own type
+                value = np.array(value)
+            elif isinstance(value, np.ndarray) and value.dtype == object:
+                continue
+            state[name] = value
+    state.update(getattr(obj, '__dict__', {}))
+    return state
+
+
+def set_object_state(obj, dict state):
+    """Restores the state given by object_state(). Read-only attributes are
+    skipped.
+    """
+    for name, value in state.items():
+        try:
+            setattr(obj, name, value)
+        except AttributeError:
+            pass
+
+
+def rebuild_object(cls, tuple args, dict kwds, dict state):
+    """Unpickles an object reduced by reduce_object()"""
+    obj = cls.__new__(cls, *args, **kwds)
+    obj.__setstate__(state)
+    return obj
+
+
+def reduce_object(obj):
+    """Reduces an extension-type object (a Face, Shape, Distortion or
+    InterfaceMaterial) for pickling. The object is re-created with the
+    arguments given by its pickle_args() method, then its state (as given
+    by __getstate__()) is restored.
+    """
+    args, kwds = obj.pickle_args()
+    return rebuild_object, (type(obj), tuple(args), dict(kwds), obj.__getstate__())
+
+
+def rebuild_ray(cls, bytes data, double max_length=1000.0):
+    """Unpickles a Ray, ParabasalRay or Gausslet from its C-structure"""
+    cdef:
+        Ray ray
+        ParabasalRay para
+        Gausslet g
+    if issubclass(cls, Ray):
+        ray = cls.__new__(cls)
+        memcpy(&ray.ray, <char*>data, sizeof(ray_t))
+        ray.max_length = max_length
+        return ray
+    elif issubclass(cls, ParabasalRay):
+        para = cls.__new__(cls)
+        memcpy(&para.ray, <char*>data, sizeof(para_t))
+        para.max_length = max_length
+        return para
+    g = cls.__new__(cls)
+    memcpy(&g.gausslet, <char*>data, sizeof(gausslet_t))
+    return g
+
+
+def collection_dtype(cls):
+    """The numpy dtype of the ray data of a ray collection class"""
+    if issubclass(cls, RayCollection):
+        return ray_dtype
+    elif issubclass(cls, GaussletCollection):
+        return gausslet_dtype
+    elif issubclass(cls, GeometricRayCollection):
+        return geo_ray_dtype
+    raise TypeError("Expecting a RayCollection, GaussletCollection or "
+                    "GeometricRayCollection class, not %s"%cls)
+
+
+def reduce_collection(rays, int protocol, wavelengths, neighbours=None):
+    """Reduces a ray collection for pickling. With pickle protocol 5 or higher, the
+    ray data is passed as a PickleBuffer, so it can be sent out-of-band without
+    copying. The parent of the rays is not kept.
+    """
+    from pickle import PickleBuffer
+    if protocol >= 5:
+        data = PickleBuffer(rays)
+    else:
+        data = rays.as_array().tobytes()
+    return rebuild_collection, (type(rays), data, wavelengths, neighbours)
+
+
+def rebuild_collection(cls, data, wavelengths=None, neighbours=None):
+    """Unpickles a ray collection reduced by reduce_collection(). A writeable
+    buffer (as given for out-of-band data) is adopted without copying.
+    """
+    arr = np.frombuffer(data, dtype=collection_dtype(cls))
+    rays = cls.from_array(arr, copy=not (arr.flags.writeable and arr.flags.aligned))
+    if wavelengths is not None:
+        rays.wavelengths = wavelengths
+    if neighbours is not None:
+        rays.neighbours = neighbours
+    return rays
+
+
+def collection_to_shared_memory(rays):
+    """Copies the data of a ray collection into a new SharedMemory block"""
+    from multiprocessing.shared_memory import SharedMemory
+    data = rays.as_array()
+    shm = SharedMemory(create=True, size=max(data.nbytes, 1))
+    np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+    return shm
+
+
+def attach_shared_memory(str name, size_t n_rays, dtype):
+    """Opens the named SharedMemory block.
+
+    returns - (array, shm), a view of the first n_rays items of the block as 
+            an array of the given dtype, and the SharedMemory
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=name)
+    return np.ndarray((n_rays,), dtype=dtype, buffer=shm.buf), shm
+
+
 ##################################
 ### Python extension types
 ##################################
 
 cdef class Transform:
-    
-    def __init__(self, rotation=[[1,0,0],[0,1,0],[0,0,1]], 
+
+    def __init__(self, rotation=[[1,0,0],[0,1,0],[0,0,1]],
                         translation=[0,0,0]):
         self.rotation = rotation
         self.translation = translation
-        
+
+    def __reduce__(self):
+        return Transform, (self.rotation, self.translation)
+
     property rotation:
         def __set__(self, rot):
             cdef transform_t t
@@ -333,6 +567,10 @@ cdef class ParabasalRay:
         return "Parabasal Ray(o=%s, d=%s)"%(str(self.origin),
                                             str(self.direction))
         
+    def __reduce__(self):
+        return rebuild_ray, (type(self), (<char*>&self.ray)[:sizeof(para_t)], 
+                             self.max_length)
+        
     property origin:
         """Origin coordinates of the ray"""
         def __get__(self):
@@ -403,6 +641,10 @@ cdef class Ray:
     def __repr__(self):
         return "Ray(o=%s, d=%s)"%(str(self.origin),
                                             str(self.direction))
+        
+    def __reduce__(self):
+        return rebuild_ray, (type(self), (<char*>&self.ray)[:sizeof(ray_t)], 
+                             self.max_length)
                 
     property origin:
         """Origin coordinates of the ray"""
@@ -670,6 +912,9 @@ cdef class Gausslet:
         return "Gausslet(o=%s, d=%s)"%(str(self.base_ray.origin),
                                             str(self.base_ray.direction))
         
+    def __reduce__(self):
+        return rebuild_ray, (type(self), (<char*>&self.gausslet)[:sizeof(gausslet_t)])
+        
     property base_ray:
         def __get__(self):
             cdef:
@@ -699,8 +944,371 @@ cdef class Gausslet:
                 self.gausslet.para[i] = paras[i].ray
                 
                 
+cdef void *resize_block_c(void *block, size_t n_bytes, size_t new_bytes, bint adopted,
+                          unsigned int n_exports, retired_t *retired) nogil:
+    """Resizes a block of ray data, preserving the first n_bytes. If the block 
+    is adopted from a numpy array, or is still exported through the buffer protocol, 
+    it is copied to a new block rather than reallocated. Exported blocks are put on
+    the retired list, to be freed once the last buffer view has been released.
+    """
+    cdef void *out
+    
+    if not (adopted or n_exports):
+        return realloc(block, new_bytes)
+    out = malloc(new_bytes)
+    if out is NULL:
+        return NULL
+    memcpy(out, block, n_bytes)
+    if not adopted:
+        retired.blocks = <void**>realloc(retired.blocks, (retired.n_blocks+1)*sizeof(void*))
+        retired.blocks[retired.n_blocks] = block
+        retired.n_blocks += 1
+    return out
+
+
+cdef void release_retired_c(retired_t *retired) nogil:
+    cdef size_t i
+    for i in range(retired.n_blocks):
+        free(retired.blocks[i])
+    free(retired.blocks)
+    retired.blocks = NULL
+    retired.n_blocks = 0
+    
+    
+### A pool of free blocks of ray data, for re-use by new RayCollections and
+### GaussletCollections. Blocks are binned by size, block_pool[k] holding blocks
+### of at least 2**k bytes. The pool is only accessed with the GIL held.
+cdef struct pool_bin_t:
+    void **blocks
+    size_t n_blocks, capacity
+    
+cdef:
+    pool_bin_t block_pool[48] #POOL_N_CLASSES bins
+    size_t pool_bytes = 0
+    size_t pool_limit = 256*1024*1024
+    size_t pool_hits = 0, pool_misses = 0
+    
+    
+cdef int pool_class_c(size_t n_bytes, bint round_up):
+    """The pool bin for a block of n_bytes, rounding the size up to the next 
+    power of two for an allocation, or down for a released block.
+    """
+    cdef int k = 0
+    while (k < 63) and ((<size_t>1)<<(k+1)) <= n_bytes:
+        k += 1
+    if round_up and ((<size_t>1)<<k) < n_bytes:
+        k += 1
+    if k < POOL_MIN_CLASS:
+        k = POOL_MIN_CLASS if round_up else -1
+    return k
+    
+    
+cdef void *pool_acquire_c(size_t n_bytes, size_t *capacity):
+    """Returns a block of at least n_bytes, taken from the pool if possible. The 
+    usable size of the block is put in capacity.
+    """
+    cdef:
+        int k = pool_class_c(n_bytes, 1)
+        pool_bin_t *b
+        size_t size
+        
+    if k >= POOL_N_CLASSES:
+        capacity[0] = n_bytes
+        return malloc(n_bytes)
+    global pool_bytes, pool_hits, pool_misses
+    size = (<size_t>1)<<k
+    capacity[0] = size
+    b = block_pool + k
+    if b.n_blocks:
+        b.n_blocks -= 1
+        pool_bytes -= size
+        pool_hits += 1
+        return b.blocks[b.n_blocks]
+    pool_misses += 1
+    return malloc(size)
+    
+    
+cdef void pool_release_c(void *block, size_t n_bytes):
+    """Returns a block of n_bytes to the pool, or frees it if the pool is full."""
+    cdef:
+        int k = pool_class_c(n_bytes, 0)
+        pool_bin_t *b
+        size_t size
+        
+    global pool_bytes
+    if block is NULL:
+        return
+    if k < 0 or k >= POOL_N_CLASSES:
+        free(block)
+        return
+    size = (<size_t>1)<<k
+    b = block_pool + k
+    if pool_bytes + size > pool_limit:
+        free(block)
+        return
+    if b.n_blocks == b.capacity:
+        b.capacity = 2*b.capacity + 4
+        b.blocks = <void**>realloc(b.blocks, b.capacity*sizeof(void*))
+    b.blocks[b.n_blocks] = block
+    b.n_blocks += 1
+    pool_bytes += size
+    
+    
+def clear_pool():
+    """Frees all blocks held in the pool of ray data."""
+    cdef:
+        int k
+        size_t i
+        pool_bin_t *b
+    global pool_bytes
+    for k in range(POOL_N_CLASSES):
+        b = block_pool + k
+        for i in range(b.n_blocks):
+            free(b.blocks[i])
+        b.n_blocks = 0
+    pool_bytes = 0
+    
+    
+def set_pool_limit(size_t n_bytes):
+    """Sets the maximum number of bytes of freed ray data to keep in the pool, for 
+    re-use by new RayCollections and GaussletCollections. Zero disables the pool.
+    """
+    global pool_limit
+    pool_limit = n_bytes
+    if pool_bytes > pool_limit:
+        clear_pool()
+        
+        
+def pool_stats():
+    """Returns a dict describing the pool of ray data: the bytes held, the limit
+    and the number of allocations served from the pool (hits) or not (misses).
+    """
+    return {'bytes': pool_bytes, 'limit': pool_limit,
+            'hits': pool_hits, 'misses': pool_misses}
+
+
+##################################
+### Performance counters
+##################################
+
+profile_dtype = np.dtype([('face', 'U64'),
+                          ('material', 'U64'),
+                          ('material_idx', np.int32), #distinguishes shared materials
+                          ('tests', np.uint64), #calls to the face intersect_c()
+                          ('hits', np.uint64), #rays ending on the face
+                          ('intersect_ns', np.uint64),
+                          ('iterations', np.uint64), #root-finding iterations of the face
+                          ('children', np.uint64), #child rays from the material
+                          ('eval_ns', np.uint64)
+                          ])
+
+cdef extern from *:
+    """
+    /* The profile recorded by the trace running in each thread (see set_thread_profile_c()) */
+    #if defined(_MSC_VER)
+    static __declspec(thread) void *raypier_thread_profile = NULL;
+    #else
+    static __thread void *raypier_thread_profile = NULL;
+    #endif
+    """
+    void *raypier_thread_profile
+
+
+cdef inline unsigned long long clock_ns_c() nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return (<unsigned long long>ts.tv_sec)*1000000000ULL + ts.tv_nsec
+
+
+cdef inline void set_thread_profile_c(profile_t *profile) nogil:
+    """Sets the profile (or NULL) in which the calling thread records the counters
+    of the faces it traces. The trace kernels set this around the tracing of each
+    block of rays, so the faces need not be given the profile.
+    """
+    global raypier_thread_profile
+    raypier_thread_profile = <void*>profile
+
+
+cdef inline face_profile_t *profile_face_c(profile_t *profile, Face face) nogil:
+    """The counters of the face in the profile for the calling thread, or NULL if 
+    the profile is NULL.
+    """
+    cdef int thread
+    if profile is NULL or face.idx < 0 or <size_t>face.idx >= profile.n_faces:
+        return NULL
+    thread = openmp.omp_get_thread_num()
+    if thread >= profile.n_threads:
+        return NULL
+    return profile.data + thread*profile.n_faces + face.idx
+
+
+cdef inline face_profile_t *face_profile_c(Face face) nogil:
+    """The counters of the face for the calling thread, or NULL if its trace
+    is not being profiled.
+    """
+    return profile_face_c(<profile_t*>raypier_thread_profile, face)
+
+
+cdef void record_iterations_c(Face face, unsigned long n) nogil:
+    """Records n iterations of an iterative intersection of the face. Called
+    by face types which find their intersections by root-finding.
+    """
+    cdef face_profile_t *prof = face_profile_c(face)
+    if prof is not NULL:
+        prof.iterations += n
+
+
+cdef inline double intersect_face_c(Face face, vector_t p1, vector_t p2,
+                                    int is_base_ray) nogil:
+    """Calls face.intersect_c(), recording the call if profiling"""
+    cdef:
+        face_profile_t *prof = face_profile_c(face)
+        unsigned long long t0
+        double dist
+    if prof is NULL:
+        return face.intersect_c(p1, p2, is_base_ray)
+    t0 = clock_ns_c()
+    dist = face.intersect_c(p1, p2, is_base_ray)
+    prof.intersect_ns += clock_ns_c() - t0
+    prof.tests += 1
+    return dist
+
+
+cdef inline void intersect_face_batch_c(Face face, vector_t *p1, vector_t *p2, double *dist,
+                                        size_t n, int is_base_ray) nogil:
+    """Calls face.intersect_batch_c(), recording the calls if profiling"""
+    cdef:
+        face_profile_t *prof = face_profile_c(face)
+        unsigned long long t0
+    if prof is NULL:
+        face.intersect_batch_c(p1, p2, dist, n, is_base_ray)
+        return
+    t0 = clock_ns_c()
+    face.intersect_batch_c(p1, p2, dist, n, is_base_ray)
+    prof.intersect_ns += clock_ns_c() - t0
+    prof.tests += n
+
+
+cdef inline void eval_child_rays_c(Face face, ray_t *ray, unsigned int idx, vector_t point,
+                                   orientation_t orient, RayCollection new_rays) nogil:
+    """Evaluates the child rays of a ray ending on the face, with the face
+    material, recording the hit if profiling.
+    """
+    cdef:
+        face_profile_t *prof = face_profile_c(face)
+        unsigned long long t0
+        size_t n_rays = new_rays.n_rays
+    if prof is NULL:
+        face.material.eval_child_ray_c(ray, idx, point, orient, new_rays)
+        return
+    t0 = clock_ns_c()
+    face.material.eval_child_ray_c(ray, idx, point, orient, new_rays)
+    prof.eval_ns += clock_ns_c() - t0
+    prof.hits += 1
+    prof.children += new_rays.n_rays - n_rays
+
+
+cdef class TraceProfile(object):
+    """Performance counters for the faces with idx below n_faces (and their 
+    materials), recorded by the traces which are given the profile (see
+    CompiledScene.trace()). The counters are kept for each thread of a trace,
+    so a profile should be given to only one trace at a time.
+    """
+    cdef profile_t profile
+
+    def __cinit__(self, size_t n_faces):
+        self.profile.n_threads = openmp.omp_get_num_procs()
+        self.profile.data = <face_profile_t*>calloc(self.profile.n_threads*n_faces + 1,
+                                                    sizeof(face_profile_t))
+        if self.profile.data is NULL:
+            raise MemoryError()
+        self.profile.n_faces = n_faces
+
+    def __dealloc__(self):
+        free(self.profile.data)
+
+    def results(self, list all_faces):
+        """The counters of each face, summed over the threads.
+
+        :param list all_faces: the faces, in order of their idx
+        :return: a numpy record array with the profile_dtype, giving the counters
+                of each face and its material
+        """
+        cdef:
+            size_t i, n = min(len(all_faces), self.profile.n_faces)
+            int thread
+            face_profile_t total, prof
+            Face face
+            dict material_ids = {}
+
+        out = np.zeros(len(all_faces), dtype=profile_dtype)
+        for i in range(len(all_faces)):
+            face = all_faces[i]
+            out['face'][i] = (<bytes>face.name).decode('ascii', 'replace')
+            out['material'][i] = type(face.material).__name__
+            out['material_idx'][i] = material_ids.setdefault(id(face.material),
+                                                             len(material_ids))
+            if i >= n:
+                continue
+            memset(&total, 0, sizeof(face_profile_t))
+            for thread in range(self.profile.n_threads):
+                prof = self.profile.data[thread*self.profile.n_faces + i]
+                total.tests += prof.tests
+                total.hits += prof.hits
+                total.intersect_ns += prof.intersect_ns
+                total.iterations += prof.iterations
+                total.children += prof.children
+                total.eval_ns += prof.eval_ns
+            out['tests'][i] = total.tests
+            out['hits'][i] = total.hits
+            out['intersect_ns'][i] = total.intersect_ns
+            out['iterations'][i] = total.iterations
+            out['children'][i] = total.children
+            out['eval_ns'][i] = total.eval_ns
+        return out
+
+
+cdef int export_buffer_c(object owner, Py_buffer *buffer, void *block, size_t n_items,
+                         size_t itemsize, bytes fmt) except -1:
+    """Fills in the Py_buffer for a 1D array of n_items structures at block."""
+    cdef Py_ssize_t *shape = <Py_ssize_t*>malloc(2*sizeof(Py_ssize_t))
+    if shape is NULL:
+        raise MemoryError()
+    shape[0] = n_items
+    shape[1] = itemsize
+    buffer.buf = block
+    buffer.obj = owner
+    buffer.len = n_items*itemsize
+    buffer.readonly = 0
+    buffer.itemsize = itemsize
+    buffer.format = fmt
+    buffer.ndim = 1
+    buffer.shape = shape
+    buffer.strides = shape + 1
+    buffer.suboffsets = NULL
+    buffer.internal = shape
+    return 0
+
+
+cdef check_adoptable(np_.ndarray data):
+    if data.ndim != 1 or not (data.flags.c_contiguous and data.flags.aligned and data.flags.writeable):
+        raise ValueError("Only a writeable, aligned and contiguous 1D array can be adopted without copying")
+    
+    
+cdef object field_view(np_.ndarray data, str name):
+    """A read-only view of a single field of a structured array"""
+    out = data[name]
+    out.flags.writeable = False
+    return out
+
+
 cdef class RayArrayView:
-    """An abstract class to provide the API for ray_t member access from python / numpy"""
+    """An abstract class to provide the API for ray_t member access from python / numpy.
+    
+    The array properties (origin, direction, length etc.) are read-only views of the
+    ray data, so no copying is done. If more rays are added to the collection after
+    a view is taken, the view remains valid but no longer follows the collection.
+    """
     cdef void set_ray_c(self, unsigned long i, ray_t ray):
         return
     
@@ -737,209 +1345,79 @@ cdef class RayArrayView:
             ray_list.append(r)
         return ray_list
     
+    def as_array(self):
+        """Returns a live view of the rays as a numpy array with the ray_dtype.
+        The data is not copied, so modifying the array modifies the rays.
+        """
+        raise NotImplementedError()
+    
     property origin:
         def __get__(self):
-            cdef:
-                unsigned long n=self.get_n_rays()
-                np_.ndarray out = np.empty((n,3), dtype='d')
-                size_t i
-                vector_t v
-            for i in xrange(n):
-                v = self.get_ray_c(i).origin
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return field_view(self.as_array(), 'origin')
         
     property direction:
         def __get__(self):
-            cdef:
-                unsigned long n=self.get_n_rays()
-                np_.ndarray out = np.empty((n,3), dtype='d')
-                size_t i
-                vector_t v
-            for i in xrange(n):
-                v = self.get_ray_c(i).direction
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return field_view(self.as_array(), 'direction')
         
     property normal:
         def __get__(self):
-            cdef:
-                unsigned long n=self.get_n_rays()
-                np_.ndarray out = np.empty((n,3), dtype='d')
-                size_t i
-                vector_t v
-            for i in xrange(n):
-                v = self.get_ray_c(i).normal
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return field_view(self.as_array(), 'normal')
         
     property E_vector:
         def __get__(self):
-            cdef:
-                unsigned long n=self.get_n_rays()
-                np_.ndarray out = np.empty((n,3), dtype='d')
-                size_t i
-                vector_t v
-            for i in xrange(n):
-                v = self.get_ray_c(i).E_vector
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return field_view(self.as_array(), 'E_vector')
         
     property refractive_index:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.complex128)
-                np_.ndarray rr,ii
-                size_t i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(N):
-                n = self.get_ray_c(i).refractive_index
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return field_view(self.as_array(), 'refractive_index')
         
     property E1_amp:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.complex128)
-                np_.ndarray rr,ii
-                size_t i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(N):
-                n = self.get_ray_c(i).E1_amp
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return field_view(self.as_array(), 'E1_amp')
         
     property E2_amp:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.complex128)
-                np_.ndarray rr,ii
-                size_t i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(N):
-                n = self.get_ray_c(i).E2_amp
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return field_view(self.as_array(), 'E2_amp')
         
     property length:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype='d')
-                size_t i
-                double v
-            for i in xrange(N):
-                v = self.get_ray_c(i).length
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'length')
         
     property phase:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype='d')
-                size_t i
-                double v
-            for i in xrange(N):
-                v = self.get_ray_c(i).phase
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'phase')
         
     property accumulated_path:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty((N,), dtype='d' )
-                size_t i
-            for i in xrange(N):
-                out[i] = self.get_ray_c(i).accumulated_path
-            return out
+            return field_view(self.as_array(), 'accumulated_path')
         
     property wavelength_idx:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.uint32)
-                size_t i
-                double v
-            for i in xrange(N):
-                v = self.get_ray_c(i).wavelength_idx
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'wavelength_idx')
         
     property parent_idx:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.uint32)
-                size_t i
-                unsigned int v
-            for i in xrange(N):
-                v = self.get_ray_c(i).parent_idx
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'parent_idx')
         
     property end_face_idx:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.uint32)
-                size_t i
-                unsigned int v
-            for i in xrange(N):
-                v = self.get_ray_c(i).end_face_idx
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'end_face_idx')
         
     property ray_type_id:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty(N, dtype=np.uint32)
-                size_t i
-                unsigned int v
-            for i in xrange(N):
-                v = self.get_ray_c(i).ray_type_id
-                out[i] = v
-            return out
+            return field_view(self.as_array(), 'ray_type_id')
         
     property termination:
         def __get__(self):
-            cdef:
-                unsigned long N=self.get_n_rays()
-                np_.ndarray out = np.empty((N,3), dtype='d')
-                size_t i
-                vector_t v
-                ray_t r
-            for i in xrange(N):
-                r = self.get_ray_c(i)
-                v = addvv_(r.origin, 
-                           multvs_(r.direction, 
-                                    r.length))
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            data = self.as_array()
+            return data['origin'] + data['direction']*data['length'][:,None]
+        
+    property power:
+        """The optical power of each ray"""
+        def __get__(self):
+            data = self.as_array()
+            return (np.abs(data['E1_amp'])**2 + np.abs(data['E2_amp'])**2)*\
+                        data['refractive_index'].real
     
     
 
@@ -951,44 +1429,95 @@ cdef class RayCollection(RayArrayView):
     The RayCollection is of variable length, in that it can grow as individual rays are added to it.
     Internally, the memory allocated to the array of ray_t structures is re-allocated to increase
     its capacity.
+    
+    The ray data is exported through the buffer protocol, so np.asarray(rc) gives a live 
+    array with the ray_dtype, without copying.
     """
     
     def __cinit__(self, size_t max_size):
-        self.rays = <ray_t*>malloc(max_size*sizeof(ray_t))
+        cdef size_t capacity
+        self.rays = <ray_t*>pool_acquire_c(max_size*sizeof(ray_t), &capacity)
         self.n_rays = 0
-        self.max_size = max_size
+        self.max_size = capacity // sizeof(ray_t)
+        self._block_bytes = capacity
         self._mtime = 0.0
+        self._neighbours = None
+        self.version = 0
+        self.mode_cache = None
+        self._adopted = 0
+        self._n_exports = 0
+        self._retired.blocks = NULL
+        self._retired.n_blocks = 0
         
     def __dealloc__(self):
-        free(self.rays)
+        if not self._adopted:
+            pool_release_c(self.rays, self._block_bytes)
+        release_retired_c(&self._retired)
         
     def __len__(self):
         return self.n_rays
     
+    property allocated_bytes:
+        """The number of bytes allocated for the ray_t array (enough for
+        at least len(self) rays).
+        """
+        def __get__(self):
+            return self.max_size*sizeof(ray_t)
+    
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        export_buffer_c(self, buffer, self.rays, self.n_rays, sizeof(ray_t), RAY_FORMAT)
+        self._n_exports += 1
+        
+    def __releasebuffer__(self, Py_buffer *buffer):
+        free(buffer.internal)
+        self._n_exports -= 1
+        if self._n_exports == 0:
+            release_retired_c(&self._retired)
+            
+    def as_array(self):
+        """Returns a live view of the rays as a numpy array with the ray_dtype.
+        The data is not copied, so modifying the array modifies the rays (call
+        touch() afterwards, so cached data derived from the rays is recomputed).
+        """
+        return np.asarray(self).view(ray_dtype)
+    
+    def touch(self):
+        """Marks the rays as modified, by incrementing the version. The methods 
+        modifying the rays do this themselves.
+        """
+        self.version += 1
+    
     cdef ray_t get_ray_c(self, unsigned long i):
         return self.rays[i]
     
     cdef void set_ray_c(self, unsigned long i, ray_t ray):
         self.rays[i] = ray
+        self.version += 1
         
     cdef unsigned long get_n_rays(self):
         return self.n_rays
         
-    cdef add_ray_c(self, ray_t r):
+    cdef void add_ray_c(self, ray_t r) nogil:
         if self.n_rays == self.max_size:
             if self.max_size == 0:
                 self.max_size = 1
             else:
                 self.max_size *= 2
-            self.rays = <ray_t*>realloc(self.rays, self.max_size*sizeof(ray_t))
+            self.rays = <ray_t*>resize_block_c(self.rays, self.n_rays*sizeof(ray_t), 
+                                               self.max_size*sizeof(ray_t), self._adopted,
+                                               self._n_exports, &self._retired)
+            self._block_bytes = self.max_size*sizeof(ray_t)
+            self._adopted = 0
         self.rays[self.n_rays] = r
         self.n_rays += 1
+        self.version += 1
         
     cdef void reset_length_c(self, double max_length):
         cdef:
             size_t i
         for i in range(self.n_rays):
             self.rays[i].length = max_length
+        self.version += 1
             
     def reset_length(self, double max_length=INF):
         """Sets the length of all rays in this RayCollection to Infinity
@@ -1014,6 +1543,7 @@ cdef class RayCollection(RayArrayView):
         """Empties this RayCollection (by setting the count to zero)
         """
         self.n_rays = 0
+        self.version += 1
         
     def __iter__(self):
         return RayCollectionIterator(self)
@@ -1032,6 +1562,7 @@ cdef class RayCollection(RayArrayView):
         
         def __set__(self, wl_list):
             self._wavelengths = np.ascontiguousarray(wl_list, dtype=np.double)
+            self.version += 1
     
     cdef double get_mtime(self, unsigned long guard):
         cdef:
@@ -1092,11 +1623,14 @@ cdef class RayCollection(RayArrayView):
                         return np.asarray(self._neighbours)
                 self._eval_neighbours(self._parent.neighbours)
                 self._mtime = time.monotonic()
+                if self._neighbours is None:
+                    return None
                 return np.asarray(self._neighbours)
                 
         def __set__(self, int[:,:] nb):
             self._neighbours = nb
             self._mtime = time.monotonic()
+            self.version += 1
             
     property parent:
         def __get__(self):
@@ -1105,29 +1639,83 @@ cdef class RayCollection(RayArrayView):
         def __set__(self, RayCollection rc):
             self._parent = rc
             self._neighbours = None
-            self._wavelengths = rc._wavelengths
+            self.version += 1
+            if rc is not None:
+                self._wavelengths = rc._wavelengths
     
     @classmethod
-    def from_array(cls, np_.ndarray data):
+    def from_array(cls, np_.ndarray data, bint copy=True):
         """Creates a new RayCollection from the given numpy array. The array
         dtype should be a ctracer.ray_dtype. The data is copied into the 
-        RayCollection
+        RayCollection, unless copy is False, in which case the RayCollection adopts
+        the array data (which must be a writeable, contiguous 1D array). The array 
+        then shares its data with the RayCollection, until more rays are added.
         """
         cdef int size=data.shape[0]
-        cdef RayCollection rc = RayCollection(size)
+        cdef RayCollection rc
         assert data.dtype is ray_dtype
+        if not copy:
+            check_adoptable(data)
+            rc = RayCollection(0)
+            pool_release_c(rc.rays, rc._block_bytes)
+            rc.rays = <ray_t *>data.data
+            rc._base = data
+            rc._adopted = 1
+            rc.n_rays = rc.max_size = size
+            return rc
+        rc = RayCollection(size)
         data = np.ascontiguousarray(data)
         memcpy(rc.rays, <np_.float64_t *>data.data, size*sizeof(ray_t))
         rc.n_rays = size
         return rc
     
+    def __reduce_ex__(self, protocol):
+        try:
+            wavelengths = self.wavelengths
+        except AttributeError: #the wavelengths have not been set
+            wavelengths = None
+        return reduce_collection(self, protocol, wavelengths, self.neighbours)
+    
+    def to_shared_memory(self):
+        """Copies the rays into a new multiprocessing SharedMemory block, which
+        other processes can map with RayCollection.attach(). The caller should 
+        close() and unlink() the block when it is no longer needed.
+        
+        returns - the SharedMemory
+        """
+        return collection_to_shared_memory(self)
+    
+    @classmethod
+    def attach(cls, str name, size_t n_rays, wavelengths=None):
+        """Creates a RayCollection sharing the data of the named SharedMemory block 
+        (see to_shared_memory()), without copying. The block is kept open while
+        the RayCollection uses it. If more rays are added, the data is copied 
+        out of the block.
+        
+        :param str name: the name of the SharedMemory block
+        :param int n_rays: the number of rays in the block
+        :param wavelengths: the wavelengths list, if any
+        """
+        cdef RayCollection rc
+        data, shm = attach_shared_memory(name, n_rays, ray_dtype)
+        rc = cls.from_array(data, copy=False)
+        ### The array view of the block must be released before it is closed
+        rc._base = (shm, data)
+        if wavelengths is not None:
+            rc.wavelengths = wavelengths
+        return rc
+    
     
 cdef class GaussletBaseRayView(RayArrayView):
     def __cinit__(self, GaussletCollection owner):
         self.owner = owner
+        
+    def __reduce__(self):
+        return GaussletBaseRayView, (self.owner,)
 
     cdef void set_ray_c(self, unsigned long i, ray_t ray):
         self.owner.rays[i].base_ray = ray
+        self.owner.version += 1
     
     cdef ray_t get_ray_c(self, unsigned long i):
         return self.owner.rays[i].base_ray
@@ -1138,6 +1726,12 @@ cdef class GaussletBaseRayView(RayArrayView):
     def __len__(self):
         return self.owner.n_rays
     
+    def as_array(self):
+        """Returns a live view of the base rays as a (strided) numpy array with 
+        the ray_dtype.
+        """
+        return self.owner.as_array()['base_ray']
+    
     def copy_as_array(self):
         cdef:
             unsigned int i, N = self.get_n_rays()
@@ -1161,33 +1755,81 @@ cdef class GaussletCollection:
     """
     
     def __cinit__(self, size_t max_size):
-        self.rays = <gausslet_t*>malloc(max_size*sizeof(gausslet_t))
+        cdef size_t capacity
+        self.rays = <gausslet_t*>pool_acquire_c(max_size*sizeof(gausslet_t), &capacity)
         self.n_rays = 0
-        self.max_size = max_size
+        self.max_size = capacity // sizeof(gausslet_t)
+        self._block_bytes = capacity
+        self._adopted = 0
+        self._n_exports = 0
+        self._retired.blocks = NULL
+        self._retired.n_blocks = 0
+        self.version = 0
+        self.mode_cache = None
         
     def __dealloc__(self):
-        free(self.rays)
+        if not self._adopted:
+            pool_release_c(self.rays, self._block_bytes)
+        release_retired_c(&self._retired)
         
     def __len__(self):
         return self.n_rays
     
+    property allocated_bytes:
+        """The number of bytes allocated for the gausslet_t array (enough for
+        at least len(self) rays).
+        """
+        def __get__(self):
+            return self.max_size*sizeof(gausslet_t)
+    
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        export_buffer_c(self, buffer, self.rays, self.n_rays, sizeof(gausslet_t), GAUSSLET_FORMAT)
+        self._n_exports += 1
+        
+    def __releasebuffer__(self, Py_buffer *buffer):
+        free(buffer.internal)
+        self._n_exports -= 1
+        if self._n_exports == 0:
+            release_retired_c(&self._retired)
+            
+    def as_array(self):
+        """Returns a live view of the gausslets as a numpy array with the 
+        gausslet_dtype. The data is not copied, so modifying the array modifies 
+        the gausslets (call touch() afterwards, so cached data derived from the 
+        gausslets is recomputed).
+        """
+        return np.asarray(self).view(gausslet_dtype)
+    
+    def touch(self):
+        """Marks the gausslets as modified, by incrementing the version. The methods 
+        modifying the gausslets do this themselves.
+        """
+        self.version += 1
+    
     property parent:
         def __get__(self):
             return self._parent
         
         def __set__(self, GaussletCollection gc):
             self._parent = gc
-            self._wavelengths = gc._wavelengths
+            if gc is not None:
+                self._wavelengths = gc._wavelengths
+            self.version += 1
         
-    cdef add_gausslet_c(self, gausslet_t r):
+    cdef void add_gausslet_c(self, gausslet_t r) nogil:
         if self.n_rays == self.max_size:
             if self.max_size == 0:
                 self.max_size = 1
             else:
                 self.max_size *= 2
-            self.rays = <gausslet_t*>realloc(self.rays, self.max_size*sizeof(gausslet_t))
+            self.rays = <gausslet_t*>resize_block_c(self.rays, self.n_rays*sizeof(gausslet_t),
+                                                    self.max_size*sizeof(gausslet_t), self._adopted,
+                                                    self._n_exports, &self._retired)
+            self._block_bytes = self.max_size*sizeof(gausslet_t)
+            self._adopted = 0
         self.rays[self.n_rays] = r
         self.n_rays += 1
+        self.version += 1
         
     def add_gausslet(self, Gausslet r):
         """Adds the given Ray instance to this collection
@@ -1211,6 +1853,7 @@ cdef class GaussletCollection:
             self.rays[i].base_ray.length = max_length
             for j in range(6):
                 self.rays[i].para[j].length = max_length
+        self.version += 1
         
             
     def reset_length(self, double max_length=INF):
@@ -1222,6 +1865,7 @@ cdef class GaussletCollection:
         """Empties this RayCollection (by setting the count to zero)
         """
         self.n_rays = 0
+        self.version += 1
         
     def get_gausslet_list(self):
         """Returns the contents of this RayCollection as a list of Rays
@@ -1247,6 +1891,7 @@ cdef class GaussletCollection:
         if idx >= self.n_rays:
             raise IndexError("Attempting to set index %d from a size %d array"%(idx, self.n_rays))
         self.rays[idx] = r.gausslet
+        self.version += 1
         
     def __iter__(self):
         return GaussletCollectionIterator(self)
@@ -1265,23 +1910,77 @@ cdef class GaussletCollection:
     cdef void extend_c(self, GaussletCollection gc):
         if (self.n_rays + gc.n_rays) > self.max_size:
             self.max_size = (self.n_rays*2 + gc.n_rays)
-            self.rays = <gausslet_t*>realloc(self.rays, self.max_size*sizeof(gausslet_t))
+            self.rays = <gausslet_t*>resize_block_c(self.rays, self.n_rays*sizeof(gausslet_t),
+                                                    self.max_size*sizeof(gausslet_t), self._adopted,
+                                                    self._n_exports, &self._retired)
+            self._block_bytes = self.max_size*sizeof(gausslet_t)
+            self._adopted = 0
         memcpy(self.rays + self.n_rays, gc.rays, gc.n_rays*sizeof(gausslet_t))
         self.n_rays += gc.n_rays
+        self.version += 1
+    
+    def __reduce_ex__(self, protocol):
+        try:
+            wavelengths = self.wavelengths
+        except AttributeError: #the wavelengths have not been set
+            wavelengths = None
+        return reduce_collection(self, protocol, wavelengths)
+    
+    def to_shared_memory(self):
+        """Copies the gausslets into a new multiprocessing SharedMemory block, which
+        other processes can map with GaussletCollection.attach(). The caller should 
+        close() and unlink() the block when it is no longer needed.
+        
+        returns - the SharedMemory
+        """
+        return collection_to_shared_memory(self)
     
     @classmethod
-    def from_array(cls, np_.ndarray data):
-        """Creates a new RayCollection from the given numpy array. The array
-        dtype should be a ctracer.ray_dtype. The data is copied into the 
-        RayCollection
+    def attach(cls, str name, size_t n_rays, wavelengths=None):
+        """Creates a GaussletCollection sharing the data of the named SharedMemory block 
+        (see to_shared_memory()), without copying. The block is kept open while
+        the GaussletCollection uses it. If more gausslets are added, the data is copied 
+        out of the block.
+        
+        :param str name: the name of the SharedMemory block
+        :param int n_rays: the number of gausslets in the block
+        :param wavelengths: the wavelengths list, if any
+        """
+        cdef GaussletCollection rc
+        data, shm = attach_shared_memory(name, n_rays, gausslet_dtype)
+        rc = cls.from_array(data, copy=False)
+        ### The array view of the block must be released before it is closed
+        rc._base = (shm, data)
+        if wavelengths is not None:
+            rc.wavelengths = wavelengths
+        return rc
+    
+    @classmethod
+    def from_array(cls, np_.ndarray data, bint copy=True):
+        """Creates a new GaussletCollection from the given numpy array. The array
+        dtype should be a ctracer.gausslet_dtype. The data is copied into the 
+        GaussletCollection, unless copy is False, in which case the array data is 
+        adopted (see RayCollection.from_array).
         """
         cdef: 
             int size=data.shape[0]
-            GaussletCollection rc = GaussletCollection(size)
+            GaussletCollection rc
             
         if data.dtype != gausslet_dtype:
             raise ValueError("Array must have gausslet_dtype dtype")
         
+        if not copy:
+            check_adoptable(data)
+            rc = GaussletCollection(0)
+            pool_release_c(rc.rays, rc._block_bytes)
+            rc.rays = <gausslet_t *>data.data
+            rc._base = data
+            rc._adopted = 1
+            rc.n_rays = rc.max_size = size
+            return rc
+        
+        rc = GaussletCollection(size)
+        data = np.ascontiguousarray(data)
         memcpy(rc.rays, <np_.float64_t *>data.data, size*sizeof(gausslet_t))
         rc.n_rays = size
         return rc
@@ -1386,6 +2085,7 @@ cdef class GaussletCollection:
                 para = &(gc.para[j])
                 a = dotprod_(subvv_(o, para.origin),d) / dotprod_(para.direction, d)
                 para.origin = addvv_(para.origin, multvs_(para.direction,a))
+        self.version += 1
                 
     def scale_amplitude(self, double complex scale):
         cdef:
@@ -1394,6 +2094,7 @@ cdef class GaussletCollection:
         for i in range(self.n_rays):
             self.rays[i].base_ray.E1_amp *= scale
             self.rays[i].base_ray.E2_amp *= scale
+        self.version += 1
     
     def config_parabasal_rays(self, double[:] wavelength_list, double radius, double working_dist):
         """
@@ -1447,6 +2148,7 @@ cdef class GaussletCollection:
                 gc.para[j+1].normal = gc.base_ray.normal 
                 gc.para[j].length = gc.base_ray.length
                 gc.para[j+1].length = gc.base_ray.length
+        self.version += 1
                 
     property base_rays:
         def __get__(self):
@@ -1475,82 +2177,317 @@ cdef class GaussletCollection:
         
         def __set__(self, wl_list):
             self._wavelengths = np.asarray(wl_list, dtype=np.double)
+            self.version += 1
         
     property para_origin:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,6,3), dtype='d')
-                size_t i, j
-                vector_t v
-            for i in xrange(self.n_rays):
-                for j in xrange(6):
-                    v = self.rays[i].para[j].origin
-                    out[i,j,0] = v.x
-                    out[i,j,1] = v.y
-                    out[i,j,2] = v.z
-            return out
+            return field_view(self.as_array()['para_rays'], 'origin')
         
     property para_direction:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,6,3), dtype='d')
-                size_t i, j
-                vector_t v
-            for i in xrange(self.n_rays):
-                for j in range(6):
-                    v = self.rays[i].para[j].direction
-                    out[i,j,0] = v.x
-                    out[i,j,1] = v.y
-                    out[i,j,2] = v.z
-            return out
+            return field_view(self.as_array()['para_rays'], 'direction')
         
     property para_normal:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,6,3), dtype='d')
-                size_t i, j
-                vector_t v
-            for i in xrange(self.n_rays):
-                for j in range(6):
-                    v = self.rays[i].para[j].normal
-                    out[i,j,0] = v.x
-                    out[i,j,1] = v.y
-                    out[i,j,2] = v.z
-            return out
+            return field_view(self.as_array()['para_rays'], 'normal')
         
     property para_termination:
         def __get__(self):
-            cdef:
-                np_.ndarray aout = np.empty((self.n_rays,6,3), dtype='d')
-                double [:,:,:] out = aout
-                size_t i,j
-                vector_t v
-                para_t *p
-            for i in xrange(self.n_rays):
-                for j in range(1,7):
-                    p = self.rays[i].para + j
-                    v = addvv_(p.origin, 
-                           multvs_(p.direction, 
-                                    p.length))
-                    out[i,j,0] = v.x
-                    out[i,j,1] = v.y
-                    out[i,j,2] = v.z
-            return aout
+            para = self.as_array()['para_rays']
+            return para['origin'] + para['direction']*para['length'][...,None]
         
     
-cdef class InterfaceMaterial(object):
-    """Abstract base class for objects describing
-    the materials characterics of a Face
-    """
+cdef class GeometricRayCollection:
+    """A list-like collection of geo_ray_t records, for geometric (illumination
+    or stray-light) tracing. 
     
-    def __cinit__(self):
+    Each record carries only the origin, direction, length, refractive index,
+    power, wavelength index and the parent link of a ray, at about half the size
+    of a ray_t. The rays are treated as unpolarised: when traced, each ray 
+    is given a circular polarisation, so that the s- and p-polarised powers are 
+    equal at every interface, and only the total power of the child rays is kept. 
+    
+    The data is exported through the buffer protocol, with the geo_ray_dtype.
+    """
+    def __cinit__(self, size_t max_size):
+        cdef size_t capacity
+        self.rays = <geo_ray_t*>pool_acquire_c(max_size*sizeof(geo_ray_t), &capacity)
+        self.n_rays = 0
+        self.max_size = capacity // sizeof(geo_ray_t)
+        self._block_bytes = capacity
+        self._adopted = 0
+        self._n_exports = 0
+        self._retired.blocks = NULL
+        self._retired.n_blocks = 0
+        self.version = 0
+        
+    def __dealloc__(self):
+        if not self._adopted:
+            pool_release_c(self.rays, self._block_bytes)
+        release_retired_c(&self._retired)
+        
+    def __len__(self):
+        return self.n_rays
+    
+    property allocated_bytes:
+        """The number of bytes allocated for the geo_ray_t array (enough for
+        at least len(self) rays).
+        """
+        def __get__(self):
+            return self.max_size*sizeof(geo_ray_t)
+    
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        export_buffer_c(self, buffer, self.rays, self.n_rays, sizeof(geo_ray_t), GEO_RAY_FORMAT)
+        self._n_exports += 1
+        
+    def __releasebuffer__(self, Py_buffer *buffer):
+        free(buffer.internal)
+        self._n_exports -= 1
+        if self._n_exports == 0:
+            release_retired_c(&self._retired)
+            
+    cdef void add_ray_c(self, geo_ray_t r) nogil:
+        if self.n_rays == self.max_size:
+            if self.max_size == 0:
+                self.max_size = 1
+            else:
+                self.max_size *= 2
+            self.rays = <geo_ray_t*>resize_block_c(self.rays, self.n_rays*sizeof(geo_ray_t), 
+                                                   self.max_size*sizeof(geo_ray_t), self._adopted,
+                                                   self._n_exports, &self._retired)
+            self._block_bytes = self.max_size*sizeof(geo_ray_t)
+            self._adopted = 0
+        self.rays[self.n_rays] = r
+        self.n_rays += 1
+        self.version += 1
+        
+    cdef void reset_length_c(self, double max_length):
+        cdef size_t i
+        for i in range(self.n_rays):
+            self.rays[i].length = max_length
+        self.version += 1
+            
+    def reset_length(self, double max_length=INF):
+        """Sets the length of all rays in this collection to max_length
+        """
+        self.reset_length_c(max_length)
+        
+    def as_array(self):
+        """Returns a live view of the rays as a numpy array with the geo_ray_dtype.
+        The data is not copied, so modifying the array modifies the rays (call
+        touch() afterwards).
+        """
+        return np.asarray(self).view(geo_ray_dtype)
+    
+    def touch(self):
+        """Marks the rays as modified, by incrementing the version. The methods 
+        modifying the rays do this themselves.
+        """
+        self.version += 1
+    
+    def copy_as_array(self):
+        """Returns the contents of this collection as a numpy array
+        (the data is always copied).
+        """
+        cdef np_.ndarray out = np.empty(self.n_rays, dtype=geo_ray_dtype)
+        memcpy(<np_.float64_t *>out.data, self.rays, self.n_rays*sizeof(geo_ray_t))
+        return out
+    
+    @classmethod
+    def from_array(cls, np_.ndarray data, bint copy=True):
+        """Creates a new GeometricRayCollection from the given numpy array, with the
+        geo_ray_dtype. The data is copied, unless copy is False, in which case the 
+        array data is adopted (see RayCollection.from_array).
+        """
+        cdef: 
+            int size=data.shape[0]
+            GeometricRayCollection rc
+            
+        if data.dtype != geo_ray_dtype:
+            raise ValueError("Array must have geo_ray_dtype dtype")
+        if not copy:
+            check_adoptable(data)
+            rc = GeometricRayCollection(0)
+            pool_release_c(rc.rays, rc._block_bytes)
+            rc.rays = <geo_ray_t *>data.data
+            rc._base = data
+            rc._adopted = 1
+            rc.n_rays = rc.max_size = size
+            return rc
+        rc = GeometricRayCollection(size)
+        data = np.ascontiguousarray(data)
+        memcpy(rc.rays, <np_.float64_t *>data.data, size*sizeof(geo_ray_t))
+        rc.n_rays = size
+        return rc
+    
+    def __reduce_ex__(self, protocol):
+        try:
+            wavelengths = self.wavelengths
+        except AttributeError: #the wavelengths have not been set
+            wavelengths = None
+        return reduce_collection(self, protocol, wavelengths)
+    
+    def to_shared_memory(self):
+        """Copies the rays into a new multiprocessing SharedMemory block, which
+        other processes can map with GeometricRayCollection.attach(). The caller should 
+        close() and unlink() the block when it is no longer needed.
+        
+        returns - the SharedMemory
+        """
+        return collection_to_shared_memory(self)
+    
+    @classmethod
+    def attach(cls, str name, size_t n_rays, wavelengths=None):
+        """Creates a GeometricRayCollection sharing the data of the named SharedMemory block 
+        (see to_shared_memory()), without copying. The block is kept open while
+        the GeometricRayCollection uses it. If more rays are added, the data is copied 
+        out of the block.
+        
+        :param str name: the name of the SharedMemory block
+        :param int n_rays: the number of rays in the block
+        :param wavelengths: the wavelengths list, if any
+        """
+        cdef GeometricRayCollection rc
+        data, shm = attach_shared_memory(name, n_rays, geo_ray_dtype)
+        rc = cls.from_array(data, copy=False)
+        ### The array view of the block must be released before it is closed
+        rc._base = (shm, data)
+        if wavelengths is not None:
+            rc.wavelengths = wavelengths
+        return rc
+    
+    @classmethod
+    def from_rays(cls, RayCollection rays):
+        """Creates a new GeometricRayCollection from the rays of a RayCollection,
+        keeping their power and wavelengths.
+        """
+        cdef:
+            size_t i
+            GeometricRayCollection rc = GeometricRayCollection(rays.n_rays)
+        for i in range(rays.n_rays):
+            rc.rays[i] = pack_geo_ray_c(rays.rays + i)
+        rc.n_rays = rays.n_rays
+        rc._wavelengths = rays._wavelengths
+        return rc
+    
+    property wavelengths:
+        def __get__(self):
+            return np.asarray(self._wavelengths)
+        
+        def __set__(self, wl_list):
+            self._wavelengths = np.asarray(wl_list, dtype=np.double)
+            self.version += 1
+            
+    property parent:
+        def __get__(self):
+            return self._parent
+        
+        def __set__(self, GeometricRayCollection rc):
+            self._parent = rc
+            self.version += 1
+            if rc is not None:
+                self._wavelengths = rc._wavelengths
+    
+    property origin:
+        def __get__(self):
+            return field_view(self.as_array(), 'origin')
+        
+    property direction:
+        def __get__(self):
+            return field_view(self.as_array(), 'direction')
+        
+    property refractive_index:
+        def __get__(self):
+            return field_view(self.as_array(), 'refractive_index')
+        
+    property length:
+        def __get__(self):
+            return field_view(self.as_array(), 'length')
+        
+    property power:
+        def __get__(self):
+            return field_view(self.as_array(), 'power')
+        
+    property wavelength_idx:
+        def __get__(self):
+            return field_view(self.as_array(), 'wavelength_idx')
+        
+    property parent_idx:
+        def __get__(self):
+            return field_view(self.as_array(), 'parent_idx')
+        
+    property end_face_idx:
+        def __get__(self):
+            return field_view(self.as_array(), 'end_face_idx')
+        
+    property ray_type_id:
+        def __get__(self):
+            return field_view(self.as_array(), 'ray_type_id')
+        
+    property termination:
+        def __get__(self):
+            data = self.as_array()
+            return data['origin'] + data['direction']*data['length'][:,None]
+        
+        
+cdef inline geo_ray_t pack_geo_ray_c(ray_t *ray) nogil:
+    """Reduces a ray_t to a geo_ray_t, keeping its power."""
+    cdef geo_ray_t out
+    out.origin = ray.origin
+    out.direction = ray.direction
+    out.refractive_index = ray.refractive_index
+    out.length = ray.length
+    out.power = ray_power_(ray[0])
+    out.wavelength_idx = ray.wavelength_idx
+    out.parent_idx = ray.parent_idx
+    out.end_face_idx = ray.end_face_idx
+    out.ray_type_id = ray.ray_type_id
+    return out
+
+
+cdef inline ray_t expand_geo_ray_c(geo_ray_t *g) nogil:
+    """Expands a geo_ray_t to a circularly polarised ray_t of the same power."""
+    cdef:
+        ray_t out
+        vector_t axis
+        double amp
+        
+    out.origin = g.origin
+    out.direction = g.direction
+    out.normal.x = out.normal.y = out.normal.z = 0.0
+    axis.x = axis.y = axis.z = 0.0
+    if fabs(g.direction.x) < 0.9:
+        axis.x = 1.0
+    else:
+        axis.y = 1.0
+    out.E_vector = norm_(cross_(g.direction, axis))
+    out.refractive_index = g.refractive_index
+    amp = sqrt(g.power/(2*g.refractive_index.real))
+    out.E1_amp = amp
+    out.E2_amp = 1j*amp
+    out.length = g.length
+    out.phase = 0.0
+    out.accumulated_path = 0.0
+    out.wavelength_idx = g.wavelength_idx
+    out.parent_idx = g.parent_idx
+    out.end_face_idx = g.end_face_idx
+    out.ray_type_id = g.ray_type_id
+    return out
+    
+
+cdef class InterfaceMaterial(object):
+    """Abstract base class for objects describing
+    the materials characterics of a Face
+    """
+    
+    def __cinit__(self):
         self.wavelengths = np.array([], dtype=np.double)
     
     cdef void eval_child_ray_c(self, ray_t *old_ray, 
                                 unsigned int ray_idx, 
                                 vector_t p, 
                                 orientation_t orient,
-                                RayCollection new_rays):
+                                RayCollection new_rays) nogil:
         pass
     
     cdef para_t eval_parabasal_ray_c(self, ray_t *base_ray, 
@@ -1558,7 +2495,7 @@ cdef class InterfaceMaterial(object):
                                    vector_t point, #position of intercept
                                    orientation_t orient,
                                    unsigned int ray_type_id, #bool, if True, it's a reflected ray
-                                   ):
+                                   ) nogil:
         cdef:
             vector_t cosThetaNormal, reflected, normal
             para_t para_out
@@ -1610,8 +2547,32 @@ cdef class InterfaceMaterial(object):
         n.tangent = set_v(tangent)
         out.ray = self.eval_parabasal_ray_c(&base_ray.ray, d, p, n, ray_type)
         return out
-            
-        
+
+    def eval_child_rays(self, RayCollection rays, points, normals, tangents,
+                        RayCollection new_rays):
+        """Evaluates the child rays of each ray of the collection, intersecting the
+        face at the given points with the given normals and tangents (each an (N,3)
+        array in global coordinates), as for eval_child_ray(). The child rays are
+        added to new_rays.
+        """
+        cdef:
+            np_.ndarray p = np.ascontiguousarray(points, dtype=np.double).reshape(-1,3)
+            np_.ndarray nm = np.ascontiguousarray(normals, dtype=np.double).reshape(-1,3)
+            np_.ndarray t = np.ascontiguousarray(tangents, dtype=np.double).reshape(-1,3)
+            vector_t *_p = <vector_t*>p.data
+            vector_t *_nm = <vector_t*>nm.data
+            vector_t *_t = <vector_t*>t.data
+            orientation_t orient
+            size_t i, n=rays.n_rays
+
+        if p.shape[0] != n or nm.shape[0] != n or t.shape[0] != n:
+            raise ValueError("Expecting a point, normal and tangent for each ray")
+        for i in range(n):
+            orient.normal = _nm[i]
+            orient.tangent = _t[i]
+            self.eval_child_ray_c(rays.rays + i, i, _p[i], orient, new_rays)
+
+
     property wavelengths:
         def __set__(self, double[:] wavelengths):
             self._wavelengths = wavelengths
@@ -1623,19 +2584,64 @@ cdef class InterfaceMaterial(object):
     cdef on_set_wavelengths(self):
         pass
     
+    pickle_exclude = ()
+    
+    def pickle_args(self):
+        """The (args, kwds) to create a new instance of this class with, on
+        unpickling, before its state is restored.
+        """
+        return (), {}
+    
+    def __reduce__(self):
+        return reduce_object(self)
+    
+    def __getstate__(self):
+        state = object_state(self, self.pickle_exclude)
+        ### The wavelengths are set last, as this evaluates the material properties
+        state['wavelengths'] = state.pop('wavelengths')
+        return state
+    
+    def __setstate__(self, state):
+        set_object_state(self, state)
+    
+    
+cdef class Shape:
+    pickle_exclude = ()
     
-cdef class Shape:        
-    cdef bint point_inside_c(self, double x, double y):
+    cdef bint point_inside_c(self, double x, double y) nogil:
         return 1
     
     def point_inside(self, double x, double y):
         return self.point_inside_c(x,y) 
     
+    def get_bounds(self):
+        """Returns the bounding rectangle of the shape as a tuple
+        (xmin, xmax, ymin, ymax), or None if the shape is unbounded.
+        """
+        return None
+    
+    def pickle_args(self):
+        """The (args, kwds) to create a new instance of this class with, on
+        unpickling, before its state is restored.
+        """
+        return (), {}
+    
+    def __reduce__(self):
+        return reduce_object(self)
+    
+    def __getstate__(self):
+        return object_state(self, self.pickle_exclude)
+    
+    def __setstate__(self, state):
+        set_object_state(self, state)
+    
     
 cdef class Distortion:
     """A abstract base class to represents distortions on a face, a z-offset 
     as a function of (x,y).
     """
+    pickle_exclude = ()
+    
     cdef vector_t z_offset_and_gradient_c(self, double x, double y) nogil:
         """The z-axis surface sag is returned as the z-component 
         of the output vector. The x- and y-components of the surface
@@ -1653,6 +2659,12 @@ cdef class Distortion:
     cdef double z_offset_c(self, double x, double y) nogil:
         return 0.0
     
+    def max_amplitude(self, double radius):
+        """Returns an upper bound on the magnitude of the z-offset over the disk
+        of the given radius about the origin, or None if no bound is known.
+        """
+        return None
+    
     def z_offset_and_gradient(self, double[:] x, double[:] y):
         cdef:
             vector_t v
@@ -1681,11 +2693,30 @@ cdef class Distortion:
             out[i] = self.z_offset_c(x[i],y[i])
         return np.asarray(out)
     
+    def pickle_args(self):
+        """The (args, kwds) to create a new instance of this class with, on
+        unpickling, before its state is restored.
+        """
+        return (), {}
+    
+    def __reduce__(self):
+        return reduce_object(self)
+    
+    def __getstate__(self):
+        return object_state(self, self.pickle_exclude)
+    
+    def __setstate__(self, state):
+        set_object_state(self, state)
+    
     
 cdef class Face(object):
     
     params = []
     
+    ### The owner is not pickled. The name is a C-string, which would not 
+    ### outlive the unpickled value.
+    pickle_exclude = ('owner', 'name')
+    
     def __cinit__(self, owner=None, tolerance=0.0001, 
                         max_length=100, material=None, **kwds):
         self.name = "base Face class"
@@ -1700,16 +2731,28 @@ cdef class Face(object):
         self.invert_normal = int(kwds.get('invert_normal', 0))
         
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, int is_base_ray) nogil:
         """returns the distance of the nearest valid intersection between 
         p1 and p2. p1 and p2 are in the local coordinate system
         """
         return 0
     
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, double *dist, size_t n,
+                                int is_base_ray) nogil:
+        """Intersects a batch of n rays, from p1[i] to p2[i] in the local coordinate 
+        system, putting the distance returned by intersect_c() for each in dist[i]. 
+        Face types may override this with a tighter loop.
+        """
+        cdef size_t i
+        for i in range(n):
+            dist[i] = self.intersect_c(p1[i], p2[i], is_base_ray)
+    
     def update(self):
         """Called to update the parameters from the owner
         to the Face
         """
+        if self.owner is None:
+            return
         for name in self.params:
             v = getattr(self.owner, name)
             setattr(self, name, v)
@@ -1723,17 +2766,41 @@ cdef class Face(object):
         p2_ = set_v(p2)
         dist = self.intersect_c(p1_, p2_, is_base_ray)
         return dist
+    
+    def intersect_batch(self, p1, p2, int is_base_ray=1):
+        """Intersects a batch of rays, with start- and end-points given by the (N,3) 
+        arrays p1 and p2, in local coordinates. Returns an array of the distances, 
+        as for intersect().
+        """
+        cdef:
+            np_.ndarray _p1 = np.ascontiguousarray(p1, dtype=np.double).reshape(-1,3)
+            np_.ndarray _p2 = np.ascontiguousarray(p2, dtype=np.double).reshape(-1,3)
+            np_.ndarray out = np.empty(_p1.shape[0], dtype=np.double)
+        if _p1.shape[0] != _p2.shape[0]:
+            raise ValueError("p1 and p2 must have the same shape")
+        self.intersect_batch_c(<vector_t*>_p1.data, <vector_t*>_p2.data, <double*>out.data, 
+                               _p1.shape[0], is_base_ray)
+        return out
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         return p
     
-    cdef vector_t compute_tangent_c(self, vector_t p):
+    cdef vector_t compute_tangent_c(self, vector_t p) nogil:
         cdef vector_t tangent
         tangent.x = 1.0
         tangent.y = 0.0
         tangent.z = 0.0
         return tangent
     
+    def get_bounds(self):
+        """Returns the axis-aligned bounding box of the face, in local 
+        coordinates, as a tuple (xmin, xmax, ymin, ymax, zmin, zmax). 
+        Returns None if the bounds are not known, in which case the face 
+        is always tested for intersections. Only the base-ray intersections 
+        need to lie within the bounds.
+        """
+        return None
+        
     def compute_normal(self, p):
         """Compute normal vector at a given point, in local
         face coordinates
@@ -1751,6 +2818,21 @@ cdef class Face(object):
         p_.x, p_.y, p_.z = p
         tangent = self.compute_tangent_c(p_)
         return (tangent.x, tangent.y, tangent.z)
+    
+    def pickle_args(self):
+        """The (args, kwds) to create a new instance of this class with, on
+        unpickling, before its state is restored.
+        """
+        return (), {}
+    
+    def __reduce__(self):
+        return reduce_object(self)
+    
+    def __getstate__(self):
+        return object_state(self, self.pickle_exclude)
+    
+    def __setstate__(self, state):
+        set_object_state(self, state)
         
 
 
@@ -1760,10 +2842,118 @@ cdef class FaceList(object):
         self.transform = Transform()
         self.inverse_transform = Transform()
         self.owner = owner
+        self._face_ptrs = NULL
+        self._face_bounds = NULL
+        self.bounded = 0
+        self.faces = []
+
+    def __dealloc__(self):
+        free(self._face_ptrs)
+        free(self._face_bounds)
+        
+    def __reduce__(self):
+        ### The owner is not pickled, so the unpickled FaceList keeps its transforms
+        return rebuild_object, (type(self), (), {}, 
+                                {'faces': self.faces,
+                                 'transform': self.transform,
+                                 'inverse_transform': self.inverse_transform})
+    
+    def __setstate__(self, state):
+        set_object_state(self, state)
+
+    property faces:
+        def __set__(self, list faces):
+            self._faces = faces
+            self.sync_faces_c()
+
+        def __get__(self):
+            return self._faces
+
+    cdef void sync_faces_c(self):
+        """Refreshes the C-array of face pointers used by the GIL-free
+        intersection methods. This is called whenever the faces list is
+        assigned, and by sync_transforms() (to catch in-place modifications
+        of the list).
+        """
+        cdef:
+            size_t i, n=len(self._faces)
+            bint changed = (n != self.n_faces)
+
+        for i in range(n):
+            if not isinstance(self._faces[i], Face):
+                raise TypeError("FaceList contains a non-Face instance at index %d"%i)
+        self._face_ptrs = <PyObject**>realloc(self._face_ptrs, (n+1)*sizeof(PyObject*))
+        for i in range(n):
+            if self._face_ptrs[i] != <PyObject*>self._faces[i]:
+                changed = 1
+            self._face_ptrs[i] = <PyObject*>self._faces[i]
+        self.n_faces = n
+        if changed:
+            ### The face bounds no longer match the faces
+            free(self._face_bounds)
+            self._face_bounds = NULL
+            self.bounded = 0
+
+    def update_bounds(self):
+        """Evaluates the bounding box of each face (in local coordinates) and
+        the bounding box of the whole FaceList (in global coordinates). The transforms 
+        should be synchronised first.
         
+        returns - the global bounds as a tuple (xmin, xmax, ymin, ymax, zmin, zmax), or 
+                None if any face is unbounded.
+        """
+        cdef:
+            size_t i
+            aabb_t box, local
+            aabb_t *face_bounds
+            Face face
+            double pad
+            
+        self.sync_faces_c()
+        face_bounds = <aabb_t*>malloc((self.n_faces+1)*sizeof(aabb_t))
+        if face_bounds is NULL:
+            raise MemoryError()
+        local = empty_aabb_c()
+        self.bounded = 1
+        for i in range(self.n_faces):
+            face = <Face>self._face_ptrs[i]
+            b = face.get_bounds()
+            if b is None:
+                box.lo.x = box.lo.y = box.lo.z = -INF
+                box.hi.x = box.hi.y = box.hi.z = INF
+                self.bounded = 0
+            else:
+                ### pad the box by the face tolerance so grazing hits are kept
+                pad = max(face.tolerance, 1e-9)
+                box.lo.x, box.hi.x, box.lo.y, box.hi.y, box.lo.z, box.hi.z = b
+                box.lo = subvs_(box.lo, pad)
+                box.hi = addvs_(box.hi, pad)
+                local = union_aabb_c(local, box)
+            face_bounds[i] = box
+        free(self._face_bounds)
+        self._face_bounds = face_bounds
+        if self.bounded and self.n_faces:
+            self.bounds_ = transform_aabb_c(self.trans, local)
+        else:
+            self.bounded = 0
+        return self.bounds
+    
+    property bounds:
+        """The global bounding box of the FaceList, as evaluated by the 
+        last call to update_bounds(). None if the bounds are unknown.
+        """
+        def __get__(self):
+            cdef aabb_t b = self.bounds_
+            if not self.bounded:
+                return None
+            return (b.lo.x, b.hi.x, b.lo.y, b.hi.y, b.lo.z, b.hi.z)
+
     cpdef void sync_transforms(self):
         """sets the transforms from the owner's VTKTransform
         """
+        self.sync_faces_c()
+        if self.owner is None:
+            return
         try:
             trans = self.owner.transform
         except AttributeError:
@@ -1802,26 +2992,30 @@ cdef class FaceList(object):
         return self.faces[intidx]
         
      
-    cdef int intersect_c(self, ray_t *ray, vector_t ray_end):
+    cdef int intersect_c(self, ray_t *ray, vector_t ray_end, bint use_bounds=0) nogil:
         """Finds the face with the nearest intersection
         point, for the ray defined by the two input points,
-        P1 and P2 (in global coords).
+        P1 and P2 (in global coords). If use_bounds is true, 
+        faces whose bounding box (from update_bounds()) the ray 
+        misses are skipped.
         """
         cdef:
             vector_t p1 = transform_c(self.inv_trans, ray.origin)
             vector_t p2 = transform_c(self.inv_trans, ray_end)
-            list faces=self.faces
-            unsigned int i
+            size_t i
             int all_idx=-1
             double dist
-            Face face
-        
-        for i in xrange(len(faces)):
-            face = faces[i]
-            dist = face.intersect_c(p1, p2, 1)
-            if face.tolerance < dist < ray.length:
+            PyObject *face
+            aabb_t *face_bounds = self._face_bounds if use_bounds else NULL
+
+        for i in range(self.n_faces):
+            face = self._face_ptrs[i]
+            if face_bounds is not NULL and intersect_aabb_c(face_bounds+i, p1, p2) < 0:
+                continue
+            dist = intersect_face_c(<Face>face, p1, p2, 1)
+            if (<Face>face).tolerance < dist < ray.length:
                 ray.length = dist
-                all_idx = face.idx
+                all_idx = (<Face>face).idx
                 ray.end_face_idx = all_idx
         return all_idx
     
@@ -1833,14 +3027,61 @@ cdef class FaceList(object):
         idx = self.intersect_c(&r.ray, P1_)
         return idx
     
-    cdef int intersect_para_c(self, para_t *ray, vector_t ray_end, Face face):
+    cdef void intersect_batch_c(self, vector_t *p1, vector_t *p2, size_t n, double *length, 
+                                int *face_idx, double *work) nogil:
+        """Finds the nearest face intersection for a batch of n rays, from p1[i] to p2[i] 
+        in the local coordinates of this FaceList. Each face is tested against the whole 
+        batch in turn. Where an intersection is nearer than length[i], length[i] and
+        face_idx[i] are updated. work is a workspace of n doubles.
+        """
+        cdef:
+            size_t i, j
+            double dist, tolerance
+            int idx
+            PyObject *face
+            
+        for j in range(self.n_faces):
+            face = self._face_ptrs[j]
+            intersect_face_batch_c(<Face>face, p1, p2, work, n, 1)
+            tolerance = (<Face>face).tolerance
+            idx = (<Face>face).idx
+            for i in range(n):
+                dist = work[i]
+                if tolerance < dist < length[i]:
+                    length[i] = dist
+                    face_idx[i] = idx
+                    
+    def intersect_batch(self, p1, p2, length=None):
+        """Finds the nearest face intersection for a batch of rays, with start- and
+        end-points given by the (N,3) arrays p1 and p2, in the local coordinates of the 
+        FaceList. Only intersections nearer than the given lengths (default infinity) 
+        are found. 
+        
+        :return: a tuple (length, face_idx) of arrays giving the distance to the nearest
+                intersection and the idx of the face, or -1 where there is none. 
+        """
+        cdef:
+            np_.ndarray _p1 = np.ascontiguousarray(p1, dtype=np.double).reshape(-1,3)
+            np_.ndarray _p2 = np.ascontiguousarray(p2, dtype=np.double).reshape(-1,3)
+            size_t n = _p1.shape[0]
+            np_.ndarray _length = np.full(n, INF) if length is None else \
+                                    np.array(length, dtype=np.double)
+            np_.ndarray face_idx = np.full(n, -1, dtype=np.intc)
+            np_.ndarray work = np.empty(n, dtype=np.double)
+        if _p2.shape[0] != n or _length.shape[0] != n:
+            raise ValueError("p1, p2 and length must have the same length")
+        self.intersect_batch_c(<vector_t*>_p1.data, <vector_t*>_p2.data, n, 
+                               <double*>_length.data, <int*>face_idx.data, <double*>work.data)
+        return _length, face_idx
+    
+    cdef int intersect_para_c(self, para_t *ray, vector_t ray_end, Face face) nogil:
         cdef:
             vector_t p1 = transform_c(self.inv_trans, ray.origin)
             vector_t p2 = transform_c(self.inv_trans, ray_end)
             unsigned int i
             double dist
         
-        dist = face.intersect_c(p1, p2, 0)
+        dist = intersect_face_c(face, p1, p2, 0)
         #print("p1:", p1.x, p1.y, p1.z, "p2:", p2.x, p2.y, p2.z, "rlen:", ray.length, "dist:", dist)
         if face.tolerance < dist < ray.length:
             ray.length = dist
@@ -1855,7 +3096,7 @@ cdef class FaceList(object):
         idx = self.intersect_para_c(&r.ray, P1_, face)
         return idx
     
-    cdef orientation_t compute_orientation_c(self, Face face, vector_t point):
+    cdef orientation_t compute_orientation_c(self, Face face, vector_t point) nogil:
         cdef orientation_t out
         
         point = transform_c(self.inv_trans, point)
@@ -1881,7 +3122,7 @@ cdef class FaceList(object):
 ### Python module functions
 ##################################
 
-cdef double ray_power_(ray_t ray):
+cdef double ray_power_(ray_t ray) nogil:
     cdef double P1, P2
     
     P1 = (ray.E1_amp.real**2 + ray.E1_amp.imag**2)*ray.refractive_index.real
@@ -1968,54 +3209,933 @@ def select_gausslet_intersections(FaceList face_set, list ray_col_list):
     
 
 
-cdef RayCollection trace_segment_c(RayCollection rays, 
-                                    list face_sets, 
-                                    list all_faces,
-                                    list decomp_faces,
-                                    float max_length):
+cdef PyObject **object_array_c(list items, type cls) except NULL:
+    """Returns a malloc'd array of borrowed references to the members of items.
+    The caller must keep the list alive (and unmodified) while the array is in 
+    use, and must free the array afterwards.
+    """
     cdef:
-        FaceList face_set #a FaceList
-        Face face
-        size_t i, j, n_sets=len(face_sets)
+        size_t i, n=len(items)
+        PyObject **out
+        
+    for i in range(n):
+        if not isinstance(items[i], cls):
+            raise TypeError("Expected a %s instance at index %d"%(cls.__name__, i))
+    out = <PyObject**>malloc((n+1)*sizeof(PyObject*))
+    if out is NULL:
+        raise MemoryError()
+    for i in range(n):
+        out[i] = <PyObject*>items[i]
+    return out
+
+
+cdef class FaceListBVH(object):
+    """A bounding-volume hierarchy (BVH) over the global bounding-boxes of a list 
+    of FaceLists. This accelerates the search for the nearest intersection in 
+    scenes with many optics. The hierarchy is traversed front-to-back, and
+    nodes further away than the nearest intersection found so far are skipped.
+    FaceLists without finite bounds are tested for every ray.
+    
+    The hierarchy is only rebuilt by update() when the bounds of the FaceLists
+    have changed.
+    
+    :param list face_sets: an optional list of FaceLists to build the hierarchy for.
+    """
+    def __cinit__(self, face_sets=None):
+        self.nodes = NULL
+        self.items = NULL
+        self.unbounded = NULL
+        self.set_ptrs = NULL
+        self.n_nodes = 0
+        self.depth = 0
+        self.n_unbounded = 0
+        self.build_count = 0
+        self._face_sets = []
+        if face_sets is not None:
+            self.update(face_sets)
+            
+    def __dealloc__(self):
+        free(self.nodes)
+        free(self.items)
+        free(self.unbounded)
+        free(self.set_ptrs)
+        
+    def __reduce__(self):
+        return FaceListBVH, (self.face_sets,)
+        
+    property face_sets:
+        def __get__(self):
+            return list(self._face_sets)
+        
+    def update(self, list face_sets):
+        """Re-evaluates the bounds of the given FaceLists and rebuilds the 
+        hierarchy if these have changed. The transforms of the FaceLists
+        should be synchronised first.
+        
+        returns - True if the hierarchy was rebuilt.
+        """
+        cdef PyObject **ptrs
+        
+        bounds = [(<FaceList?>fs).update_bounds() for fs in face_sets]
+        ptrs = object_array_c(face_sets, FaceList)
+        free(self.set_ptrs)
+        self.set_ptrs = ptrs
+        self._face_sets = list(face_sets)
+        key = [(id(fs), b) for fs, b in zip(face_sets, bounds)]
+        if key == self._boxes:
+            return False
+        self._boxes = key
+        self.build(bounds)
+        self.build_count += 1
+        return True
+    
+    cdef build(self, list bounds):
+        cdef:
+            size_t i, n
+            list bounded = [i for i,b in enumerate(bounds) if b is not None]
+            list unbounded = [i for i,b in enumerate(bounds) if b is None]
+            
+        n = len(bounded)
+        free(self.nodes)
+        free(self.items)
+        free(self.unbounded)
+        self.nodes = <bvh_node_t*>malloc((2*n+1)*sizeof(bvh_node_t))
+        self.items = <int*>malloc((n+1)*sizeof(int))
+        self.unbounded = <int*>malloc((len(unbounded)+1)*sizeof(int))
+        if self.nodes is NULL or self.items is NULL or self.unbounded is NULL:
+            raise MemoryError()
+        for i in range(len(unbounded)):
+            self.unbounded[i] = unbounded[i]
+        self.n_unbounded = len(unbounded)
+        self.n_nodes = 0
+        self.depth = 0
+        if n == 0:
+            return
+        boxes = np.array([bounds[i] for i in bounded], dtype=np.double).reshape(-1,6)
+        centres = 0.5*(boxes[:,0::2] + boxes[:,1::2])
+        self.n_nodes = 1
+        self.build_node(0, boxes, centres, np.arange(n), 0, np.array(bounded), 0)
+        
+    cdef build_node(self, int node_idx, object boxes, object centres, object members, 
+                    int start, object set_idx, int level):
+        """Fills in the given node for the members (indices into boxes), splitting 
+        at the median centre along the axis of greatest extent.
+        """
+        cdef:
+            bvh_node_t *node = self.nodes + node_idx
+            int i, half, n=len(members)
+            
+        if level >= self.depth:
+            self.depth = level + 1
+        sub = boxes[members]
+        node.box.lo.x, node.box.lo.y, node.box.lo.z = sub[:,0::2].min(axis=0)
+        node.box.hi.x, node.box.hi.y, node.box.hi.z = sub[:,1::2].max(axis=0)
+        if n <= BVH_LEAF_SIZE:
+            node.child = -1
+            node.start = start
+            node.count = n
+            for i in range(n):
+                self.items[start+i] = set_idx[members[i]]
+            return
+        c = centres[members]
+        axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+        members = members[np.argsort(c[:,axis], kind="stable")]
+        half = n//2
+        node.child = self.n_nodes
+        node.count = 0
+        self.n_nodes += 2
+        self.build_node(node.child, boxes, centres, members[:half], start, set_idx, level+1)
+        self.build_node(node.child+1, boxes, centres, members[half:], start+half, set_idx, 
+                        level+1)
+        
+    cdef int intersect_c(self, ray_t *ray, vector_t ray_end, PyObject **face_set) nogil:
+        """Finds the face with the nearest intersection for the ray from 
+        ray.origin to ray_end (in global coords). As for FaceList.intersect_c, 
+        the ray length and end_face_idx are updated and the face idx is returned, 
+        or -1 if no face is hit. The FaceList of the hit face is placed in face_set.
+        """
+        cdef:
+            int i, idx, nearest_idx=-1, sp
+            int stack[64]
+            double tstack[64]
+            double t, tL, tR, seg_len = sep_(ray.origin, ray_end)
+            bvh_node_t *node
+            PyObject *fs
+            
+        for i in range(self.n_unbounded):
+            fs = self.set_ptrs[self.unbounded[i]]
+            idx = (<FaceList>fs).intersect_c(ray, ray_end, 1)
+            if idx >= 0:
+                nearest_idx = idx
+                face_set[0] = fs
+                
+        if self.n_nodes == 0:
+            return nearest_idx
+        t = intersect_aabb_c(&self.nodes[0].box, ray.origin, ray_end)
+        if t < 0:
+            return nearest_idx
+        stack[0] = 0
+        tstack[0] = t
+        sp = 1
+        while sp > 0:
+            sp -= 1
+            if tstack[sp]*seg_len > ray.length:
+                continue
+            node = self.nodes + stack[sp]
+            if node.child < 0:
+                for i in range(node.start, node.start+node.count):
+                    fs = self.set_ptrs[self.items[i]]
+                    idx = (<FaceList>fs).intersect_c(ray, ray_end, 1)
+                    if idx >= 0:
+                        nearest_idx = idx
+                        face_set[0] = fs
+            else:
+                tL = intersect_aabb_c(&self.nodes[node.child].box, ray.origin, ray_end)
+                tR = intersect_aabb_c(&self.nodes[node.child+1].box, ray.origin, ray_end)
+                ### Push the furthest child first, so the nearest is visited first
+                if tL > tR:
+                    stack[sp] = node.child
+                    tstack[sp] = tL
+                    sp += 1
+                    if tR >= 0:
+                        stack[sp] = node.child+1
+                        tstack[sp] = tR
+                        sp += 1
+                else:
+                    if tR >= 0:
+                        stack[sp] = node.child+1
+                        tstack[sp] = tR
+                        sp += 1
+                    if tL >= 0:
+                        stack[sp] = node.child
+                        tstack[sp] = tL
+                        sp += 1
+        return nearest_idx
+
+
+cdef class CompiledScene(object):
+    """A list of FaceLists prepared for repeated tracing of a static scene.
+    
+    On creation, the faces are indexed and updated from their owners, the 
+    FaceList transforms are synchronised, a FaceListBVH is built and the 
+    FaceLists and Faces are flattened into C arrays. Tracing through a
+    CompiledScene then needs no further per-trace or per-generation setup. 
+    If any optic is moved or changed, a new CompiledScene should be created.
+    
+    :param list face_lists: the FaceLists making up the scene.
+    :param wavelengths: the wavelengths (in microns) to set on the face materials.
+    :param double max_length: the maximum ray length.
+    :param FaceListBVH bvh: an optional FaceListBVH to (re-)use for the scene.
+    :param bool face_major: if True, RayCollections are traced face-major, 
+                intersecting each face with a whole batch of rays in turn, rather
+                than searching the BVH for each ray. The batches are still culled
+                with the BVH, down to the rays crossing each FaceList's bounds.
+    """
+    def __cinit__(self, *args, **kwds):
+        self.set_ptrs = NULL
+        self.face_ptrs = NULL
+        self.prune.min_power = 0.0
+        self.prune.roulette_power = 0.0
+        self.prune.seed = 0
+        self.prune.generation = 0
+        reset_prune_c(&self.prune)
+        self._branching = []
+        self._generation = 0
+        
+    def __init__(self, list face_lists, wavelengths=None, double max_length=100.0,
+                 FaceListBVH bvh=None, bint face_major=False):
+        cdef:
+            FaceList fs
+            Face f
+            size_t i
+            
+        self.face_major = face_major
+        self.face_sets = list(face_lists)
+        self.all_faces = [f for fs in self.face_sets for f in fs.faces]
+        for i, f in enumerate(self.all_faces):
+            f.idx = i
+            f.update()
+        for fs in self.face_sets:
+            fs.sync_transforms()
+        self.bvh = FaceListBVH() if bvh is None else bvh
+        self.bvh.update(self.face_sets)
+        
+        free(self.set_ptrs)
+        self.set_ptrs = NULL
+        free(self.face_ptrs)
+        self.face_ptrs = NULL
+        self.set_ptrs = object_array_c(self.face_sets, FaceList)
+        self.face_ptrs = object_array_c(self.all_faces, Face)
+        self.n_sets = len(self.face_sets)
+        self.n_faces = len(self.all_faces)
+        
+        self.decomp_faces = [f for f in self.all_faces if f.material.is_decomp_material()]
+        self._wavelengths = None
+        self.max_length = -1
+        self.set_max_length(max_length)
+        if wavelengths is not None:
+            self.set_wavelengths(wavelengths)
+        
+    def __dealloc__(self):
+        free(self.set_ptrs)
+        free(self.face_ptrs)
+        
+    def __reduce__(self):
+        return CompiledScene, (self.face_sets, self._wavelengths, self.max_length, 
+                               None, self.face_major)
+        
+    def set_wavelengths(self, wavelengths):
+        """Sets the wavelengths on the materials of all faces, if these have changed.
+        """
+        wavelengths = np.ascontiguousarray(wavelengths, dtype=np.double)
+        if self._wavelengths is not None and np.array_equal(wavelengths, self._wavelengths):
+            return
+        for f in self.all_faces:
+            f.material.wavelengths = wavelengths
+        self._wavelengths = wavelengths
+        
+    def set_max_length(self, double max_length):
+        """Sets the maximum ray length on all faces, if this has changed.
+        """
+        cdef size_t i
+        if max_length == self.max_length:
+            return
+        for i in range(self.n_faces):
+            (<Face>self.face_ptrs[i]).max_length = max_length
+        self.max_length = max_length
+        
+    def reset_counts(self):
+        """Resets the intersection count of all faces to zero, at the start of a new
+        trace.
+        """
+        cdef size_t i
+        for i in range(self.n_faces):
+            (<Face>self.face_ptrs[i]).count = 0
+        self._generation = 0
+        
+    cdef size_t child_capacity(self, size_t n_rays):
+        """Estimates the number of child rays from n_rays in the current generation,
+        from the ratio of child to parent rays in the same generation of previous traces. 
+        """
+        if self._generation < len(self._branching):
+            return <size_t>(n_rays*self._branching[self._generation]*1.1) + 1
+        return n_rays
+    
+    cdef void record_branching(self, size_t n_rays, size_t n_children):
+        cdef double ratio = n_children/<double>max(n_rays,1)
+        if self._generation < len(self._branching):
+            self._branching[self._generation] = ratio
+        else:
+            self._branching.append(ratio)
+        self._generation += 1
+            
+    def set_pruning(self, double min_power=0.0, double roulette_power=0.0, 
+                    unsigned long long seed=0, unsigned long long generation=0):
+        """Sets the pruning of low-power child rays, applied after each generation
+        is traced. Rays with power below min_power are discarded. Rays with power 
+        below roulette_power are discarded with probability 1-(power/roulette_power);
+        the survivors have their amplitudes increased to bring their power up to 
+        roulette_power, which conserves the power on average. A value of zero 
+        disables either sort of pruning.
+        
+        The Russian roulette is deterministic, for a given seed. The generation 
+        is the number of the next generation to be traced.
+        """
+        if min_power < 0 or roulette_power < 0:
+            raise ValueError("Pruning powers must not be negative")
+        self.prune.min_power = min_power
+        self.prune.roulette_power = roulette_power
+        self.prune.seed = seed
+        reset_prune_c(&self.prune)
+        self.prune.generation = generation
+        
+    property pruned:
+        """A dict of the rays and power removed by pruning in the last generation 
+        traced. n_pruned and pruned_power count the rays below the min_power. 
+        n_killed and killed_power count the rays lost in the Russian roulette, 
+        n_survived the reweighted survivors and added_power the power added to these.
+        """
+        def __get__(self):
+            return {'n_pruned': self.prune.n_pruned,
+                    'pruned_power': self.prune.pruned_power,
+                    'n_killed': self.prune.n_killed,
+                    'killed_power': self.prune.killed_power,
+                    'n_survived': self.prune.n_survived,
+                    'added_power': self.prune.added_power}
+        
+    property decomp_time:
+        """The time (in seconds) spent evaluating the decomposed rays of
+        decomposition faces, in the last generation traced.
+        """
+        def __get__(self):
+            return self.decomp_ns*1e-9
+        
+    def trace(self, rays, int num_threads=1, TraceProfile profile=None):
+        """Traces a single generation of rays through the scene. The rays may be
+        a RayCollection, GaussletCollection or GeometricRayCollection.
+        
+        :param int num_threads: The number of threads to trace with (see trace_segment()).
+        :param TraceProfile profile: if given, the performance counters of the faces 
+                    are recorded in it.
+        :return: a new collection, of the same type, containing the child rays.
+        """
+        cdef:
+            prune_t *prune = NULL
+            profile_t *prof = NULL if profile is None else &profile.profile
+            size_t n_rays = len(rays)
+            
+        if self.prune.min_power > 0 or self.prune.roulette_power > 0:
+            prune = &self.prune
+            reset_prune_c(prune)
+        self.decomp_ns = 0
+        if isinstance(rays, RayCollection):
+            out = trace_segment_ptrs_c(rays, self.set_ptrs, self.n_sets, 
+                                       self.face_ptrs, self.n_faces, self.max_length,
+                                       num_threads, <PyObject*>self.bvh, prune,
+                                       self.child_capacity(n_rays), self.face_major, prof)
+        elif isinstance(rays, GaussletCollection):
+            out = trace_gausslet_ptrs_c(rays, self.set_ptrs, self.n_sets,
+                                        self.face_ptrs, self.n_faces, self.decomp_faces,
+                                        self.max_length, num_threads, <PyObject*>self.bvh,
+                                        prune, self.child_capacity(n_rays), &self.decomp_ns,
+                                        prof)
+        elif isinstance(rays, GeometricRayCollection):
+            out = trace_geometric_ptrs_c(rays, self.set_ptrs, self.n_sets, 
+                                         self.face_ptrs, self.n_faces, self.max_length,
+                                         num_threads, <PyObject*>self.bvh, prune,
+                                         self.child_capacity(n_rays), prof)
+        else:
+            raise TypeError("Expecting a RayCollection, GaussletCollection or "
+                            "GeometricRayCollection, not %s"%type(rays))
+        self.record_branching(n_rays, len(out))
+        return out
+    
+
+cdef int trace_thread_count(int num_threads):
+    """Translates the num_threads argument of the trace-functions into an 
+    actual thread count. Zero or negative values select one thread per processor. 
+    The count is limited to the number of processors, as the per-thread
+    workspaces of the Distortion classes are allocated for this many threads.
+    """
+    cdef int max_threads = openmp.omp_get_num_procs()
+    if num_threads <= 0 or num_threads > max_threads:
+        return max_threads
+    return num_threads
+
+
+cdef size_t trace_chunk_count(size_t n_rays, int num_threads):
+    """The number of contiguous blocks of rays to split a generation into. Using
+    a few blocks per thread helps to balance the load where rays have
+    unequal cost (e.g. missing rays are cheaper than rays which hit).
+    """
+    cdef size_t n_chunks
+    n_chunks = n_rays // MIN_CHUNK_SIZE
+    if n_chunks > <size_t>(4*num_threads):
+        n_chunks = 4*num_threads
+    if n_chunks < 1:
+        n_chunks = 1
+    return n_chunks
+
+
+cdef void count_face_hits_c(unsigned int *end_face_idx, size_t n_rays, size_t stride, 
+                            PyObject **all_faces, size_t n_faces):
+    """Increments the intersection count of each face from the end_face_idx of 
+    the traced rays (the end_face_idx of the first ray, with the given stride between 
+    rays). Done as a separate pass so that the counts do not depend on
+    the order in which the rays were traced.
+    """
+    cdef:
+        size_t i
+        unsigned int idx
+    for i in range(n_rays):
+        idx = (<unsigned int*>((<char*>end_face_idx) + i*stride))[0]
+        if idx < n_faces:
+            (<Face>all_faces[idx]).count += 1
+            
+
+cdef inline int find_nearest_face_c(ray_t *ray, vector_t ray_end,
+                                    PyObject **face_sets, size_t n_sets,
+                                    PyObject *bvh, PyObject **nearest_set) nogil:
+    """Returns the idx of the nearest face intersected by the ray (or -1), 
+    and puts its FaceList in nearest_set.
+    """
+    cdef:
+        size_t j
+        int idx, nearest_idx=-1
+        
+    if bvh is not NULL:
+        return (<FaceListBVH>bvh).intersect_c(ray, ray_end, nearest_set)
+    for j in range(n_sets):
+        #intersect_c returns the face idx of the intersection, or -1 otherwise
+        idx = (<FaceList>face_sets[j]).intersect_c(ray, ray_end)
+        if idx >= 0:
+            nearest_set[0] = face_sets[j]
+            nearest_idx = idx
+    return nearest_idx
+
+
+cdef void reset_prune_c(prune_t *prune) nogil:
+    """Zeros the pruning tallies."""
+    prune.n_pruned = 0
+    prune.n_killed = 0
+    prune.n_survived = 0
+    prune.pruned_power = 0.0
+    prune.killed_power = 0.0
+    prune.added_power = 0.0
+    
+
+cdef inline double prune_uniform_c(unsigned long long seed, unsigned long long generation, 
+                                   unsigned long long key) nogil:
+    """A uniform random number in [0,1) computed from the seed, generation and key
+    (using the SplitMix64 mixing function), so that the Russian roulette does not
+    depend on the order in which the rays were traced.
+    """
+    cdef unsigned long long z
+    z = seed + (generation<<40) + key*<unsigned long long>0x9E3779B97F4A7C15
+    z = (z ^ (z >> 30)) * <unsigned long long>0xBF58476D1CE4E5B9
+    z = (z ^ (z >> 27)) * <unsigned long long>0x94D049BB133111EB
+    z = z ^ (z >> 31)
+    return (z >> 11) * (1.0/9007199254740992.0)
+
+
+cdef inline double prune_power_c(double P, unsigned int parent_idx, unsigned int ray_type_id,
+                                 prune_t *prune) nogil:
+    """Applies the power-cutoff and the Russian roulette to a child ray of power P. 
+    Returns the factor by which the ray power should be scaled, zero if the ray 
+    should be discarded.
+    """
+    cdef:
+        double survival
+        unsigned long long key
+        
+    if P < prune.min_power:
+        prune.n_pruned += 1
+        prune.pruned_power += P
+        return 0.0
+    if P < prune.roulette_power:
+        survival = P / prune.roulette_power
+        #Child rays are identified by their parent and their type
+        key = 2*(<unsigned long long>parent_idx) + (ray_type_id & REFL_RAY)
+        if prune_uniform_c(prune.seed, prune.generation, key) >= survival:
+            prune.n_killed += 1
+            prune.killed_power += P
+            return 0.0
+        prune.n_survived += 1
+        prune.added_power += prune.roulette_power - P
+        return 1./survival
+    return 1.0
+
+
+cdef inline bint keep_ray_c(ray_t *ray, prune_t *prune) nogil:
+    """Prunes a child ray, reweighting it if it survives the roulette. Returns False 
+    if the ray should be discarded.
+    """
+    cdef double scale = prune_power_c(ray_power_(ray[0]), ray.parent_idx, 
+                                      ray.ray_type_id, prune)
+    if scale == 0.0:
+        return 0
+    if scale != 1.0:
+        scale = sqrt(scale)
+        ray.E1_amp = ray.E1_amp*scale
+        ray.E2_amp = ray.E2_amp*scale
+    return 1
+
+
+cdef void prune_rays_c(RayCollection rays, prune_t *prune) nogil:
+    """Removes the low-power rays from a generation of child rays, in place."""
+    cdef size_t i, j=0
+    for i in range(rays.n_rays):
+        if keep_ray_c(rays.rays + i, prune):
+            if j != i:
+                rays.rays[j] = rays.rays[i]
+            j += 1
+    rays.n_rays = j
+    prune.generation += 1
+    
+    
+cdef void prune_geo_rays_c(GeometricRayCollection rays, prune_t *prune) nogil:
+    """Removes the low-power rays from a generation of geometric rays, in place."""
+    cdef:
+        size_t i, j=0
+        double scale
+        geo_ray_t *ray
+    for i in range(rays.n_rays):
+        ray = rays.rays + i
+        scale = prune_power_c(ray.power, ray.parent_idx, ray.ray_type_id, prune)
+        if scale != 0.0:
+            ray.power *= scale
+            if j != i:
+                rays.rays[j] = ray[0]
+            j += 1
+    rays.n_rays = j
+    prune.generation += 1
+    
+    
+cdef void prune_gausslets_c(GaussletCollection gausslets, prune_t *prune) nogil:
+    """Removes the low-power gausslets from a generation of child gausslets, in place."""
+    cdef size_t i, j=0
+    for i in range(gausslets.n_rays):
+        if keep_ray_c(&gausslets.rays[i].base_ray, prune):
+            if j != i:
+                gausslets.rays[j] = gausslets.rays[i]
+            j += 1
+    gausslets.n_rays = j
+    prune.generation += 1
+        
+
+cdef void trace_segment_range_c(RayCollection rays,
+                                size_t start, size_t end,
+                                PyObject **face_sets, size_t n_sets,
+                                PyObject **all_faces,
+                                double max_length,
+                                RayCollection new_rays,
+                                PyObject *bvh) nogil:
+    """Traces the rays with indices from start to end, appending the child rays 
+    to new_rays. If bvh is not NULL, it is used to find the nearest face, rather
+    than testing each FaceList in turn.
+    """
+    cdef:
+        size_t i
         vector_t point
         orientation_t orient
-        int idx, nearest_set=-1, nearest_idx=-1
+        int nearest_idx
         ray_t *ray
-        RayCollection new_rays
-   
-    #need to allocate the output rays here 
-    new_rays = RayCollection(rays.n_rays)
-    new_rays.parent = rays
-    
-    for i in range(rays.n_rays):
+        PyObject *face
+        PyObject *face_set=NULL
+        
+    for i in range(start, end):
         ray = rays.rays + i
         ray.length = max_length
         ray.end_face_idx = -1
-        nearest_idx=-1
         point = addvv_(ray.origin, 
                             multvs_(ray.direction, 
                                     max_length))
-        #print "points", P1, P2
-        for j in range(n_sets):
-            face_set = face_sets[j]
-            #intersect_c returns the face idx of the intersection, or -1 otherwise
-            idx = (<FaceList>face_set).intersect_c(ray, point)
-            if idx >= 0:
-                nearest_set = j
-                nearest_idx = idx
+        nearest_idx = find_nearest_face_c(ray, point, face_sets, n_sets, bvh, &face_set)
         if nearest_idx >= 0:
-            #print "GET FACE", nearest.face_idx, len(all_faces)
             face = all_faces[nearest_idx]
-            face.count += 1
-            #print "ray length", ray.length
             point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
-            orient = (<FaceList>(face_sets[nearest_set])).compute_orientation_c(face, point)
-            #print "s normal", normal
-            (<InterfaceMaterial>(face.material)).eval_child_ray_c(ray, i, 
-                                                    point,
-                                                    orient,
-                                                    new_rays
-                                                    )
+            orient = (<FaceList>face_set).compute_orientation_c(<Face>face, point)
+            eval_child_rays_c(<Face>face, ray, i, point, orient, new_rays)
+
+
+cdef struct batch_work_t:
+    ### The workspace of trace_segment_batch_range_c(), for a block of up to n rays
+    size_t n
+    vector_t *p1
+    vector_t *p2
+    vector_t *ends
+    double *length
+    double *work
+    int *face_idx
+    size_t *sel
+    size_t *lists #A list of ray indices for each level of the FaceListBVH
+    PyObject **nearest_set
+    
+    
+cdef int alloc_batch_work_c(batch_work_t *w, size_t n, int depth) nogil:
+    """Allocates the workspace for n rays and a FaceListBVH with the given depth.
+    Returns -1 if the memory could not be allocated (in which case nothing is
+    left allocated), zero otherwise.
+    """
+    w.n = n
+    w.p1 = <vector_t*>malloc((n+1)*sizeof(vector_t))
+    w.p2 = <vector_t*>malloc((n+1)*sizeof(vector_t))
+    w.ends = <vector_t*>malloc((n+1)*sizeof(vector_t))
+    w.length = <double*>malloc((n+1)*sizeof(double))
+    w.work = <double*>malloc((n+1)*sizeof(double))
+    w.face_idx = <int*>malloc((n+1)*sizeof(int))
+    w.sel = <size_t*>malloc((n+1)*sizeof(size_t))
+    w.lists = <size_t*>malloc((n*(depth+1)+1)*sizeof(size_t))
+    w.nearest_set = <PyObject**>malloc((n+1)*sizeof(PyObject*))
+    if w.p1 is NULL or w.p2 is NULL or w.ends is NULL or w.length is NULL or \
+            w.work is NULL or w.face_idx is NULL or w.sel is NULL or w.lists is NULL or \
+            w.nearest_set is NULL:
+        free_batch_work_c(w)
+        return -1
+    return 0
+
+
+cdef void free_batch_work_c(batch_work_t *w) nogil:
+    free(w.p1)
+    free(w.p2)
+    free(w.ends)
+    free(w.length)
+    free(w.work)
+    free(w.face_idx)
+    free(w.sel)
+    free(w.lists)
+    free(w.nearest_set)
+    w.p1 = w.p2 = w.ends = NULL
+    w.length = w.work = NULL
+    w.face_idx = NULL
+    w.sel = w.lists = NULL
+    w.nearest_set = NULL
+    
+    
+cdef batch_work_t *alloc_batch_works_c(size_t n_works, size_t n, PyObject *bvh) except NULL:
+    """Allocates n_works workspaces for trace_segment_batch_range_c(), each for n rays
+    and the depth of the bvh (if not NULL). Raises MemoryError if this fails.
+    """
+    cdef:
+        batch_work_t *works = <batch_work_t*>calloc(n_works + 1, sizeof(batch_work_t))
+        int depth = 0 if bvh is NULL else (<FaceListBVH>bvh).depth
+        size_t i
+    if works is NULL:
+        raise MemoryError()
+    for i in range(n_works):
+        if alloc_batch_work_c(works + i, n, depth) < 0:
+            free_batch_works_c(works, i)
+            raise MemoryError()
+    return works
+
+
+cdef void free_batch_works_c(batch_work_t *works, size_t n_works) nogil:
+    cdef size_t i
+    if works is NULL:
+        return
+    for i in range(n_works):
+        free_batch_work_c(works + i)
+    free(works)
+    
+    
+cdef void intersect_set_batch_c(PyObject *face_set, RayCollection rays, size_t start,
+                                size_t *idx, size_t n_idx, batch_work_t *w) nogil:
+    """Intersects the FaceList with the rays start+idx[k], for k up to n_idx, 
+    whose path crosses its bounds. The rays are transformed into local coordinates
+    once, then each face is intersected with the whole batch (see 
+    FaceList.intersect_batch_c()). The rays with a nearer intersection than before 
+    have their length and end_face_idx updated, and the FaceList put in w.nearest_set.
+    """
+    cdef:
+        size_t i, k, m=0
+        ray_t *ray
+        
+    for k in range(n_idx):
+        i = idx[k]
+        ray = rays.rays + start + i
+        if (<FaceList>face_set).bounded and \
+                intersect_aabb_c(&(<FaceList>face_set).bounds_, ray.origin, w.ends[i]) < 0:
+            continue
+        w.sel[m] = i
+        w.p1[m] = transform_c((<FaceList>face_set).inv_trans, ray.origin)
+        w.p2[m] = transform_c((<FaceList>face_set).inv_trans, w.ends[i])
+        w.length[m] = ray.length
+        w.face_idx[m] = -1
+        m += 1
+    if m == 0:
+        return
+    (<FaceList>face_set).intersect_batch_c(w.p1, w.p2, m, w.length, w.face_idx, w.work)
+    for k in range(m):
+        if w.face_idx[k] >= 0:
+            i = w.sel[k]
+            ray = rays.rays + start + i
+            ray.length = w.length[k]
+            ray.end_face_idx = w.face_idx[k]
+            w.nearest_set[i] = face_set
+            
+            
+cdef size_t select_box_rays_c(aabb_t *box, RayCollection rays, size_t start, 
+                              size_t *idx, size_t n_idx, size_t *out, batch_work_t *w) nogil:
+    """Puts the rays of idx whose path crosses the box, before their current 
+    length, in out. Returns the number of these.
+    """
+    cdef:
+        size_t i, k, m=0
+        ray_t *ray
+        double t
+    for k in range(n_idx):
+        i = idx[k]
+        ray = rays.rays + start + i
+        t = intersect_aabb_c(box, ray.origin, w.ends[i])
+        if t < 0 or t*sep_(ray.origin, w.ends[i]) > ray.length:
+            continue
+        out[m] = i
+        m += 1
+    return m
+            
+            
+cdef void intersect_bvh_batch_c(PyObject *bvh, int node_idx, int level, 
+                                RayCollection rays, size_t start,
+                                size_t *idx, size_t n_idx, batch_work_t *w) nogil:
+    """Intersects the rays of idx (which cross the box of the given node) with the 
+    FaceLists in the node, and its descendents. The rays crossing each child node 
+    are listed in w.lists, at the level of the child.
+    """
+    cdef:
+        bvh_node_t *nodes = (<FaceListBVH>bvh).nodes
+        bvh_node_t *node = nodes + node_idx
+        PyObject **set_ptrs = (<FaceListBVH>bvh).set_ptrs
+        int *items = (<FaceListBVH>bvh).items
+        size_t *out = w.lists + (level+1)*w.n
+        size_t m
+        int i, child
+    if node.child < 0:
+        for i in range(node.start, node.start+node.count):
+            intersect_set_batch_c(set_ptrs[items[i]], rays, start, idx, n_idx, w)
+        return
+    for child in range(node.child, node.child+2):
+        m = select_box_rays_c(&nodes[child].box, rays, start, idx, n_idx, out, w)
+        if m > 0:
+            intersect_bvh_batch_c(bvh, child, level+1, rays, start, out, m, w)
+
+
+cdef void trace_segment_batch_range_c(RayCollection rays,
+                                      size_t start, size_t end,
+                                      PyObject **face_sets, size_t n_sets,
+                                      PyObject **all_faces,
+                                      double max_length,
+                                      RayCollection new_rays,
+                                      PyObject *bvh,
+                                      batch_work_t *w) nogil:
+    """Traces the rays with indices from start to end, as for trace_segment_range_c(),
+    but finding the intersections face-major: each FaceList is intersected with the
+    whole batch of rays crossing its bounds in turn (see intersect_set_batch_c()).
+    If bvh is not NULL, the batch is narrowed down to the rays crossing each node 
+    on the way down the hierarchy, rather than testing each FaceList with every ray. 
+    The child rays are then evaluated, in order of the rays. w is a workspace for
+    at least end-start rays, and the depth of the bvh.
+    """
+    cdef:
+        size_t i, m, n = end - start
+        vector_t point
+        orientation_t orient
+        ray_t *ray
+        PyObject *face
+        
+    for i in range(n):
+        ray = rays.rays + start + i
+        ray.length = max_length
+        ray.end_face_idx = -1
+        w.ends[i] = addvv_(ray.origin, multvs_(ray.direction, max_length))
+        w.nearest_set[i] = NULL
+        w.lists[i] = i
+        
+    if bvh is NULL:
+        for i in range(n_sets):
+            intersect_set_batch_c(face_sets[i], rays, start, w.lists, n, w)
+    else:
+        for i in range((<FaceListBVH>bvh).n_unbounded):
+            intersect_set_batch_c((<FaceListBVH>bvh).set_ptrs[(<FaceListBVH>bvh).unbounded[i]],
+                                  rays, start, w.lists, n, w)
+        if (<FaceListBVH>bvh).n_nodes > 0:
+            m = select_box_rays_c(&(<FaceListBVH>bvh).nodes[0].box, rays, start, w.lists, n, 
+                                  w.lists, w)
+            if m > 0:
+                intersect_bvh_batch_c(bvh, 0, 0, rays, start, w.lists, m, w)
+                
+    for i in range(n):
+        if w.nearest_set[i] is NULL:
+            continue
+        ray = rays.rays + start + i
+        face = all_faces[ray.end_face_idx]
+        point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
+        orient = (<FaceList>w.nearest_set[i]).compute_orientation_c(<Face>face, point)
+        eval_child_rays_c(<Face>face, ray, start + i, point, orient, new_rays)
+
+
+cdef RayCollection trace_segment_c(RayCollection rays, 
+                                    list face_sets, 
+                                    list all_faces,
+                                    list decomp_faces,
+                                    float max_length,
+                                    int num_threads=1,
+                                    FaceListBVH bvh=None):
+    cdef:
+        PyObject **set_ptrs=NULL
+        PyObject **face_ptrs=NULL
+        
+    set_ptrs = object_array_c(face_sets, FaceList)
+    try:
+        face_ptrs = object_array_c(all_faces, Face)
+        return trace_segment_ptrs_c(rays, set_ptrs, len(face_sets), face_ptrs, len(all_faces),
+                                    max_length, num_threads, 
+                                    NULL if bvh is None else <PyObject*>bvh, NULL, rays.n_rays,
+                                    0, NULL)
+    finally:
+        free(set_ptrs)
+        free(face_ptrs)
+        
+
+cdef RayCollection trace_segment_ptrs_c(RayCollection rays, 
+                                        PyObject **set_ptrs, size_t n_sets,
+                                        PyObject **face_ptrs, size_t n_faces,
+                                        double max_length,
+                                        int num_threads,
+                                        PyObject *bvh_ptr,
+                                        prune_t *prune,
+                                        size_t capacity,
+                                        bint face_major,
+                                        profile_t *profile):
+    """Traces a generation of rays through arrays of FaceLists and Faces
+    (the Faces in order of their idx). If prune is not NULL, the low-power
+    child rays are then removed. The output is allocated for the expected 
+    number of child rays, given by capacity. If face_major is true, the 
+    intersections are found face-by-face (see trace_segment_batch_range_c()).
+    If profile is not NULL, the performance counters of the faces are recorded
+    in it.
+    """
+    cdef:
+        size_t i, n_chunks, chunk_size, start, end
+        int n_threads = trace_thread_count(num_threads)
+        PyObject **chunk_ptrs=NULL
+        batch_work_t *works=NULL
+        list chunks
+        RayCollection new_rays, chunk
+        
+    if num_threads == 1:
+        n_chunks = 1
+    else:
+        n_chunks = trace_chunk_count(rays.n_rays, n_threads)
+    chunk_size = (rays.n_rays + n_chunks - 1) // n_chunks
+    try:
+        if face_major:
+            works = alloc_batch_works_c(n_chunks, chunk_size, bvh_ptr)
+        if n_chunks == 1:
+            #need to allocate the output rays here 
+            new_rays = RayCollection(capacity)
+            set_thread_profile_c(profile)
+            if face_major:
+                trace_segment_batch_range_c(rays, 0, rays.n_rays, set_ptrs, n_sets,
+                                            face_ptrs, max_length, new_rays, bvh_ptr, works)
+            else:
+                trace_segment_range_c(rays, 0, rays.n_rays, set_ptrs, n_sets, 
+                                      face_ptrs, max_length, new_rays, bvh_ptr)
+            set_thread_profile_c(NULL)
+        else:
+            ### Each block of rays is traced into its own RayCollection. These are
+            ### concatenated in order afterwards, so the result is identical to the 
+            ### single-threaded trace.
+            chunks = [RayCollection((capacity + n_chunks - 1) // n_chunks) 
+                      for i in range(n_chunks)]
+            chunk_ptrs = object_array_c(chunks, RayCollection)
+            with nogil:
+                for i in prange(n_chunks, num_threads=n_threads, schedule="dynamic"):
+                    start = i*chunk_size
+                    end = min(start + chunk_size, rays.n_rays)
+                    set_thread_profile_c(profile)
+                    if face_major:
+                        trace_segment_batch_range_c(rays, start, end, set_ptrs, n_sets,
+                                                    face_ptrs, max_length, 
+                                                    <RayCollection>chunk_ptrs[i], bvh_ptr,
+                                                    works + i)
+                    else:
+                        trace_segment_range_c(rays, start, end, set_ptrs, n_sets,
+                                              face_ptrs, max_length, 
+                                              <RayCollection>chunk_ptrs[i], bvh_ptr)
+                    set_thread_profile_c(NULL)
+            new_rays = RayCollection(sum(len(c) for c in chunks))
+            for chunk in chunks:
+                memcpy(new_rays.rays + new_rays.n_rays, chunk.rays, chunk.n_rays*sizeof(ray_t))
+                new_rays.n_rays += chunk.n_rays
+        if prune is not NULL:
+            prune_rays_c(new_rays, prune)
+        count_face_hits_c(&rays.rays[0].end_face_idx, rays.n_rays, sizeof(ray_t), 
+                          face_ptrs, n_faces)
+        rays.version += 1
+    finally:
+        free(chunk_ptrs)
+        free_batch_works_c(works, n_chunks)
+    new_rays.parent = rays
     return new_rays
 
 
@@ -2023,97 +4143,466 @@ def trace_segment(RayCollection rays,
                     list face_sets, 
                     list all_faces,
                     max_length=100,
-                    decomp_faces=[]):
+                    decomp_faces=[],
+                    int num_threads=1,
+                    FaceListBVH bvh=None):
+    """Traces a single generation of rays through the given list of FaceLists.
+    
+    :param RayCollection rays: The input rays.
+    :param list face_sets: A list of FaceList objects.
+    :param list all_faces: The list of all Faces, in order of their idx attribute.
+    :param double max_length: The maximum ray length.
+    :param list decomp_faces: unused for RayCollections.
+    :param int num_threads: The number of threads to trace with. The default, 1,
+                traces in the calling thread. Zero selects one thread per processor.
+                The output is the same for any number of threads.
+    :param FaceListBVH bvh: An optional bounding-volume hierarchy over the face_sets,
+                used to accelerate the search for the nearest face. It should be 
+                up to date with the face_sets.
+    :return: a new RayCollection containing the child rays.
+    """
     for fs in face_sets:
         fs.sync_transforms()
-    return trace_segment_c(rays, face_sets, all_faces, decomp_faces, max_length)
+    return trace_segment_c(rays, face_sets, all_faces, decomp_faces, max_length, num_threads, bvh)
 
 def trace_gausslet(GaussletCollection rays, 
                     list face_sets, 
                     list all_faces,
                     max_length=100,
-                    decomp_faces=[]):
+                    decomp_faces=[],
+                    int num_threads=1,
+                    FaceListBVH bvh=None):
+    """Traces a single generation of Gausslets through the given list of FaceLists.
+    
+    The arguments are as for trace_segment(). If any decomposition-faces
+    are given, the trace is single-threaded as these collect the incident rays in the order
+    they arrive.
+    """
     for fs in face_sets:
         (<FaceList>fs).sync_transforms()
-    return trace_gausslet_c(rays, face_sets, all_faces, decomp_faces, max_length)
+    return trace_gausslet_c(rays, face_sets, all_faces, decomp_faces, max_length, num_threads, bvh)
 
 
-cdef GaussletCollection trace_gausslet_c(GaussletCollection gausslets, 
-                                    list face_sets, 
-                                    list all_faces,
-                                    list decomp_faces,
-                                    double max_length):
+cdef enum:
+    #The child rays kept by a sequential trace
+    BRANCH_AUTO = 0
+    BRANCH_TRANSMITTED = 1
+    BRANCH_REFLECTED = 2
+    
+BRANCHES = {"auto": BRANCH_AUTO, 
+            "transmitted": BRANCH_TRANSMITTED, 
+            "reflected": BRANCH_REFLECTED}
+
+
+cdef void trace_surface_range_c(RayCollection rays,
+                                size_t start, size_t end,
+                                FaceList face_set,
+                                PyObject *face,
+                                PyObject **all_faces,
+                                double max_length,
+                                int branch,
+                                RayCollection new_rays) nogil:
+    """Traces the rays with indices from start to end to a single surface, being
+    the given face of the face_set or, if face is NULL, the nearest face of the
+    face_set. At most one child ray is kept for each ray, from the given branch.
+    Rays which miss the surface have no children.
+    """
     cdef:
-        FaceList face_set #a FaceList
-        Face face
-        size_t i, j, n_sets=len(face_sets), n_decomp = len(decomp_faces)
+        size_t i, j, first, keep
         vector_t point
         orientation_t orient
-        int idx, nearest_set=-1, nearest_idx=-1
-        gausslet_t *gausslet
+        int idx
+        double dist
         ray_t *ray
-        GaussletCollection new_gausslets
-        RayCollection child_rays
-   
-    #need to allocate the output rays here 
-    new_gausslets = GaussletCollection(gausslets.n_rays)
-    new_gausslets.parent = gausslets
-    
-    child_rays = RayCollection(2)
+        PyObject *hit
+        
+    for i in range(start, end):
+        ray = rays.rays + i
+        ray.length = max_length
+        ray.end_face_idx = -1
+        point = addvv_(ray.origin, multvs_(ray.direction, max_length))
+        if face is NULL:
+            idx = face_set.intersect_c(ray, point, 1)
+            if idx < 0:
+                continue
+            hit = all_faces[idx]
+        else:
+            hit = face
+            dist = intersect_face_c(<Face>hit, transform_c(face_set.inv_trans, ray.origin),
+                                    transform_c(face_set.inv_trans, point), 1)
+            if not ((<Face>hit).tolerance < dist < ray.length):
+                continue
+            ray.length = dist
+            ray.end_face_idx = (<Face>hit).idx
+        point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
+        orient = face_set.compute_orientation_c(<Face>hit, point)
+        first = new_rays.n_rays
+        eval_child_rays_c(<Face>hit, ray, i, point, orient, new_rays)
+        
+        ### Keep only the child on the selected branch
+        keep = new_rays.n_rays
+        for j in range(first, new_rays.n_rays):
+            if new_rays.rays[j].ray_type_id & REFL_RAY:
+                if branch != BRANCH_TRANSMITTED and keep == new_rays.n_rays:
+                    keep = j
+            elif branch != BRANCH_REFLECTED:
+                keep = j
+                break
+        if keep < new_rays.n_rays:
+            new_rays.rays[first] = new_rays.rays[keep]
+            new_rays.n_rays = first + 1
+        else:
+            new_rays.n_rays = first
+            
+
+def trace_surface(RayCollection rays, FaceList face_set, Face face, list all_faces,
+                  double max_length=100.0, branch="auto", int num_threads=1):
+    """Traces a single generation of rays to one surface, for a sequential trace. 
     
-    for i in range(gausslets.n_rays):
+    :param RayCollection rays: The input rays.
+    :param FaceList face_set: The FaceList containing the surface. Its transforms 
+                and bounds should be up to date.
+    :param Face face: The Face to intersect, or None to intersect the nearest 
+                face of the face_set.
+    :param list all_faces: The list of all Faces, in order of their idx attribute.
+    :param double max_length: The maximum ray length.
+    :param str branch: Which child ray is kept for each incident ray: "transmitted",
+                "reflected" or "auto" (the transmitted ray if there is one, otherwise 
+                the reflected ray).
+    :param int num_threads: The number of threads to trace with, as for trace_segment().
+    :return: a new RayCollection containing the child rays. Rays which miss the surface
+                are vignetted, having no child ray.
+    """
+    cdef:
+        size_t i, n_chunks, chunk_size, start, end
+        int n_threads = trace_thread_count(num_threads)
+        int branch_id
+        PyObject **face_ptrs=NULL
+        PyObject **chunk_ptrs=NULL
+        PyObject *face_ptr = NULL if face is None else <PyObject*>face
+        list chunks
+        RayCollection new_rays, chunk
+        
+    try:
+        branch_id = BRANCHES[branch]
+    except KeyError:
+        raise ValueError("branch must be one of %s, not %r"%(tuple(BRANCHES), branch))
+    n_chunks = 1 if num_threads == 1 else trace_chunk_count(rays.n_rays, n_threads)
+    face_ptrs = object_array_c(all_faces, Face)
+    try:
+        if n_chunks == 1:
+            new_rays = RayCollection(rays.n_rays)
+            trace_surface_range_c(rays, 0, rays.n_rays, face_set, face_ptr, face_ptrs,
+                                  max_length, branch_id, new_rays)
+        else:
+            chunk_size = (rays.n_rays + n_chunks - 1) // n_chunks
+            chunks = [RayCollection(chunk_size) for i in range(n_chunks)]
+            chunk_ptrs = object_array_c(chunks, RayCollection)
+            with nogil:
+                for i in prange(n_chunks, num_threads=n_threads, schedule="dynamic"):
+                    start = i*chunk_size
+                    end = min(start + chunk_size, rays.n_rays)
+                    trace_surface_range_c(rays, start, end, face_set, face_ptr, face_ptrs,
+                                          max_length, branch_id, 
+                                          <RayCollection>chunk_ptrs[i])
+            new_rays = RayCollection(sum(len(c) for c in chunks))
+            for chunk in chunks:
+                memcpy(new_rays.rays + new_rays.n_rays, chunk.rays, chunk.n_rays*sizeof(ray_t))
+                new_rays.n_rays += chunk.n_rays
+        count_face_hits_c(&rays.rays[0].end_face_idx, rays.n_rays, sizeof(ray_t), 
+                          face_ptrs, len(all_faces))
+        rays.version += 1
+    finally:
+        free(chunk_ptrs)
+        free(face_ptrs)
+    new_rays.parent = rays
+    return new_rays
+
+
+cdef void trace_geometric_range_c(GeometricRayCollection rays,
+                                  size_t start, size_t end,
+                                  PyObject **face_sets, size_t n_sets,
+                                  PyObject **all_faces,
+                                  double max_length,
+                                  RayCollection child_rays,
+                                  GeometricRayCollection new_rays,
+                                  PyObject *bvh) nogil:
+    """Traces the geometric rays with indices from start to end, appending the 
+    child rays to new_rays. Each ray is expanded to a ray_t for the intersection
+    and the face material. The child_rays collection is used as workspace.
+    """
+    cdef:
+        size_t i, j
+        vector_t point
+        orientation_t orient
+        int nearest_idx
+        geo_ray_t *g
+        ray_t ray
+        PyObject *face
+        PyObject *face_set=NULL
+        
+    for i in range(start, end):
+        g = rays.rays + i
+        ray = expand_geo_ray_c(g)
+        ray.length = max_length
+        ray.end_face_idx = -1
+        point = addvv_(ray.origin, multvs_(ray.direction, max_length))
+        nearest_idx = find_nearest_face_c(&ray, point, face_sets, n_sets, bvh, &face_set)
+        g.length = ray.length
+        g.end_face_idx = ray.end_face_idx
+        if nearest_idx >= 0:
+            face = all_faces[nearest_idx]
+            point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
+            orient = (<FaceList>face_set).compute_orientation_c(<Face>face, point)
+            child_rays.n_rays = 0
+            eval_child_rays_c(<Face>face, &ray, i, point, orient, child_rays)
+            for j in range(child_rays.n_rays):
+                new_rays.add_ray_c(pack_geo_ray_c(child_rays.rays + j))
+                
+                
+cdef GeometricRayCollection trace_geometric_ptrs_c(GeometricRayCollection rays, 
+                                        PyObject **set_ptrs, size_t n_sets,
+                                        PyObject **face_ptrs, size_t n_faces,
+                                        double max_length,
+                                        int num_threads,
+                                        PyObject *bvh_ptr,
+                                        prune_t *prune,
+                                        size_t capacity,
+                                        profile_t *profile):
+    """Traces a generation of geometric rays through arrays of FaceLists and Faces,
+    as for trace_segment_ptrs_c().
+    """
+    cdef:
+        size_t i, n_chunks, chunk_size, start, end
+        int n_threads = trace_thread_count(num_threads)
+        PyObject **chunk_ptrs=NULL
+        PyObject **child_ptrs=NULL
+        list chunks, child_rays
+        GeometricRayCollection new_rays, chunk
+        RayCollection child
+        
+    if num_threads == 1:
+        n_chunks = 1
+    else:
+        n_chunks = trace_chunk_count(rays.n_rays, n_threads)
+    try:
+        if n_chunks == 1:
+            new_rays = GeometricRayCollection(capacity)
+            child = RayCollection(2)
+            set_thread_profile_c(profile)
+            trace_geometric_range_c(rays, 0, rays.n_rays, set_ptrs, n_sets, face_ptrs,
+                                    max_length, child, new_rays, bvh_ptr)
+            set_thread_profile_c(NULL)
+        else:
+            chunk_size = (rays.n_rays + n_chunks - 1) // n_chunks
+            chunks = [GeometricRayCollection((capacity + n_chunks - 1) // n_chunks) 
+                      for i in range(n_chunks)]
+            child_rays = [RayCollection(2) for i in range(n_chunks)]
+            chunk_ptrs = object_array_c(chunks, GeometricRayCollection)
+            child_ptrs = object_array_c(child_rays, RayCollection)
+            with nogil:
+                for i in prange(n_chunks, num_threads=n_threads, schedule="dynamic"):
+                    start = i*chunk_size
+                    end = min(start + chunk_size, rays.n_rays)
+                    set_thread_profile_c(profile)
+                    trace_geometric_range_c(rays, start, end, set_ptrs, n_sets,
+                                            face_ptrs, max_length, 
+                                            <RayCollection>child_ptrs[i],
+                                            <GeometricRayCollection>chunk_ptrs[i],
+                                            bvh_ptr)
+                    set_thread_profile_c(NULL)
+            new_rays = GeometricRayCollection(sum(len(c) for c in chunks))
+            for chunk in chunks:
+                memcpy(new_rays.rays + new_rays.n_rays, chunk.rays, 
+                       chunk.n_rays*sizeof(geo_ray_t))
+                new_rays.n_rays += chunk.n_rays
+        if prune is not NULL:
+            prune_geo_rays_c(new_rays, prune)
+        count_face_hits_c(&rays.rays[0].end_face_idx, rays.n_rays, sizeof(geo_ray_t), 
+                          face_ptrs, n_faces)
+        rays.version += 1
+    finally:
+        free(chunk_ptrs)
+        free(child_ptrs)
+    new_rays.parent = rays
+    return new_rays
+
+
+cdef void trace_gausslet_range_c(GaussletCollection gausslets,
+                                size_t start, size_t end,
+                                PyObject **face_sets, size_t n_sets,
+                                PyObject **all_faces,
+                                double max_length,
+                                RayCollection child_rays,
+                                GaussletCollection new_gausslets,
+                                PyObject *bvh) nogil:
+    """Traces the gausslets with indices from start to end, appending the child 
+    gausslets to new_gausslets. The child_rays collection is used as workspace.
+    """
+    cdef:
+        size_t i
+        vector_t point
+        orientation_t orient
+        int nearest_idx
+        gausslet_t *gausslet
+        ray_t *ray
+        PyObject *face
+        PyObject *face_set=NULL
+        
+    for i in range(start, end):
         gausslet = gausslets.rays + i
         ray = &gausslet.base_ray
         ray.end_face_idx = -1
-        nearest_idx=-1
         point = addvv_(ray.origin, 
                             multvs_(ray.direction, 
                                     max_length))
-        #print "points", P1, P2
-        for j in range(n_sets):
-            face_set = face_sets[j]
-            #intersect_c returns the face idx of the intersection, or -1 otherwise
-            idx = (<FaceList>face_set).intersect_c(ray, point)
-            if idx >= 0:
-                nearest_set = j
-                nearest_idx = idx
+        nearest_idx = find_nearest_face_c(ray, point, face_sets, n_sets, bvh, &face_set)
         if nearest_idx >= 0:
-            #print "GET FACE", nearest.face_idx, len(all_faces)
             face = all_faces[nearest_idx]
-            face.count += 1
-            #print "ray length", ray.length
             point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
-            face_set = (<FaceList>(face_sets[nearest_set])) 
-            orient = face_set.compute_orientation_c(face, point)
-            #print "s normal", normal
+            orient = (<FaceList>face_set).compute_orientation_c(<Face>face, point)
             ### Clear the child_rays structure
             child_rays.n_rays = 0
-            (<InterfaceMaterial>(face.material)).eval_child_ray_c(ray, i, 
-                                                    point,
-                                                    orient,
-                                                    child_rays
-                                                    )
-            trace_parabasal_rays(gausslet, child_rays, face, face_set, new_gausslets, max_length)
+            eval_child_rays_c(<Face>face, ray, i, point, orient, child_rays)
+            trace_parabasal_rays(gausslet, child_rays, <Face>face, <FaceList>face_set, 
+                                 new_gausslets, max_length)
+
+
+cdef GaussletCollection trace_gausslet_c(GaussletCollection gausslets, 
+                                    list face_sets, 
+                                    list all_faces,
+                                    list decomp_faces,
+                                    double max_length,
+                                    int num_threads=1,
+                                    FaceListBVH bvh=None):
+    cdef:
+        PyObject **set_ptrs=NULL
+        PyObject **face_ptrs=NULL
+        
+    set_ptrs = object_array_c(face_sets, FaceList)
+    try:
+        face_ptrs = object_array_c(all_faces, Face)
+        return trace_gausslet_ptrs_c(gausslets, set_ptrs, len(face_sets), face_ptrs, 
+                                     len(all_faces), decomp_faces, max_length, num_threads,
+                                     NULL if bvh is None else <PyObject*>bvh, NULL, 
+                                     gausslets.n_rays, NULL, NULL)
+    finally:
+        free(set_ptrs)
+        free(face_ptrs)
+        
+        
+cdef GaussletCollection trace_gausslet_ptrs_c(GaussletCollection gausslets, 
+                                        PyObject **set_ptrs, size_t n_sets,
+                                        PyObject **face_ptrs, size_t n_faces,
+                                        list decomp_faces,
+                                        double max_length,
+                                        int num_threads,
+                                        PyObject *bvh_ptr,
+                                        prune_t *prune,
+                                        size_t capacity,
+                                        unsigned long long *decomp_ns,
+                                        profile_t *profile):
+    """Traces a generation of gausslets through arrays of FaceLists and Faces
+    (the Faces in order of their idx). If prune is not NULL, the low-power
+    child gausslets are then removed. The output is allocated for the expected 
+    number of child gausslets, given by capacity. If decomp_ns is not NULL, the
+    time spent evaluating decomposed rays is added to it. If profile is not NULL,
+    the performance counters of the faces are recorded in it.
+    """
+    cdef:
+        Face face
+        size_t i, j, n_decomp = len(decomp_faces)
+        size_t n_chunks, chunk_size, start, end
+        int n_threads = trace_thread_count(num_threads)
+        PyObject **chunk_ptrs=NULL
+        PyObject **child_ptrs=NULL
+        list chunks, child_rays
+        GaussletCollection new_gausslets, chunk
+        RayCollection child
+        
+    ### The hit counts of the decomposition faces before this generation
+    decomp_counts = [face.count for face in decomp_faces]
+    if n_decomp or num_threads == 1:
+        n_chunks = 1
+    else:
+        n_chunks = trace_chunk_count(gausslets.n_rays, n_threads)
+    try:
+        if n_chunks == 1:
+            #need to allocate the output rays here 
+            new_gausslets = GaussletCollection(capacity)
+            new_gausslets.parent = gausslets
+            child = RayCollection(2)
+            set_thread_profile_c(profile)
+            trace_gausslet_range_c(gausslets, 0, gausslets.n_rays, set_ptrs, n_sets,
+                                   face_ptrs, max_length, child, new_gausslets, bvh_ptr)
+            set_thread_profile_c(NULL)
+        else:
+            chunk_size = (gausslets.n_rays + n_chunks - 1) // n_chunks
+            chunks = [GaussletCollection((capacity + n_chunks - 1) // n_chunks) 
+                      for i in range(n_chunks)]
+            child_rays = [RayCollection(2) for i in range(n_chunks)]
+            chunk_ptrs = object_array_c(chunks, GaussletCollection)
+            child_ptrs = object_array_c(child_rays, RayCollection)
+            with nogil:
+                for i in prange(n_chunks, num_threads=n_threads, schedule="dynamic"):
+                    start = i*chunk_size
+                    end = min(start + chunk_size, gausslets.n_rays)
+                    set_thread_profile_c(profile)
+                    trace_gausslet_range_c(gausslets, start, end, set_ptrs, n_sets,
+                                           face_ptrs, max_length, 
+                                           <RayCollection>child_ptrs[i],
+                                           <GaussletCollection>chunk_ptrs[i],
+                                           bvh_ptr)
+                    set_thread_profile_c(NULL)
+            new_gausslets = GaussletCollection(sum(len(c) for c in chunks))
+            new_gausslets.parent = gausslets
+            for chunk in chunks:
+                new_gausslets.extend_c(chunk)
+        count_face_hits_c(&gausslets.rays[0].base_ray.end_face_idx, gausslets.n_rays, 
+                          sizeof(gausslet_t), face_ptrs, n_faces)
+        gausslets.version += 1
+    finally:
+        free(chunk_ptrs)
+        free(child_ptrs)
             
     for j in range(n_decomp):
         face = decomp_faces[j]
-        if face.count:
-            (<InterfaceMaterial>(face.material)).eval_decomposed_rays_c(new_gausslets)
-            face.count = 0
+        if face.count > decomp_counts[j]:
+            eval_decomposed_rays_c(face, new_gausslets, decomp_ns, profile)
             
+    if prune is not NULL:
+        prune_gausslets_c(new_gausslets, prune)
     new_gausslets.reset_length_c(max_length)
     return new_gausslets
 
 
+cdef void eval_decomposed_rays_c(Face face, GaussletCollection new_gausslets,
+                                 unsigned long long *decomp_ns, profile_t *profile):
+    """Evaluates the decomposed rays of a face with a decomposition material, 
+    adding the time taken to decomp_ns (if not NULL), and recording the time and
+    child gausslets in the profile (if not NULL).
+    """
+    cdef:
+        face_profile_t *prof = profile_face_c(profile, face)
+        unsigned long long dt, t0 = clock_ns_c()
+        size_t n_rays = new_gausslets.n_rays
+    face.material.eval_decomposed_rays_c(new_gausslets)
+    dt = clock_ns_c() - t0
+    if decomp_ns is not NULL:
+        decomp_ns[0] += dt
+    if prof is not NULL:
+        prof.eval_ns += dt
+        prof.children += new_gausslets.n_rays - n_rays
+    
+    
 cdef void trace_parabasal_rays(gausslet_t *g_in, RayCollection base_rays, Face face, FaceList face_set, 
-                          GaussletCollection new_gausslets, double max_length):
+                          GaussletCollection new_gausslets, double max_length) nogil:
     cdef:
         unsigned int i,j
         para_t *para_ray
         gausslet_t gausslet
         vector_t ray_end, point[6]
         orientation_t orient[6]
-        InterfaceMaterial material = (<InterfaceMaterial>(face.material))
         
     for j in range(6):
         para_ray = g_in.para + j
@@ -2129,7 +4618,7 @@ cdef void trace_parabasal_rays(gausslet_t *g_in, RayCollection base_rays, Face f
         gausslet.base_ray = base_rays.rays[i]
         for j in range(6):
             para_ray = g_in.para + j            
-            gausslet.para[j] = material.eval_parabasal_ray_c(base_rays.rays + i,
+            gausslet.para[j] = face.material.eval_parabasal_ray_c(base_rays.rays + i,
                                                             para_ray.direction, #incoming ray direction
                                                             point[j], #position of intercept
                                                             orient[j],
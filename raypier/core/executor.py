@@ -0,0 +1,135 @@
+"""
+A background executor for traces, for interactive and service use.
+
+Trace requests often arrive faster than they can be traced (e.g. while a slider
+is dragged), and only the trace of the latest state is wanted. The TraceExecutor
+runs one trace at a time in a background thread. A new request replaces any
+request still waiting, and cancels the trace in progress (which stops between
+ray generations, see tracer.TraceMonitor). The futures of the replaced requests
+complete with the result of the request which replaced them, so each caller
+gets the result of a trace started after its request.
+"""
+
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+from .tracer import TraceMonitor, TraceCancelled
+
+
+class TraceRequest(object):
+    """A job waiting for, or running in, a TraceExecutor"""
+    def __init__(self, job, on_progress=None):
+        self.job = job
+        self.monitor = TraceMonitor(on_progress=on_progress)
+        self.futures = [Future()]
+
+
+def resolve(futures, result=None, exception=None, cancel=False):
+    for f in futures:
+        try:
+            if cancel:
+                f.cancel()
+            elif exception is not None:
+                f.set_exception(exception)
+            else:
+                f.set_result(result)
+        except InvalidStateError:
+            #The caller has already cancelled this future
+            pass
+
+
+class TraceExecutor(object):
+    """
+    Runs trace jobs, one at a time, in a background thread, with the latest request
+    winning (see the module docstring). The thread is started by the first request.
+
+    A job is a callable taking a tracer.TraceMonitor, to be passed on to the trace
+    functions; it should stop (raising TraceCancelled) once the monitor is cancelled.
+    Its return value is the result of the request's future.
+    """
+    def __init__(self, name="raypier-trace"):
+        self.name = name
+        self._lock = threading.Condition()
+        self._pending = None
+        self._running = None
+        self._thread = None
+        self._shutdown = False
+
+    def submit(self, job, on_progress=None):
+        """
+        Requests a call of job(monitor) in the background thread. Any request still
+        waiting is replaced and the running job is cancelled. on_progress is passed to
+        the TraceMonitor of the job (and is called in the background thread).
+
+        returns - a concurrent.futures.Future for the result.
+        """
+        request = TraceRequest(job, on_progress)
+        future = request.futures[0]
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("The TraceExecutor has been shut down")
+            if self._pending is not None:
+                request.futures[:0] = self._pending.futures
+            if self._running is not None:
+                self._running.monitor.cancel()
+                request.futures[:0] = self._running.futures
+                self._running.futures = []
+            self._pending = request
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._lock.notify_all()
+        return future
+
+    def cancel(self):
+        """Cancels the waiting request and the running job, and their futures."""
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if self._running is not None:
+                self._running.monitor.cancel()
+        if pending is not None:
+            resolve(pending.futures, cancel=True)
+
+    @property
+    def busy(self):
+        """True while a job is running or waiting"""
+        with self._lock:
+            return self._pending is not None or self._running is not None
+
+    def wait(self, timeout=None):
+        """Waits until no job is running or waiting. Returns False on a timeout."""
+        with self._lock:
+            return self._lock.wait_for(lambda: self._pending is None and self._running is None,
+                                       timeout)
+
+    def shutdown(self, wait=True):
+        """Cancels any requests and stops the background thread."""
+        self.cancel()
+        with self._lock:
+            self._shutdown = True
+            self._lock.notify_all()
+            thread = self._thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._pending is not None or self._shutdown)
+                if self._pending is None:
+                    return
+                request, self._pending = self._pending, None
+                self._running = request
+            try:
+                result = request.job(request.monitor)
+            except TraceCancelled:
+                outcome = dict(cancel=True)
+            except BaseException as e:
+                outcome = dict(exception=e)
+            else:
+                outcome = dict(result=result)
+            with self._lock:
+                futures, request.futures = request.futures, []
+                self._running = None
+                self._lock.notify_all()
+            resolve(futures, **outcome)
@@ -5,7 +5,8 @@ summation of General Astigmatic Gaussian Beams
 """
 
 
-from .cfields import sum_gaussian_modes, evaluate_modes as evaluate_modes_c
+from .cfields import sum_gaussian_modes, sum_gaussian_modes_times, sum_gaussian_modes_spectral, \
+        evaluate_modes as evaluate_modes_c
 from .utils import normaliseVector, dotprod
 from .ctracer import RayCollection
 
@@ -185,6 +186,56 @@ def Gamma(z, A, B, C):
     return AA, BB, CC
 
 
+def sum_modes(rays, modes, wavelengths, points, time_ps=0.0, tolerance=0.0, times=None, 
+              spectral=False):
+    """
+    Sums the Gaussian modes at the points, with the output selected by the arguments:
+    the field at time_ps, of shape (N,3); the field at each of the given times, of 
+    shape (T,N,3); or, if spectral is True, the field of each wavelength at time_ps,
+    of shape (W,N,3). The tolerance only applies to the first.
+    """
+    if times is not None:
+        if spectral:
+            raise ValueError("Give either times or spectral output, not both")
+        return sum_gaussian_modes_times(rays, modes, wavelengths, points, times)
+    if spectral:
+        return sum_gaussian_modes_spectral(rays, modes, wavelengths, points, time_ps)
+    return sum_gaussian_modes(rays, modes, wavelengths, points, time_ps, tolerance)
+
+
+def cached_modes(collection, key, compute):
+    """
+    Returns the data derived from a RayCollection or GaussletCollection which is 
+    stored under the given key in the collection's mode_cache, calling compute() 
+    to evaluate it if it is not there. The cache is cleared whenever the collection's 
+    version changes (i.e. when its rays are modified).
+    """
+    cache = collection.mode_cache
+    version = collection.version
+    if cache is None or cache[0] != version:
+        cache = (version, {})
+        collection.mode_cache = cache
+    try:
+        return cache[1][key]
+    except KeyError:
+        value = cache[1][key] = compute()
+        return value
+
+
+def gausslet_modes(gausslet_collection, blending=1.0):
+    """
+    Returns the base rays (as a RayCollection) and the mode coefficients of a 
+    GaussletCollection. These are cached on the collection until it is modified
+    (see cached_modes()).
+    """
+    def compute():
+        gc = gausslet_collection.copy_as_array() 
+        rays, x, y, dx, dy = evaluate_neighbours_gc(gc)
+        modes = evaluate_modes_c(x, y, dx, dy, blending=blending)
+        return RayCollection.from_array(rays), modes
+    return cached_modes(gausslet_collection, ("gausslets", blending), compute)
+
+
 def ExtractGamma(gausslet_collection, blending=1.0):
     """Used in Testing"""
     gc = gausslet_collection.copy_as_array() 
@@ -197,23 +248,29 @@ def eval_Efield_from_rays(ray_collection, points, wavelengths,
                           blending=1.0,
                           time_ps=0.0,
                           exit_pupil_offset=0.0, 
-                          exit_pupil_centre=(0.0,0.0,0.0)):
-    rays = ray_collection.copy_as_array() 
-    radius = exit_pupil_offset
+                          exit_pupil_centre=(0.0,0.0,0.0),
+                          tolerance=0.0,
+                          times=None,
+                          spectral=False):
+    def compute():
+        rays = ray_collection.copy_as_array() 
+        radius = exit_pupil_offset
+            
+        if radius:
+            projected = project_to_sphere(rays, exit_pupil_centre, radius)
+        else:
+            projected = rays
         
-    if radius:
-        projected = project_to_sphere(rays, exit_pupil_centre, radius)
-    else:
-        projected = rays
+        neighbours_idx = ray_collection.neighbours
+        rays, x, y, dx, dy = evaluate_neighbours(projected, neighbours_idx)
     
-    neighbours_idx = ray_collection.neighbours
-    rays, x, y, dx, dy = evaluate_neighbours(projected, neighbours_idx)
-
-    modes = evaluate_modes_c(x, y, dx, dy, blending=blending)
+        modes = evaluate_modes_c(x, y, dx, dy, blending=blending)
+        return RayCollection.from_array(rays), modes
     
-    _rays = RayCollection.from_array(rays)
+    key = ("rays", blending, exit_pupil_offset, tuple(exit_pupil_centre))
+    _rays, modes = cached_modes(ray_collection, key, compute)
     
-    E = sum_gaussian_modes(_rays, modes, wavelengths, points, time_ps)
+    E = sum_modes(_rays, modes, wavelengths, points, time_ps, tolerance, times, spectral)
     
     return E
 
@@ -223,36 +280,75 @@ class EFieldSummation(object):
     For situations where you wish to evaluate the E-field from a set of Gausslets with different sets of evaluation points,
     this class provides a small optimisation by performing the maths to convert ray-intercepts to Gaussian mode parameters
     up front.
+    
+    The modes are truncated at the given amplitude tolerance (see cfields.sum_gaussian_modes()).
+    
+    The modes are cached on the GaussletCollection (see gausslet_modes()), so they are shared
+    by every EFieldSummation of the same (unmodified) collection.
     """
-    def __init__(self, gausslet_collection, wavelengths=None, blending=1.0 ):
+    def __init__(self, gausslet_collection, wavelengths=None, blending=1.0, tolerance=0.0):
         if wavelengths is None:
             wavelengths = numpy.asarray(gausslet_collection.wavelengths)
         if wavelengths is None:
             raise ValueError("No wavelengths supplied")
         self.wavelengths = wavelengths
-        self.gc = gc = gausslet_collection.copy_as_array() 
-        rays, x, y, dx, dy = evaluate_neighbours_gc(gc)
-        self.modes = evaluate_modes_c(x, y, dx, dy, blending=blending)
-        self.base_rays = RayCollection.from_array(rays)
+        self.tolerance = tolerance
+        self.base_rays, self.modes = gausslet_modes(gausslet_collection, blending)
         
-    def evaluate(self, points, time_ps=0.0):
+    def evaluate(self, points, time_ps=0.0, tolerance=None):
         """
-        Called to calculate the E-field for the given points.
+        Called to calculate the E-field for the given points. The tolerance, if given,
+        overrides the tolerance of the EFieldSummation.
         """
         points = numpy.ascontiguousarray(points)
         shape = points.shape
         points.shape=(-1,3)
+        if tolerance is None:
+            tolerance = self.tolerance
         E = sum_gaussian_modes(self.base_rays, 
                               self.modes, 
-                              self.wavelengths, points, time_ps)
+                              self.wavelengths, points, time_ps, tolerance)
         E.shape = shape
         return E
+    
+    def evaluate_times(self, points, times):
+        """
+        Calculates the E-field for the given points at each of the given times (in ps),
+        in one pass over the modes. The modes are not truncated.
+        
+        returns - an array of shape (len(times),)+points.shape
+        """
+        points = numpy.ascontiguousarray(points)
+        shape = points.shape
+        points.shape=(-1,3)
+        E = sum_gaussian_modes_times(self.base_rays, self.modes, self.wavelengths, 
+                                     points, times)
+        E.shape = (E.shape[0],) + shape
+        return E
+    
+    def evaluate_spectrum(self, points, time_ps=0.0):
+        """
+        Calculates the E-field for the given points of the Gausslets of each wavelength 
+        separately. The modes are not truncated.
+        
+        returns - an array of shape (len(wavelengths),)+points.shape
+        """
+        points = numpy.ascontiguousarray(points)
+        shape = points.shape
+        points.shape=(-1,3)
+        E = sum_gaussian_modes_spectral(self.base_rays, self.modes, self.wavelengths, 
+                                        points, time_ps)
+        E.shape = (E.shape[0],) + shape
+        return E
 
 
 def eval_Efield_from_gausslets(gausslet_collection, points, 
                                wavelengths = None,
                                blending=1.0,
                                time_ps=0.0, 
+                               tolerance=0.0,
+                               times=None,
+                               spectral=False,
                                **kwds):
     """
     Calculates the vector E-field is each of the points given. The returned 
@@ -265,13 +361,18 @@ def eval_Efield_from_gausslets(gausslet_collection, points,
                                     overriding the wavelengths data contained by the GaussletCollection object.
     :param float blending: The 1/width of each Gaussian mode at the evaluation points. A value of unity (the default),
                             means the parabasal rays are determined to be the 1/e point in the field amplitude.
+    :param float tolerance: If non-zero, each Gaussian mode is only evaluated at the points where its amplitude 
+                            is at least this fraction of its on-axis amplitude (see cfields.sum_gaussian_modes()). 
+                            This is much faster when the modes are small compared to the set of points.
+    :param ndarray[T] times: If given, the field is evaluated at each of these times (in ps, instead 
+                            of time_ps), returning an array of shape (T,N,3). Each mode is evaluated 
+                            once for all the times.
+    :param bool spectral: If True, the field of each wavelength is returned separately, as an array 
+                            of shape (W,N,3) for W wavelengths.
     """
-    gc = gausslet_collection.copy_as_array() 
     if wavelengths is None:
         wavelengths = numpy.asarray(gausslet_collection.wavelengths)
-    rays, x, y, dx, dy = evaluate_neighbours_gc(gc)
-    modes = evaluate_modes_c(x, y, dx, dy, blending=blending)
-    _rays = RayCollection.from_array(rays)
-    E = sum_gaussian_modes(_rays, modes, wavelengths, points, time_ps)
+    _rays, modes = gausslet_modes(gausslet_collection, blending)
+    E = sum_modes(_rays, modes, wavelengths, points, time_ps, tolerance, times, spectral)
     return E
 
@@ -0,0 +1,320 @@
+"""
+A lightweight model API, for tracing without the GUI. The optics, ray sources and
+the trace() function here depend only on raypier.core and numpy, so they import
+quickly and need no traits, VTK or Qt. This suits batch and worker processes.
+
+The optics are placed with a centre, direction and rotation, as for the optics of
+the traits-based API (raypier.bases.ModelObject), and the sources generate the
+same input rays as their namesakes in raypier.sources.
+
+Example::
+
+    from raypier.core.model import ParallelRaySource, PlanoConvexLens, trace
+
+    src = ParallelRaySource(origin=(0,0,-20), direction=(0,0,1), radius=5.0)
+    lens = PlanoConvexLens(centre=(0,0,0), direction=(0,0,1), curvature=25.0)
+    traced_rays, all_faces = trace([src], [lens])[0]
+"""
+
+import numpy
+
+from .ctracer import FaceList, Transform, RayCollection, ray_dtype
+from .cfaces import CircularFace, SphericalFace, RectangularFace
+from .cmaterials import PECMaterial, SingleLayerCoatedMaterial
+from .utils import normaliseVector
+from .tracer import trace_rays
+
+
+def rotation_matrix(direction, rotation=0.0):
+    """
+    Returns the (3,3) rotation matrix taking the local z-axis to the given direction,
+    with a further rotation (in degrees) about the direction. This is the rotation
+    of the transform of a raypier.bases.ModelObject.
+    """
+    x,y,z = normaliseVector(numpy.asarray(direction, dtype=numpy.float64))
+    orientation = -numpy.arctan2(x,y)
+    elevation = -numpy.arccos(numpy.clip(z, -1.0, 1.0))
+    def rot_z(a):
+        c, s = numpy.cos(a), numpy.sin(a)
+        return numpy.array([[c,-s,0.],[s,c,0.],[0.,0.,1.]])
+    c, s = numpy.cos(elevation), numpy.sin(elevation)
+    rot_x = numpy.array([[1.,0.,0.],[0.,c,-s],[0.,s,c]])
+    return rot_z(orientation).dot(rot_x).dot(rot_z(numpy.radians(rotation)))
+
+
+def make_transforms(centre, direction, rotation=0.0):
+    """
+    Returns the (transform, inverse_transform) pair of ctracer.Transforms for an
+    object at the given centre, direction and rotation.
+    """
+    rot = rotation_matrix(direction, rotation)
+    centre = numpy.asarray(centre, dtype=numpy.float64)
+    trans = Transform(rotation=rot.tolist(), translation=centre.tolist())
+    inv_trans = Transform(rotation=rot.T.tolist(), translation=(-rot.T.dot(centre)).tolist())
+    return trans, inv_trans
+
+
+class Optic(object):
+    """
+    A traceable optic, made of a list of Faces which share a transform.
+
+    The parameters of the faces (named in the 'params' attribute of each Face class,
+    e.g. diameter) are taken from the optic when it is traced, as for the optics
+    of the traits-based API.
+
+    :param list faces: the cfaces.Face objects of the optic, in local coordinates.
+    :param centre: the position of the optic.
+    :param direction: the direction of the local z-axis.
+    :param float rotation: the rotation about the direction, in degrees.
+    """
+    def __init__(self, faces=None, centre=(0.,0.,0.), direction=(0.,0.,1.), rotation=0.0,
+                 name=""):
+        self.name = name
+        self._centre = tuple(centre)
+        self._direction = tuple(normaliseVector(direction))
+        self._rotation = rotation
+        self.faces = FaceList()
+        self.faces.faces = self.make_faces() if faces is None else list(faces)
+        for face in self.faces.faces:
+            if face.owner is None:
+                face.owner = self
+        self.update_transforms()
+
+    def make_faces(self):
+        """Returns the list of faces of the optic. Subclasses override this."""
+        return []
+
+    def update_transforms(self):
+        self.faces.transform, self.faces.inverse_transform = make_transforms(self._centre,
+                                                                             self._direction,
+                                                                             self._rotation)
+
+    @property
+    def centre(self):
+        return self._centre
+
+    @centre.setter
+    def centre(self, centre):
+        self._centre = tuple(centre)
+        self.update_transforms()
+
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, direction):
+        self._direction = tuple(normaliseVector(direction))
+        self.update_transforms()
+
+    @property
+    def rotation(self):
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, rotation):
+        self._rotation = rotation
+        self.update_transforms()
+
+
+class PECMirror(Optic):
+    """A flat, circular, perfectly-reflecting mirror, as raypier.mirrors.PECMirror"""
+    def __init__(self, diameter=25.4, offset=0.0, **kwds):
+        self.diameter = diameter
+        self.offset = offset
+        super().__init__(**kwds)
+
+    def make_faces(self):
+        return [CircularFace(owner=self, material=PECMaterial())]
+
+
+class RectMirror(Optic):
+    """A flat, rectangular, perfectly-reflecting mirror, as raypier.mirrors.RectMirror"""
+    def __init__(self, length=25.4, width=25.4, offset=0.0, **kwds):
+        self.length = length
+        self.width = width
+        self.offset = offset
+        super().__init__(**kwds)
+
+    def make_faces(self):
+        return [RectangularFace(owner=self, material=PECMaterial())]
+
+
+class PlanoConvexLens(Optic):
+    """
+    A plano-convex lens with a single-layer coating, as raypier.lenses.PlanoConvexLens.
+    The planar face is at the centre, the spherical face at z=CT.
+    """
+    def __init__(self, diameter=15.0, CT=5.0, curvature=11.7, n_inside=1.5, n_outside=1.0,
+                 n_coating=1.3, coating_thickness=0.25, offset=0.0, **kwds):
+        self.diameter = diameter
+        self.offset = offset
+        self.CT = CT
+        self.curvature = curvature
+        self.material = SingleLayerCoatedMaterial(n_inside=n_inside,
+                                                  n_outside=n_outside,
+                                                  n_coating=n_coating,
+                                                  coating_thickness=coating_thickness)
+        super().__init__(**kwds)
+
+    def make_faces(self):
+        f1 = CircularFace(owner=self, material=self.material)
+        f2 = SphericalFace(owner=self, material=self.material, z_height=self.CT,
+                           curvature=self.curvature)
+        return [f1, f2]
+
+
+class SphericalMirror(Optic):
+    """A spherical, perfectly-reflecting mirror with its vertex at the centre"""
+    def __init__(self, diameter=25.4, curvature=50.0, **kwds):
+        self.diameter = diameter
+        self.curvature = curvature
+        super().__init__(**kwds)
+
+    def make_faces(self):
+        return [SphericalFace(owner=self, material=PECMaterial(), z_height=0.0,
+                              curvature=self.curvature)]
+
+
+def transverse_axes(direction):
+    """Returns two unit vectors normal to the direction and to each other."""
+    direction = numpy.asarray(direction)
+    if numpy.abs(direction).argmax()==0:
+        v = numpy.array([0.,1.,0.])
+    else:
+        v = numpy.array([1.,0.,0.])
+    d1 = normaliseVector(numpy.cross(direction, v))
+    d2 = normaliseVector(numpy.cross(direction, d1))
+    return d1, d2
+
+
+def parallel_ray_array(origin, direction, radius, number, rings, E_vector=(1.,0.,0.),
+                       E1_amp=1.0, E2_amp=0.0):
+    """
+    Returns an array (of ray_dtype) of parallel rays at the origin and in concentric
+    rings about it, with 'number' rays in each of 'rings' rings out to the given radius.
+    """
+    origin = numpy.asarray(origin, dtype=numpy.float64)
+    direction = numpy.asarray(direction, dtype=numpy.float64)
+    d1, d2 = transverse_axes(direction)
+    E_vector = numpy.cross(E_vector, direction)
+    E_vector = numpy.cross(E_vector, direction)
+
+    ray_data = numpy.zeros((rings*number)+1, dtype=ray_dtype)
+    if rings:
+        radii = ((numpy.arange(rings)+1)*(radius/rings))[:,None,None]
+        angles = (numpy.arange(number)*(2*numpy.pi/number))[None,:,None]
+        offsets = radii*(d1*numpy.sin(angles) + d2*numpy.cos(angles))
+        offsets.shape = (-1,3)
+        ray_data['origin'][1:] = offsets
+    ray_data['origin'] += origin
+    ray_data['direction'] = direction
+    ray_data['wavelength_idx'] = 0
+    ray_data['E_vector'] = [normaliseVector(E_vector)]
+    ray_data['E1_amp'] = E1_amp
+    ray_data['E2_amp'] = E2_amp
+    ray_data['refractive_index'] = 1.0+0.0j
+    ray_data['normal'] = [[0,1,0]]
+    return ray_data
+
+
+def broadband_wavelengths(wavelength_start, wavelength_end, number, uniform_deltaf=True):
+    """
+    Returns the wavelengths of a broadband source, uniformly spaced in frequency
+    (if uniform_deltaf) or in wavelength.
+    """
+    if uniform_deltaf:
+        return 1./numpy.linspace(1./wavelength_start, 1./wavelength_end, number)
+    return numpy.linspace(wavelength_start, wavelength_end, number)
+
+
+def broadband_ray_array(origin, direction, number, E_vector=(1.,0.,0.), E1_amp=1.0,
+                        E2_amp=0.0):
+    """
+    Returns an array (of ray_dtype) of 'number' coincident rays, each with its own
+    wavelength index.
+    """
+    origin = numpy.asarray(origin, dtype=numpy.float64)
+    direction = numpy.asarray(direction, dtype=numpy.float64)
+    E_vector = numpy.cross(E_vector, direction)
+    E_vector = numpy.cross(E_vector, direction)
+
+    ray_data = numpy.zeros(number, dtype=ray_dtype)
+    ray_data['origin'] = origin.reshape(-1,3)
+    ray_data['direction'] = direction.reshape(-1,3)
+    ray_data['wavelength_idx'] = numpy.arange(number)
+    ray_data['E_vector'] = [normaliseVector(E_vector)]
+    ray_data['E1_amp'] = E1_amp
+    ray_data['E2_amp'] = E2_amp
+    ray_data['refractive_index'] = 1.0+0.0j
+    ray_data['normal'] = [[0,1,0]]
+    return ray_data
+
+
+class RaySource(object):
+    """
+    A source of input rays, given as any ray collection (a RayCollection,
+    GaussletCollection or GeometricRayCollection) and its list of wavelengths.
+    After tracing, the traced_rays attribute holds the list of ray generations.
+    """
+    def __init__(self, input_rays=None, wavelength_list=(0.78,), max_ray_len=200.0, name=""):
+        self.name = name
+        self.wavelength_list = list(wavelength_list)
+        self.max_ray_len = max_ray_len
+        self._input_rays = input_rays
+        self.traced_rays = []
+
+    @property
+    def input_rays(self):
+        return self._input_rays
+
+
+class ParallelRaySource(RaySource):
+    """A bundle of parallel rays in concentric rings, as raypier.sources.ParallelRaySource"""
+    def __init__(self, origin=(0.,0.,0.), direction=(0.,0.,1.), radius=10.0, number=20,
+                 rings=3, wavelength=0.78, E_vector=(1.,0.,0.), E1_amp=1.0, E2_amp=0.0,
+                 **kwds):
+        super().__init__(wavelength_list=[wavelength], **kwds)
+        self.ray_data = parallel_ray_array(origin, normaliseVector(direction), radius,
+                                           number, rings, E_vector, E1_amp, E2_amp)
+
+    @property
+    def input_rays(self):
+        return RayCollection.from_array(self.ray_data)
+
+
+class BroadbandRaySource(RaySource):
+    """Coincident rays covering a range of wavelengths, as raypier.sources.BroadbandRaySource"""
+    def __init__(self, origin=(0.,0.,0.), direction=(0.,0.,1.), number=200,
+                 wavelength_start=1.5, wavelength_end=1.6, uniform_deltaf=True,
+                 E_vector=(1.,0.,0.), E1_amp=1.0, E2_amp=0.0, **kwds):
+        wavelengths = broadband_wavelengths(wavelength_start, wavelength_end, number,
+                                            uniform_deltaf)
+        super().__init__(wavelength_list=wavelengths, **kwds)
+        self.ray_data = broadband_ray_array(origin, normaliseVector(direction), number,
+                                            E_vector, E1_amp, E2_amp)
+
+    @property
+    def input_rays(self):
+        return RayCollection.from_array(self.ray_data)
+
+
+def trace(sources, optics, recursion_limit=200, num_threads=1, **kwds):
+    """
+    Traces each source through the optics (Optics or FaceLists). Further keyword
+    arguments are passed on to tracer.trace_rays().
+
+    returns - a list of the (traced_rays, all_faces) results of trace_rays(), one
+              for each source. The traced rays are also kept in the traced_rays
+              attribute of each source.
+    """
+    face_lists = [getattr(o, "faces", o) for o in optics]
+    results = []
+    for src in sources:
+        rays = src.input_rays
+        rays.wavelengths = numpy.asarray(src.wavelength_list)
+        result = trace_rays(rays, face_lists, recursion_limit=recursion_limit,
+                            max_length=src.max_ray_len, num_threads=num_threads, **kwds)
+        src.traced_rays = list(result[0])
+        results.append(result)
+    return results
@@ -0,0 +1,260 @@
+"""
+Tracing of ray sources, or slices of a source's wavelengths, in parallel using
+a pool of worker processes.
+
+Where possible, the workers are forked from the tracing process, so each inherits
+the CompiledScene once, when the pool is created (the faces do not need to be
+pickled). Otherwise (on Windows, or when tracing from a thread other than the
+main thread, where forking could copy locks held by other threads) the workers
+are spawned and the CompiledScene is pickled to each of them. The traced ray 
+generations are returned through shared memory blocks, and merged into the same
+generation lists as a single-process trace.
+"""
+
+from .ctracer import RayCollection, GaussletCollection, GeometricRayCollection, \
+        CompiledScene, ray_dtype, gausslet_dtype, geo_ray_dtype
+from .tracer import trace_rays, base_ray_array
+
+from multiprocessing import get_context, get_all_start_methods, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import threading
+import numpy
+
+
+DTYPES = {RayCollection: ray_dtype,
+          GaussletCollection: gausslet_dtype,
+          GeometricRayCollection: geo_ray_dtype}
+
+#The scene of a worker process, inherited from the parent on forking (or unpickled)
+_worker_scene = None
+
+
+def default_start_method():
+    """
+    The start method for the worker processes: "fork" where it is available and
+    the caller is the main thread, otherwise "spawn".
+    """
+    if "fork" in get_all_start_methods() and \
+            threading.current_thread() is threading.main_thread():
+        return "fork"
+    return "spawn"
+
+
+def _init_worker(scene):
+    global _worker_scene
+    _worker_scene = scene
+
+
+def _trace_job(cls, data, wavelengths, recursion_limit, max_length):
+    """Traces one job in a worker process, returning the shared memory block name
+    and length of each generation, and the face intersection counts.
+    """
+    rays = cls.from_array(data.view(DTYPES[cls]))
+    rays.wavelengths = wavelengths
+    traced_rays, all_faces = trace_rays(rays, _worker_scene, recursion_limit=recursion_limit,
+                                        max_length=max_length)
+    blocks = []
+    for r in traced_rays:
+        #The block is left for the parent to unlink, in from_shared()
+        shm = r.to_shared_memory()
+        blocks.append((shm.name, len(r)))
+        shm.close()
+    return blocks, numpy.array([f.count for f in all_faces])
+
+
+def from_shared(block, cls):
+    """
+    Creates a new ray collection of type cls from a shared memory block made by
+    a worker (see _trace_job()), then unlinks the block.
+    """
+    name, n = block
+    shm = SharedMemory(name=name)
+    try:
+        view = numpy.ndarray((n,), dtype=DTYPES[cls], buffer=shm.buf)
+        rays = cls.from_array(view)
+        del view
+    finally:
+        shm.close()
+        shm.unlink()
+    return rays
+
+
+def split_wavelengths(input_rays, n_slices):
+    """
+    Splits the rays into at most n_slices jobs by wavelength. Each slice has a
+    contiguous block of the wavelengths list, with the wavelength_idx of its
+    rays offset to match.
+
+    returns - a list of (data, wavelengths, indices, offset) tuples, where indices
+            gives the index in the input_rays of each ray of the data.
+    """
+    data = input_rays.as_array()
+    wavelength_idx = base_ray_array(input_rays)['wavelength_idx']
+    wavelengths = numpy.asarray(input_rays.wavelengths)
+    out = []
+    for block in numpy.array_split(numpy.arange(len(wavelengths)), max(n_slices, 1)):
+        if not len(block):
+            continue
+        start, end = block[0], block[-1]+1
+        indices = numpy.flatnonzero((wavelength_idx >= start) & (wavelength_idx < end))
+        if not len(indices):
+            continue
+        sliced = data[indices]
+        base = sliced['base_ray'] if isinstance(input_rays, GaussletCollection) else sliced
+        base['wavelength_idx'] -= start
+        out.append((sliced, wavelengths[start:end], indices, start))
+    return out
+
+
+def merge_generations(input_rays, slices, generations):
+    """
+    Merges the traced generations of several wavelength slices of the input_rays
+    (see split_wavelengths()). The wavelength_idx of each slice is offset into the
+    full wavelengths list, as for select_ray_intersections(). The rays of each
+    generation are put in order of their parents, and the parent_idx mapped to
+    the merged parent generation, giving the same generations as tracing the
+    input_rays in one piece.
+
+    :param input_rays: the input rays, which are updated with the traced lengths.
+    :param list slices: the slices, as returned by split_wavelengths()
+    :param list generations: for each slice, the list of traced ray collections
+    :return: the list of merged ray collections, starting with the input_rays.
+    """
+    cls = type(input_rays)
+    for (data, wavelengths, indices, offset), traced in zip(slices, generations):
+        for rays in traced:
+            base_ray_array(rays)['wavelength_idx'] += offset
+            rays.touch()
+        input_rays.as_array()[indices] = traced[0].as_array()
+        input_rays.touch()
+
+    out = [input_rays]
+    #For each slice, the merged index of each ray of the previous generation
+    index_maps = [s[2] for s in slices]
+    for gen in range(1, max(len(g) for g in generations)):
+        parts = [(i, traced[gen]) for i, traced in enumerate(generations) if len(traced) > gen]
+        data = numpy.concatenate([rays.as_array() for i, rays in parts])
+        parent_idx = numpy.concatenate([index_maps[i][base_ray_array(rays)['parent_idx']]
+                                        for i, rays in parts])
+        order = numpy.argsort(parent_idx, kind='stable')
+        data = data[order]
+        base = data['base_ray'] if cls is GaussletCollection else data
+        base['parent_idx'] = parent_idx[order]
+
+        merged = numpy.empty(len(order), dtype=numpy.intp)
+        merged[order] = numpy.arange(len(order))
+        index_maps = [None]*len(generations)
+        start = 0
+        for i, rays in parts:
+            index_maps[i] = merged[start:start+len(rays)]
+            start += len(rays)
+
+        rays = cls.from_array(data.view(DTYPES[cls]))
+        rays.parent = out[-1]
+        out.append(rays)
+    return out
+
+
+class ProcessTracer(object):
+    """
+    Traces ray sources in parallel, using a pool of worker processes. Each job
+    is traced as for trace_rays(), so this is best suited to several sources, or
+    sources with many wavelengths, with a static scene. Pruning is not supported.
+
+    The worker processes are started when the ProcessTracer is created, and keep
+    the scene as it was then. A new ProcessTracer is needed if the scene changes.
+    Call close() (or use the ProcessTracer as a context manager) to end the workers.
+
+    :param face_lists: a list of FaceLists, or a CompiledScene
+    :param int processes: the number of worker processes (default, one per processor)
+    :param int recursion_limit: the maximum number of ray generations
+    :param double max_length: the maximum ray length
+    :param str start_method: the multiprocessing start method of the workers, 
+                "fork" or "spawn" (for which the scene is pickled). The default
+                is given by default_start_method().
+    """
+    def __init__(self, face_lists, processes=None, recursion_limit=100, max_length=100.0,
+                 start_method=None):
+        if isinstance(face_lists, CompiledScene):
+            self.scene = face_lists
+        else:
+            self.scene = CompiledScene(list(face_lists), max_length=max_length)
+        self.recursion_limit = recursion_limit
+        self.max_length = max_length
+        if start_method is None:
+            start_method = default_start_method()
+        if start_method not in ("fork", "spawn"):
+            raise ValueError("Unknown start method '%s' (expected 'fork' or 'spawn')"%start_method)
+        self.start_method = start_method
+        #The workers must share the parent's tracker, which unlinks any leaked blocks
+        resource_tracker.ensure_running()
+        self.pool = get_context(start_method).Pool(processes, initializer=_init_worker,
+                                                   initargs=(self.scene,))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def trace(self, input_rays, wavelength_slices=1):
+        """
+        Traces a single source, split into the given number of wavelength slices.
+
+        returns - (traced_rays, all_faces) as for trace_rays()
+        """
+        traced = self.trace_sources([input_rays], wavelength_slices)
+        return traced[0], self.scene.all_faces
+
+    def trace_sources(self, sources, wavelength_slices=1, max_lengths=None):
+        """
+        Traces a list of input ray collections, each split into the given number of
+        wavelength slices, with all jobs run concurrently. The face intersection
+        counts are left as for the trace of the last source.
+
+        :param list sources: the input ray collections, with their wavelengths set
+        :param int wavelength_slices: the number of jobs to split each source into
+        :param list max_lengths: the maximum ray length for each source, if not
+                    the max_length of the ProcessTracer
+        :return: a list of traced_rays lists, one for each source.
+        """
+        if self.pool is None:
+            raise ValueError("The ProcessTracer has been closed")
+        if max_lengths is None:
+            max_lengths = [self.max_length]*len(sources)
+        jobs = []
+        for input_rays, max_length in zip(sources, max_lengths):
+            cls = type(input_rays)
+            if cls not in DTYPES:
+                raise TypeError("Expecting a RayCollection, GaussletCollection or "
+                                "GeometricRayCollection, not %s"%cls)
+            input_rays.reset_length(max_length)
+            slices = split_wavelengths(input_rays, wavelength_slices)
+            results = [self.pool.apply_async(_trace_job, (cls, data, wavelengths,
+                                                          self.recursion_limit,
+                                                          max_length))
+                       for data, wavelengths, indices, offset in slices]
+            jobs.append((input_rays, slices, results))
+
+        out = []
+        for input_rays, slices, results in jobs:
+            generations = []
+            counts = numpy.zeros(len(self.scene.all_faces), dtype=int)
+            for result in results:
+                blocks, job_counts = result.get()
+                generations.append([from_shared(b, type(input_rays)) for b in blocks])
+                counts += job_counts
+            if slices:
+                out.append(merge_generations(input_rays, slices, generations))
+            else:
+                out.append([])
+            for face, count in zip(self.scene.all_faces, counts):
+                face.count = count
+        return out
+
@@ -0,0 +1,163 @@
+"""
+Synthesis of the temporal field of a broadband pulse from its spectral field.
+
+The time-dependence of the field of each Gausslet is only a phase factor,
+exp(-i*omega*t), where omega is the angular frequency of its wavelength in the
+medium of its last leg (see cfields.sum_gaussian_modes()). Hence the field at the
+evaluation points is summed once for each wavelength (see
+EFieldSummation.evaluate_spectrum()), after which the field at any time is a sum
+over the wavelengths only. For frequencies uniformly spaced (as given by a
+BroadbandGaussletSource with uniform_deltaf=True), the field over a window of
+times is given by an FFT.
+
+The rays of each wavelength are assumed to end in the same medium, so that they
+share one frequency.
+"""
+
+import numpy
+
+from .fields import EFieldSummation
+
+
+#: The speed of light, in mm/ps
+C_MM_PS = 0.299792458
+
+
+def mode_frequencies(rays, wavelengths):
+    """
+    The angular frequency (in rad/ps) of the time-dependence of the field of the
+    rays of each wavelength, i.e. 2*pi*c/(n*wavelength), with the mean
+    refractive index n of the rays of the wavelength (or 1 if there are none).
+
+    :param RayCollection rays: the rays (with wavelength_idx into wavelengths)
+    :param ndarray[W] wavelengths: the wavelengths, in microns
+    :returns: ndarray[W] of frequencies
+    """
+    wavelengths = numpy.asarray(wavelengths, dtype=numpy.float64)
+    idx = numpy.asarray(rays.wavelength_idx, dtype=numpy.intp)
+    n = numpy.asarray(rays.refractive_index).real
+    count = numpy.bincount(idx, minlength=len(wavelengths))
+    n_sum = numpy.bincount(idx, weights=n, minlength=len(wavelengths))
+    n_mean = numpy.where(count > 0, n_sum/numpy.maximum(count, 1), 1.0)
+    k = 2000.0*numpy.pi/wavelengths #in 1/mm
+    return C_MM_PS*k/n_mean
+
+
+class PulseSynthesis(object):
+    """
+    Gives the temporal field of a broadband pulse at a set of points, from the
+    spectral field of an EFieldSummation evaluated once on the points.
+
+    A spectral amplitude and phase may be applied to the field, each given as
+    an array with a value per wavelength or as a function of the angular frequency
+    offset (in rad/ps) from the centre_frequency. A spectral phase phi(omega) delays
+    each frequency by d(phi)/d(omega) (so a phase 0.5*GDD*omega**2 adds a group
+    delay dispersion GDD, in ps^2).
+
+    :param EFieldSummation summation: the modes of the Gausslets
+    :param ndarray[...,3] points: the points at which to evaluate the field
+    """
+    def __init__(self, summation, points):
+        points = numpy.asarray(points, dtype=numpy.float64)
+        self.points_shape = points.shape[:-1]
+        self.wavelengths = numpy.asarray(summation.wavelengths)
+
+        #: The field of each wavelength at time zero, an array of shape (W,N,3)
+        self.spectrum = summation.evaluate_spectrum(points.reshape(-1,3))
+
+        #: The angular frequency of each wavelength, in rad/ps
+        self.frequencies = mode_frequencies(summation.base_rays, self.wavelengths)
+
+        #: The centre (mean) frequency, about which the spectral weightings are given
+        self.centre_frequency = self.frequencies.mean()
+
+    @classmethod
+    def from_gausslets(cls, gausslet_collection, points, wavelengths=None, blending=1.0):
+        """Creates the synthesis for the given GaussletCollection (see EFieldSummation)."""
+        return cls(EFieldSummation(gausslet_collection, wavelengths=wavelengths,
+                                   blending=blending), points)
+
+    def weights(self, amplitude=None, phase=None):
+        """
+        The complex weighting of each wavelength, for the given spectral amplitude
+        and phase.
+        """
+        offset = self.frequencies - self.centre_frequency
+        weights = numpy.ones(len(offset), dtype=numpy.complex128)
+        for value, is_phase in ((amplitude, False), (phase, True)):
+            if value is None:
+                continue
+            if callable(value):
+                value = value(offset)
+            value = numpy.broadcast_to(numpy.asarray(value, dtype=numpy.float64), offset.shape)
+            weights *= numpy.exp(1j*value) if is_phase else value
+        return weights
+
+    def _output(self, E, times, carrier):
+        if not carrier:
+            E *= numpy.exp(1j*self.centre_frequency*times)[:,None,None]
+        return E.reshape((len(times),) + self.points_shape + (3,))
+
+    def field(self, times, amplitude=None, phase=None, carrier=True):
+        """
+        The field at each of the given times (in ps), by direct summation over
+        the wavelengths.
+
+        :param ndarray[T] times: the times
+        :param amplitude: the spectral amplitude (see the class docstring)
+        :param phase: the spectral phase (see the class docstring)
+        :param bool carrier: If False, the carrier wave at the centre_frequency is
+                             taken out, leaving the (complex) envelope.
+        :returns: ndarray[T,...,3], for points of shape (...,3)
+        """
+        times = numpy.asarray(times, dtype=numpy.float64).reshape(-1)
+        W = len(self.frequencies)
+        coefs = self.spectrum.reshape(W, -1) * self.weights(amplitude, phase)[:,None]
+        factors = numpy.exp(-1j*numpy.outer(times, self.frequencies))
+        E = numpy.dot(factors, coefs).reshape(len(times), -1, 3)
+        return self._output(E, times, carrier)
+
+    def field_fft(self, amplitude=None, phase=None, oversample=4, t_start=None, carrier=True):
+        """
+        The field over a window of uniformly spaced times, by FFT. The frequencies
+        must be uniformly spaced. The window is the repetition period of the
+        frequency comb, 2*pi/d_omega, sampled at oversample times the number of
+        wavelengths.
+
+        :param amplitude: the spectral amplitude (see the class docstring)
+        :param phase: the spectral phase (see the class docstring)
+        :param int oversample: the ratio of the number of times to the number of wavelengths
+        :param float t_start: the first time of the window, in ps. The default centres
+                              the window on zero.
+        :param bool carrier: If False, the carrier wave at the centre_frequency is
+                             taken out, leaving the (complex) envelope.
+        :returns: (times, E) where E is an ndarray[M,...,3] for M times and points of
+                  shape (...,3)
+        """
+        order = numpy.argsort(self.frequencies)
+        freqs = self.frequencies[order]
+        W = len(freqs)
+        if W < 2:
+            raise ValueError("At least two wavelengths are needed for an FFT")
+        steps = numpy.diff(freqs)
+        d_omega = steps.mean()
+        if not numpy.allclose(steps, d_omega, rtol=1e-6, atol=0):
+            raise ValueError("The frequencies are not uniformly spaced (use field() instead)")
+        if oversample < 1:
+            raise ValueError("oversample must be at least 1")
+
+        M = int(round(oversample*W))
+        period = 2*numpy.pi/d_omega
+        dt = period/M
+        if t_start is None:
+            t_start = -period/2
+        times = t_start + numpy.arange(M)*dt
+
+        coefs = self.spectrum[order].reshape(W, -1) * self.weights(amplitude, phase)[order,None]
+        #With omega_w = omega_0 + w*d_omega and t_j = t_start + j*dt,
+        #exp(-i*omega_w*t_j) = exp(-i*omega_0*t_j) * exp(-i*w*d_omega*t_start) * exp(-2i*pi*w*j/M)
+        coefs *= numpy.exp(-1j*numpy.arange(W)*d_omega*t_start)[:,None]
+        E = numpy.fft.fft(coefs, n=M, axis=0)
+        E *= numpy.exp(-1j*freqs[0]*times)[:,None]
+        return times, self._output(E.reshape(M, -1, 3), times, carrier)
+
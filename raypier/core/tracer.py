@@ -1,47 +1,880 @@
+from .ctracer import trace_segment, trace_gausslet, RayCollection, GaussletCollection, \
+        FaceListBVH, CompiledScene, Face, FaceList, trace_surface, TraceProfile
 
-from .ctracer import trace_segment, trace_gausslet, RayCollection
-
-from itertools import chain
 import numpy
+import json
+import time
+import threading
 
 
-def trace_rays(input_rays, face_lists, recursion_limit=100, max_length=100.0):
+def trace_rays(input_rays, face_lists, recursion_limit=100, max_length=100.0, num_threads=1,
+               bvh=None, on_generation=None, min_power=0.0, roulette_power=0.0, seed=0,
+               energy_report=None, sort_rays=None, profile=False, timeline=None,
+               monitor=None):
     """
-    Core ray-tracing routine. Takes either a RayCollection or GaussletCollection
-    and traces the rays non-sequentially through the given list of FaceList objects.
+    Core ray-tracing routine. Takes a RayCollection, GaussletCollection or 
+    GeometricRayCollection and traces the rays non-sequentially through the given 
+    list of FaceList objects.
     
     The input_rays should already have a consistent wavelengths property set.
     
+    face_lists may also be a CompiledScene. This avoids the setup of the faces
+    for each trace, when the same static scene is traced repeatedly.
+    
+    Each generation of rays may be traced using multiple threads, with the
+    num_threads argument (1 = single threaded, 0 = one thread per processor). The
+    traced rays are identical (and in the same order) for any number of threads.
+    
+    The nearest intersection for each ray is found using a bounding-volume hierarchy
+    over the face_lists. A FaceListBVH may be passed in with the bvh argument, to 
+    be re-used between traces; it is only rebuilt if the optics have moved or changed.
+    
+    If on_generation is given, it is called with each generation of rays once it
+    has been traced. Its return value, if not None, is put in the traced_rays list 
+    in place of the rays, so the callback can filter, reduce or save each generation
+    (see EndFaceSelector). The generations are not otherwise kept (see 
+    iter_trace_rays()), so the memory used stays near that of two generations.
+    
+    Low-power rays may be pruned from the ray-tree after each generation. Child rays 
+    with power below min_power are discarded. Those below roulette_power are 
+    discarded at random (with a given seed), the survivors being reweighted to 
+    conserve the power on average (Russian roulette). Both powers are given
+    relative to the largest power of the input rays; zero disables them. If an 
+    EnergyReport is given, the power removed from each generation is recorded in it.
+    
+    If sort_rays is given, each generation of child rays is re-ordered before it
+    is traced, to keep rays with similar origins and directions together. It may be
+    'morton', 'face' or a CoherenceSorter (which keeps the permutations, so that 
+    the unsorted order can be restored afterwards).
+    
+    If profile is True, performance counters are recorded for each face and its 
+    material: the intersection tests, the rays ending on the face, the time spent
+    in the intersections, the root-finding iterations of iterative faces, and the 
+    child rays and time spent in the material. These are returned as a record 
+    array with the ctracer.profile_dtype, one record per face (see also 
+    material_profile()). Profiling slows the trace a little. The counters are 
+    recorded in a ctracer.TraceProfile for the trace, so concurrent traces are 
+    profiled independently. A TraceProfile (for the faces of the scene) may also be
+    given as the profile, to record the counters of several traces together; 
+    (traced_rays, all_faces) is then returned.
+    
+    If a TraceTimeline is given, the ray count, allocated memory and trace times 
+    of each generation are recorded in it. The neighbours of each generation
+    (where the input rays have them) are then evaluated during the trace, so 
+    their cost is included.
+    
+    If a TraceMonitor is given, it is told of each generation as it is traced, 
+    and the trace stops (raising TraceCancelled) between generations once the 
+    monitor has been cancelled.
+    
     returns - (traced_rays, all_faces)
-            where traced_rays is a list of RayCollection or GaussletCollections 
+            where traced_rays is a list of ray collections (of the input type) 
             representing the sequence of ray generations. The 'all_faces' list
             is a list of cfaces.Face objects. The end_face_idx member of each
             traced ray indexes into this list to give the face where it terminates.
+            With profile=True, (traced_rays, all_faces, profile) is returned.
     """
-    input_rays.reset_length(max_length)
+    if profile is True:
+        scene = compile_scene(input_rays, face_lists, max_length, bvh)
+        counters = TraceProfile(len(scene.all_faces))
+        traced_rays, all_faces = trace_rays(input_rays, scene, recursion_limit=recursion_limit,
+                                            max_length=max_length, num_threads=num_threads,
+                                            on_generation=on_generation, min_power=min_power,
+                                            roulette_power=roulette_power, seed=seed,
+                                            energy_report=energy_report, sort_rays=sort_rays,
+                                            profile=counters, timeline=timeline, 
+                                            monitor=monitor)
+        return traced_rays, all_faces, counters.results(scene.all_faces)
+    if not isinstance(profile, TraceProfile):
+        profile = None
+    
     traced_rays = []
-    trace_func = trace_segment if isinstance(input_rays, RayCollection) else trace_gausslet
+    
+    if on_generation is not None:
+        scene = compile_scene(input_rays, face_lists, max_length, bvh)
+        for rays in iter_trace_rays(input_rays, scene, recursion_limit=recursion_limit,
+                                    max_length=max_length, num_threads=num_threads,
+                                    min_power=min_power, roulette_power=roulette_power,
+                                    seed=seed, energy_report=energy_report,
+                                    sort_rays=sort_rays, timeline=timeline, monitor=monitor,
+                                    profile=profile):
+            result = on_generation(rays)
+            if result is not None:
+                traced_rays.append(result)
+        return traced_rays, scene.all_faces
+    
+    input_rays.reset_length(max_length)
     count = 0
-    wavelengths = numpy.asarray(input_rays.wavelengths)
+    scene = compile_scene(input_rays, face_lists, max_length, bvh)
+    scene.reset_counts() #reset intersection counts
+    set_pruning(scene, input_rays, min_power, roulette_power, seed, energy_report)
+    sorter = get_sorter(sort_rays)
+    if timeline is not None:
+        timeline.reset()
+    if monitor is not None:
+        monitor.check()
     
-    all_faces = list(chain(*(fs.faces for fs in face_lists)))
+    rays = input_rays
+    while rays.n_rays>0 and count<recursion_limit:
+        traced_rays.append(rays)
+        start = time.perf_counter()
+        child_rays = scene.trace(rays, num_threads=num_threads, profile=profile)
+        trace_time = time.perf_counter() - start
+        if energy_report is not None:
+            energy_report.add_generation(scene.pruned)
+        if sorter is not None:
+            sorter(child_rays, rays)
+        if timeline is not None:
+            timeline.add_generation(rays, len(child_rays), start, trace_time, 
+                                    scene.decomp_time, eval_neighbours(child_rays, rays))
+        if monitor is not None:
+            monitor.step(count, rays, child_rays)
+        rays = child_rays
+        count += 1
+    
+    return traced_rays, scene.all_faces 
+
+
+def trace_sequence(input_rays, sequence, max_length=100.0, num_threads=1):
+    """
+    Sequential ray-tracing routine. Traces a RayCollection through a sequence
+    of surfaces, in the given order. Each generation of rays is intersected with
+    only the next surface in the sequence, which is much faster than the 
+    non-sequential search for the nearest face, where the order of the surfaces
+    is known (as for most imaging systems). Rays which miss a surface are 
+    vignetted, and are not traced further.
+    
+    The input_rays should already have a consistent wavelengths property set.
+    
+    Each item of the sequence is a surface, or a tuple (surface, branch). A surface
+    is either a Face (whose owner has the FaceList containing it, as for the faces 
+    of any optic) or a FaceList, in which case the nearest face of the FaceList is 
+    intersected. The branch selects which child ray is kept for each ray: 
+    "transmitted", "reflected" or "auto" (the default, the transmitted ray if there 
+    is one, otherwise the reflected ray).
+    
+    returns - (traced_rays, all_faces) as for trace_rays(). traced_rays has one 
+            more generation than there are surfaces (less any after all rays 
+            have been vignetted). The last generation is not traced, so has 
+            the maximum length.
+    """
+    if not isinstance(input_rays, RayCollection):
+        raise TypeError("Sequential tracing needs a RayCollection, not %s"%type(input_rays))
+    steps = []
+    face_lists = []
+    for item in sequence:
+        surface, branch = item if isinstance(item, tuple) else (item, "auto")
+        if isinstance(surface, FaceList):
+            face_set, face = surface, None
+        elif isinstance(surface, Face):
+            face_set, face = getattr(surface.owner, "faces", None), surface
+            if not isinstance(face_set, FaceList) or face not in face_set.faces:
+                raise ValueError("Cannot find the FaceList of face %r"%face)
+        else:
+            raise TypeError("Expecting a Face or FaceList in the sequence, not %s"%type(surface))
+        if not any(face_set is fl for fl in face_lists):
+            face_lists.append(face_set)
+        steps.append((face_set, face, branch))
+        
+    wavelengths = numpy.asarray(input_rays.wavelengths)
+    all_faces = [f for fl in face_lists for f in fl.faces]
     for i, f in enumerate(all_faces):
         f.idx = i
-        f.count = 0 #reset intersection count
-        f.update() #This was a bad idea.
-        f.material.wavelengths = wavelengths
+        f.update()
+        f.count = 0
         f.max_length = max_length
+        f.material.wavelengths = wavelengths
+    for fl in face_lists:
+        fl.sync_transforms()
+        fl.update_bounds()
+    
+    input_rays.reset_length(max_length)
+    rays = input_rays
+    traced_rays = [rays]
+    for face_set, face, branch in steps:
+        rays = trace_surface(rays, face_set, face, all_faces, max_length, branch, num_threads)
+        if rays.n_rays == 0:
+            break
+        traced_rays.append(rays)
+    
+    ### The last generation ends nowhere, as for a non-sequential trace
+    rays.reset_length(max_length)
+    rays.as_array()['end_face_idx'] = numpy.iinfo(numpy.uint32).max
+    rays.touch()
+    return traced_rays, all_faces
+
+
+def ray_powers(rays):
+    """
+    Returns the power of each ray of a RayCollection or GeometricRayCollection, 
+    or of the base ray of each gausslet of a GaussletCollection.
+    """
+    if isinstance(rays, GaussletCollection):
+        return rays.base_rays.power
+    return rays.power
+
+
+def material_profile(profile):
+    """
+    Sums the counters of a trace profile (as returned by trace_rays() with 
+    profile=True) over the faces sharing each material.
     
-    face_sets = list(face_lists)
-    decomp_faces = [f for f in all_faces if f.material.is_decomp_material()]
+    returns - a record array with the material (class name), material_idx, the 
+            number of faces, and the hits, children and eval_ns of each material.
+    """
+    dtype = numpy.dtype([('material', profile.dtype['material']), ('material_idx', numpy.int32),
+                         ('faces', numpy.int32), ('hits', numpy.uint64), 
+                         ('children', numpy.uint64), ('eval_ns', numpy.uint64)])
+    idx, first = numpy.unique(profile['material_idx'], return_index=True)
+    out = numpy.zeros(len(idx), dtype=dtype)
+    out['material'] = profile['material'][first]
+    out['material_idx'] = idx
+    group = numpy.searchsorted(idx, profile['material_idx'])
+    out['faces'] = numpy.bincount(group, minlength=len(idx))
+    for name in ('hits', 'children', 'eval_ns'):
+        numpy.add.at(out[name], group, profile[name])
+    return out
+
+
+def set_pruning(scene, input_rays, min_power, roulette_power, seed, energy_report=None):
+    """
+    Sets up the pruning of the CompiledScene for a trace of the input_rays, 
+    with the min_power and roulette_power given relative to the largest 
+    input ray power.
+    """
+    power = ray_powers(input_rays)
+    max_power = power.max() if len(power) else 0.0
+    scene.set_pruning(min_power*max_power, roulette_power*max_power, seed)
+    if energy_report is not None:
+        energy_report.reset(power.sum())
+
+
+def compile_scene(input_rays, face_lists, max_length, bvh=None):
+    """
+    Returns a CompiledScene for the face_lists (which may already be a CompiledScene),
+    set up for the wavelengths of the input_rays.
+    """
+    wavelengths = numpy.asarray(input_rays.wavelengths)
+    if isinstance(face_lists, CompiledScene):
+        scene = face_lists
+        scene.set_max_length(max_length)
+        scene.set_wavelengths(wavelengths)
+    else:
+        scene = CompiledScene(list(face_lists), wavelengths=wavelengths, 
+                              max_length=max_length, bvh=bvh)
+    return scene
+
+
+def iter_trace_rays(input_rays, face_lists, recursion_limit=100, max_length=100.0, 
+                    num_threads=1, bvh=None, min_power=0.0, roulette_power=0.0, seed=0,
+                    energy_report=None, sort_rays=None, timeline=None, monitor=None,
+                    profile=None):
+    """
+    Generator form of trace_rays(). Yields each generation of rays once it has 
+    been traced (so the end_face_idx and length of each ray are set). If a 
+    ctracer.TraceProfile is given, the performance counters of the faces are
+    recorded in it.
+    
+    The link from each generation to its parent is removed, so that generations
+    are freed once the caller has finished with them. The ray neighbours, where
+    the input rays have them, are evaluated before the parent link is removed.
+    The face intersection counts are complete once the generator is exhausted.
+    """
+    input_rays.reset_length(max_length)
+    scene = compile_scene(input_rays, face_lists, max_length, bvh)
+    scene.reset_counts()
+    set_pruning(scene, input_rays, min_power, roulette_power, seed, energy_report)
+    sorter = get_sorter(sort_rays)
+    if timeline is not None:
+        timeline.reset()
+    if monitor is not None:
+        monitor.check()
     
     rays = input_rays
+    count = 0
     while rays.n_rays>0 and count<recursion_limit:
-        traced_rays.append(rays)
-        rays = trace_func(rays, face_sets, all_faces, 
-                                     max_length=max_length,
-                                     decomp_faces=decomp_faces)
+        start = time.perf_counter()
+        child_rays = scene.trace(rays, num_threads=num_threads, profile=profile)
+        trace_time = time.perf_counter() - start
+        if energy_report is not None:
+            energy_report.add_generation(scene.pruned)
+        if sorter is not None:
+            sorter(child_rays, rays)
+        neighbour_time = eval_neighbours(child_rays, rays)
+        if isinstance(child_rays, RayCollection) and rays.neighbours is not None:
+            neighbours = child_rays.neighbours
+            child_rays.parent = None
+            child_rays.neighbours = neighbours
+        else:
+            child_rays.parent = None
+        if timeline is not None:
+            timeline.add_generation(rays, len(child_rays), start, trace_time, 
+                                    scene.decomp_time, neighbour_time)
+        if monitor is not None:
+            monitor.step(count, rays, child_rays)
+        yield rays
+        rays = child_rays
         count += 1
+        
+
+def get_sorter(sort_rays):
+    """
+    Returns a CoherenceSorter for the sort_rays argument of trace_rays(), which may
+    be None, a sort key or a CoherenceSorter. A CoherenceSorter is reset for the 
+    new trace.
+    """
+    if sort_rays is None:
+        return None
+    if isinstance(sort_rays, CoherenceSorter):
+        sort_rays.reset()
+        return sort_rays
+    return CoherenceSorter(sort_rays)
+
+
+def spread_bits(x):
+    """
+    Spreads the lower 21 bits of each (uint64) x so that there are two zero bits 
+    between each of them, for interleaving into a 3D Morton code.
+    """
+    x = x & numpy.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), 
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)):
+        x = (x | (x << numpy.uint64(shift))) & numpy.uint64(mask)
+    return x
+
+
+def morton_codes(origin, direction, bits=10):
+    """
+    Computes a sort key for each ray, being the octant of its direction followed
+    by the Morton code of its origin. The origins are quantised to 2**bits steps 
+    over their bounding box.
     
-    return traced_rays, all_faces 
+    returns - a uint64 array
+    """
+    out = numpy.zeros(len(origin), dtype=numpy.uint64)
+    if not len(origin):
+        return out
+    lo = origin.min(axis=0)
+    span = origin.max(axis=0) - lo
+    span[span<=0] = 1.0
+    scale = (2**bits - 1)/span
+    cells = ((origin - lo)*scale).astype(numpy.uint64)
+    for axis in range(3):
+        out |= spread_bits(cells[:,axis]) << numpy.uint64(axis)
+        out |= (direction[:,axis] < 0).astype(numpy.uint64) << numpy.uint64(3*bits + axis)
+    return out
+
 
+class CoherenceSorter(object):
+    """
+    Re-orders each generation of rays in a trace (see the sort_rays argument of 
+    trace_rays()), so that rays which are close together in space and direction 
+    are traced together. This keeps the working set of the face and BVH traversal
+    small, and gives the face-major trace (see CompiledScene) longer runs of rays 
+    hitting the same FaceLists.
+    
+    The rays are sorted in place, after they are created and before they are traced,
+    so the parent_idx of each generation refers to the sorted order of its parent. 
+    The permutation of each generation is kept, so that the rays can be put back 
+    into the order an unsorted trace would give (see restore()). 
+    
+    Note, the Russian roulette selects rays by their parent index, so a trace 
+    with roulette pruning is a different (but equally valid) sample when sorted.
+    
+    :param str key: 'morton' to sort by the octant of the ray direction then the 
+                    Morton code of the ray origin, or 'face' to sort by the face 
+                    where the parent ray terminated, then by the Morton code.
+    :param int bits: the number of bits for each axis of the Morton code
+    """
+    keys = ('morton', 'face')
+    
+    def __init__(self, key='morton', bits=10):
+        if key not in self.keys:
+            raise ValueError("Sort key must be one of %s, not %r"%(self.keys, key))
+        if not 0 < bits <= 20:
+            raise ValueError("Morton code bits must be between 1 and 20")
+        self.key = key
+        self.bits = bits
+        self.reset()
+        
+    def reset(self):
+        #For each traced generation, the unsorted index of each sorted ray.
+        #The input rays are not sorted, so this starts with None.
+        self.permutations = [None]
+        
+    def order(self, rays, parent=None):
+        """
+        Returns the sorted order of the given rays (whose parent rays are needed
+        for the 'face' key).
+        """
+        base = base_ray_array(rays)
+        key = morton_codes(base['origin'], base['direction'], self.bits)
+        if self.key == 'face' and parent is not None and len(base):
+            end_face = base_ray_array(parent)['end_face_idx'][base['parent_idx']]
+            return numpy.lexsort((key, end_face))
+        return numpy.argsort(key, kind='stable')
+        
+    def __call__(self, rays, parent=None):
+        """
+        Sorts the rays in place, and records the permutation.
+        """
+        perm = self.order(rays, parent)
+        data = rays.as_array()
+        #Whole records are moved much faster as opaque (void) items
+        data = data.view(numpy.dtype((numpy.void, data.dtype.itemsize)))
+        data[:] = data[perm]
+        rays.touch()
+        self.permutations.append(perm)
+        return perm
+    
+    def restore(self, traced_rays):
+        """
+        Returns a copy of the traced rays (from a trace using this sorter), in the 
+        order given by an unsorted trace. The parent_idx, and the neighbours of
+        RayCollections, are mapped to the restored order.
+        """
+        if len(traced_rays) > len(self.permutations):
+            raise ValueError("More generations than have been sorted")
+        out = []
+        #The restored index of each (sorted) ray of the previous generation
+        index_map = None
+        for rays, perm in zip(traced_rays, self.permutations):
+            data = rays.as_array()
+            base = data['base_ray'] if isinstance(rays, GaussletCollection) else data
+            if perm is None:
+                order = numpy.arange(len(data))
+            else:
+                parent_idx = index_map[base['parent_idx']]
+                #Children of the same parent keep the order they were created in
+                order = numpy.lexsort((perm, parent_idx))
+            restored = data[order]
+            restored_base = restored['base_ray'] if isinstance(rays, GaussletCollection) \
+                                else restored
+            if perm is not None:
+                restored_base['parent_idx'] = parent_idx[order]
+            index_map = numpy.empty(len(order), dtype=numpy.intp)
+            index_map[order] = numpy.arange(len(order))
+            
+            new = type(rays).from_array(restored)
+            new.wavelengths = rays.wavelengths
+            nb = rays.neighbours if isinstance(rays, RayCollection) else None
+            if nb is not None and nb.ndim == 2:
+                nb = nb[order]
+                new.neighbours = numpy.where(nb >= 0, index_map[nb], -1).astype(numpy.int32)
+            out.append(new)
+        return out
+    
+    
+def base_ray_array(rays):
+    """
+    Returns a live view of the rays of a RayCollection or GeometricRayCollection, 
+    or of the base rays of a GaussletCollection, as a numpy array.
+    """
+    data = rays.as_array()
+    if isinstance(rays, GaussletCollection):
+        return data['base_ray']
+    return data
+
+        
+class EnergyReport(object):
+    """
+    Records the power removed by the pruning of low-power rays in trace_rays().
+    
+    The pruned_power, lost to the min_power cutoff, bounds the error in the
+    total power arriving anywhere in the system. The power killed by the Russian
+    roulette is balanced, on average, by the power added to the survivors.
+    """
+    def __init__(self):
+        self.reset(0.0)
+        
+    def reset(self, input_power):
+        #The total power of the input rays
+        self.input_power = input_power
+        #For each traced generation, a dict as given by CompiledScene.pruned
+        self.generations = []
+        
+    def add_generation(self, pruned):
+        self.generations.append(dict(pruned))
+        
+    def _total(self, key):
+        return sum(g[key] for g in self.generations)
+        
+    @property
+    def n_pruned(self):
+        return self._total('n_pruned')
+    
+    @property
+    def pruned_power(self):
+        return self._total('pruned_power')
+    
+    @property
+    def n_killed(self):
+        return self._total('n_killed')
+    
+    @property
+    def killed_power(self):
+        return self._total('killed_power')
+    
+    @property
+    def added_power(self):
+        return self._total('added_power')
+    
+    @property
+    def discarded_power(self):
+        """The net power removed from the trace by pruning."""
+        return self.pruned_power + self.killed_power - self.added_power
+    
+    @property
+    def relative_error(self):
+        """The power lost to the min_power cutoff, relative to the input power."""
+        if self.input_power <= 0:
+            return 0.0
+        return self.pruned_power/self.input_power
+    
+        
+class TraceTimeline(object):
+    """
+    Records, for each generation of a trace, the number of rays, the memory 
+    allocated for them, and the time spent tracing them (as a whole, and in the 
+    evaluation of decomposed gausslets and of the child ray neighbours). Pass one
+    to the timeline argument of trace_rays(), iter_trace_rays() or retrace_rays().
+    
+    The timeline can be saved as JSON (to_json()) or as a Chrome trace-event file 
+    (to_chrome_trace()), which can be viewed with chrome://tracing or Perfetto.
+    Times are in seconds, relative to the start of the trace.
+    """
+    def __init__(self):
+        self.reset()
+        
+    @classmethod
+    def from_traced_rays(cls, traced_rays):
+        """
+        Creates a TraceTimeline for a list of traced generations, as returned by 
+        trace_rays(), with their rays and memory but no trace times.
+        """
+        timeline = cls()
+        for rays, children in zip(traced_rays, list(traced_rays[1:]) + [()]):
+            timeline.add_generation(rays, len(children), timeline.start, 0.0)
+        return timeline
+        
+    def reset(self):
+        #The time.perf_counter() value at the start of the trace
+        self.start = time.perf_counter()
+        #For each traced generation, a dict of its counts and times
+        self.generations = []
+        
+    def add_generation(self, rays, n_children, start, trace_time, decomp_time=0.0,
+                       neighbour_time=0.0):
+        """
+        Records a generation of rays.
+        
+        :param rays: the traced ray collection
+        :param int n_children: the number of child rays traced from them
+        :param float start: the time.perf_counter() value when tracing started
+        :param float trace_time: the time taken to trace the rays
+        :param float decomp_time: the part of trace_time spent on decomposition faces
+        :param float neighbour_time: the time taken to evaluate the child neighbours
+        """
+        self.generations.append({'generation': len(self.generations),
+                                 'n_rays': len(rays),
+                                 'n_children': int(n_children),
+                                 'allocated_bytes': rays.allocated_bytes,
+                                 'start': start - self.start,
+                                 'trace_time': trace_time,
+                                 'decomp_time': decomp_time,
+                                 'neighbour_time': neighbour_time})
+        
+    def _total(self, key):
+        return sum(g[key] for g in self.generations)
+        
+    @property
+    def n_rays(self):
+        return self._total('n_rays')
+        
+    @property
+    def allocated_bytes(self):
+        """The memory allocated for all the traced generations together."""
+        return self._total('allocated_bytes')
+    
+    @property
+    def trace_time(self):
+        return self._total('trace_time')
+    
+    @property
+    def decomp_time(self):
+        return self._total('decomp_time')
+    
+    @property
+    def neighbour_time(self):
+        return self._total('neighbour_time')
+    
+    def as_dict(self):
+        return {'n_rays': self.n_rays,
+                'allocated_bytes': self.allocated_bytes,
+                'trace_time': self.trace_time,
+                'decomp_time': self.decomp_time,
+                'neighbour_time': self.neighbour_time,
+                'generations': [dict(g) for g in self.generations]}
+    
+    def to_json(self, filename=None):
+        """
+        Returns the timeline as a JSON string, also writing it to the given 
+        filename, if any.
+        """
+        text = json.dumps(self.as_dict(), indent=1)
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(text)
+        return text
+    
+    def chrome_trace_events(self, pid=0, tid=0):
+        """
+        Returns the list of Chrome trace events for the timeline: a complete ("X")
+        event for the tracing of each generation, containing events for the 
+        decomposition, followed by one for the neighbour evaluation, and counter 
+        ("C") events for the rays and allocated bytes.
+        """
+        def event(name, cat, start, duration, args):
+            return {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                    'ts': start*1e6, 'dur': duration*1e6, 'args': args}
+        
+        events = []
+        for g in self.generations:
+            start, end = g['start'], g['start'] + g['trace_time']
+            args = {'n_rays': g['n_rays'], 'n_children': g['n_children'],
+                    'allocated_bytes': g['allocated_bytes']}
+            events.append(event("generation %d"%g['generation'], "trace", start, 
+                                g['trace_time'], args))
+            if g['decomp_time'] > 0:
+                #The decomposition is done once the generation has been traced
+                events.append(event("decomposition", "trace", end - g['decomp_time'],
+                                    g['decomp_time'], {}))
+            if g['neighbour_time'] > 0:
+                events.append(event("neighbours", "trace", end, g['neighbour_time'], {}))
+            for name in ('n_rays', 'allocated_bytes'):
+                events.append({'name': name, 'ph': 'C', 'pid': pid, 'tid': tid,
+                               'ts': start*1e6, 'args': {name: g[name]}})
+        return events
+    
+    def to_chrome_trace(self, filename=None):
+        """
+        Returns the timeline in the Chrome trace-event format (as a JSON string),
+        also writing it to the given filename, if any.
+        """
+        text = json.dumps({'traceEvents': self.chrome_trace_events(),
+                           'displayTimeUnit': 'ms'})
+        if filename is not None:
+            with open(filename, "w") as f:
+                f.write(text)
+        return text
+    
+    
+class TraceCancelled(Exception):
+    """Raised by a trace stopped by its TraceMonitor."""
+    
+    
+class TraceMonitor(object):
+    """
+    Follows the progress of a trace, and allows it to be cancelled from another 
+    thread. Pass one to the monitor argument of trace_rays(), iter_trace_rays() or 
+    retrace_rays(). The trace checks for cancellation before the first generation
+    and after each generation is traced, raising TraceCancelled. 
+    
+    If given, on_progress(monitor, generation, rays) is called after each 
+    generation is traced. The 'source' attribute may be set by the caller, to 
+    identify what is being traced to the progress callback.
+    """
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        self.source = None
+        self._cancelled = threading.Event()
+        #The generations and rays traced so far
+        self.n_generations = 0
+        self.n_rays = 0
+        
+    def cancel(self):
+        self._cancelled.set()
+        
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+    
+    def check(self):
+        """Raises TraceCancelled if the monitor has been cancelled."""
+        if self._cancelled.is_set():
+            raise TraceCancelled()
+        
+    def step(self, generation, rays, child_rays):
+        """Called by the trace after each generation is traced."""
+        self.n_generations += 1
+        self.n_rays += len(rays)
+        if self.on_progress is not None:
+            self.on_progress(self, generation, rays)
+        self.check()
+    
+    
+def eval_neighbours(child_rays, rays):
+    """
+    Evaluates the neighbours of the child_rays, where their parent rays have 
+    neighbours (the neighbours are otherwise evaluated on first use).
+    
+    returns - the time taken.
+    """
+    start = time.perf_counter()
+    if isinstance(child_rays, RayCollection) and rays.neighbours is not None:
+        child_rays.neighbours
+    return time.perf_counter() - start
+    
+    
+class EndFaceSelector(object):
+    """
+    A callback for the on_generation argument of trace_rays(), which keeps only the 
+    rays terminating on the given faces. Each selected set of rays is returned as 
+    a new RayCollection or GaussletCollection. 
+    
+    The parent_idx of every generation is kept (but not the rays themselves), so the
+    ancestry of a selected ray can be followed back to the input rays.
+    
+    :param list faces: the Faces on which rays should be selected.
+    """
+    def __init__(self, faces):
+        self.faces = list(faces)
+        #For each generation, the parent_idx of its rays
+        self.parent_idx = []
+        #For each selected set of rays, the generation it came from
+        self.generations = []
+        #For each selected set of rays, the indices of the rays in their generation
+        self.indices = []
+        
+    def __call__(self, rays):
+        data = rays.as_array()
+        base = data['base_ray'] if isinstance(rays, GaussletCollection) else data
+        self.parent_idx.append(base['parent_idx'].copy())
+        mask = numpy.isin(base['end_face_idx'], [f.idx for f in self.faces])
+        if not mask.any():
+            return None
+        selected = type(rays).from_array(data[mask])
+        selected.wavelengths = rays.wavelengths
+        self.generations.append(len(self.parent_idx)-1)
+        self.indices.append(numpy.flatnonzero(mask))
+        return selected
+    
+    def ancestry(self, generation, idx):
+        """
+        Returns the indices of the ancestors of ray idx, of the given generation, 
+        in each generation from the input rays onwards, ending with idx itself.
+        """
+        out = [int(idx)]
+        for gen in range(generation, 0, -1):
+            idx = self.parent_idx[gen][idx]
+            out.append(int(idx))
+        return out[::-1]
+
+
+def first_affected_generation(traced_rays, face_idx, bounds):
+    """
+    Finds the first generation of a previous trace which may be affected by a 
+    change to some of the faces. A generation is affected if any of its rays 
+    terminated on one of the changed faces (so the old geometry is covered by
+    the record of the faces each generation hit), or if any ray path passes 
+    through the new bounds of the changed faces.
+    
+    :param list traced_rays: the ray generations returned by trace_rays()
+    :param face_idx: the indices of the changed faces
+    :param bounds: the global bounds (xmin, xmax, ymin, ymax, zmin, zmax) of the 
+                changed faces, or None if they are unbounded.
+    :return: the index of the first affected generation, or None if no generation 
+                is affected.
+    """
+    if bounds is None:
+        return 0
+    face_idx = numpy.asarray(list(face_idx), dtype=numpy.uint32)
+    lo = numpy.array(bounds[0::2])
+    hi = numpy.array(bounds[1::2])
+    for i, rays in enumerate(traced_rays):
+        if isinstance(rays, GaussletCollection):
+            data = rays.base_rays.as_array()
+        else:
+            data = rays.as_array()
+        if numpy.isin(data['end_face_idx'], face_idx).any():
+            return i
+        if segments_hit_box(data['origin'], data['direction'], data['length'], lo, hi).any():
+            return i
+    return None
+
+
+def segments_hit_box(origin, direction, length, lo, hi):
+    """
+    Tests which ray paths, from origin to origin + direction*length, intersect 
+    the axis-aligned box from lo to hi. 
+    
+    returns - a boolean array
+    """
+    d = direction*length[:,None]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t1 = (lo - origin)/d
+        t2 = (hi - origin)/d
+    inside = (origin>=lo) & (origin<=hi)
+    parallel = (d==0)
+    tmin = numpy.where(parallel, numpy.where(inside, -numpy.inf, numpy.inf), 
+                       numpy.minimum(t1,t2)).max(axis=1)
+    tmax = numpy.where(parallel, numpy.where(inside, numpy.inf, -numpy.inf),
+                       numpy.maximum(t1,t2)).min(axis=1)
+    return numpy.maximum(tmin, 0.0) <= numpy.minimum(tmax, 1.0)
+
+
+def retrace_rays(traced_rays, face_lists, first_generation, recursion_limit=100, 
+                 max_length=100.0, num_threads=1, bvh=None, timeline=None, monitor=None):
+    """
+    Continues a previous trace from the given generation, after some faces have
+    changed (see first_affected_generation()). The generations before 
+    first_generation are re-used unchanged, so the faces must be the same (and 
+    in the same order) as for the previous trace. The remaining arguments are as 
+    for trace_rays(). A TraceTimeline records the re-used generations with no 
+    trace time.
+    
+    returns - (traced_rays, all_faces) as for trace_rays().
+    """
+    scene = compile_scene(traced_rays[0], face_lists, max_length, bvh)
+    all_faces = scene.all_faces
+    
+    if first_generation is None:
+        first_generation = len(traced_rays)
+    reused = list(traced_rays[:first_generation])
+    
+    ### Re-count the intersections for the re-used generations
+    counts = numpy.zeros(len(all_faces), dtype=numpy.int64)
+    for rays in reused:
+        data = rays.base_rays.as_array() if isinstance(rays, GaussletCollection) else rays.as_array()
+        idx = data['end_face_idx']
+        counts += numpy.bincount(idx[idx < len(all_faces)], minlength=len(all_faces))
+    for f, c in zip(all_faces, counts):
+        f.count = c
+    
+    if timeline is not None:
+        timeline.reset()
+        for i, rays in enumerate(reused):
+            timeline.add_generation(rays, len(traced_rays[i+1]) if i+1 < len(traced_rays) else 0,
+                                    timeline.start, 0.0)
+    if first_generation >= len(traced_rays):
+        return reused, all_faces
+    
+    if monitor is not None:
+        monitor.check()
+    rays = traced_rays[first_generation]
+    rays.reset_length(max_length)
+    count = len(reused)
+    while rays.n_rays>0 and count<recursion_limit:
+        reused.append(rays)
+        start = time.perf_counter()
+        child_rays = scene.trace(rays, num_threads=num_threads)
+        if timeline is not None:
+            timeline.add_generation(rays, len(child_rays), start, 
+                                    time.perf_counter() - start, scene.decomp_time,
+                                    eval_neighbours(child_rays, rays))
+        if monitor is not None:
+            monitor.step(count, rays, child_rays)
+        rays = child_rays
+        count += 1
+    return reused, all_faces
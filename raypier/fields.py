@@ -57,6 +57,10 @@ class EFieldPlane(Probe):
     #: offered by the gausslet_source classes.
     blending = Float(1.0)
     
+    #: If non-zero, each Gaussian mode is only evaluated where its amplitude is at least
+    #: this fraction of its on-axis amplitude. This is much faster for large planes.
+    tolerance = Float(0.0)
+    
     #: When assigned to (triggered) the EField plane will be repositioned on the geometric focus
     #: of the input rays (calculated as the point of closest approach of the input rays).
     centre_on_focus_btn = Button()
@@ -64,6 +68,17 @@ class EFieldPlane(Probe):
     #: The output of the probe. A (size,size,3)-shaped complex array.
     E_field = Array()
     
+    #: If True, the E-field of each wavelength is also given separately, in E_spectrum.
+    spectral = Bool(False)
+    
+    #: The E-field of each wavelength in spectrum_wavelengths (if spectral is True). A 
+    #: (n_wavelengths,size,size,3)-shaped complex array. E_field is its sum over wavelengths.
+    E_spectrum = Array()
+    
+    #: The wavelengths (in microns, sorted) of the rows of E_spectrum. The fields of 
+    #: input rays of the same wavelength, from different sources, are added together.
+    spectrum_wavelengths = Array()
+    
     #: property - The "|E-field|**2" calculated from the E-field.
     intensity = Property(Array, depends_on="E_field")
     
@@ -101,6 +116,8 @@ class EFieldPlane(Probe):
                        Item('time_ps', editor=NumEditor),
                        Item('peak_hold'),
                        Item('blending', editor=NumEditor),
+                       Item('tolerance', editor=NumEditor),
+                       Item('spectral'),
                        Item('gen_idx', editor=IntEditor),
                        Item('centre_on_focus_btn', show_label=False, label="Centre on focus")
                    )))
@@ -118,7 +135,7 @@ class EFieldPlane(Probe):
         self._mtime = 0.0
         self.on_change()
     
-    @on_trait_change("orientation, size, width, height, exit_pupil_offset, blending, gen_idx")
+    @on_trait_change("orientation, size, width, height, exit_pupil_offset, blending, gen_idx, tolerance, spectral")
     def config_pipeline(self):
         src = self._plane_src
         size = self.size
@@ -180,71 +197,108 @@ class EFieldPlane(Probe):
         
     def evaluate(self, src_list):
         mtime = self._mtime
-        detector = self.detector
         if src_list is None:
             src_list = self._src_list
         else:
             self._src_list = src_list
         
         start = time.monotonic()
-            
+        
+        ray_list = self._input_rays(src_list, mtime)
+        if not ray_list:
+            return
+        
+        if self.spectral:
+            wavelengths, E_spectrum = self._sum_fields(ray_list, time_ps=self.time_ps, 
+                                                       spectral=True)
+            self.spectrum_wavelengths = wavelengths
+            self.E_spectrum = E_spectrum
+            self.E_field = E_spectrum.sum(axis=0)
+        else:
+            self.E_field = self._sum_fields(ray_list, time_ps=self.time_ps, 
+                                            tolerance=self.tolerance)
+        
+        self._attrib.modified()
+        end = time.monotonic()
+        self._mtime = end
+        print(f"Field calculation took: {end-start} s")
+        
+    def evaluate_times(self, times, src_list=None):
+        """
+        Evaluates the E-field over the plane at each of the given times (in ps), in
+        one pass over the Gaussian modes. This is much faster than setting time_ps
+        to each time in turn. The E_field trait is not changed.
+        
+        returns - a complex array of shape (len(times),size,size,3)
+        """
+        if src_list is None:
+            src_list = self._src_list
+        ray_list = self._input_rays(src_list)
+        times = numpy.asarray(times, dtype=numpy.float64).reshape(-1)
+        if not ray_list:
+            return numpy.zeros((len(times), self.size, self.size, 3), dtype=numpy.complex128)
+        return self._sum_fields(ray_list, times=times)
+        
+    def _input_rays(self, src_list, mtime=None):
+        """The list of ray-collections to evaluate the field of (or None if the 
+        detector is not up to date)."""
+        detector = self.detector
         if detector is not None:
             detector.evaluate(src_list)
             if detector.captured is None:
-                return
-            if mtime > detector._mtime:
-                return
-            ray_list = detector.captured
-        else:
-            idx = self.gen_idx
-            ray_list = [src.traced_rays[idx] for src in src_list if src.traced_rays]
+                return None
+            if mtime is not None and mtime > detector._mtime:
+                return None
+            return detector.captured
+        idx = self.gen_idx
+        return [src.traced_rays[idx] for src in src_list if src.traced_rays]
+    
+    def _sum_fields(self, ray_list, **kwds):
+        """Sums the fields of the ray-collections over the plane. The keyword arguments
+        are passed on to the eval_Efield functions (selecting the output). Sets the
+        refractive_index. For spectral output, returns the merged (sorted) list of 
+        wavelengths and the field of each."""
+        size = self.size
+        side = self.width/2.
+        yside = self.height/2
+        px = numpy.linspace(-side,side,size)
+        py = numpy.linspace(-yside, yside, size)
+        
+        centre = numpy.asarray(self.centre)
+        axis2 = numpy.cross(self.direction, self.x_axis)
+        axis1 = numpy.cross(axis2, self.direction)
+        
+        points = centre[None,None,:] + px[None,:,None]*axis1 + py[:,None,None]*axis2
+        points2 = points.reshape(-1,3)
         
         n_list = []
-        for ct, rays in enumerate(ray_list):
-            wavelengths = rays.wavelengths
-            
-            size = self.size
-            side = self.width/2.
-            yside = self.height/2
-            px = numpy.linspace(-side,side,size)
-            py = numpy.linspace(-yside, yside, size)
-            
-            centre = numpy.asarray(self.centre)
-            axis2 = numpy.cross(self.direction, self.x_axis)
-            axis1 = numpy.cross(axis2, self.direction)
-            
-            points = centre[None,None,:] + px[None,:,None]*axis1 + py[:,None,None]*axis2
-            points2 = points.reshape(-1,3)
-            
+        fields = []
+        for rays in ray_list:
             if isinstance(rays, GaussletCollection):
                 n_list.append(rays.base_rays.refractive_index.real)
                 E = eval_Efield_from_gausslets(rays, points2,
                                                blending=self.blending,
-                                               time_ps=self.time_ps)
+                                               **kwds)
             else:
                 n_list.append(rays.refractive_index.real)
-                E = eval_Efield_from_rays(rays, points2, wavelengths, 
+                E = eval_Efield_from_rays(rays, points2, rays.wavelengths, 
                                           blending=self.blending,
-                                          time_ps=self.time_ps,
                                           exit_pupil_offset=self.exit_pupil_offset,
-                                          exit_pupil_centre=self.centre)
+                                          exit_pupil_centre=self.centre,
+                                          **kwds)
             
-            if ct==0:
-                E_field = E.reshape(self.size, self.size, 3)
-            else:
-                E_field += E.reshape(self.size, self.size, 3)
-                
-        if not n_list:
-            return
+            fields.append((numpy.asarray(rays.wavelengths), 
+                           E.reshape(E.shape[:-2] + (size, size, 3))))
                 
         self.refractive_index = numpy.concatenate(n_list).mean()
-        self.E_field = E_field
-        
-        self._attrib.modified()
-        end = time.monotonic()
-        self._mtime = end
-        print(f"Field calculation took: {end-start} s")
-        
+        if kwds.get("spectral", False):
+            ### Each source's spectrum goes into the rows of its wavelengths
+            wavelengths = numpy.unique(numpy.concatenate([wl for wl, E in fields]))
+            E_spectrum = numpy.zeros((len(wavelengths), size, size, 3), dtype=numpy.complex128)
+            for wl, E in fields:
+                numpy.add.at(E_spectrum, numpy.searchsorted(wavelengths, wl), E)
+            return wavelengths, E_spectrum
+        return sum(E for wl, E in fields)
             
     def intersect_plane(self, rays):
         """
@@ -31,6 +31,7 @@ from traitsui.api import View, Item, Tabbed, VGroup, Include, \
 from tvtk.api import tvtk
 
 from raypier.core.ctracer import RayCollection, GaussletCollection, Ray, ray_dtype, GAUSSLET_, PARABASAL_
+from raypier.core.model import parallel_ray_array, broadband_ray_array, broadband_wavelengths
 from raypier.utils import normaliseVector, Range, TupleVector, Tuple, \
             UnitTupleVector, UnitVectorTrait
 from raypier.bases import RaypierObject, NumEditor, BaseRayCollection
@@ -457,35 +458,14 @@ class BroadbandRaySource(SingleRaySource):
         
     @on_trait_change("number, wavelength_start, wavelength_end, uniform_deltaf")
     def _do_wavelength_changed(self):
-        if self.uniform_deltaf:
-            f_start = 1./self.wavelength_start
-            f_end = 1./self.wavelength_end
-            wavelengths = 1./numpy.linspace(f_start, f_end, self.number)
-        else:
-            wavelengths = numpy.linspace(self.wavelength_start, self.wavelength_end,
-                                         self.number)
+        wavelengths = broadband_wavelengths(self.wavelength_start, self.wavelength_end,
+                                            self.number, self.uniform_deltaf)
         self.wavelength_list = list(wavelengths)
         
     @cached_property
     def _get_input_rays(self):
-        origin = numpy.array(self.origin)
-        direction = numpy.array(self.direction)
-        count = self.number
-
-        E_vector = numpy.cross(self.E_vector, direction)
-        E_vector = numpy.cross(E_vector, direction)
-        
-        wavelen_idx = numpy.arange(count)
-
-        ray_data = numpy.zeros(count, dtype=ray_dtype)            
-        ray_data['origin'] = origin.reshape(-1,3)
-        ray_data['direction'] = direction.reshape(-1,3)
-        ray_data['wavelength_idx'] = wavelen_idx
-        ray_data['E_vector'] = [normaliseVector(E_vector)]
-        ray_data['E1_amp'] = self.E1_amp
-        ray_data['E2_amp'] = self.E2_amp
-        ray_data['refractive_index'] = 1.0+0.0j
-        ray_data['normal'] = [[0,1,0]]
+        ray_data = broadband_ray_array(self.origin, self.direction, self.number,
+                                       self.E_vector, self.E1_amp, self.E2_amp)
         rays = RayCollection.from_array(ray_data)
         return rays
     
@@ -521,40 +501,8 @@ class ParallelRaySource(SingleRaySource):
     
     @cached_property
     def _get_input_rays(self):
-        origin = numpy.array(self.origin)
-        direction = numpy.array(self.direction)
-        count = self.number
-        rings = self.rings
-        radius = self.radius
-        max_axis = numpy.abs(direction).argmax()
-        if max_axis==0:
-            v = numpy.array([0.,1.,0.])
-        else:
-            v = numpy.array([1.,0.,0.])
-        d1 = numpy.cross(direction, v)
-        d1 = normaliseVector(d1)
-        d2 = numpy.cross(direction, d1)
-        d2 = normaliseVector(d2)
-
-        E_vector = numpy.cross(self.E_vector, direction)
-        E_vector = numpy.cross(E_vector, direction)
-
-        ray_data = numpy.zeros((rings*count)+1, dtype=ray_dtype)
-        if rings:
-            radii = ((numpy.arange(rings)+1)*(radius/rings))[:,None,None]
-            angles = (numpy.arange(count)*(2*numpy.pi/count))[None,:,None]
-            offsets = radii*(d1*numpy.sin(angles) + d2*numpy.cos(angles)) 
-            offsets.shape = (-1,3)
-            
-            ray_data['origin'][1:] = offsets
-        ray_data['origin'] += origin
-        ray_data['direction'] = direction
-        ray_data['wavelength_idx'] = 0
-        ray_data['E_vector'] = [normaliseVector(E_vector)]
-        ray_data['E1_amp'] = self.E1_amp
-        ray_data['E2_amp'] = self.E2_amp
-        ray_data['refractive_index'] = 1.0+0.0j
-        ray_data['normal'] = [[0,1,0]]
+        ray_data = parallel_ray_array(self.origin, self.direction, self.radius, self.number,
+                                      self.rings, self.E_vector, self.E1_amp, self.E2_amp)
         rays = RayCollection.from_array(ray_data)
         return rays
     
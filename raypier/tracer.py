@@ -20,13 +20,14 @@
 from traits.api import HasTraits, Array, Float, Complex,\
             Property, List, Instance, Range, Any,\
             Tuple, Event, cached_property, Set, Int, Trait, Button,\
-            self, Str, Bool, PythonValue, Enum, File
+            self, Str, Bool, PythonValue, Enum, File, Dict
 from traitsui.api import View, Item, ListEditor, VSplit,\
             RangeEditor, ScrubberEditor, HSplit, VGroup, TextEditor,\
             TupleEditor, VGroup, HGroup, TreeEditor, TreeNode, TitleEditor,\
             ShellEditor, Controller, Tabbed
             
 from traitsui.menu import Menu, MenuBar, Action, Separator
+from traits import trait_notifiers
             
 from pyface.api import FileDialog, OK as FD_OK
             
@@ -38,11 +39,15 @@ import threading, os, itertools
 import os
 import traceback
 import yaml
+import asyncio
 from contextlib import contextmanager
 from itertools import chain, islice, count
 from raypier.sources import BaseRaySource
 from raypier.core.ctracer import Face, RayCollection
-from raypier.core.tracer import trace_rays
+from raypier.core.tracer import trace_rays, retrace_rays, first_affected_generation, \
+        trace_sequence, TraceTimeline, TraceCancelled
+from raypier.core.parallel import ProcessTracer
+from raypier.core.executor import TraceExecutor
 from raypier.constraints import BaseConstraint
 from raypier.has_queue import HasQueue, on_trait_change
 from raypier.bases import Traceable, Probe, Result
@@ -168,6 +173,27 @@ class RayTraceModel(HasQueue):
                      "can be used to index this list")
     face_sets = List(ctracer.FaceList, desc="list of FaceLists extracted from all "
                      "optics when a tracing operation is initiated")
+    face_bvh = Instance(ctracer.FaceListBVH, (), transient=True,
+                        desc="bounding-volume hierarchy over the face_sets, re-used between traces")
+    compiled_scene = Instance(ctracer.CompiledScene, transient=True,
+                        desc="the face_sets prepared for tracing, shared by all sources")
+    
+    #The optics which have changed since the last trace, or None if everything must be re-traced
+    _changed_optics = Any(None, transient=True)
+    #The last trace of each source, used to re-trace only the generations affected by a change.
+    #A plain dict, as it is updated in the tracing thread.
+    _trace_cache = Any(factory=dict, transient=True)
+    #Guards the _changed_optics, which a background trace takes from another thread
+    _changes_lock = Any(factory=threading.Lock, transient=True)
+    #Counts the changes of the optics, so that worker processes can be kept while they 
+    #have a current copy of the scene
+    _optics_version = Int(0, transient=True)
+    #The ProcessTracer of the last trace in worker processes, with the faces, optics 
+    #version and settings it was created for
+    _process_tracer = Any(None, transient=True)
+    
+    trace_timelines = Dict(transient=True, desc="the TraceTimeline of each source, "
+                           "recorded by the last update")
     
     update = Event() #triggers a tracing operation
     _updating = Bool(False) #indicating that tracing is in progress
@@ -176,11 +202,26 @@ class RayTraceModel(HasQueue):
     _hold_off = Bool(False) #Blocks tracing (while model parameters are altered)
     _update_requested = Bool(False)
     
+    background_trace = Bool(False, desc="trace in a background thread, where a new "
+                            "request replaces any trace waiting or in progress")
+    trace_executor = Instance(TraceExecutor, transient=True)
+    trace_progress = Event(desc="fired (in the tracing thread) after each generation "
+                           "of a background trace, with a dict of the source index, "
+                           "generation and number of rays")
+    
     Self = self
     ShellObj = PythonValue({}, transient=True)
         
     recursion_limit = Int(200, desc="maximum number of refractions or reflections")
     
+    num_threads = Int(1, desc="number of threads used for tracing (0 = one per processor)")
+    
+    num_processes = Int(1, desc="number of worker processes used to trace the sources "
+                        "(1 = trace in this process, 0 = one per processor)")
+    
+    wavelength_slices = Int(1, desc="number of jobs each source is split into, by "
+                            "wavelength, when tracing with worker processes")
+    
     save_btn = Button("Save scene")
     
     filename = File()
@@ -220,10 +261,10 @@ class RayTraceModel(HasQueue):
                 pass
         
         for optic in opticList:
-            optic.on_trait_change(self.trace_all, "update")
+            optic.on_trait_change(self.on_optic_update, "update")
             optic.on_trait_change(self.render_vtk, "render")
         for optic in removed:
-            optic.on_trait_change(self.trace_all, "update", remove=True)
+            optic.on_trait_change(self.on_optic_update, "update", remove=True)
             optic.on_trait_change(self.render_vtk, "render", remove=True)
         self.trace_all()
     
@@ -260,10 +301,31 @@ class RayTraceModel(HasQueue):
         if self.scene is not None:
             self.render_vtk()
         
+    def _trace_executor_default(self):
+        return TraceExecutor()
+        
     def trace_all(self):
+        with self._changes_lock:
+            self._changed_optics = None
+        self.request_trace()
+        
+    def on_optic_update(self, optic, name, new):
+        """Called when an optic requests a re-trace. The optic is recorded so that
+        only the ray generations it may affect need to be re-traced.
+        """
+        with self._changes_lock:
+            if self._changed_optics is not None:
+                self._changed_optics.add(optic)
+            self._optics_version += 1
+        self.request_trace()
+        
+    def request_trace(self):
         if self._hold_off:
             self._update_requested=True
             return
+        if self.background_trace:
+            self.submit_trace()
+            return
         if not self._updating:
             self._updating = True
             self.update = True
@@ -283,38 +345,153 @@ class RayTraceModel(HasQueue):
             self._hold_off = False
         if self._update_requested:
             self._update_requested = False
-            self.trace_all()
+            self.request_trace()
         
     @on_trait_change("update", dispatch="queued")
     def do_update(self):
-        optics = self.optics
         print( "trace") 
         next(counter)
         try:
-            if optics is not None:
-                self.prepare_to_trace()
-                for o in optics:
-                    o.intersections = []
-                for ray_source in self.sources:
-                    self.trace_ray_source(ray_source, optics)
-                for probe in self.probes:
-                    try:
-                        probe.evaluate(self.sources)
-                    except:
-                        traceback.print_exc()
-                for o in optics:
-                    o.update_complete()
-                for r in self.results:
-                    try:
-                        r.calc_result(self)
-                    except:
-                        traceback.print_exc()
+            self.run_trace()
             self.render_vtk()
             self._updating = False
         except:
             traceback.print_exc()
+            
+    def run_trace(self, monitor=None):
+        """
+        Traces all sources, then evaluates the probes and results. This is the work
+        of an update, without the rendering (see compute_trace() and apply_trace()).
+        
+        If a core.tracer.TraceMonitor is given, it is passed to the trace of each
+        source (with its 'source' attribute set to the index of the source), so 
+        the trace can be followed and cancelled. A cancelled trace raises 
+        TraceCancelled, and the next trace then re-traces everything.
+        """
+        self.apply_trace(self.compute_trace(monitor))
+        
+    def compute_trace(self, monitor=None):
+        """
+        Traces all sources, without altering the traits of the model, its optics or 
+        its sources, so that it may run in a background thread. The monitor is as 
+        for run_trace().
+        
+        returns - the trace, to be passed to apply_trace(), or None if there are
+                no optics.
+        """
+        optics = self.optics
+        with self._changes_lock:
+            changed_optics, self._changed_optics = self._changed_optics, set()
+            optics_version = self._optics_version
+        if optics is None:
+            return None
+        try:
+            face_sets, scene = self.compile_scene()
+            if self.num_processes != 1:
+                if monitor is not None:
+                    monitor.check()
+                traces = self.trace_sources_in_processes(self.sources, changed_optics, 
+                                                         scene=scene, 
+                                                         optics_version=optics_version)
+            else:
+                self.close_process_tracer()
+                traces = []
+                for i, ray_source in enumerate(self.sources):
+                    if monitor is not None:
+                        monitor.source = i
+                    traces.append(self._trace_source(ray_source, scene, changed_optics, 
+                                                     monitor=monitor))
+            if monitor is not None:
+                monitor.check()
+        except TraceCancelled:
+            with self._changes_lock:
+                self._changed_optics = None
+            raise
+        return face_sets, scene, traces
+    
+    def apply_trace(self, trace):
+        """
+        Sets the traced rays of each source, from a trace given by compute_trace(), 
+        then evaluates the probes and results. This updates the traits of the model
+        and so should run in the GUI thread (if there is one).
+        """
+        if trace is None:
+            return
+        face_sets, scene, traces = trace
+        self.face_sets = face_sets
+        self.compiled_scene = scene
+        self.all_faces = scene.all_faces
+        self.trace_timelines = {}
+        for o in self.optics:
+            o.intersections = []
+        for source_trace in traces:
+            self._apply_source_trace(source_trace)
+        for probe in self.probes:
+            try:
+                probe.evaluate(self.sources)
+            except:
+                traceback.print_exc()
+        for o in self.optics:
+            o.update_complete()
+        for r in self.results:
+            try:
+                r.calc_result(self)
+            except:
+                traceback.print_exc()
+        
+    def submit_trace(self):
+        """
+        Requests a trace in the background thread of the trace_executor. A trace 
+        still waiting is replaced, and a trace in progress is cancelled (between 
+        ray generations), so only the latest state of the model is traced. The 
+        progress of the trace is reported by the trace_progress event. 
+        
+        The optics and sources should not be changed while they are traced, other 
+        than by the changes which request a new trace. Only the tracing runs in the
+        background thread: the traced rays are set on the sources, the probes and 
+        results evaluated and the scene rendered in the GUI thread (see 
+        apply_trace()), or in the background thread where there is no GUI.
+        
+        returns - a concurrent.futures.Future, whose result is the list of the
+                traced rays of each source. It is cancelled if the trace is 
+                cancelled (by trace_executor.cancel()). A trace replaced by a newer
+                request gives the result of the newer trace.
+        """
+        return self.trace_executor.submit(self._background_trace, 
+                                          on_progress=self._on_trace_progress)
+    
+    async def trace_async(self):
+        """
+        Traces the model in the background thread (see submit_trace()), for use 
+        in a coroutine: ``traced = await model.trace_async()``.
+        
+        returns - the list of the traced rays of each source.
+        """
+        return await asyncio.wrap_future(self.submit_trace())
+    
+    def _background_trace(self, monitor):
+        trace = self.compute_trace(monitor)
+        if trait_notifiers.ui_handler is not None:
+            trait_notifiers.ui_dispatch(self._apply_and_render, trace)
+        else:
+            self.apply_trace(trace)
+        if trace is None:
+            return []
+        return [list(traced_rays) for ray_source, traced_rays, cache, timeline in trace[2]]
+    
+    def _apply_and_render(self, trace):
+        try:
+            self.apply_trace(trace)
+            self.render_vtk()
+        except:
+            traceback.print_exc()
+    
+    def _on_trace_progress(self, monitor, generation, rays):
+        self.trace_progress = {"source": monitor.source,
+                               "generation": generation,
+                               "n_rays": len(rays)}
         
-    def trace_detail(self, _async=False):
+    def trace_detail(self):
         optics = [o.clone_traits() for o in self.optics]
         for child, parent in zip(optics, self.optics):
             child.shadow_parent = parent
@@ -324,15 +501,10 @@ class RayTraceModel(HasQueue):
         probes = [p.clone_traits() for p in self.probes]
         for child, parent in zip(probes, self.probes):
             child.shadow_parent = parent
-        if _async:
-            self.thd = threading.Thread(target=self.async_trace, 
-                                args=(optics, sources, probes))
-            self.thd.start()
-        else:
-            self.async_trace(optics, sources, probes)
+        self.async_trace(optics, sources, probes)
         
     def async_trace(self, optics, sources, probes):
-        """called in a thread to do background tracing"""
+        """traces copies of the optics and sources, for trace_detail()"""
         for o in optics:
             o.intersections = []
         for ray_source in sources:
@@ -356,63 +528,201 @@ class RayTraceModel(HasQueue):
         if self.scene is not None:
             self.scene.render()
             
-    def prepare_to_trace(self):
-        """Called before a tracing operation is performed, to do
-        all synchronisation between optics and their faces
+    def compile_scene(self):
+        """Synchronises the optics with their faces and compiles them for tracing, 
+        without altering the traits of the model.
+        
+        returns - (face_sets, compiled_scene)
         """
         face_sets = [o.faces for o in self.optics]
         for fs in face_sets:
             fs.sync_transforms()
+        return face_sets, ctracer.CompiledScene(face_sets, bvh=self.face_bvh)
             
-        self.face_sets = face_sets
+    def prepare_to_trace(self):
+        """Called before a tracing operation is performed, to do
+        all synchronisation between optics and their faces
+        """
+        self.face_sets, self.compiled_scene = self.compile_scene()
+        
+    def trace_ray_source(self, ray_source, optics, changed_optics=None, monitor=None):
+        """trace a ray source asequentially, using the ctracer framework.
+        
+        If changed_optics is given (a set of optics), the previous trace of this
+        source is resumed from the first generation of rays which these optics 
+        may affect. A TraceMonitor is passed on to the trace.
+        """
+        try:
+            source_trace = self._trace_source(ray_source, self.compiled_scene, changed_optics,
+                                              monitor=monitor)
+            self.all_faces = self.compiled_scene.all_faces
+            self._apply_source_trace(source_trace)
+        except:
+            ray_source.data_source.modified()
+            raise
+        
+    def _trace_source(self, ray_source, scene, changed_optics=None, monitor=None):
+        """Traces a source (as trace_ray_source()) without setting its traced_rays.
         
-    def trace_ray_source(self, ray_source, optics):
-        """trace a ray source asequentially, using the ctracer framework"""
+        returns - (ray_source, traced_rays, cache, timeline), for _apply_source_trace()
+        """
         max_length = ray_source.max_ray_len
+        rays, cache = self.new_trace_cache(ray_source, scene)
+        first = self.first_changed_generation(ray_source, cache, changed_optics)
+        timeline = TraceTimeline()
+        if first == 0:
+            traced_rays, all_faces = trace_rays(rays, scene, 
+                                            recursion_limit=self.recursion_limit, 
+                                            max_length=max_length,
+                                            num_threads=self.num_threads,
+                                            timeline=timeline, monitor=monitor)
+        else:
+            previous = list(self._trace_cache[ray_source]['traced_rays'])
+            traced_rays, all_faces = retrace_rays(previous, scene, first,
+                                            recursion_limit=self.recursion_limit,
+                                            max_length=max_length,
+                                            num_threads=self.num_threads,
+                                            timeline=timeline, monitor=monitor)
+        cache['traced_rays'] = traced_rays
+        cache['applied'] = False
+        self._trace_cache[ray_source] = cache
+        return ray_source, traced_rays, cache, timeline
+    
+    def _apply_source_trace(self, source_trace):
+        ray_source, traced_rays, cache, timeline = source_trace
+        self.trace_timelines[ray_source] = timeline
+        ray_source.traced_rays = traced_rays
+        cache['applied'] = True
+        ray_source.data_source.modified()
+            
+    def trace_sources_in_processes(self, sources, changed_optics=None, scene=None, 
+                                   optics_version=None):
+        """Traces the ray sources together, in a pool of num_processes worker processes
+        (see raypier.core.parallel.ProcessTracer), each source being split into 
+        wavelength_slices jobs. Sources where only part of the previous trace must be
+        re-traced are traced in this process. The traced rays are not set on the 
+        sources (see compute_trace()).
+        
+        The worker processes are kept for the next trace, unless the optics change
+        (see process_tracer()).
+        
+        The TraceTimeline of each source traced in the workers records the rays
+        and memory of each generation, but not their trace times.
+        
+        returns - a list of (ray_source, traced_rays, cache, timeline), for each source 
+        """
+        if scene is None:
+            scene = self.compiled_scene
+        traces = {}
+        jobs = []
+        for ray_source in sources:
+            rays, cache = self.new_trace_cache(ray_source, scene)
+            if self.first_changed_generation(ray_source, cache, changed_optics) == 0:
+                jobs.append((ray_source, rays, cache))
+            else:
+                traces[ray_source] = self._trace_source(ray_source, scene, changed_optics)
+        if jobs:
+            tracer = self.process_tracer(scene, optics_version)
+            traced = tracer.trace_sources([rays for s, rays, c in jobs], 
+                                          wavelength_slices=self.wavelength_slices,
+                                          max_lengths=[s.max_ray_len for s, r, c in jobs])
+            for (ray_source, rays, cache), traced_rays in zip(jobs, traced):
+                cache['traced_rays'] = traced_rays
+                cache['applied'] = False
+                self._trace_cache[ray_source] = cache
+                traces[ray_source] = (ray_source, traced_rays, cache, 
+                                      TraceTimeline.from_traced_rays(traced_rays))
+        return [traces[ray_source] for ray_source in sources]
+            
+    def process_tracer(self, scene, optics_version=None):
+        """The ProcessTracer for the scene (a CompiledScene), compiled when the optics
+        had been changed optics_version times (by default, the current count). The 
+        worker processes of the last trace are re-used if they were created for the 
+        same faces, with no change of the optics since, and the same settings. 
+        Otherwise they are closed and new workers are started.
+        """
+        if optics_version is None:
+            optics_version = self._optics_version
+        processes = self.num_processes if self.num_processes > 0 else None
+        settings = (optics_version, processes, self.recursion_limit)
+        if self._process_tracer is not None:
+            tracer, faces, previous = self._process_tracer
+            if previous == settings and len(faces) == len(scene.all_faces) and \
+                    all(a is b for a,b in zip(faces, scene.all_faces)):
+                return tracer
+            self.close_process_tracer()
+        tracer = ProcessTracer(scene, processes=processes, recursion_limit=self.recursion_limit)
+        self._process_tracer = (tracer, list(scene.all_faces), settings)
+        return tracer
+    
+    def close_process_tracer(self):
+        """Ends the worker processes kept from the last trace, if any."""
+        if self._process_tracer is not None:
+            self._process_tracer[0].close()
+            self._process_tracer = None
+            
+    def new_trace_cache(self, ray_source, scene=None):
+        """Prepares the input rays of a source for tracing, with the given CompiledScene
+        (by default, the compiled_scene). 
+        
+        returns - (input_rays, cache), where the cache records the trace settings, 
+                to be kept with the traced rays (see first_changed_generation()).
+        """
+        if scene is None:
+            scene = self.compiled_scene
         rays = ray_source.input_rays #FIXME
-        face_lists = self.face_sets
         rays.wavelengths = numpy.ascontiguousarray(ray_source.wavelength_list, numpy.double)
-        try:
-            traced_rays, all_faces = trace_rays(rays, face_lists, 
-                                                recursion_limit=self.recursion_limit, 
-                                                max_length=max_length)
-            self.all_faces = all_faces
-            ray_source.traced_rays = traced_rays
-        finally:
-            ray_source.data_source.modified()
+        cache = {"input_rays": rays, 
+                 "max_length": ray_source.max_ray_len,
+                 "recursion_limit": self.recursion_limit,
+                 "wavelengths": numpy.asarray(rays.wavelengths),
+                 "all_faces": scene.all_faces}
+        return rays, cache
+            
+    def first_changed_generation(self, ray_source, cache, changed_optics):
+        """Returns the first generation of the previous trace of ray_source which
+        must be re-traced (None if the previous trace is unaffected). Returns 0 if
+        the previous trace cannot be re-used.
+        """
+        previous = self._trace_cache.get(ray_source)
+        if changed_optics is None or previous is None:
+            return 0
+        traced_rays = previous['traced_rays']
+        #A trace not yet applied (see apply_trace()) will replace the source's traced_rays
+        if previous.get('applied', True) and (len(traced_rays) != len(ray_source.traced_rays) or \
+                any(a is not b for a,b in zip(traced_rays, ray_source.traced_rays))):
+            return 0
+        for key in ("input_rays", "max_length", "recursion_limit"):
+            if previous[key] is not cache[key] and previous[key] != cache[key]:
+                return 0
+        if not numpy.array_equal(previous['wavelengths'], cache['wavelengths']):
+            return 0
+        old_faces, new_faces = previous['all_faces'], cache['all_faces']
+        if len(old_faces) != len(new_faces) or any(a is not b for a,b in zip(old_faces, new_faces)):
+            return 0
+        first = None
+        for optic in changed_optics:
+            fs = optic.faces
+            gen = first_affected_generation(traced_rays, [f.idx for f in fs.faces], 
+                                            fs.bounds)
+            if gen is not None and (first is None or gen < first):
+                first = gen
+        return first
         
-    def trace_sequence(self, input_rays, faces_sequence):
+    def trace_sequence(self, input_rays, faces_sequence, max_length=100.0):
         """
-        Perform a sequential ray-trace. *** THIS IS BROKEN ***
+        Perform a sequential ray-trace (see raypier.core.tracer.trace_sequence()).
         
-        @param input_rays: a RayCollection instance
-        @param optics_sequence: a list of Face instances or lists of Faces
+        @param input_rays: a RayCollection instance, with its wavelengths set
+        @param faces_sequence: a list of Faces or FaceLists, in the order the 
+                rays meet them, optionally as (surface, branch) tuples
         
         returns - the traced rays, as a list of RayCollections including
                 the initial input rays
         """
-        traced_rays = [rays]
-        rays = input_rays
-        for faces in faces_sequence:
-            if isinstance(faces, Face):
-                intersections = face.trace_rays(rays)
-                mask = intersections['length']!=numpy.Infinity
-                intersections = intersections[mask]
-                points = intersections['point']
-                children = face.eval_children(rays, points)
-            else:
-                intersections = numpy.column_stack([f.trace_rays(rays) for f in faces])
-                shortest = numpy.argmin(intersections['length'], axis=1)
-                ar = numpy.arange(size)
-                lengths = intersections['length'][ar,shortest]
-                
-                #now remove infinite rays
-                mask = lengths!=numpy.Infinity
-                shortest = shortest[mask]
-                ar = ar[mask]
-                
-            rays = children
-            traces_rays.append(rays)
+        traced_rays, all_faces = trace_sequence(input_rays, faces_sequence, 
+                                                max_length=max_length,
+                                                num_threads=self.num_threads)
         return traced_rays
     
     def _save_btn_changed(self):
@@ -47,7 +47,7 @@ with open("README.rst", 'r', encoding="utf-8") as fh:
 setup(
     name="raypier",
     version="0.2.3",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     scripts = [], #no stand-alone application yet
     cmdclass = {'build_ext': build_ext},
     #ext_package = "raypier", ###Not needed on linux. Is it necessary on Win64?
@@ -0,0 +1,126 @@
+
+import unittest
+import numpy
+
+from raypier.core.cfields import sum_gaussian_modes, sum_gaussian_modes_times, \
+        sum_gaussian_modes_spectral
+from raypier.core.fields import EFieldSummation, eval_Efield_from_gausslets, \
+        evaluate_neighbours_gc, evaluate_modes_c
+from raypier.core.ctracer import RayCollection
+from raypier.gausslet_sources import BroadbandGaussletSource
+
+
+def make_source():
+    return BroadbandGaussletSource(origin=(0,0,0), direction=(0,0,1), E_vector=(1,0,0),
+                                   number=8, wavelength=1.0, wavelength_extent=0.03,
+                                   bandwidth_nm=13.0, beam_waist=5.0, working_dist=0.0)
+    
+
+class TestBatchedFields(unittest.TestCase):
+    def setUp(self):
+        self.gausslets = make_source().input_rays
+        self.wavelengths = numpy.asarray(self.gausslets.wavelengths)
+        self.points = numpy.column_stack([numpy.linspace(-1, 1, 70), numpy.zeros(70), 
+                                          numpy.full(70, 3.0)])
+        
+    def test_times(self):
+        summation = EFieldSummation(self.gausslets)
+        times = numpy.linspace(-0.5, 0.5, 7)
+        E = summation.evaluate_times(self.points, times)
+        self.assertEqual(E.shape, (7, 70, 3))
+        scale = numpy.abs(E).max()
+        for i, t in enumerate(times):
+            expected = summation.evaluate(self.points, t)
+            self.assertTrue(numpy.allclose(E[i], expected, rtol=0, atol=1e-10*scale))
+        #The pulse moves on, so the times really differ
+        self.assertFalse(numpy.allclose(E[0], E[-1]))
+        
+        #Keeps the shape of the points
+        E = summation.evaluate_times(self.points.reshape(7,10,3), times[:2])
+        self.assertEqual(E.shape, (2, 7, 10, 3))
+        self.assertEqual(summation.evaluate_times(self.points, []).shape, (0, 70, 3))
+        
+        E2 = eval_Efield_from_gausslets(self.gausslets, self.points, times=times[:2])
+        self.assertTrue(numpy.allclose(E2, E.reshape(2, 70, 3)))
+        
+    def test_spectrum(self):
+        summation = EFieldSummation(self.gausslets)
+        S = summation.evaluate_spectrum(self.points, 0.2)
+        self.assertEqual(S.shape, (len(self.wavelengths), 70, 3))
+        E = summation.evaluate(self.points, 0.2)
+        self.assertTrue(numpy.allclose(S.sum(axis=0), E, rtol=0, atol=1e-10*numpy.abs(E).max()))
+        
+        #Each wavelength holds the field of its own rays only
+        rays = summation.base_rays
+        idx = numpy.asarray(rays.wavelength_idx)
+        for w in (0, len(self.wavelengths)//2):
+            select = (idx == w)
+            sub = RayCollection.from_array(rays.copy_as_array()[select])
+            expected = sum_gaussian_modes(sub, summation.modes[select], self.wavelengths, 
+                                          self.points, 0.2)
+            self.assertTrue(numpy.allclose(S[w], expected))
+            
+        S2 = eval_Efield_from_gausslets(self.gausslets, self.points, time_ps=0.2, spectral=True)
+        self.assertTrue(numpy.allclose(S2, S))
+        self.assertRaises(ValueError, eval_Efield_from_gausslets, self.gausslets, self.points, 
+                          times=[0.0], spectral=True)
+        self.assertRaises(ValueError, sum_gaussian_modes_spectral, rays, summation.modes,
+                          self.wavelengths[:1], self.points, 0.0)
+        
+    def test_efield_plane(self):
+        from raypier.tracer import RayTraceModel
+        from raypier.fields import EFieldPlane
+        
+        field = EFieldPlane(centre=(0,0,3), direction=(0,0,1), width=2.0, height=2.0, size=9,
+                            gen_idx=0)
+        model = RayTraceModel(sources=[make_source()], probes=[field])
+        field.evaluate(model.sources)
+        E_field = field.E_field
+        self.assertEqual(E_field.shape, (9, 9, 3))
+        
+        field.spectral = True
+        field.evaluate(model.sources)
+        self.assertEqual(field.E_spectrum.shape, (len(self.wavelengths), 9, 9, 3))
+        self.assertTrue(numpy.allclose(field.E_field, E_field, rtol=0, 
+                                       atol=1e-10*numpy.abs(E_field).max()))
+        
+        E = field.evaluate_times([0.0, 0.3])
+        self.assertEqual(E.shape, (2, 9, 9, 3))
+        self.assertTrue(numpy.allclose(E[0], E_field, rtol=0, atol=1e-10*numpy.abs(E_field).max()))
+        field.time_ps = 0.3
+        self.assertTrue(numpy.allclose(E[1], field.E_field, rtol=0, 
+                                       atol=1e-10*numpy.abs(E_field).max()))
+
+    def test_efield_plane_sources(self):
+        #Sources with different wavelengths are merged by wavelength
+        from raypier.tracer import RayTraceModel
+        from raypier.fields import EFieldPlane
+        
+        src1 = make_source()
+        src2 = BroadbandGaussletSource(origin=(0.5,0,0), direction=(0,0,1), E_vector=(1,0,0),
+                                       number=5, wavelength=1.01, wavelength_extent=0.02,
+                                       bandwidth_nm=13.0, beam_waist=5.0, working_dist=0.0)
+        field = EFieldPlane(centre=(0,0,3), direction=(0,0,1), width=2.0, height=2.0, size=9,
+                            gen_idx=0)
+        model = RayTraceModel(sources=[src1, src2], probes=[field])
+        field.evaluate(model.sources)
+        E_field = field.E_field
+        field.spectral = True
+        field.evaluate(model.sources)
+        
+        wavelengths = numpy.union1d(src1.wavelength_list, src2.wavelength_list)
+        self.assertTrue(numpy.array_equal(field.spectrum_wavelengths, wavelengths))
+        self.assertEqual(field.E_spectrum.shape, (len(wavelengths), 9, 9, 3))
+        self.assertTrue(numpy.allclose(field.E_spectrum.sum(axis=0), E_field, rtol=0,
+                                       atol=1e-10*numpy.abs(E_field).max()))
+        
+        #A row of the second source only
+        field.evaluate([src2])
+        row = numpy.searchsorted(wavelengths, field.spectrum_wavelengths[0])
+        field2 = field.E_spectrum[0]
+        field.evaluate(model.sources)
+        self.assertTrue(numpy.allclose(field.E_spectrum[row], field2))
+
+
+if __name__=="__main__":
+    unittest.main()
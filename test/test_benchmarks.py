@@ -0,0 +1,64 @@
+
+import unittest
+import io
+import os
+import tempfile
+import numpy
+
+from benchmarks import run_benchmarks
+from benchmarks.bench_materials import MaterialEvalChildRays
+from raypier.core.ctracer import RayCollection, Ray
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_discover(self):
+        benchmarks = run_benchmarks.discover()
+        names = [b.name for b in benchmarks]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn("bench_faces.FaceIntersect.time_intersect(face=aspheric, n_rays=1000)", names)
+        self.assertIn("bench_collections.RayCollectionAccessors.time_origin(n_rays=1000)", names)
+
+        #Each benchmark runs, with its first (smallest) parameters
+        first = {}
+        for bench in benchmarks:
+            first.setdefault((bench.cls, bench.method), bench)
+        out = io.StringIO()
+        results = run_benchmarks.run(first.values(), quick=True, out=out)
+        self.assertEqual(len(results), len(first))
+        self.assertTrue(all(t > 0 for t in results.values()))
+        self.assertEqual(len(out.getvalue().splitlines()), len(first))
+
+    def test_compare(self):
+        baseline = {"a": 1.0, "b": 1.0, "c": 1.0}
+        results = {"a": 1.1, "b": 1.5, "c": 0.5, "d": 2.0}
+        rows = run_benchmarks.compare(results, baseline, threshold=1.2)
+        self.assertEqual([r[-1] for r in rows], ["same", "regressed", "improved", "new"])
+        report = run_benchmarks.format_report(rows, 1.2)
+        self.assertIn("1 regressed, 1 improved (threshold 1.20), 1 new", report)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "base.json")
+            self.assertEqual(run_benchmarks.save_baseline(baseline, path), path)
+            self.assertEqual(run_benchmarks.load_baseline(path), baseline)
+            status = run_benchmarks.main(["-k", "RayCollectionAccessors.time_as_array(n_rays=1000)",
+                                          "--quick", "--compare", path, "--threshold", "1e9"])
+            self.assertEqual(status, 0)
+
+    def test_eval_child_rays(self):
+        bench = MaterialEvalChildRays()
+        bench.setup("dielectric", 20)
+        rays, mat = bench.rays, bench.material
+        new_rays = RayCollection(40)
+        mat.eval_child_rays(rays, bench.points, bench.normals, bench.tangents, new_rays)
+        #The same as evaluating each ray in turn
+        expected = RayCollection(40)
+        for i in range(len(rays)):
+            mat.eval_child_ray(rays[i], i, bench.points[i], bench.normals[i],
+                               bench.tangents[i], expected)
+        self.assertEqual(new_rays.copy_as_array().tobytes(), expected.copy_as_array().tobytes())
+        self.assertRaises(ValueError, mat.eval_child_rays, rays, bench.points[:3],
+                          bench.normals, bench.tangents, new_rays)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core.ctracer import FaceListBVH, trace_segment, FaceList, RayCollection, Ray
+from raypier.core.cshapes import CircleShape, RectangleShape
+from raypier.core.cfaces import ShapedSphericalFace, ConicRevolutionFace, AsphericFace, \
+        DistortionFace, ShapedPlanarFace
+from raypier.core.cdistortions import ZernikeDistortion, SimpleTestZernikeJ7
+from raypier.core.tracer import trace_rays
+
+
+class TestFaceListBVH(unittest.TestCase):
+    def setUp(self):
+        optics = [PlanoConvexLens(centre=(x,y,z), direction=(0,0,1), diameter=10.,
+                                  curvature=20., n_inside=1.5, CT=3.)
+                  for x in (-6,6) for y in (-6,6) for z in (20,40)]
+        optics.append(PECMirror(centre=(0,0,70), direction=(0,0.3,-1), diameter=40.))
+        self.optics = optics
+        self.face_lists = [o.faces for o in optics]
+        for fl in self.face_lists:
+            fl.sync_transforms()
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=12.,
+                                rings=15, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_trace_matches_linear_search(self):
+        traced, all_faces = trace_rays(self.rays, self.face_lists)
+        self.assertGreater(len(traced), 3)
+        for rays in traced[:-1]:
+            rays.reset_length(100.0)
+            linear = trace_segment(rays, self.face_lists, all_faces, max_length=100.0)
+            rays.reset_length(100.0)
+            bvh = trace_segment(rays, self.face_lists, all_faces, max_length=100.0,
+                                bvh=FaceListBVH(self.face_lists))
+            self.assertEqual(linear.copy_as_array().tobytes(),
+                             bvh.copy_as_array().tobytes())
+
+    def test_hits_inside_bounds(self):
+        traced, all_faces = trace_rays(self.rays, self.face_lists)
+        for rays in traced[:-1]:
+            for fl in self.face_lists:
+                lo = numpy.array(fl.bounds[0::2])
+                hi = numpy.array(fl.bounds[1::2])
+                idx = set(f.idx for f in fl.faces)
+                sel = numpy.array([i in idx for i in rays.end_face_idx])
+                if not sel.any():
+                    continue
+                ends = rays.origin[sel] + rays.direction[sel]*rays.length[sel,None]
+                self.assertTrue((ends >= lo).all() and (ends <= hi).all())
+
+    def test_rebuild_on_change(self):
+        bvh = FaceListBVH()
+        self.assertTrue(bvh.update(self.face_lists))
+        self.assertFalse(bvh.update(self.face_lists))
+        self.assertEqual(bvh.build_count, 1)
+
+        self.optics[0].centre = (-6,-6,25)
+        self.face_lists[0].sync_transforms()
+        self.assertTrue(bvh.update(self.face_lists))
+        self.assertEqual(bvh.build_count, 2)
+
+    def test_shape_bounds(self):
+        circle = CircleShape(radius=2.0, centre=(1.0,0.0))
+        rect = RectangleShape(width=2.0, height=4.0)
+        self.assertEqual(circle.get_bounds(), (-1.0, 3.0, -2.0, 2.0))
+        self.assertEqual((circle & rect).get_bounds(), (-1.0, 1.0, -2.0, 2.0))
+        self.assertEqual((circle | rect).get_bounds(), (-1.0, 3.0, -2.0, 2.0))
+        self.assertIsNone((~circle).get_bounds())
+        self.assertIsNone((rect | ~circle).get_bounds())
+
+
+class TestShapedFaceBounds(unittest.TestCase):
+    def check_contains(self, face, n=401):
+        b = face.get_bounds()
+        x, y = numpy.meshgrid(numpy.linspace(b[0], b[1], n), numpy.linspace(b[2], b[3], n))
+        z = face.eval_z_points(numpy.column_stack([x.ravel(), y.ravel()]))
+        z = z[numpy.isfinite(z)]
+        self.assertGreater(len(z), 0)
+        eps = 1e-9*max(1.0, numpy.abs(z).max())
+        self.assertGreaterEqual(z.min(), b[4] - eps)
+        self.assertLessEqual(z.max(), b[5] + eps)
+        return b
+        
+    def test_surfaces_of_revolution(self):
+        shape = CircleShape(radius=8.0)
+        faces = [ShapedSphericalFace(curvature=c, z_height=2.0, shape=shape) for c in (20.0, -20.0, 5.0)]
+        faces += [ConicRevolutionFace(curvature=c, conic_const=k, z_height=3.0, shape=shape)
+                  for c in (15.0, -15.0) for k in (-2.0, 0.0, 0.5, 3.0)]
+        for face in faces:
+            b = self.check_contains(face)
+            #The vertex is at one end of the range, except for a hyperboloid, whose 
+            #second sheet lies beyond it
+            if getattr(face, "conic_const", 0.0) >= -1:
+                self.assertIn(face.z_height, (b[4], b[5]))
+        for c in (30.0, -30.0):
+            self.check_contains(AsphericFace(curvature=c, conic_const=-0.5, A4=1e-4, A6=-1e-6, 
+                                             A8=3e-9, z_height=1.0, shape=shape))
+            
+    def test_negative_conic_sheet(self):
+        face = ConicRevolutionFace(curvature=-15.0, conic_const=0.5, z_height=3.0,
+                                   shape=CircleShape(radius=8.0))
+        dist = face.intersect((2.0, 1.0, -10.0), (2.0, 1.0, 10.0), 1)
+        z = face.eval_z_points(numpy.array([[2.0, 1.0]]))[0]
+        self.assertAlmostEqual(-10.0 + dist, z)
+        b = face.get_bounds()
+        self.assertTrue(b[4] <= z <= b[5])
+        
+    def test_conic_sheets(self):
+        #Rays across the axis hit the back of a closed ellipsoid, and the second 
+        #sheet of a hyperboloid
+        rng = numpy.random.default_rng(0)
+        n = 400
+        origin = numpy.column_stack([numpy.full(n, -20.0), rng.uniform(-8,8,n), 
+                                     rng.uniform(-15,15,n)])
+        direction = numpy.column_stack([numpy.ones(n), rng.uniform(-0.3,0.3,(n,2))])
+        shape = CircleShape(radius=8.0)
+        faces = [ConicRevolutionFace(curvature=c, conic_const=k, z_height=0.5, shape=shape)
+                 for c in (5.0, -5.0) for k in (1.5, -2.0)]
+        faces += [AsphericFace(curvature=c, conic_const=1.5, A4=1e-3, z_height=0.5, shape=shape)
+                  for c in (5.0, -5.0)]
+        for face in faces:
+            face.idx = 0
+            fl = FaceList()
+            fl.faces = [face]
+            rays = RayCollection(n)
+            for o, d in zip(origin, direction):
+                rays.add_ray(Ray(origin=tuple(o), direction=tuple(d)))
+            rays.wavelengths = numpy.array([0.78])
+            linear = trace_segment(rays, [fl], [face], max_length=100.0)
+            rays.reset_length(100.0)
+            bvh = trace_segment(rays, [fl], [face], max_length=100.0, bvh=FaceListBVH([fl]))
+            self.assertGreater(linear.n_rays, 0)
+            self.assertEqual(linear.copy_as_array().tobytes(), bvh.copy_as_array().tobytes())
+            b = face.get_bounds()
+            self.assertTrue(((linear.origin[:,2] >= b[4]) & (linear.origin[:,2] <= b[5])).all())
+        
+    def test_distortions(self):
+        shape = CircleShape(radius=8.0)
+        base = ShapedSphericalFace(curvature=40.0, shape=shape)
+        #High order terms, with narrow ripples near the edge
+        radius = 8*numpy.sqrt(2)
+        narrow = ZernikeDistortion(unit_radius=radius, j0=0.001, j350=0.05, j377=-0.02, j1200=0.01)
+        face = DistortionFace(base_face=base, distortion=narrow)
+        b = self.check_contains(face, n=1201)
+        base_b = base.get_bounds()
+        amp = narrow.max_amplitude(radius)
+        #j350, j377 and j1200 are (n,m) = (25,25), (26,26) and (48,0)
+        self.assertAlmostEqual(amp, 0.001 + 0.05*numpy.sqrt(52) + 0.02*numpy.sqrt(54) + 0.01*7)
+        self.assertAlmostEqual(b[4], base_b[4] - amp)
+        self.assertAlmostEqual(b[5], base_b[5] + amp)
+        
+        #Part of the shape lies beyond the unit radius of the distortion
+        face = DistortionFace(base_face=base, distortion=ZernikeDistortion(unit_radius=6.0, 
+                                                                          j5=0.01, j12=-0.003))
+        self.check_contains(face)
+        face = DistortionFace(base_face=ShapedPlanarFace(shape=shape), 
+                              distortion=SimpleTestZernikeJ7(unit_radius=6.0, amplitude=0.02))
+        self.check_contains(face)
+
+
+if __name__=="__main__":
+    unittest.main()
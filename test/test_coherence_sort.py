@@ -0,0 +1,74 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import HexagonalRayFieldSource
+from raypier.gausslet_sources import CollimatedGaussletSource
+from raypier.core.ctracer import CompiledScene
+from raypier.core.tracer import trace_rays, iter_trace_rays, CoherenceSorter, morton_codes
+
+
+class TestCoherenceSort(unittest.TestCase):
+    def setUp(self):
+        optics = [PlanoConvexLens(centre=(x,0,z), direction=(0,0,1), diameter=10.,
+                                  curvature=20., n_inside=1.5, CT=3.)
+                  for x in (-6,6) for z in (20,40)]
+        optics.append(PECMirror(centre=(0,0,70), direction=(0,0.3,-1), diameter=40.))
+        self.face_lists = [o.faces for o in optics]
+        src = HexagonalRayFieldSource(origin=(0,0,0), direction=(0,0,1), radius=12.,
+                                      resolution=10.0)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def check_restored(self, expected, sorter, traced):
+        restored = sorter.restore(traced)
+        self.assertEqual(len(expected), len(restored))
+        for a, b in zip(expected, restored):
+            self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+        return restored
+
+    def test_morton_codes(self):
+        origin = numpy.array([[0.,0,0], [1,1,1], [0,0,1], [1,1,1]])
+        direction = numpy.array([[0.,0,1], [0,0,1], [0,0,1], [0,0,-1]])
+        key = morton_codes(origin, direction, bits=1)
+        self.assertEqual(list(key), [0, 7, 4, 7 + (4<<3)])
+        self.assertRaises(ValueError, CoherenceSorter, 'random')
+
+    def test_restore(self):
+        expected, faces = trace_rays(self.rays, self.face_lists)
+        counts = [f.count for f in faces]
+        self.assertTrue(expected[2].neighbours is not None)
+        scene = CompiledScene(self.face_lists, face_major=True)
+        for key in ('morton', 'face'):
+            sorter = CoherenceSorter(key)
+            traced, faces = trace_rays(self.rays, scene, sort_rays=sorter)
+            self.assertEqual(counts, [f.count for f in faces])
+            self.assertNotEqual(expected[2].copy_as_array().tobytes(),
+                                traced[2].copy_as_array().tobytes())
+            #Rays are sorted by the face where their parent ended
+            if key == 'face':
+                end_face = traced[1].end_face_idx[traced[2].parent_idx]
+                self.assertTrue((numpy.diff(end_face.astype(int)) >= 0).all())
+            restored = self.check_restored(expected, sorter, traced)
+            for a, b in zip(expected, restored):
+                self.assertTrue((a.neighbours == b.neighbours).all())
+
+        sorter = CoherenceSorter()
+        streamed = list(iter_trace_rays(self.rays, self.face_lists, sort_rays=sorter))
+        self.check_restored(expected, sorter, streamed)
+
+    def test_gausslets(self):
+        src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                       resolution=10, wavelength=1.0, beam_waist=10.0)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        expected, faces = trace_rays(rays, self.face_lists)
+        sorter = CoherenceSorter('face')
+        traced, faces = trace_rays(rays, self.face_lists, sort_rays=sorter)
+        self.check_restored(expected, sorter, traced)
+
+
+if __name__=="__main__":
+    unittest.main()
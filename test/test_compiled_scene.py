@@ -0,0 +1,46 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core.ctracer import CompiledScene
+from raypier.core.tracer import trace_rays
+
+
+class TestCompiledScene(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+        
+    def test_trace_matches_face_lists(self):
+        expected, faces = trace_rays(self.rays, self.face_lists)
+        counts = [f.count for f in faces]
+        scene = CompiledScene(self.face_lists)
+        for i in range(2):
+            traced, faces = trace_rays(self.rays, scene)
+            self.assertEqual(len(expected), len(traced))
+            for a, b in zip(expected, traced):
+                self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+            self.assertEqual(counts, [f.count for f in faces])
+            
+    def test_set_wavelengths(self):
+        scene = CompiledScene(self.face_lists, wavelengths=[0.5])
+        scene.set_wavelengths([0.6, 0.7])
+        for f in scene.all_faces:
+            self.assertEqual(list(f.material.wavelengths), [0.6, 0.7])
+            
+    def test_trace_type(self):
+        scene = CompiledScene(self.face_lists)
+        self.assertRaises(TypeError, scene.trace, [])
+
+
+if __name__=="__main__":
+    unittest.main()
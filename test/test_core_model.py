@@ -0,0 +1,91 @@
+
+import unittest
+import subprocess
+import sys
+import numpy
+
+import raypier
+from raypier.core import model
+from raypier.core.tracer import trace_rays
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_core_model_imports_without_gui(self):
+        code = ("import sys, raypier.core.model; "
+                "print(sorted({m.split('.')[0] for m in sys.modules} & "
+                "{'traits', 'traitsui', 'tvtk', 'vtk', 'pyface', 'scipy'}))")
+        out = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        self.assertEqual(out.strip(), "[]")
+
+    def test_lazy_names(self):
+        from raypier import api, tracer
+        self.assertIs(raypier.RayTraceModel, tracer.RayTraceModel)
+        names = [n for n in dir(api) if not n.startswith("_")]
+        for name in names:
+            if isinstance(getattr(api, name), type(api)):
+                continue
+            self.assertIs(getattr(raypier, name), getattr(api, name), name)
+        self.assertIn("EFieldPlane", dir(raypier))
+        self.assertIs(raypier.core.model, model)
+        self.assertRaises(AttributeError, getattr, raypier, "no_such_thing")
+
+
+class TestCoreModel(unittest.TestCase):
+    def test_transforms(self):
+        from raypier.mirrors import PECMirror
+        for direction, rotation in [((0,0,1),0.0), ((0,1,1),0.0), ((1,-2,0.5),30.0),
+                                    ((-1,0,0),-45.0)]:
+            gui = PECMirror(centre=(1,2,3), direction=direction, rotation=rotation)
+            gui.faces.sync_transforms()
+            core = model.PECMirror(centre=(1,2,3), direction=direction, rotation=rotation)
+            for attr in ("transform", "inverse_transform"):
+                t1 = getattr(gui.faces, attr)
+                t2 = getattr(core.faces, attr)
+                self.assertTrue(numpy.allclose(t1.rotation, t2.rotation), (direction, attr))
+                self.assertTrue(numpy.allclose(t1.translation, t2.translation), (direction, attr))
+
+    def test_trace(self):
+        from raypier.sources import ParallelRaySource
+        from raypier.lenses import PlanoConvexLens
+
+        kwds = dict(origin=(0,0,-20), direction=(0,0,1), radius=5.0, number=8, rings=3,
+                    wavelength=0.8)
+        src = model.ParallelRaySource(**kwds)
+        gui_src = ParallelRaySource(**kwds)
+        self.assertEqual(src.input_rays.copy_as_array().tobytes(),
+                         gui_src.input_rays.copy_as_array().tobytes())
+
+        lens = model.PlanoConvexLens(centre=(0,0,0), direction=(0,0,1), curvature=25.0,
+                                     diameter=20.0)
+        mirror = model.PECMirror(centre=(0,0,40), direction=(0,1,-1), diameter=30.0)
+        (traced, faces), = model.trace([src], [lens, mirror])
+        self.assertIs(src.traced_rays[-1], traced[-1])
+        self.assertEqual(len(faces), 3)
+
+        gui_lens = PlanoConvexLens(centre=(0,0,0), direction=(0,0,1), curvature=25.0,
+                                   diameter=20.0, n_inside=1.5)
+        gui_lens.faces.sync_transforms()
+        rays = gui_src.input_rays
+        rays.wavelengths = numpy.array(gui_src.wavelength_list)
+        expected, _ = trace_rays(rays, [gui_lens.faces, mirror.faces], recursion_limit=200,
+                                 max_length=gui_src.max_ray_len)
+        self.assertEqual(len(traced), len(expected))
+        for a, b in zip(traced, expected):
+            self.assertTrue(numpy.allclose(a.origin, b.origin))
+            self.assertTrue(numpy.allclose(a.direction, b.direction))
+        #The reflected rays travel along +y
+        self.assertGreater(traced[-1].direction[:,1].max(), 0.9)
+
+    def test_broadband(self):
+        from raypier.sources import BroadbandRaySource
+        kwds = dict(origin=(0,0,0), direction=(0,0,1), number=20, wavelength_start=0.7,
+                    wavelength_end=0.8)
+        src = model.BroadbandRaySource(**kwds)
+        gui_src = BroadbandRaySource(**kwds)
+        self.assertTrue(numpy.allclose(src.wavelength_list, gui_src.wavelength_list))
+        self.assertEqual(src.input_rays.copy_as_array().tobytes(),
+                         gui_src.input_rays.copy_as_array().tobytes())
+
+
+if __name__=="__main__":
+    unittest.main()
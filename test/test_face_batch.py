@@ -0,0 +1,98 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core.cfaces import CircularFace, SphericalFace, ConicRevolutionFace, \
+        RectangularFace, AsphericFace
+from raypier.core.cshapes import CircleShape
+from raypier.core.ctracer import CompiledScene
+from raypier.core.tracer import trace_rays
+
+
+class TestFaceBatch(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(2)
+        n = 500
+        self.p1 = numpy.column_stack([rng.uniform(-6,6,n), rng.uniform(-6,6,n),
+                                      numpy.full(n, -10.0)])
+        self.p2 = self.p1 + numpy.column_stack([rng.uniform(-0.3,0.3,(n,2)),
+                                                numpy.ones(n)])*30.0
+
+    def test_faces(self):
+        faces = [CircularFace(), SphericalFace(curvature=-12.0, z_height=1.0),
+                 SphericalFace(curvature=15.0)]
+        for face in faces:
+            face.diameter = 8.0
+        faces[0].offset = 0.5
+        faces.append(ConicRevolutionFace(curvature=10.0, conic_const=-0.5,
+                                         shape=CircleShape(radius=4.0)))
+        faces.append(RectangularFace(width=4.0, length=6.0))
+        faces.append(AsphericFace(curvature=-30.0, conic_const=-0.5, A4=1e-4, A6=-1e-6,
+                                  z_height=2.0, shape=CircleShape(radius=5.0)))
+        for face in faces:
+            for is_base_ray in (0, 1):
+                batch = face.intersect_batch(self.p1, self.p2, is_base_ray)
+                single = [face.intersect(a, b, is_base_ray) for a, b in zip(self.p1, self.p2)]
+                self.assertTrue((batch == numpy.array(single)).all())
+            self.assertTrue((batch > face.tolerance).any())
+
+    def test_trace_face_major(self):
+        optics = [PlanoConvexLens(centre=(x,0,z), direction=(0,0,1), diameter=10.,
+                                  curvature=20., n_inside=1.5, CT=3.)
+                  for x in (-6,6) for z in (20,40)]
+        optics.append(PECMirror(centre=(0,0,70), direction=(0,0.3,-1), diameter=40.))
+        face_lists = [o.faces for o in optics]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=12.,
+                                rings=15, number=20)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+
+        expected, faces = trace_rays(rays, face_lists)
+        expected = [r.copy_as_array().tobytes() for r in expected]
+        counts = [f.count for f in faces]
+        scene = CompiledScene(face_lists, face_major=True)
+        for num_threads in (1, 2):
+            traced, faces = trace_rays(rays, scene, num_threads=num_threads)
+            self.assertEqual(expected, [r.copy_as_array().tobytes() for r in traced])
+            self.assertEqual(counts, [f.count for f in faces])
+
+        fl = optics[0].faces
+        fl.sync_transforms()
+        length, idx = fl.intersect_batch(self.p1, self.p2)
+        hit = idx >= 0
+        self.assertTrue(hit.any())
+        self.assertTrue(numpy.isinf(length[~hit]).all())
+        self.assertTrue(set(idx[hit]) <= set(f.idx for f in fl.faces))
+
+
+    def test_face_major_bvh(self):
+        #Enough optics for a FaceListBVH several levels deep, with some rays 
+        #passing through several of them
+        optics = [PlanoConvexLens(centre=(x,y,z), direction=(0,0,1), diameter=5.,
+                                  curvature=10., n_inside=1.5, CT=2.)
+                  for x in (-9,-3,3,9) for y in (-9,-3,3,9) for z in (20,40)]
+        optics.append(PECMirror(centre=(0,0,70), direction=(0,0.3,-1), diameter=40.))
+        face_lists = [o.faces for o in optics]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=12.,
+                                rings=15, number=20)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        
+        scene = CompiledScene(face_lists)
+        self.assertGreater(scene.bvh.depth, 3)
+        expected, faces = trace_rays(rays, scene)
+        expected = [r.copy_as_array().tobytes() for r in expected]
+        self.assertGreater(len(expected), 3)
+        counts = [f.count for f in faces]
+        scene = CompiledScene(face_lists, face_major=True)
+        for num_threads in (1, 2):
+            traced, faces = trace_rays(rays, scene, num_threads=num_threads)
+            self.assertEqual(expected, [r.copy_as_array().tobytes() for r in traced])
+            self.assertEqual(counts, [f.count for f in faces])
+
+
+if __name__=="__main__":
+    unittest.main()
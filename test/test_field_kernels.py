@@ -0,0 +1,69 @@
+
+import unittest
+import numpy
+
+from raypier.core.cfields import sum_gaussian_modes, sum_gaussian_modes_tiled, \
+        sum_gaussian_modes_rays
+from raypier.core.ctracer import RayCollection
+
+from test_truncated_modes import make_modes
+
+
+class TestFieldKernels(unittest.TestCase):
+    def setUp(self):
+        self.gausslets, self.rays, self.modes, self.wavelengths = make_modes()
+        
+    def points(self, n, z=10.0):
+        rng = numpy.random.default_rng(n)
+        points = numpy.column_stack([rng.uniform(-8, 8, n), rng.uniform(-8, 8, n), 
+                                     numpy.full(n, z)])
+        points[:1,:2] = 0.0 #In the beam
+        return points
+    
+    def reference(self, points, time_ps=0.0):
+        #The truncated summation visits the modes in the original (ray by ray) order
+        return sum_gaussian_modes(self.rays, self.modes, self.wavelengths, points, time_ps, 1e-15)
+        
+    def test_methods_agree(self):
+        #Either side of the tile size
+        for n in (1, 63, 64, 65, 200):
+            points = self.points(n)
+            ref = self.reference(points, 0.1)
+            scale = numpy.abs(ref).max()
+            for method in ("auto", "tiled", "rays"):
+                for num_threads in (0, 1, 3):
+                    E = sum_gaussian_modes(self.rays, self.modes, self.wavelengths, points, 0.1,
+                                           0.0, method, num_threads)
+                    self.assertEqual(E.shape, (n, 3))
+                    self.assertTrue(numpy.allclose(E, ref, rtol=0, atol=1e-12*scale), (n, method))
+            E = sum_gaussian_modes_tiled(self.rays, self.modes, self.wavelengths, points, 0.1)
+            self.assertTrue(numpy.allclose(E, ref, rtol=0, atol=1e-12*scale))
+            E = sum_gaussian_modes_rays(self.rays, self.modes, self.wavelengths, points, 0.1)
+            self.assertTrue(numpy.allclose(E, ref, rtol=0, atol=1e-12*scale))
+            
+    def test_few_rays(self):
+        #Fewer rays than threads
+        rays = RayCollection.from_array(self.rays.copy_as_array()[:2])
+        points = self.points(10)
+        E1 = sum_gaussian_modes_rays(rays, self.modes[:2], self.wavelengths, points, 0.0, 8)
+        E2 = sum_gaussian_modes_tiled(rays, self.modes[:2], self.wavelengths, points, 0.0, 8)
+        self.assertTrue(numpy.allclose(E1, E2))
+        
+    def test_empty(self):
+        for method in ("tiled", "rays"):
+            E = sum_gaussian_modes(self.rays, self.modes, self.wavelengths, self.points(0), 
+                                   0.0, 0.0, method)
+            self.assertEqual(E.shape, (0, 3))
+            rays = RayCollection(1)
+            E = sum_gaussian_modes(rays, self.modes[:0], self.wavelengths, self.points(5),
+                                   0.0, 0.0, method)
+            self.assertEqual(E.shape, (5, 3))
+            self.assertFalse(E.any())
+            
+    def test_bad_method(self):
+        self.assertRaises(ValueError, sum_gaussian_modes, self.rays, self.modes, self.wavelengths,
+                          self.points(5), 0.0, 0.0, "points")
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core.ctracer import GeometricRayCollection, geo_ray_dtype, ray_dtype
+from raypier.core.tracer import trace_rays
+
+
+class TestGeometricRays(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        #Circularly polarised, as geometric rays are traced
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20, E1_amp=2**-0.5, E2_amp=1j*2**-0.5)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_record_size(self):
+        self.assertLess(geo_ray_dtype.itemsize, 0.6*ray_dtype.itemsize)
+        geo = GeometricRayCollection.from_rays(self.rays)
+        self.assertEqual(len(geo), len(self.rays))
+        self.assertTrue(numpy.allclose(geo.power, self.rays.power))
+        self.assertTrue((geo.wavelengths == self.rays.wavelengths).all())
+        copy = GeometricRayCollection.from_array(geo.as_array())
+        self.assertEqual(copy.copy_as_array().tobytes(), geo.copy_as_array().tobytes())
+
+    def test_trace_matches_full_rays(self):
+        full, faces = trace_rays(self.rays, self.face_lists)
+        counts = [f.count for f in faces]
+        for num_threads in (1, 2):
+            geo, faces = trace_rays(GeometricRayCollection.from_rays(self.rays),
+                                    self.face_lists, num_threads=num_threads)
+            self.assertEqual(counts, [f.count for f in faces])
+            self.assertEqual([len(r) for r in full], [len(r) for r in geo])
+            for a, b in zip(full, geo):
+                a = a.copy_as_array()
+                b = b.copy_as_array()
+                for name in ('origin', 'direction', 'length', 'end_face_idx', 'parent_idx'):
+                    self.assertTrue((a[name] == b[name]).all())
+        #The first interface sees the same (circular) polarisation in both traces
+        self.assertTrue(numpy.allclose(full[1].power, geo[1].power))
+
+    def test_pruning(self):
+        geo = GeometricRayCollection.from_rays(self.rays)
+        traced, faces = trace_rays(geo, self.face_lists, min_power=0.1)
+        for rays in traced[1:]:
+            self.assertTrue((rays.power >= 0.1*geo.power.max()).all())
+
+
+if __name__=="__main__":
+    unittest.main()
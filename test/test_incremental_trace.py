@@ -0,0 +1,61 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.tracer import RayTraceModel
+from raypier.core.tracer import trace_rays, segments_hit_box
+
+
+class TestIncrementalTrace(unittest.TestCase):
+    def setUp(self):
+        self.lens1 = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                                     curvature=40., n_inside=1.5, CT=5.)
+        self.lens2 = PlanoConvexLens(centre=(0,0,40), direction=(0,0,1), diameter=25.,
+                                     curvature=40., n_inside=1.5, CT=5.)
+        self.mirror = PECMirror(centre=(0,0,80), direction=(0,0.3,-1), diameter=30.)
+        self.src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                     rings=5, number=10, max_ray_len=200.)
+        self.model = RayTraceModel(optics=[self.lens1, self.lens2, self.mirror], 
+                                   sources=[self.src])
+        self.model.trace_all()
+        
+    def check_full_trace(self):
+        traced = list(self.src.traced_rays)
+        face_lists = [o.faces for o in self.model.optics]
+        expected, faces = trace_rays(self.src.input_rays, face_lists, 
+                                     recursion_limit=self.model.recursion_limit,
+                                     max_length=self.src.max_ray_len)
+        self.assertEqual(len(expected), len(traced))
+        for a, b in zip(expected, traced):
+            self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+        
+    def test_move_last_optic(self):
+        before = list(self.src.traced_rays)
+        self.mirror.centre = (0,0,90)
+        after = list(self.src.traced_rays)
+        self.assertTrue(all(a is b for a,b in zip(before[:5], after[:5])))
+        self.assertIsNot(before[5], after[5])
+        self.check_full_trace()
+        
+    def test_move_first_optic(self):
+        before = list(self.src.traced_rays)
+        self.lens1.centre = (0,1,20)
+        after = list(self.src.traced_rays)
+        self.assertIs(before[0], after[0])
+        self.assertIsNot(before[1], after[1])
+        self.check_full_trace()
+        
+    def test_segments_hit_box(self):
+        origin = numpy.zeros((3,3))
+        direction = numpy.array([[0,0,1.],[1,0,0],[0,0,1]])
+        length = numpy.array([10., 10., 1.])
+        hits = segments_hit_box(origin, direction, length, 
+                                numpy.array([-1,-1,5.]), numpy.array([1,1,6.]))
+        self.assertEqual(list(hits), [True, False, False])
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+
+import unittest
+import numpy
+
+from raypier.core.fields import gausslet_modes, EFieldSummation, eval_Efield_from_gausslets, \
+        eval_Efield_from_rays
+from raypier.core.ctracer import GaussletCollection, RayCollection, Ray, trace_gausslet
+from raypier.gausslet_sources import CollimatedGaussletSource
+
+
+def make_gausslets():
+    src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=3., 
+                                   resolution=5, wavelength=1.0, beam_waist=5.0, 
+                                   E_vector=(1,0,0))
+    return src.input_rays
+
+
+class TestModeCache(unittest.TestCase):
+    def setUp(self):
+        self.gausslets = make_gausslets()
+        self.points = numpy.column_stack([numpy.linspace(-2, 2, 20), numpy.zeros(20), 
+                                          numpy.full(20, 5.0)])
+        
+    def assertBumps(self, collection, func, *args):
+        version = collection.version
+        func(*args)
+        self.assertGreater(collection.version, version, func)
+        
+    def test_version(self):
+        gc = self.gausslets
+        self.assertBumps(gc, gc.scale_amplitude, 1.0)
+        self.assertBumps(gc, gc.reset_length, 10.0)
+        self.assertBumps(gc, gc.project_to_plane, (0,0,1), (0,0,1))
+        self.assertBumps(gc, gc.config_parabasal_rays, numpy.array([1.0]), 0.5, 0.0)
+        self.assertBumps(gc, gc.__setitem__, 0, gc[1])
+        self.assertBumps(gc, gc.base_rays.__setitem__, 0, gc[1].base_ray)
+        self.assertBumps(gc, setattr, gc, "wavelengths", [1.0])
+        self.assertBumps(gc, gc.extend, make_gausslets())
+        self.assertBumps(gc, gc.touch)
+        
+        rc = RayCollection(2)
+        self.assertBumps(rc, rc.add_ray, Ray(origin=(0,0,0), direction=(0,0,1)))
+        self.assertBumps(rc, rc.__setitem__, 0, Ray(origin=(0,0,1), direction=(0,0,1)))
+        self.assertBumps(rc, rc.reset_length, 1.0)
+        self.assertBumps(rc, setattr, rc, "wavelengths", [1.0])
+        self.assertBumps(rc, rc.clear_ray_list)
+        
+        #Reading the rays doesn't change the version
+        version = gc.version
+        gc.base_rays.origin, gc.copy_as_array(), gc.as_array()
+        self.assertEqual(gc.version, version)
+        
+    def test_trace(self):
+        #The trace sets the lengths of the input gausslets
+        gc = self.gausslets
+        version = gc.version
+        trace_gausslet(gc, [], [], max_length=10.0)
+        self.assertGreater(gc.version, version)
+        
+    def test_library_writes(self):
+        #Library code writing through as_array() bumps the version
+        from raypier.core.tracer import CoherenceSorter
+        from raypier.core.parallel import split_wavelengths, merge_generations
+        
+        gc = self.gausslets
+        self.assertBumps(gc, CoherenceSorter(), gc)
+        
+        rays = RayCollection.from_array(numpy.ascontiguousarray(gc.copy_as_array()['base_ray']))
+        rays.wavelengths = gc.wavelengths
+        slices = split_wavelengths(rays, 1)
+        generations = [[RayCollection.from_array(data)] for data, wl, idx, offset in slices]
+        versions = [g[0].version for g in generations]
+        self.assertBumps(rays, merge_generations, rays, slices, generations)
+        self.assertGreater(generations[0][0].version, versions[0])
+        
+    def test_gausslet_modes(self):
+        gc = self.gausslets
+        rays, modes = gausslet_modes(gc)
+        self.assertIs(gausslet_modes(gc)[1], modes)
+        self.assertIsNot(gausslet_modes(gc, blending=2.0)[1], modes)
+        #Every EFieldSummation of the collection shares the modes
+        self.assertIs(EFieldSummation(gc).modes, modes)
+        self.assertIs(EFieldSummation(gc, tolerance=1e-3).base_rays, rays)
+        
+        E = eval_Efield_from_gausslets(gc, self.points)
+        self.assertIs(gausslet_modes(gc)[1], modes)
+        
+        #A modification clears the cache
+        gc.config_parabasal_rays(numpy.asarray(gc.wavelengths), 0.8, 0.0)
+        self.assertIsNot(gausslet_modes(gc)[1], modes)
+        E2 = eval_Efield_from_gausslets(gc, self.points)
+        copy = GaussletCollection.from_array(gc.copy_as_array())
+        copy.wavelengths = gc.wavelengths
+        self.assertTrue(numpy.allclose(E2, eval_Efield_from_gausslets(copy, self.points)))
+        self.assertFalse(numpy.allclose(E2, E))
+        
+        #As must modifications through the live array (with touch())
+        gc.as_array()['base_ray']['E1_amp'] *= 2
+        self.assertTrue(numpy.allclose(eval_Efield_from_gausslets(gc, self.points), E2))
+        gc.touch()
+        self.assertTrue(numpy.allclose(eval_Efield_from_gausslets(gc, self.points), 2*E2))
+        
+    def test_ray_modes(self):
+        from raypier.core.ctracer import ray_dtype
+        #A 7x7 grid of rays, with neighbours as in RayFieldSource
+        n = 7
+        x, y = numpy.meshgrid(numpy.linspace(-2, 2, n), numpy.linspace(-2, 2, n))
+        data = numpy.zeros(n*n, dtype=ray_dtype)
+        data['origin'][:,0] = x.ravel()
+        data['origin'][:,1] = y.ravel()
+        data['direction'] = (0,0,1)
+        data['E_vector'] = (1,0,0)
+        data['E1_amp'] = 1.0
+        data['refractive_index'] = 1.0
+        data['length'] = numpy.inf
+        rays = RayCollection.from_array(data)
+        label = numpy.arange(n*n).reshape(n, n)
+        neighbours = numpy.full((n, n, 6), -1, 'i')
+        neighbours[1:,:,3] = label[:-1,:]
+        neighbours[:-1,:,0] = label[1:,:]
+        neighbours[:,1:,4] = label[:,:-1]
+        neighbours[:,:-1,1] = label[:,1:]
+        neighbours[1:,:-1,2] = label[:-1,1:]
+        neighbours[:-1,1:,5] = label[1:,:-1]
+        rays.neighbours = neighbours.reshape(-1,6)
+        wavelengths = numpy.array([1.0])
+        E = eval_Efield_from_rays(rays, self.points, wavelengths)
+        version, cache = rays.mode_cache
+        self.assertEqual(version, rays.version)
+        self.assertEqual(len(cache), 1)
+        eval_Efield_from_rays(rays, self.points, wavelengths, time_ps=0.1)
+        self.assertEqual(len(cache), 1)
+        eval_Efield_from_rays(rays, self.points, wavelengths, exit_pupil_offset=10.0)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(numpy.allclose(eval_Efield_from_rays(rays, self.points, wavelengths), E))
+        
+    def test_efield_plane(self):
+        from raypier.tracer import RayTraceModel
+        from raypier.fields import EFieldPlane
+        
+        field = EFieldPlane(centre=(0,0,5), direction=(0,0,1), width=2.0, height=2.0, size=9,
+                            gen_idx=0)
+        model = RayTraceModel(sources=[CollimatedGaussletSource(origin=(0,0,0), 
+                                          direction=(0,0,1), radius=3., resolution=5, 
+                                          wavelength=1.0, beam_waist=5.0, E_vector=(1,0,0))], 
+                              probes=[field])
+        field.evaluate(model.sources)
+        rays = model.sources[0].traced_rays[0]
+        cache = rays.mode_cache
+        self.assertIsNotNone(cache)
+        field.time_ps = 0.2
+        field.size = 11
+        self.assertIs(rays.mode_cache, cache)
+        self.assertEqual(field.E_field.shape, (11, 11, 3))
+
+
+if __name__=="__main__":
+    unittest.main()
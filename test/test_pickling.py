@@ -0,0 +1,125 @@
+
+import unittest
+import pickle
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.gausslet_sources import CollimatedGaussletSource
+from raypier.dispersion import NondispersiveCurve
+from raypier.core.ctracer import CompiledScene, RayCollection, GaussletCollection, \
+        GeometricRayCollection, Transform, Ray
+from raypier.core.cfaces import CircularFace, DistortionFace, ShapedSphericalFace
+from raypier.core.cmaterials import CoatedDispersiveMaterial
+from raypier.core.cshapes import CircleShape, RectangleShape
+from raypier.core.cdistortions import ZernikeDistortion
+from raypier.core.tracer import trace_rays
+
+
+def roundtrip(obj, protocol=pickle.HIGHEST_PROTOCOL):
+    return pickle.loads(pickle.dumps(obj, protocol=protocol))
+
+
+class TestPickling(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_core_objects(self):
+        t = roundtrip(Transform(rotation=[[0,1,0],[-1,0,0],[0,0,1]], translation=(1,2,3)))
+        self.assertEqual(t.translation, (1,2,3))
+        self.assertEqual(t.rotation[0], [0,1,0])
+
+        ray = roundtrip(Ray(origin=(1,2,3), direction=(0,0,1), E1_amp=1j))
+        self.assertEqual(ray.origin, (1,2,3))
+        self.assertEqual(ray.E1_amp, 1j)
+
+        shape = roundtrip(CircleShape(radius=2.0) & ~RectangleShape(width=1.0, height=1.0))
+        self.assertTrue(shape.point_inside(1.5, 0.0))
+        self.assertFalse(shape.point_inside(0.2, 0.0))
+
+        mat = CoatedDispersiveMaterial(dispersion_inside=NondispersiveCurve(1.6),
+                                       coating_thickness=0.2)
+        mat.wavelengths = numpy.array([0.5, 0.8])
+        mat2 = roundtrip(mat)
+        self.assertEqual(mat2.coating_thickness, 0.2)
+        self.assertTrue(isinstance(mat2.dispersion_inside, NondispersiveCurve))
+        self.assertTrue(numpy.allclose(mat2.n_inside, mat.n_inside))
+
+        face = CircularFace(material=mat)
+        face.diameter = 5.0
+        face.offset = 0.3
+        face2 = roundtrip(face)
+        self.assertEqual((face2.diameter, face2.offset), (5.0, 0.3))
+        self.assertTrue(face2.owner is None)
+
+        base = ShapedSphericalFace(curvature=20.0, shape=CircleShape(radius=4.0))
+        distortion = ZernikeDistortion(unit_radius=4.0, j5=0.01, j7=-0.002)
+        face = DistortionFace(base_face=base, distortion=distortion)
+        face2 = roundtrip(face)
+        self.assertEqual(face2.distortion.unit_radius, 4.0)
+        self.assertEqual([face2.distortion[i] for i in range(2)],
+                         [distortion[i] for i in range(2)])
+        p1, p2 = (0.5,1.0,-10), (0.6,0.9,10)
+        self.assertEqual(face2.intersect(p1, p2, 1), face.intersect(p1, p2, 1))
+
+    def test_scene(self):
+        expected, faces = trace_rays(self.rays, self.face_lists)
+        scene = roundtrip(CompiledScene(self.face_lists, face_major=True))
+        self.assertTrue(scene.face_major)
+        self.assertTrue(all(f.owner is None for f in scene.all_faces))
+        rays = roundtrip(self.rays)
+        traced, faces2 = trace_rays(rays, scene)
+        self.assertEqual([r.copy_as_array().tobytes() for r in expected],
+                         [r.copy_as_array().tobytes() for r in traced])
+        self.assertEqual([f.count for f in faces], [f.count for f in faces2])
+
+    def test_collections(self):
+        geo = GeometricRayCollection.from_rays(self.rays)
+        src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                       resolution=5, wavelength=1.0, beam_waist=10.0)
+        gausslets = src.input_rays
+        for rays in (self.rays, geo, gausslets, RayCollection(5)):
+            for protocol in (2, 5):
+                copy = roundtrip(rays, protocol)
+                self.assertEqual(type(copy), type(rays))
+                self.assertEqual(copy.copy_as_array().tobytes(), rays.copy_as_array().tobytes())
+        self.assertTrue((roundtrip(geo).wavelengths == geo.wavelengths).all())
+
+        #With protocol 5, the ray data (and wavelengths) can go out-of-band, and
+        #the rays adopt their buffer on loading
+        buffers = []
+        data = pickle.dumps(self.rays, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual(len(buffers), 2)
+        self.assertLess(len(data), 1000)
+        raw = [bytearray(b.raw()) for b in buffers]
+        copy = pickle.loads(data, buffers=raw)
+        copy.as_array()['length'] = 3.0
+        self.assertTrue((numpy.frombuffer(raw[0], dtype=copy.as_array().dtype)['length'] == 3.0).all())
+
+    def test_shared_memory(self):
+        for rays in (self.rays, GeometricRayCollection.from_rays(self.rays)):
+            shm = rays.to_shared_memory()
+            try:
+                shared = type(rays).attach(shm.name, len(rays), rays.wavelengths)
+                self.assertEqual(shared.copy_as_array().tobytes(), rays.copy_as_array().tobytes())
+                self.assertTrue((shared.wavelengths == rays.wavelengths).all())
+                #The collection maps the block, without copying
+                shared.as_array()['length'] = 7.0
+                other = type(rays).attach(shm.name, len(rays))
+                self.assertTrue((other.length == 7.0).all())
+                del shared, other
+            finally:
+                shm.close()
+                shm.unlink()
+
+
+if __name__=="__main__":
+    unittest.main()
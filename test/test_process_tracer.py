@@ -0,0 +1,123 @@
+
+import unittest
+import threading
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.gausslet_sources import BroadbandGaussletSource
+from raypier.tracer import RayTraceModel
+from raypier.core.ctracer import CompiledScene
+from raypier.core.tracer import trace_rays
+from raypier.core.parallel import ProcessTracer, split_wavelengths, default_start_method
+
+
+class TestProcessTracer(unittest.TestCase):
+    def setUp(self):
+        self.optics = [PlanoConvexLens(centre=(x,0,z), direction=(0,0,1), diameter=10.,
+                                       curvature=20., n_inside=1.5, CT=3.)
+                       for x in (-6,6) for z in (20,40)]
+        self.optics.append(PECMirror(centre=(0,0,70), direction=(0,0.3,-1), diameter=40.))
+        self.scene = CompiledScene([o.faces for o in self.optics])
+
+    def check_same(self, expected, traced):
+        self.assertEqual(len(expected), len(traced))
+        for a, b in zip(expected, traced):
+            self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+            self.assertTrue((a.wavelengths == b.wavelengths).all())
+        for parent, child in zip(traced[:-1], traced[1:]):
+            self.assertIs(child.parent, parent)
+
+    def test_wavelength_slices(self):
+        src = BroadbandGaussletSource(origin=(0,0,0), direction=(0,0,1), number=7,
+                                      wavelength=1.0, wavelength_extent=0.1, 
+                                      beam_waist=5000.0)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        data = rays.copy_as_array()
+        expected, faces = trace_rays(rays, self.scene)
+        counts = [f.count for f in faces]
+        
+        slices = split_wavelengths(rays, 3)
+        self.assertEqual([len(s[1]) for s in slices], [3, 2, 2])
+        self.assertEqual(sorted(numpy.concatenate([s[2] for s in slices])), 
+                         list(range(len(rays))))
+        
+        with ProcessTracer(self.scene, processes=2) as tracer:
+            for n in (1, 3, 7):
+                rays.as_array()[:] = data
+                traced, faces = tracer.trace(rays, wavelength_slices=n)
+                self.assertIs(traced[0], rays)
+                self.check_same(expected, traced)
+                self.assertEqual(counts, [f.count for f in faces])
+
+    def test_sources(self):
+        sources = [ParallelRaySource(origin=(x,0,0), direction=(0,0,1), radius=4.,
+                                     rings=5, number=10, wavelength=w) 
+                   for x, w in ((-6, 0.8), (6, 1.2))]
+        inputs = []
+        for src in sources:
+            rays = src.input_rays
+            rays.wavelengths = numpy.array(src.wavelength_list)
+            inputs.append(rays.copy_as_array())
+        expected = []
+        for src in sources:
+            traced, faces = trace_rays(src.input_rays, self.scene)
+            expected.append(traced)
+        for src, data in zip(sources, inputs):
+            src.input_rays.as_array()[:] = data
+        with ProcessTracer([o.faces for o in self.optics], processes=2) as tracer:
+            traced = tracer.trace_sources([s.input_rays for s in sources])
+        for a, b in zip(expected, traced):
+            self.check_same(a, b)
+        self.assertRaises(ValueError, tracer.trace_sources, [sources[0].input_rays])
+
+    def test_spawn(self):
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=5, number=10)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        data = rays.copy_as_array()
+        expected, faces = trace_rays(rays, self.scene)
+        rays.as_array()[:] = data
+        #The scene is pickled to spawned workers
+        with ProcessTracer(self.scene, processes=2, start_method="spawn") as tracer:
+            traced, faces = tracer.trace(rays)
+        self.check_same(expected, traced)
+        self.assertRaises(ValueError, ProcessTracer, self.scene, start_method="bad")
+        
+        #Workers are not forked from threads other than the main thread
+        methods = []
+        thread = threading.Thread(target=lambda: methods.append(default_start_method()))
+        thread.start()
+        thread.join()
+        self.assertEqual(methods, ["spawn"])
+        
+    def test_model(self):
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=5, number=10, max_ray_len=200.)
+        model = RayTraceModel(optics=self.optics, sources=[src], num_processes=2)
+        model.trace_all()
+        traced = list(src.traced_rays)
+        expected, faces = trace_rays(src.input_rays, [o.faces for o in self.optics],
+                                     recursion_limit=model.recursion_limit,
+                                     max_length=src.max_ray_len)
+        self.check_same(expected, traced)
+        
+        #The workers are kept until the optics change
+        try:
+            tracer = model._process_tracer[0]
+            src.max_ray_len = 150.
+            self.assertIs(model._process_tracer[0], tracer)
+            self.assertEqual(max(r.length.max() for r in src.traced_rays[-1:]), 150.)
+            self.optics[-1].centre = (0,0,75)
+            self.assertIsNot(model._process_tracer[0], tracer)
+            self.assertIsNone(tracer.pool)
+        finally:
+            model.close_process_tracer()
+        self.assertIsNone(model._process_tracer)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+
+import unittest
+import numpy
+
+from raypier.core.pulses import PulseSynthesis, mode_frequencies
+from raypier.core.cfields import sum_gaussian_modes_times
+from raypier.core.fields import EFieldSummation
+from raypier.gausslet_sources import BroadbandGaussletSource
+
+
+def make_source(**kwds):
+    return BroadbandGaussletSource(origin=(0,0,0), direction=(0,0,1), E_vector=(1,0,0),
+                                   number=16, wavelength=1.0, wavelength_extent=0.03,
+                                   bandwidth_nm=10.0, beam_waist=5.0, working_dist=0.0, **kwds)
+
+
+class TestPulseSynthesis(unittest.TestCase):
+    def setUp(self):
+        self.gausslets = make_source().input_rays
+        self.summation = EFieldSummation(self.gausslets)
+        self.points = numpy.column_stack([numpy.linspace(-1, 1, 12), numpy.zeros(12), 
+                                          numpy.full(12, 3.0)]).reshape(3,4,3)
+        self.pulse = PulseSynthesis(self.summation, self.points)
+        
+    def test_frequencies(self):
+        wl = self.summation.wavelengths
+        freqs = mode_frequencies(self.summation.base_rays, wl)
+        self.assertTrue(numpy.allclose(freqs, 2*numpy.pi*299.792458/wl))
+        
+    def test_field(self):
+        times = numpy.linspace(-0.3, 0.3, 11)
+        E = self.pulse.field(times)
+        self.assertEqual(E.shape, (11, 3, 4, 3))
+        expected = sum_gaussian_modes_times(self.summation.base_rays, self.summation.modes,
+                                            self.summation.wavelengths, 
+                                            self.points.reshape(-1,3), times)
+        scale = numpy.abs(expected).max()
+        self.assertTrue(numpy.allclose(E.reshape(11,-1,3), expected, rtol=0, atol=1e-9*scale))
+        
+        pulse = PulseSynthesis.from_gausslets(self.gausslets, self.points)
+        self.assertTrue(numpy.allclose(pulse.field(times), E))
+        
+        #The envelope only differs by the carrier phase
+        env = self.pulse.field(times, carrier=False)
+        self.assertTrue(numpy.allclose(numpy.abs(env), numpy.abs(E)))
+        
+    def test_field_fft(self):
+        times, E = self.pulse.field_fft(oversample=3)
+        self.assertEqual(len(times), 48)
+        self.assertEqual(E.shape, (48, 3, 4, 3))
+        self.assertAlmostEqual(times.mean() + (times[1]-times[0])/2, 0.0)
+        direct = self.pulse.field(times)
+        scale = numpy.abs(direct).max()
+        self.assertTrue(numpy.allclose(E, direct, rtol=0, atol=1e-9*scale))
+        
+        times, E = self.pulse.field_fft(t_start=0.1, carrier=False, amplitude=lambda w: 1+w**2)
+        direct = self.pulse.field(times, carrier=False, amplitude=lambda w: 1+w**2)
+        self.assertAlmostEqual(times[0], 0.1)
+        self.assertTrue(numpy.allclose(E, direct, rtol=0, atol=1e-9*numpy.abs(direct).max()))
+        
+    def test_spectral_phase(self):
+        #A linear spectral phase delays the pulse
+        tau = 0.2
+        times = numpy.linspace(-0.5, 0.5, 21)
+        E = self.pulse.field(times)
+        delayed = self.pulse.field(times + tau, phase=lambda w: w*tau)
+        self.assertTrue(numpy.allclose(numpy.abs(delayed), numpy.abs(E)))
+        
+        #Amplitude weights, per wavelength
+        W = len(self.summation.wavelengths)
+        amplitude = numpy.zeros(W)
+        amplitude[3] = 2.0
+        E = self.pulse.field([0.0], amplitude=amplitude)
+        self.assertTrue(numpy.allclose(E[0].reshape(-1,3), 2*self.pulse.spectrum[3]))
+        
+    def test_non_uniform(self):
+        gausslets = make_source(uniform_deltaf=False).input_rays
+        pulse = PulseSynthesis.from_gausslets(gausslets, self.points)
+        self.assertRaises(ValueError, pulse.field_fft)
+        self.assertEqual(pulse.field([0.0, 0.1]).shape, (2, 3, 4, 3))
+
+
+if __name__=="__main__":
+    unittest.main()
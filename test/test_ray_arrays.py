@@ -0,0 +1,63 @@
+
+import unittest
+import random
+import numpy
+
+from raypier.core.ctracer import Ray, RayCollection, GaussletCollection, \
+        ray_dtype, gausslet_dtype
+
+
+def make_ray():
+    rnd = random.random
+    return Ray(origin=(rnd(), rnd(), rnd()),
+               direction=(rnd(), rnd(), rnd()),
+               E1_amp = (rnd() + 1j*rnd()))
+
+
+class TestRayCollectionArray(unittest.TestCase):
+    def test_live_array(self):
+        rc = RayCollection(2)
+        for i in range(2):
+            rc.add_ray(make_ray())
+        data = rc.as_array()
+        self.assertEqual(data.dtype, ray_dtype)
+        data['length'] = 3.0
+        self.assertEqual(rc[1].length, 3.0)
+        self.assertTrue(numpy.shares_memory(rc.origin, data))
+        self.assertFalse(rc.origin.flags.writeable)
+        self.assertTrue(numpy.alltrue(rc.E1_amp == rc.copy_as_array()['E1_amp']))
+        
+        ### Growing the collection leaves the old view intact
+        for i in range(10):
+            rc.add_ray(make_ray())
+        self.assertEqual(len(data), 2)
+        self.assertTrue(numpy.alltrue(data['length']==3.0))
+        self.assertEqual(len(rc.as_array()), 12)
+        self.assertEqual(rc.termination.shape, (12,3))
+
+    def test_adopt_array(self):
+        a = numpy.zeros(5, dtype=ray_dtype)
+        rc = RayCollection.from_array(a, copy=False)
+        a['length'] = 2.0
+        self.assertEqual(rc[4].length, 2.0)
+        rc.add_ray(make_ray())
+        self.assertEqual(len(rc), 6)
+        self.assertEqual(rc[4].length, 2.0)
+        self.assertRaises(ValueError, RayCollection.from_array, a[::2], copy=False)
+
+
+class TestGaussletCollectionArray(unittest.TestCase):
+    def test_live_array(self):
+        data = numpy.zeros(4, dtype=gausslet_dtype)
+        data['para_rays']['length'] = numpy.arange(24).reshape(4,6)
+        gc = GaussletCollection.from_array(data, copy=False)
+        self.assertTrue(numpy.shares_memory(gc.as_array(), data))
+        self.assertEqual(gc.para_origin.shape, (4,6,3))
+        self.assertEqual(gc.base_rays.origin.shape, (4,3))
+        data['base_ray']['length'] = 5.0
+        self.assertTrue(numpy.alltrue(gc.base_rays.length==5.0))
+        self.assertTrue(numpy.alltrue(gc.para_termination[...,2]==0.0))
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core import ctracer
+from raypier.core.ctracer import RayCollection, GaussletCollection, CompiledScene
+from raypier.core.tracer import trace_rays
+
+
+class TestRayPool(unittest.TestCase):
+    def setUp(self):
+        self.limit = ctracer.pool_stats()['limit']
+        ctracer.clear_pool()
+
+    def tearDown(self):
+        ctracer.set_pool_limit(self.limit)
+
+    def test_reuse(self):
+        rc = RayCollection(1000)
+        self.assertGreaterEqual(rc.max_size, 1000)
+        del rc
+        held = ctracer.pool_stats()
+        self.assertGreater(held['bytes'], 0)
+
+        gc = GaussletCollection(500)
+        rc = RayCollection(1000)
+        stats = ctracer.pool_stats()
+        self.assertEqual(stats['hits'], held['hits']+1)
+        self.assertEqual(stats['bytes'], 0)
+
+        ctracer.set_pool_limit(0)
+        del rc, gc
+        self.assertEqual(ctracer.pool_stats()['bytes'], 0)
+
+    def test_adopted_array(self):
+        data = numpy.zeros(10, dtype=ctracer.ray_dtype)
+        rc = RayCollection.from_array(data, copy=False)
+        held = ctracer.pool_stats()['bytes']
+        del rc
+        self.assertEqual(ctracer.pool_stats()['bytes'], held)
+
+    def test_repeated_trace(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        scene = CompiledScene([lens.faces, mirror.faces])
+
+        expected, faces = trace_rays(rays, scene)
+        expected = [r.copy_as_array().tobytes() for r in expected]
+        for i in range(3):
+            traced, faces = trace_rays(rays, scene)
+            self.assertEqual(expected, [r.copy_as_array().tobytes() for r in traced])
+            #Children are allocated from the branching of the previous trace
+            for parent, child in zip(traced[:-1], traced[1:]):
+                self.assertGreaterEqual(child.max_size, len(child))
+                self.assertLessEqual(child.max_size, 2*(int(1.1*len(child))+1) + 64)
+            del traced
+        self.assertGreater(ctracer.pool_stats()['hits'], 0)
+
+
+if __name__=="__main__":
+    unittest.main()
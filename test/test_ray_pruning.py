@@ -0,0 +1,72 @@
+
+import unittest
+import numpy
+
+from raypier.achromats import Singlet
+from raypier.dispersion import NondispersiveCurve
+from raypier.sources import ParallelRaySource
+from raypier.core.ctracer import CompiledScene
+from raypier.core.tracer import trace_rays, EnergyReport
+
+
+class TestRayPruning(unittest.TestCase):
+    def setUp(self):
+        optics = [Singlet(centre=(0,0,z), direction=(0,0,1),
+                          dispersion=NondispersiveCurve(1.5),
+                          dispersion_coating=NondispersiveCurve(1.25)) for z in (20,40,60)]
+        for o in optics:
+            for m in (o._material1, o._material2):
+                m.reflection_threshold = 1e-12
+                m.transmission_threshold = 1e-12
+        self.face_lists = [o.faces for o in optics]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=5.,
+                                rings=4, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_power_cutoff(self):
+        scene = CompiledScene(self.face_lists, wavelengths=self.rays.wavelengths)
+        full, faces = trace_rays(self.rays, scene, recursion_limit=3)
+        children = full[1].copy_as_array()
+        power = full[1].power
+
+        cutoff = 1e-3*self.rays.power.max()
+        scene.set_pruning(min_power=cutoff)
+        self.rays.reset_length(100.0)
+        pruned = scene.trace(self.rays)
+        kept = children[power >= cutoff]
+        for name in ('origin', 'direction', 'E1_amp', 'E2_amp', 'parent_idx', 'ray_type_id'):
+            self.assertTrue((pruned.copy_as_array()[name] == kept[name]).all())
+        self.assertEqual(scene.pruned['n_pruned'], (power < cutoff).sum())
+        self.assertAlmostEqual(scene.pruned['pruned_power'], power[power < cutoff].sum())
+
+    def test_energy_report(self):
+        full, faces = trace_rays(self.rays, self.face_lists, recursion_limit=8)
+        report = EnergyReport()
+        pruned, faces = trace_rays(self.rays, self.face_lists, recursion_limit=8,
+                                   min_power=1e-4, energy_report=report)
+        self.assertLess(sum(r.n_rays for r in pruned), sum(r.n_rays for r in full))
+        self.assertAlmostEqual(report.input_power, self.rays.power.sum())
+        self.assertEqual(len(report.generations), len(pruned))
+        self.assertGreater(report.pruned_power, 0.0)
+        self.assertLess(report.relative_error, 1e-2)
+        self.assertEqual(report.discarded_power, report.pruned_power)
+
+    def test_russian_roulette(self):
+        kwds = dict(recursion_limit=8, roulette_power=1e-2, seed=3)
+        report = EnergyReport()
+        first, faces = trace_rays(self.rays, self.face_lists, energy_report=report, **kwds)
+        self.assertGreater(report.n_killed, 0)
+        cutoff = 1e-2*self.rays.power.max()
+        for rays in first[1:]:
+            self.assertTrue((rays.power >= cutoff*(1-1e-9)).all())
+        for num_threads in (1, 2):
+            second, faces = trace_rays(self.rays, self.face_lists, num_threads=num_threads,
+                                       **kwds)
+            self.assertEqual(len(first), len(second))
+            for a, b in zip(first, second):
+                self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+
+
+if __name__=="__main__":
+    unittest.main()
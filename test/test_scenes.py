@@ -0,0 +1,48 @@
+
+import unittest
+import io
+import json
+
+from benchmarks import run_scenes
+from benchmarks.scenes import SCENES
+
+
+class TestSceneBenchmarks(unittest.TestCase):
+    def test_run(self):
+        out = io.StringIO()
+        report = run_scenes.run(["achromat", "cpc"], [0.5, 1], [1], label="test", out=out)
+        #The report is JSON serialisable
+        report = json.loads(json.dumps(report))
+        self.assertEqual(report["label"], "test")
+        self.assertIn("numpy", report["build"])
+        results = report["results"]
+        self.assertEqual([(r["scene"], r["density"]) for r in results],
+                         [("achromat", 0.5), ("achromat", 1), ("cpc", 0.5), ("cpc", 1)])
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+        for r in results:
+            self.assertGreater(r["n_rays"], 0)
+            self.assertGreater(r["trace_time"], 0)
+            self.assertGreater(r["ray_bytes"], 0)
+            self.assertGreaterEqual(r["peak_bytes"], r["ray_bytes"])
+        #More rays at a higher density
+        self.assertGreater(results[1]["n_rays"], results[0]["n_rays"])
+
+        times = run_scenes.flatten_times(report)
+        self.assertEqual(len(times), 4*len(run_scenes.TIMES))
+        self.assertIn("cpc(density=1, num_threads=1).trace_time", times)
+
+    def test_decomposition(self):
+        result = run_scenes.measure("decompose_position", 0.5)
+        self.assertGreater(result["decomp_time"], 0)
+        self.assertGreater(result["field_time"], 0)
+        self.assertEqual(len(result["field_times"]), 1)
+
+    def test_scenes_build(self):
+        for name, make_model in SCENES.items():
+            model = make_model(1)
+            self.assertTrue(model.sources, name)
+            self.assertTrue(model.optics, name)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core.tracer import trace_rays, trace_sequence
+
+REFL_RAY = 1
+
+
+class TestSequentialTrace(unittest.TestCase):
+    def setUp(self):
+        self.lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                                    curvature=40., n_inside=1.5, CT=5.)
+        self.mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+        self.sequence = [self.lens.faces.faces[0], self.lens.faces.faces[1], 
+                         self.mirror.faces]
+
+    def test_matches_non_sequential(self):
+        expected, faces = trace_rays(self.rays, [self.lens.faces, self.mirror.faces])
+        counts = [f.count for f in faces]
+        for num_threads in (1, 2):
+            traced, faces = trace_sequence(self.rays, self.sequence, num_threads=num_threads)
+            self.assertEqual(counts, [f.count for f in faces])
+            self.assertEqual(len(expected), len(traced))
+            for a, b in zip(expected, traced):
+                self.assertEqual(a.copy_as_array().tobytes(), b.copy_as_array().tobytes())
+
+    def test_branches(self):
+        for m in (self.lens.faces.faces[0].material, self.lens.faces.faces[1].material):
+            m.reflection_threshold = 1e-12
+        full, faces = trace_rays(self.rays, [self.lens.faces, self.mirror.faces], 
+                                 recursion_limit=2)
+        self.assertTrue((full[1].ray_type_id & REFL_RAY).any())
+        transmitted = full[1].copy_as_array()
+        transmitted = transmitted[(transmitted['ray_type_id'] & REFL_RAY) == 0]
+        
+        traced, faces = trace_sequence(self.rays, self.sequence)
+        self.assertEqual(len(traced), 4)
+        a = traced[1].copy_as_array()
+        for name in ('origin', 'direction', 'E1_amp', 'E2_amp', 'parent_idx'):
+            self.assertTrue((a[name] == transmitted[name]).all())
+        
+        #The reflected ghost misses the rest of the sequence
+        traced, faces = trace_sequence(self.rays, [(self.sequence[0], "reflected")] + 
+                                       self.sequence[1:])
+        self.assertEqual(len(traced), 2)
+        self.assertTrue((traced[1].ray_type_id & REFL_RAY).all())
+        self.assertEqual(len(traced[1]), len(self.rays))
+        self.assertRaises(ValueError, trace_sequence, self.rays, [(self.sequence[0], "both")])
+
+    def test_vignetting(self):
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=8.)
+        traced, faces = trace_sequence(self.rays, self.sequence[:2] + [mirror.faces])
+        missed = traced[2].end_face_idx >= len(faces)
+        self.assertTrue(missed.any())
+        self.assertFalse(missed.all())
+        self.assertEqual(len(traced[3]), (~missed).sum())
+        self.assertEqual(faces[-1].count, len(traced[3]))
+        self.assertTrue((traced[3].parent_idx == numpy.flatnonzero(~missed)).all())
+
+
+if __name__=="__main__":
+    unittest.main()
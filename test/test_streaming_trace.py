@@ -0,0 +1,76 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.gausslet_sources import CollimatedGaussletSource
+from raypier.core.tracer import trace_rays, iter_trace_rays, EndFaceSelector
+
+
+class TestStreamingTrace(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.mirror = mirror
+        self.face_lists = [lens.faces, mirror.faces]
+        for fl in self.face_lists:
+            fl.sync_transforms()
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_generations_match(self):
+        full, faces = trace_rays(self.rays, self.face_lists)
+        full = [r.copy_as_array() for r in full]
+        counts = [f.count for f in faces]
+        streamed = list(iter_trace_rays(self.rays, self.face_lists))
+        self.assertEqual(len(full), len(streamed))
+        for a, b in zip(full, streamed):
+            self.assertEqual(a.tobytes(), b.copy_as_array().tobytes())
+        for rays in streamed[1:]:
+            self.assertIsNone(rays.parent)
+        self.assertEqual(counts, [f.count for f in faces])
+
+    def test_end_face_selector(self):
+        full, faces = trace_rays(self.rays, self.face_lists)
+        mirror_idx = [f.idx for f in self.mirror.faces.faces]
+        expected = [r.copy_as_array() for r in full]
+        expected = [a[numpy.isin(a['end_face_idx'], mirror_idx)] for a in expected]
+        expected = [a for a in expected if len(a)]
+        self.assertTrue(expected)
+
+        selector = EndFaceSelector(self.mirror.faces.faces)
+        selected, faces = trace_rays(self.rays, self.face_lists, on_generation=selector)
+        self.assertEqual(len(selected), len(expected))
+        for a, b in zip(expected, selected):
+            self.assertEqual(a.tobytes(), b.copy_as_array().tobytes())
+
+        gen = selector.generations[-1]
+        idx = selector.indices[-1][0]
+        chain = selector.ancestry(gen, idx)
+        self.assertEqual(len(chain), gen+1)
+        self.assertEqual(chain[-1], idx)
+        ray = full[gen][idx]
+        for g in range(gen, 0, -1):
+            self.assertEqual(ray.parent_idx, chain[g-1])
+            ray = full[g-1][chain[g-1]]
+
+    def test_gausslet_selector(self):
+        src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                       resolution=10, wavelength=1.0, beam_waist=10.0)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        selector = EndFaceSelector(self.mirror.faces.faces)
+        selected, faces = trace_rays(rays, self.face_lists, on_generation=selector)
+        self.assertTrue(selected)
+        mirror_idx = set(f.idx for f in self.mirror.faces.faces)
+        for gc in selected:
+            self.assertTrue(all(i in mirror_idx for i in gc.base_rays.end_face_idx))
+
+
+if __name__=="__main__":
+    unittest.main()
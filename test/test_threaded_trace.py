@@ -0,0 +1,48 @@
+
+import unittest
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.gausslet_sources import CollimatedGaussletSource
+from raypier.core.tracer import trace_rays
+
+
+class TestThreadedTrace(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        for fl in self.face_lists:
+            fl.sync_transforms()
+
+    def compare_traces(self, rays):
+        serial, faces = trace_rays(rays, self.face_lists)
+        serial = [r.copy_as_array() for r in serial]
+        counts = [f.count for f in faces]
+        for num_threads in (2, 0):
+            threaded, faces = trace_rays(rays, self.face_lists, num_threads=num_threads)
+            self.assertEqual(len(serial), len(threaded))
+            for a, b in zip(serial, threaded):
+                self.assertEqual(a.tobytes(), b.copy_as_array().tobytes())
+            self.assertEqual(counts, [f.count for f in faces])
+
+    def test_ray_collection(self):
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=20, number=20)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        self.compare_traces(rays)
+
+    def test_gausslet_collection(self):
+        src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                       resolution=20, wavelength=1.0, beam_waist=10.0)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        self.compare_traces(rays)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+
+import unittest
+import asyncio
+import threading
+import numpy
+from traits import trait_notifiers
+
+from raypier.core.executor import TraceExecutor
+from raypier.core.tracer import trace_rays, TraceMonitor, TraceCancelled
+from raypier.sources import ParallelRaySource
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.tracer import RayTraceModel
+
+
+class TestTraceExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = TraceExecutor()
+        
+    def tearDown(self):
+        self.executor.shutdown()
+        
+    def test_latest_request_wins(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def make_job(name):
+            def job(monitor):
+                calls.append(name)
+                if name == "a":
+                    started.set()
+                    while not release.wait(0.001):
+                        monitor.check()
+                return name
+            return job
+        fa = self.executor.submit(make_job("a"))
+        self.assertTrue(started.wait(5))
+        fb = self.executor.submit(make_job("b"))
+        fc = self.executor.submit(make_job("c"))
+        self.assertEqual([f.result(5) for f in (fa, fb, fc)], ["c", "c", "c"])
+        #"a" was cancelled while running, "b" was replaced before it started
+        self.assertEqual(calls, ["a", "c"])
+        self.assertTrue(self.executor.wait(5))
+        self.assertFalse(self.executor.busy)
+        
+    def test_cancel(self):
+        started = threading.Event()
+        def job(monitor):
+            started.set()
+            while True:
+                monitor.check()
+                threading.Event().wait(0.001)
+        future = self.executor.submit(job)
+        self.assertTrue(started.wait(5))
+        self.executor.cancel()
+        self.assertTrue(self.executor.wait(5))
+        self.assertTrue(future.cancelled())
+        
+    def test_exception(self):
+        def job(monitor):
+            raise ValueError("bad")
+        future = self.executor.submit(job)
+        self.assertRaises(ValueError, future.result, 5)
+        #The executor carries on after a failed job
+        self.assertEqual(self.executor.submit(lambda m: 1).result(5), 1)
+        self.executor.shutdown()
+        self.assertRaises(RuntimeError, self.executor.submit, lambda m: 1)
+        
+        
+def make_model():
+    src = ParallelRaySource(origin=(0,0,-20), direction=(0,0,1), radius=5.0, number=10, 
+                            rings=3)
+    lens = PlanoConvexLens(centre=(0,0,0), direction=(0,0,1), curvature=25.0, 
+                           diameter=20.0, n_inside=1.5)
+    mirror = PECMirror(centre=(0,0,40), direction=(0,1,-1), diameter=30.0)
+    return RayTraceModel(optics=[lens, mirror], sources=[src])
+        
+        
+class TestBackgroundTrace(unittest.TestCase):
+    def test_monitor(self):
+        model = make_model()
+        model.prepare_to_trace()
+        src = model.sources[0]
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        progress = []
+        def on_progress(monitor, generation, rays):
+            progress.append((generation, len(rays)))
+            if generation == 1:
+                monitor.cancel()
+        monitor = TraceMonitor(on_progress)
+        self.assertRaises(TraceCancelled, trace_rays, rays, model.compiled_scene, monitor=monitor)
+        self.assertEqual([g for g, n in progress], [0, 1])
+        self.assertEqual(monitor.n_generations, 2)
+        self.assertEqual(monitor.n_rays, sum(n for g, n in progress))
+        
+        traced, faces = trace_rays(rays, model.compiled_scene, monitor=TraceMonitor())
+        self.assertGreater(len(traced), 2)
+        
+    def test_trace_async(self):
+        reference = make_model()
+        reference.trace_all()
+        expected = [r.copy_as_array() for r in reference.sources[0].traced_rays]
+        
+        model = make_model()
+        model._changed_optics = None
+        progress = []
+        model.on_trait_change(lambda new: progress.append(new), "trace_progress")
+        try:
+            traced = asyncio.run(model.trace_async())
+        finally:
+            model.trace_executor.shutdown()
+        self.assertEqual(len(traced), 1)
+        self.assertEqual([r.copy_as_array().tobytes() for r in traced[0]],
+                         [r.tobytes() for r in expected])
+        self.assertIs(model.sources[0].traced_rays[0], traced[0][0])
+        self.assertEqual([p['generation'] for p in progress], list(range(len(expected))))
+        self.assertEqual({p['source'] for p in progress}, {0})
+        
+    def test_background_requests(self):
+        model = make_model()
+        model.background_trace = True
+        try:
+            model.trace_all()
+            mirror = model.optics[1]
+            for y in numpy.linspace(0, 2, 5):
+                mirror.centre = (0, y, 40)
+            self.assertTrue(model.trace_executor.wait(30))
+            future = model.submit_trace()
+            traced = future.result(30)
+        finally:
+            model.trace_executor.shutdown()
+        #The last trace is of the final mirror position
+        expected = make_model()
+        expected.optics[1].centre = (0, 2, 40)
+        expected.trace_all()
+        self.assertEqual([r.copy_as_array().tobytes() for r in traced[0]],
+                         [r.copy_as_array().tobytes() for r in expected.sources[0].traced_rays])
+
+    def test_applied_in_ui_thread(self):
+        model = make_model()
+        src = model.sources[0]
+        previous = src.traced_rays[0]
+        calls = []
+        trait_notifiers.set_ui_handler(lambda handler, *args, **kwds:
+                                       calls.append((handler, args, kwds)))
+        try:
+            future = model.submit_trace()
+            traced = future.result(30)
+        finally:
+            trait_notifiers.set_ui_handler(None)
+            model.trace_executor.shutdown()
+        #The traced rays are only set by the call dispatched to the GUI thread
+        self.assertIs(src.traced_rays[0], previous)
+        self.assertEqual(len(calls), 1)
+        handler, args, kwds = calls[0]
+        handler(*args, **kwds)
+        self.assertIs(src.traced_rays[0], traced[0][0])
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+
+import unittest
+import threading
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import ParallelRaySource
+from raypier.core import ctracer
+from raypier.core.ctracer import CompiledScene, FaceList, GeometricRayCollection
+from raypier.core.cfaces import AsphericFace
+from raypier.core.cshapes import CircleShape
+from raypier.core.tracer import trace_rays, material_profile
+
+
+class TestTraceProfile(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                rings=10, number=20)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_counters(self):
+        traced, faces, profile = trace_rays(self.rays, self.face_lists, profile=True)
+        self.assertEqual(profile.dtype, ctracer.profile_dtype)
+        self.assertEqual(list(profile['hits']), [f.count for f in faces])
+        self.assertEqual(profile['children'].sum(), sum(len(r) for r in traced[1:]))
+        self.assertTrue((profile['tests'] >= profile['hits']).all())
+        hit = profile['hits'] > 0
+        self.assertTrue((profile['intersect_ns'][hit] > 0).all())
+        self.assertTrue((profile['eval_ns'][hit] > 0).all())
+        self.assertEqual(list(profile['material']), [type(f.material).__name__ for f in faces])
+
+        materials = material_profile(profile)
+        self.assertEqual(materials['faces'].sum(), len(faces))
+        self.assertEqual(materials['hits'].sum(), profile['hits'].sum())
+
+        #The counters are the same with several threads, or for geometric rays
+        scene = CompiledScene(self.face_lists)
+        for rays, num_threads in ((self.rays, 2),
+                                  (GeometricRayCollection.from_rays(self.rays), 1)):
+            traced, faces, profile2 = trace_rays(rays, scene, num_threads=num_threads,
+                                                 profile=True)
+            for name in ('tests', 'hits', 'children'):
+                self.assertEqual(list(profile[name]), list(profile2[name]))
+
+        #A TraceProfile records the counters of several traces
+        counters = ctracer.TraceProfile(len(scene.all_faces))
+        for i in range(2):
+            traced, faces = trace_rays(self.rays, scene, profile=counters)
+        profile2 = counters.results(faces)
+        self.assertEqual(list(profile2['hits']), list(2*profile['hits']))
+
+    def test_concurrent(self):
+        #Traces in several threads each record their own profile
+        expected = trace_rays(self.rays, self.face_lists, profile=True)[2]
+        profiles = []
+        def trace():
+            src = ParallelRaySource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                    rings=10, number=20)
+            rays = src.input_rays
+            rays.wavelengths = numpy.array(src.wavelength_list)
+            for i in range(5):
+                profiles.append(trace_rays(rays, CompiledScene(self.face_lists),
+                                           profile=True)[2])
+        threads = [threading.Thread(target=trace) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(profiles), 15)
+        for profile in profiles:
+            for name in ('tests', 'hits', 'children'):
+                self.assertEqual(list(profile[name]), list(expected[name]))
+
+    def test_iterations(self):
+        face = AsphericFace(curvature=-30.0, conic_const=-0.5, A4=1e-5,
+                            shape=CircleShape(radius=10.0))
+        fl = FaceList()
+        fl.faces = [face]
+        traced, faces, profile = trace_rays(self.rays, [fl], profile=True)
+        self.assertGreater(profile['hits'][0], 0)
+        self.assertGreaterEqual(profile['iterations'][0], profile['tests'][0])
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+
+import unittest
+import json
+import time
+import numpy
+
+from raypier.lenses import PlanoConvexLens
+from raypier.mirrors import PECMirror
+from raypier.sources import HexagonalRayFieldSource
+from raypier.gausslet_sources import CollimatedGaussletSource
+from raypier.core.ctracer import FaceList, GaussletCollection
+from raypier.core.cfaces import CircularFace
+from raypier.core.cmaterials import ResampleGaussletMaterial
+from raypier.core.tracer import trace_rays, iter_trace_rays, retrace_rays, TraceTimeline
+
+
+class TestTraceTimeline(unittest.TestCase):
+    def setUp(self):
+        lens = PlanoConvexLens(centre=(0,0,20), direction=(0,0,1), diameter=25.,
+                               curvature=40., n_inside=1.5, CT=5.)
+        mirror = PECMirror(centre=(0,0,60), direction=(0,0.3,-1), diameter=30.)
+        self.face_lists = [lens.faces, mirror.faces]
+        src = HexagonalRayFieldSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                      resolution=6.0)
+        self.rays = src.input_rays
+        self.rays.wavelengths = numpy.array(src.wavelength_list)
+
+    def test_generations(self):
+        timeline = TraceTimeline()
+        traced, faces = trace_rays(self.rays, self.face_lists, timeline=timeline)
+        gens = timeline.generations
+        self.assertEqual([g['generation'] for g in gens], list(range(len(traced))))
+        self.assertEqual([g['n_rays'] for g in gens], [len(r) for r in traced])
+        self.assertEqual([g['n_children'] for g in gens[:-1]], [len(r) for r in traced[1:]])
+        self.assertEqual([g['allocated_bytes'] for g in gens],
+                         [r.allocated_bytes for r in traced])
+        self.assertTrue(all(r.allocated_bytes >= r.copy_as_array().nbytes for r in traced))
+        self.assertEqual(timeline.n_rays, sum(len(r) for r in traced))
+        self.assertTrue(all(g['trace_time'] > 0 for g in gens))
+        self.assertTrue(all(b['start'] >= a['start'] + a['trace_time']
+                            for a, b in zip(gens, gens[1:])))
+        #The input rays have neighbours, so each generation has them evaluated
+        self.assertTrue(all(g['neighbour_time'] > 0 for g in gens))
+        self.assertEqual(timeline.decomp_time, 0.0)
+
+        streamed = TraceTimeline()
+        list(iter_trace_rays(self.rays, self.face_lists, timeline=streamed))
+        self.assertEqual([g['n_rays'] for g in streamed.generations], [len(r) for r in traced])
+
+        retraced = TraceTimeline()
+        retrace_rays(traced, self.face_lists, 2, timeline=retraced)
+        self.assertEqual([g['n_rays'] for g in retraced.generations], [len(r) for r in traced])
+        self.assertEqual([g['trace_time'] > 0 for g in retraced.generations],
+                         [i >= 2 for i in range(len(traced))])
+
+        copy = TraceTimeline.from_traced_rays(traced)
+        self.assertEqual(copy.allocated_bytes, timeline.allocated_bytes)
+        self.assertEqual(copy.trace_time, 0.0)
+
+    def test_export(self):
+        timeline = TraceTimeline()
+        trace_rays(self.rays, self.face_lists, timeline=timeline)
+        data = json.loads(timeline.to_json())
+        self.assertEqual(data['generations'], timeline.generations)
+        self.assertEqual(data['allocated_bytes'], timeline.allocated_bytes)
+
+        events = json.loads(timeline.to_chrome_trace())['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X' and e['name'].startswith('generation')]
+        self.assertEqual(len(spans), len(timeline.generations))
+        for e, g in zip(spans, timeline.generations):
+            self.assertAlmostEqual(e['ts'], g['start']*1e6)
+            self.assertEqual(e['args']['n_rays'], g['n_rays'])
+        counters = [e for e in events if e['ph'] == 'C' and e['name'] == 'allocated_bytes']
+        self.assertEqual([e['args']['allocated_bytes'] for e in counters],
+                         [g['allocated_bytes'] for g in timeline.generations])
+
+    def test_decomposition(self):
+        def resample(rays):
+            time.sleep(0.01)
+            return GaussletCollection.from_array(rays.copy_as_array())
+        face = CircularFace(z_plane=30.0, material=ResampleGaussletMaterial(eval_func=resample))
+        face.diameter = 40.0
+        fl = FaceList()
+        fl.faces = [face]
+        src = CollimatedGaussletSource(origin=(0,0,0), direction=(0,0,1), radius=8.,
+                                       resolution=5, wavelength=1.0, beam_waist=10.0)
+        rays = src.input_rays
+        rays.wavelengths = numpy.array(src.wavelength_list)
+        timeline = TraceTimeline()
+        traced, faces = trace_rays(rays, [fl], timeline=timeline, recursion_limit=3)
+        self.assertGreater(len(traced[1]), 0)
+        decomp = timeline.generations[0]['decomp_time']
+        self.assertGreaterEqual(decomp, 0.01)
+        self.assertLessEqual(decomp, timeline.generations[0]['trace_time'])
+        names = [e['name'] for e in timeline.chrome_trace_events()]
+        self.assertIn("decomposition", names)
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+
+import unittest
+import numpy
+
+from raypier.core.cfields import sum_gaussian_modes, build_point_grid
+from raypier.core.fields import evaluate_neighbours_gc, evaluate_modes_c, EFieldSummation, \
+        eval_Efield_from_gausslets
+from raypier.core.ctracer import RayCollection
+from raypier.gausslet_sources import CollimatedGaussletSource
+
+
+def make_modes(resolution=8, direction=(0,0,1)):
+    src = CollimatedGaussletSource(origin=(0,0,0), direction=direction, radius=6., 
+                                   resolution=resolution, wavelength=1.0, beam_waist=8.0, 
+                                   E_vector=(1,0,0))
+    gausslets = src.input_rays
+    gausslets.wavelengths = numpy.array(src.wavelength_list)
+    rays, x, y, dx, dy = evaluate_neighbours_gc(gausslets.copy_as_array())
+    modes = evaluate_modes_c(x, y, dx, dy, blending=1.0)
+    return gausslets, RayCollection.from_array(rays), modes, numpy.array(src.wavelength_list)
+
+
+class TestTruncatedModes(unittest.TestCase):
+    def check(self, points, tolerance, direction=(0,0,1)):
+        gausslets, rays, modes, wavelengths = make_modes(direction=direction)
+        dense = sum_gaussian_modes(rays, modes, wavelengths, points, 0.0)
+        truncated = sum_gaussian_modes(rays, modes, wavelengths, points, 0.0, tolerance)
+        #Bounded by tolerance times the sum of the (unit) on-axis amplitudes
+        #of the few modes overlapping any point
+        err = numpy.abs(truncated - dense).max()/numpy.abs(dense).max()
+        self.assertLess(err, 5*tolerance)
+        self.assertTrue(numpy.abs(truncated).max() > 0)
+        return err
+    
+    def test_plane(self):
+        px = numpy.linspace(-8, 8, 60)
+        X, Y = numpy.meshgrid(px, px)
+        for z in (0.0, 30.0):
+            points = numpy.column_stack([X.ravel(), Y.ravel(), numpy.full(X.size, z)])
+            for tol in (1e-3, 1e-6):
+                self.check(points, tol)
+                
+    def test_tilted_plane_and_volume(self):
+        rng = numpy.random.default_rng(0)
+        u, v = rng.uniform(-8, 8, (2, 3000))
+        points = numpy.column_stack([u, v*0.8, 10 + v*0.6])
+        self.check(points, 1e-4, direction=(0, 0.2, 1))
+        points = rng.uniform(-8, 8, (3000, 3)) + [0, 0, 20]
+        self.check(points, 1e-4)
+        
+    def test_point_grid(self):
+        rng = numpy.random.default_rng(1)
+        points = numpy.column_stack([rng.uniform(0,10,500), rng.uniform(-1,1,500), 
+                                     numpy.full(500, 3.0)])
+        lo, size, shape, order, start = build_point_grid(points)
+        self.assertEqual(shape[2], 1)
+        self.assertEqual(sorted(order), list(range(500)))
+        self.assertEqual(start[-1], 500)
+        for cell in range(shape.prod()):
+            idx = numpy.unravel_index(cell, shape)
+            for i in order[start[cell]:start[cell+1]]:
+                ci = numpy.minimum(((points[i] - lo)//size).astype(int), shape-1)
+                self.assertEqual(tuple(ci), tuple(idx))
+                
+    def test_api(self):
+        gausslets, rays, modes, wavelengths = make_modes()
+        points = numpy.column_stack([numpy.linspace(-5, 5, 50), numpy.zeros(50), numpy.full(50, 5.0)])
+        dense = eval_Efield_from_gausslets(gausslets, points)
+        E = eval_Efield_from_gausslets(gausslets, points, tolerance=1e-6)
+        self.assertTrue(numpy.allclose(E, dense, atol=1e-5*numpy.abs(dense).max()))
+        E2 = EFieldSummation(gausslets, tolerance=1e-6).evaluate(points)
+        self.assertTrue(numpy.allclose(E2, E))
+        self.assertRaises(ValueError, sum_gaussian_modes, rays, modes, wavelengths, points, 
+                          0.0, 1.5)
+        self.assertEqual(sum_gaussian_modes(rays, modes, wavelengths, points[:0], 0.0,
+                                            1e-3).shape, (0, 3))
+
+    def test_num_threads(self):
+        gausslets, rays, modes, wavelengths = make_modes()
+        points = numpy.column_stack([numpy.linspace(-5, 5, 50), numpy.zeros(50), numpy.full(50, 5.0)])
+        E1 = sum_gaussian_modes(rays, modes, wavelengths, points, 0.0, 1e-4, num_threads=1)
+        E4 = sum_gaussian_modes(rays, modes, wavelengths, points, 0.0, 1e-4, num_threads=4)
+        self.assertTrue(numpy.allclose(E4, E1, rtol=1e-12, atol=1e-12*numpy.abs(E1).max()))
+
+
+if __name__=="__main__":
+    unittest.main()